@@ -4,19 +4,19 @@ import json
 import logging
 import mimetypes
 import os
+import tempfile
 import time
-from collections.abc import AsyncGenerator
+from collections.abc import AsyncGenerator, AsyncIterator, Awaitable, Iterator
+from json.encoder import encode_basestring
 from pathlib import Path
-from typing import Any, Union, cast
+from typing import Any, Callable, Optional, Union, cast
 
 from azure.cognitiveservices.speech import (
-    ResultReason,
     SpeechConfig,
     SpeechSynthesisOutputFormat,
-    SpeechSynthesisResult,
-    SpeechSynthesizer,
 )
-from azure.core.exceptions import ResourceNotFoundError
+from azure.core import MatchConditions
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
 from azure.identity.aio import (
     AzureDeveloperCliCredential,
     ManagedIdentityCredential,
@@ -26,11 +26,12 @@ from azure.monitor.opentelemetry import configure_azure_monitor
 from azure.search.documents.agent.aio import KnowledgeAgentRetrievalClient
 from azure.search.documents.aio import SearchClient
 from azure.search.documents.indexes.aio import SearchIndexClient
-from azure.storage.blob.aio import ContainerClient
+from azure.storage.blob.aio import BlobServiceClient, ContainerClient
 from azure.storage.blob.aio import StorageStreamDownloader as BlobDownloader
 from azure.storage.filedatalake.aio import FileSystemClient
 from azure.storage.filedatalake.aio import StorageStreamDownloader as DatalakeDownloader
 from openai import AsyncAzureOpenAI, AsyncOpenAI
+from openai.types.chat import ChatCompletionMessageParam
 from opentelemetry.instrumentation.aiohttp_client import AioHttpClientInstrumentor
 from opentelemetry.instrumentation.asgi import OpenTelemetryMiddleware
 from opentelemetry.instrumentation.httpx import (
@@ -45,21 +46,32 @@ from quart import (
     jsonify,
     make_response,
     request,
-    send_file,
     send_from_directory,
 )
 from quart_cors import cors
+from werkzeug.http import quote_etag, unquote_etag
 
+from approaches.answercache import AnswerCache
 from approaches.approach import Approach
 from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
 from approaches.chatreadretrievereadvision import ChatReadRetrieveReadVisionApproach
+from approaches.contextpacker import ContextPacker
+from approaches.embeddingcache import QueryEmbeddingCache
+from approaches.fairshare import FairShareScheduler
+from approaches.historywindow import HistoryManager
 from approaches.promptmanager import PromptyManager
+from approaches.requestcoalescer import RequestCoalescer
 from approaches.retrievethenread import RetrieveThenReadApproach
 from approaches.retrievethenreadvision import RetrieveThenReadVisionApproach
+from approaches.searchcache import SearchResultCache
+from approaches.thoughtstore import ThoughtStore
+from chat_history.conversationstore import ConversationStore
 from chat_history.cosmosdb import chat_history_cosmosdb_bp
 from config import (
+    CONFIG_ADMISSION_CONTROLLER,
     CONFIG_AGENT_CLIENT,
     CONFIG_AGENTIC_RETRIEVAL_ENABLED,
+    CONFIG_ANSWER_CACHE,
     CONFIG_ASK_APPROACH,
     CONFIG_ASK_VISION_APPROACH,
     CONFIG_AUTH_CLIENT,
@@ -68,14 +80,25 @@ from config import (
     CONFIG_CHAT_HISTORY_BROWSER_ENABLED,
     CONFIG_CHAT_HISTORY_COSMOS_ENABLED,
     CONFIG_CHAT_VISION_APPROACH,
+    CONFIG_CONTENT_FILE_CACHE,
+    CONFIG_CONTENT_SAS_PROVIDER,
+    CONFIG_CONTEXT_PACKER,
+    CONFIG_CONVERSATION_STORE,
     CONFIG_CREDENTIAL,
     CONFIG_DEFAULT_REASONING_EFFORT,
+    CONFIG_EMBEDDING_CACHE,
+    CONFIG_FAIR_SHARE_SCHEDULER,
     CONFIG_GPT4V_DEPLOYED,
+    CONFIG_HISTORY_MANAGER,
+    CONFIG_HTTP_SESSION_POOL,
     CONFIG_INGESTER,
     CONFIG_LANGUAGE_PICKER_ENABLED,
+    CONFIG_METRICS_ENABLED,
     CONFIG_OPENAI_CLIENT,
     CONFIG_QUERY_REWRITING_ENABLED,
     CONFIG_REASONING_EFFORT_ENABLED,
+    CONFIG_REQUEST_COALESCER,
+    CONFIG_SEARCH_CACHE,
     CONFIG_SEARCH_CLIENT,
     CONFIG_SEMANTIC_RANKER_DEPLOYED,
     CONFIG_SPEECH_INPUT_ENABLED,
@@ -85,15 +108,26 @@ from config import (
     CONFIG_SPEECH_SERVICE_LOCATION,
     CONFIG_SPEECH_SERVICE_TOKEN,
     CONFIG_SPEECH_SERVICE_VOICE,
+    CONFIG_SPEECH_SYNTHESIS_SERVICE,
+    CONFIG_STREAM_COALESCER,
     CONFIG_STREAMING_ENABLED,
+    CONFIG_THOUGHT_STORE,
     CONFIG_USER_BLOB_CONTAINER_CLIENT,
     CONFIG_USER_UPLOAD_ENABLED,
     CONFIG_VECTOR_SEARCH_ENABLED,
 )
+from core.admission import AdaptiveLimiter, AdmissionController, get_retry_after_seconds
 from core.authentication import AuthenticationHelper
+from core.blobsas import UserDelegationSasProvider
+from core.contentcache import CachedContentFile, ContentFileCache
+from core.groupcache import GroupMembershipCache
+from core.httpsession import HttpSessionPool
+from core.pathauthcache import PathAuthCache
 from core.sessionhelper import create_session_id
+from core.speechsynthesis import SpeechAudioCache, SpeechSynthesisService
+from core.streamcoalescer import DeltaCoalescer
 from decorators import authenticated, authenticated_path
-from error import error_dict, error_response
+from error import ERROR_MESSAGE_CONVERSATION_NOT_FOUND, error_dict, error_response
 
 from prepdocs import (
     clean_key_if_exists,
@@ -109,6 +143,9 @@ bp = Blueprint("routes", __name__, static_folder="static")
 mimetypes.add_type("application/javascript", ".js")
 mimetypes.add_type("text/css", ".css")
 
+# Size of the chunks in which /content downloads files from storage and streams them to the browser
+CONTENT_DOWNLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+
 
 @bp.route("/")
 async def index():
@@ -132,6 +169,46 @@ async def assets(path):
     return await send_from_directory(Path(__file__).resolve().parent / "static" / "assets", path)
 
 
+def content_file_sources(
+    path: str, auth_claims: dict[str, Any]
+) -> Iterator[tuple[str, Callable[..., Awaitable[Union[BlobDownloader, DatalakeDownloader]]]]]:
+    """
+    Yields the places a content file may be stored in, in the order they are searched,
+    as a key that identifies the file in that place and a function that downloads it from there
+    """
+    blob_container_client: ContainerClient = current_app.config[CONFIG_BLOB_CONTAINER_CLIENT]
+    yield f"blob/{path}", blob_container_client.get_blob_client(path).download_blob
+    if current_app.config[CONFIG_USER_UPLOAD_ENABLED]:
+        user_oid = auth_claims["oid"]
+        user_blob_container_client = current_app.config[CONFIG_USER_BLOB_CONTAINER_CLIENT]
+        user_directory_client: FileSystemClient = user_blob_container_client.get_directory_client(user_oid)
+        yield f"user/{user_oid}/{path}", user_directory_client.get_file_client(path).download_file
+
+
+async def send_cached_content_file(content_file_cache: ContentFileCache, cached_file: CachedContentFile):
+    response = current_app.response_class(
+        current_app.response_class.file_body_class(cached_file.file_path), content_type=cached_file.content_type
+    )
+    response.timeout = None  # type: ignore
+    response.content_length = cached_file.size
+    response.headers["ETag"] = cached_file.etag
+    if cached_file.last_modified:
+        response.last_modified = cached_file.last_modified
+    # The cached copy was just revalidated, so the client's own conditions and range can be evaluated locally
+    await response.make_conditional(request, accept_ranges=True, complete_length=cached_file.size)
+    content_file_cache.record_hit(response.content_length or 0)
+    return response
+
+
+def is_if_range_satisfied(blob: Union[BlobDownloader, DatalakeDownloader]) -> bool:
+    if_range = request.if_range
+    if if_range.etag:
+        return blob.properties.etag is not None and unquote_etag(blob.properties.etag)[0] == if_range.etag
+    if if_range.date:
+        return blob.properties.last_modified == if_range.date
+    return True
+
+
 @bp.route("/content/<path>")
 @authenticated_path
 async def content_file(path: str, auth_claims: dict[str, Any]):
@@ -140,7 +217,8 @@ async def content_file(path: str, auth_claims: dict[str, Any]):
     *** NOTE *** if you are using app services authentication, this route will return unauthorized to all users that are not logged in
     if AZURE_ENFORCE_ACCESS_CONTROL is not set or false, logged in users can access all files regardless of access control
     if AZURE_ENFORCE_ACCESS_CONTROL is set to true, logged in users can only access files they have access to
-    This is also slow and memory hungry.
+    The file is streamed in chunks, and single byte ranges and conditional requests are supported,
+    so browser PDF viewers only download the pages they show and unchanged files are not downloaded again.
     """
     # Remove page number from path, filename-1.txt -> filename.txt
     # This shouldn't typically be necessary as browsers don't send hash fragments to servers
@@ -148,33 +226,104 @@ async def content_file(path: str, auth_claims: dict[str, Any]):
         path_parts = path.rsplit("#page=", 1)
         path = path_parts[0]
     current_app.logger.info("Opening file %s", path)
-    blob_container_client: ContainerClient = current_app.config[CONFIG_BLOB_CONTAINER_CLIENT]
+
+    # Let the browser download shared files straight from storage, using a short-lived read-only URL
+    content_sas_provider: Optional[UserDelegationSasProvider] = current_app.config[CONFIG_CONTENT_SAS_PROVIDER]
+    if content_sas_provider:
+        blob_client = current_app.config[CONFIG_BLOB_CONTAINER_CLIENT].get_blob_client(path)
+        # Files uploaded by users are only looked up if the shared container doesn't have the file, and are still sent from here
+        if not current_app.config[CONFIG_USER_UPLOAD_ENABLED] or await blob_client.exists():
+            url = await content_sas_provider.generate_read_url(blob_client, content_type=mimetypes.guess_type(path)[0])
+            return current_app.redirect(url)
+
+    # Let storage evaluate conditional requests, so that unchanged files are never downloaded
+    condition_kwargs: dict[str, Any] = {}
+    if request.if_none_match:
+        if_none_match = request.if_none_match.as_set(include_weak=True)
+        if len(if_none_match) == 1 and not request.if_none_match.star_tag:
+            condition_kwargs = {"etag": quote_etag(if_none_match.pop()), "match_condition": MatchConditions.IfModified}
+    elif request.if_modified_since:
+        condition_kwargs = {"if_modified_since": request.if_modified_since}
+
+    # Only a single range with a known start is supported, as other ranges need the file size upfront
+    range_kwargs: dict[str, Any] = {}
+    byte_range = request.range
+    if byte_range and byte_range.units == "bytes" and len(byte_range.ranges) == 1 and byte_range.ranges[0][0] >= 0:
+        range_start, range_stop = byte_range.ranges[0]
+        range_kwargs = {"offset": range_start, "length": range_stop - range_start if range_stop is not None else None}
+
+    content_file_cache: Optional[ContentFileCache] = current_app.config[CONFIG_CONTENT_FILE_CACHE]
     blob: Union[BlobDownloader, DatalakeDownloader]
-    try:
-        blob = await blob_container_client.get_blob_client(path).download_blob()
-    except ResourceNotFoundError:
-        current_app.logger.info("Path not found in general Blob container: %s", path)
-        if current_app.config[CONFIG_USER_UPLOAD_ENABLED]:
-            try:
-                user_oid = auth_claims["oid"]
-                user_blob_container_client = current_app.config[CONFIG_USER_BLOB_CONTAINER_CLIENT]
-                user_directory_client: FileSystemClient = user_blob_container_client.get_directory_client(user_oid)
-                file_client = user_directory_client.get_file_client(path)
-                blob = await file_client.download_file()
-            except ResourceNotFoundError:
-                current_app.logger.exception("Path not found in DataLake: %s", path)
-                abort(404)
-        else:
-            abort(404)
+    for cache_key, download in content_file_sources(path, auth_claims):
+        cached_file = content_file_cache.get(cache_key) if content_file_cache else None
+        # A cached copy is revalidated with its own ETag, and only downloaded again if the file changed
+        download_condition_kwargs = (
+            {"etag": cached_file.etag, "match_condition": MatchConditions.IfModified}
+            if cached_file
+            else condition_kwargs
+        )
+        try:
+            blob = await download(**download_condition_kwargs, **range_kwargs)
+            if range_kwargs and not is_if_range_satisfied(blob):
+                # The file changed since the client fetched the first part of it, so send the whole file instead
+                blob = await download(**download_condition_kwargs)
+                range_kwargs = {}
+            break
+        except ResourceNotFoundError:
+            current_app.logger.info("Path not found in %s", cache_key)
+            if content_file_cache and cached_file:
+                content_file_cache.remove(cache_key)
+        except HttpResponseError as error:
+            # Storage reports unmodified files as errors, whose type depends on the error code it sends along
+            if error.status_code == 304:
+                if content_file_cache and cached_file:
+                    return await send_cached_content_file(content_file_cache, cached_file)
+                response = await make_response("", 304)
+                if "etag" in condition_kwargs:
+                    response.headers["ETag"] = condition_kwargs["etag"]
+                return response
+            if error.status_code == 416:
+                abort(416)
+            raise
+    else:
+        abort(404)
+    if content_file_cache:
+        content_file_cache.record_miss()
+        if cached_file:
+            content_file_cache.remove(cache_key)
     if not blob.properties or not blob.properties.has_key("content_settings"):
         abort(404)
     mime_type = blob.properties["content_settings"]["content_type"]
     if mime_type == "application/octet-stream":
         mime_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
-    blob_file = io.BytesIO()
-    await blob.readinto(blob_file)
-    blob_file.seek(0)
-    return await send_file(blob_file, mimetype=mime_type, as_attachment=False, attachment_filename=path)
+
+    chunks: AsyncIterator[bytes] = blob.chunks()
+    if content_file_cache and not range_kwargs and blob.properties.etag:
+        chunks = content_file_cache.store_while_streaming(
+            cache_key, chunks, blob.properties.etag, blob.properties.last_modified, mime_type, blob.size
+        )
+
+    async def stream_chunks() -> AsyncGenerator[bytes, None]:
+        async for chunk in chunks:
+            yield chunk
+
+    response = await make_response(stream_chunks())
+    response.timeout = None  # type: ignore
+    response.content_type = mime_type
+    response.content_length = blob.size
+    response.accept_ranges = "bytes"
+    if blob.properties.etag:
+        response.headers["ETag"] = blob.properties.etag
+    if blob.properties.last_modified:
+        response.last_modified = blob.properties.last_modified
+    if range_kwargs:
+        # Data Lake downloads don't report the size of the whole file, which is allowed to be unknown
+        content_range = getattr(blob.properties, "content_range", None)
+        file_size = content_range.rsplit("/", 1)[-1] if content_range else "*"
+        range_end = range_kwargs["offset"] + blob.size - 1
+        response.status_code = 206
+        response.headers["Content-Range"] = f"bytes {range_kwargs['offset']}-{range_end}/{file_size}"
+    return response
 
 
 @bp.route("/ask", methods=["POST"])
@@ -192,9 +341,16 @@ async def ask(auth_claims: dict[str, Any]):
             approach = cast(Approach, current_app.config[CONFIG_ASK_VISION_APPROACH])
         else:
             approach = cast(Approach, current_app.config[CONFIG_ASK_APPROACH])
-        r = await approach.run(
-            request_json["messages"], context=context, session_state=request_json.get("session_state")
-        )
+        if request_coalescer := current_app.config.get(CONFIG_REQUEST_COALESCER):
+            r = await request_coalescer.run(
+                approach, request_json["messages"], context, session_state=request_json.get("session_state")
+            )
+        else:
+            r = await approach.run(
+                request_json["messages"], context=context, session_state=request_json.get("session_state")
+            )
+        if thought_store := current_app.config.get(CONFIG_THOUGHT_STORE):
+            r = await thought_store.compact_response(r, auth_claims.get("oid"))
         return jsonify(r)
     except Exception as error:
         return error_response(error, "/ask")
@@ -203,19 +359,165 @@ async def ask(auth_claims: dict[str, Any]):
 class JSONEncoder(json.JSONEncoder):
     def default(self, o):
         if dataclasses.is_dataclass(o) and not isinstance(o, type):
-            return dataclasses.asdict(o)
+            # Nested dataclasses are converted once the encoder reaches them, which saves the deep copy of asdict
+            return {field.name: getattr(o, field.name) for field in dataclasses.fields(o)}
         return super().default(o)
 
 
+NDJSON_ENCODER = JSONEncoder(ensure_ascii=False)
+# Content deltas make up almost every line of a streamed answer, so their lines are put together
+# from pre-serialized parts instead of going through the encoder
+NDJSON_DELTA_PREFIX = '{"delta": {"content": '
+NDJSON_DELTA_SUFFIXES = {role: ', "role": ' + json.dumps(role) + "}}\n" for role in ("assistant", None)}
+
+
+def format_event_as_ndjson(event: dict) -> str:
+    if len(event) == 1 and (delta := event.get("delta")) and tuple(delta) == ("content", "role"):
+        content = delta["content"]
+        suffix = NDJSON_DELTA_SUFFIXES.get(delta["role"])
+        if suffix and isinstance(content, str):
+            return NDJSON_DELTA_PREFIX + encode_basestring(content) + suffix
+        if suffix and content is None:
+            return NDJSON_DELTA_PREFIX + "null" + suffix
+    return NDJSON_ENCODER.encode(event) + "\n"
+
+
 async def format_as_ndjson(r: AsyncGenerator[dict, None]) -> AsyncGenerator[str, None]:
     try:
         async for event in r:
-            yield json.dumps(event, ensure_ascii=False, cls=JSONEncoder) + "\n"
+            yield format_event_as_ndjson(event)
     except Exception as error:
         logging.exception("Exception while generating response stream: %s", error)
         yield json.dumps(error_dict(error))
 
 
+async def start_stream(events: AsyncGenerator[dict, None]) -> AsyncGenerator[dict, None]:
+    """
+    Waits for the first event of a stream before the response starts, so that a stream shed by admission control
+    still gets a 503 with Retry-After. Any other error is left to the stream, as before.
+    """
+    first_events: list[dict] = []
+    stream_error: Optional[Exception] = None
+    try:
+        first_events.append(await events.__anext__())
+    except StopAsyncIteration:
+        pass
+    except Exception as error:
+        if get_retry_after_seconds(error) is not None:
+            raise
+        stream_error = error
+
+    async def resume() -> AsyncGenerator[dict, None]:
+        if stream_error:
+            raise stream_error
+        for event in first_events:
+            yield event
+        async for event in events:
+            yield event
+
+    return resume()
+
+
+async def get_conversation_messages(
+    conversation_store: ConversationStore,
+    messages: list[ChatCompletionMessageParam],
+    context: dict[str, Any],
+    entra_oid: Optional[str],
+    session_id: str,
+) -> Optional[list[ChatCompletionMessageParam]]:
+    """
+    Puts the conversation kept on the server in front of the new message, when the client only sent that
+    (with the number of earlier messages it has in "history_length"). Returns None when the server
+    doesn't have the whole conversation, so that the client sends it instead.
+    """
+    history_length = int(context.pop("history_length", None) or 0)
+    if not history_length:
+        return messages
+    history = await conversation_store.get_messages(entra_oid, session_id)
+    if history is None or len(history) < history_length:
+        return None
+    return history[:history_length] + messages
+
+
+async def save_conversation_turn(
+    conversation_store: ConversationStore,
+    entra_oid: Optional[str],
+    session_id: str,
+    messages: list[ChatCompletionMessageParam],
+    response: dict[str, Any],
+) -> None:
+    try:
+        await conversation_store.save_turn(entra_oid, session_id, messages, response)
+    except Exception as error:
+        # The answer was already given, so the request doesn't fail over it
+        logging.exception("Exception while saving conversation turn: %s", error)
+
+
+async def save_conversation_turn_after_stream(
+    events: AsyncGenerator[dict, None],
+    conversation_store: ConversationStore,
+    entra_oid: Optional[str],
+    session_id: str,
+    messages: list[ChatCompletionMessageParam],
+) -> AsyncGenerator[dict, None]:
+    """
+    Saves the turn once the answer was streamed whole, putting the response together from the events
+    the same way the client does
+    """
+    response: dict[str, Any] = {}
+    answer_content = []
+    async for event in events:
+        yield event
+        if "context" in event:
+            event_json = json.loads(NDJSON_ENCODER.encode(event))
+            if "data_points" in event_json["context"]:
+                response = event_json
+            elif response:
+                response["context"] = response["context"] | event_json["context"]
+        elif (delta := event.get("delta")) and delta.get("content"):
+            answer_content.append(delta["content"])
+    if response:
+        response["message"] = {"content": "".join(answer_content), "role": response["delta"].get("role")}
+        await save_conversation_turn(conversation_store, entra_oid, session_id, messages, response)
+
+
+@bp.route("/ask/stream", methods=["POST"])
+@authenticated
+async def ask_stream(auth_claims: dict[str, Any]):
+    if not request.is_json:
+        return jsonify({"error": "request must be json"}), 415
+    request_json = await request.get_json()
+    context = request_json.get("context", {})
+    context["auth_claims"] = auth_claims
+    try:
+        use_gpt4v = context.get("overrides", {}).get("use_gpt4v", False)
+        approach: Approach
+        if use_gpt4v and CONFIG_ASK_VISION_APPROACH in current_app.config:
+            approach = cast(Approach, current_app.config[CONFIG_ASK_VISION_APPROACH])
+        else:
+            approach = cast(Approach, current_app.config[CONFIG_ASK_APPROACH])
+        if request_coalescer := current_app.config.get(CONFIG_REQUEST_COALESCER):
+            result = await request_coalescer.run_stream(
+                approach, request_json["messages"], context, session_state=request_json.get("session_state")
+            )
+        else:
+            result = await approach.run_stream(
+                request_json["messages"], context=context, session_state=request_json.get("session_state")
+            )
+        if current_app.config.get(CONFIG_ADMISSION_CONTROLLER):
+            result = await start_stream(result)
+        if thought_store := current_app.config.get(CONFIG_THOUGHT_STORE):
+            result = thought_store.compact_events(result, auth_claims.get("oid"))
+        if stream_coalescer := current_app.config.get(CONFIG_STREAM_COALESCER):
+            result = stream_coalescer.coalesce(result)
+        response = await make_response(format_as_ndjson(result))
+        response.timeout = None  # type: ignore
+        response.mimetype = "application/json-lines"
+        return response
+    except Exception as error:
+        return error_response(error, "/ask")
+
+
 @bp.route("/chat", methods=["POST"])
 @authenticated
 async def chat(auth_claims: dict[str, Any]):
@@ -235,16 +537,38 @@ async def chat(auth_claims: dict[str, Any]):
         # If session state is provided, persists the session state,
         # else creates a new session_id depending on the chat history options enabled.
         session_state = request_json.get("session_state")
+        conversation_store: Optional[ConversationStore] = current_app.config.get(CONFIG_CONVERSATION_STORE)
         if session_state is None:
             session_state = create_session_id(
                 current_app.config[CONFIG_CHAT_HISTORY_COSMOS_ENABLED],
-                current_app.config[CONFIG_CHAT_HISTORY_BROWSER_ENABLED],
+                current_app.config[CONFIG_CHAT_HISTORY_BROWSER_ENABLED] or conversation_store is not None,
             )
-        result = await approach.run(
-            request_json["messages"],
-            context=context,
-            session_state=session_state,
-        )
+        messages = request_json["messages"]
+        if conversation_store and isinstance(session_state, str):
+            conversation_messages = await get_conversation_messages(
+                conversation_store, messages, context, auth_claims.get("oid"), session_state
+            )
+            if conversation_messages is None:
+                return jsonify({"error": ERROR_MESSAGE_CONVERSATION_NOT_FOUND}), 409
+            messages = conversation_messages
+        if request_coalescer := current_app.config.get(CONFIG_REQUEST_COALESCER):
+            result = await request_coalescer.run(approach, messages, context, session_state)
+        else:
+            result = await approach.run(
+                messages,
+                context=context,
+                session_state=session_state,
+            )
+        if conversation_store and isinstance(session_state, str):
+            await save_conversation_turn(
+                conversation_store,
+                auth_claims.get("oid"),
+                session_state,
+                messages,
+                json.loads(NDJSON_ENCODER.encode(result)),
+            )
+        if thought_store := current_app.config.get(CONFIG_THOUGHT_STORE):
+            result = await thought_store.compact_response(result, auth_claims.get("oid"))
         return jsonify(result)
     except Exception as error:
         return error_response(error, "/chat")
@@ -269,16 +593,38 @@ async def chat_stream(auth_claims: dict[str, Any]):
         # If session state is provided, persists the session state,
         # else creates a new session_id depending on the chat history options enabled.
         session_state = request_json.get("session_state")
+        conversation_store: Optional[ConversationStore] = current_app.config.get(CONFIG_CONVERSATION_STORE)
         if session_state is None:
             session_state = create_session_id(
                 current_app.config[CONFIG_CHAT_HISTORY_COSMOS_ENABLED],
-                current_app.config[CONFIG_CHAT_HISTORY_BROWSER_ENABLED],
+                current_app.config[CONFIG_CHAT_HISTORY_BROWSER_ENABLED] or conversation_store is not None,
             )
-        result = await approach.run_stream(
-            request_json["messages"],
-            context=context,
-            session_state=session_state,
-        )
+        messages = request_json["messages"]
+        if conversation_store and isinstance(session_state, str):
+            conversation_messages = await get_conversation_messages(
+                conversation_store, messages, context, auth_claims.get("oid"), session_state
+            )
+            if conversation_messages is None:
+                return jsonify({"error": ERROR_MESSAGE_CONVERSATION_NOT_FOUND}), 409
+            messages = conversation_messages
+        if request_coalescer := current_app.config.get(CONFIG_REQUEST_COALESCER):
+            result = await request_coalescer.run_stream(approach, messages, context, session_state)
+        else:
+            result = await approach.run_stream(
+                messages,
+                context=context,
+                session_state=session_state,
+            )
+        if conversation_store and isinstance(session_state, str):
+            result = save_conversation_turn_after_stream(
+                result, conversation_store, auth_claims.get("oid"), session_state, messages
+            )
+        if current_app.config.get(CONFIG_ADMISSION_CONTROLLER):
+            result = await start_stream(result)
+        if thought_store := current_app.config.get(CONFIG_THOUGHT_STORE):
+            result = thought_store.compact_events(result, auth_claims.get("oid"))
+        if stream_coalescer := current_app.config.get(CONFIG_STREAM_COALESCER):
+            result = stream_coalescer.coalesce(result)
         response = await make_response(format_as_ndjson(result))
         response.timeout = None  # type: ignore
         response.mimetype = "application/json-lines"
@@ -312,11 +658,82 @@ def config():
             "showSpeechOutputAzure": current_app.config[CONFIG_SPEECH_OUTPUT_AZURE_ENABLED],
             "showChatHistoryBrowser": current_app.config[CONFIG_CHAT_HISTORY_BROWSER_ENABLED],
             "showChatHistoryCosmos": current_app.config[CONFIG_CHAT_HISTORY_COSMOS_ENABLED],
+            "serverConversationState": current_app.config.get(CONFIG_CONVERSATION_STORE) is not None,
             "showAgenticRetrievalOption": current_app.config[CONFIG_AGENTIC_RETRIEVAL_ENABLED],
         }
     )
 
 
+@bp.route("/metrics", methods=["GET"])
+@authenticated
+async def metrics(auth_claims: dict[str, Any]):
+    # The statistics tell about the users of the app and the services behind it, so they are only served when enabled
+    if not current_app.config[CONFIG_METRICS_ENABLED]:
+        abort(404)
+    metrics: dict[str, Any] = {}
+    if answer_cache := current_app.config.get(CONFIG_ANSWER_CACHE):
+        metrics["answer_cache"] = answer_cache.stats()
+    if embedding_cache := current_app.config.get(CONFIG_EMBEDDING_CACHE):
+        metrics["embedding_cache"] = embedding_cache.stats()
+    if search_cache := current_app.config.get(CONFIG_SEARCH_CACHE):
+        metrics["search_cache"] = search_cache.stats()
+    if content_file_cache := current_app.config.get(CONFIG_CONTENT_FILE_CACHE):
+        metrics["content_file_cache"] = content_file_cache.stats()
+    if content_sas_provider := current_app.config.get(CONFIG_CONTENT_SAS_PROVIDER):
+        metrics["content_sas"] = content_sas_provider.stats()
+    auth_helper = current_app.config[CONFIG_AUTH_CLIENT]
+    if auth_helper.use_authentication:
+        metrics["auth"] = auth_helper.stats()
+    if path_auth_cache := auth_helper.path_auth_cache:
+        metrics["path_auth_cache"] = path_auth_cache.stats()
+    if group_cache := auth_helper.group_cache:
+        metrics["group_cache"] = group_cache.stats()
+    metrics["http_session_pool"] = current_app.config[CONFIG_HTTP_SESSION_POOL].stats()
+    if admission_controller := current_app.config.get(CONFIG_ADMISSION_CONTROLLER):
+        metrics["admission"] = admission_controller.stats()
+    if chat_scheduler := current_app.config.get(CONFIG_FAIR_SHARE_SCHEDULER):
+        metrics["fair_share"] = chat_scheduler.stats()
+    if context_packer := current_app.config.get(CONFIG_CONTEXT_PACKER):
+        metrics["context_packing"] = context_packer.stats()
+    if history_manager := current_app.config.get(CONFIG_HISTORY_MANAGER):
+        metrics["history_window"] = history_manager.stats()
+    if conversation_store := current_app.config.get(CONFIG_CONVERSATION_STORE):
+        metrics["conversation_state"] = conversation_store.stats()
+    if thought_store := current_app.config.get(CONFIG_THOUGHT_STORE):
+        metrics["thought_store"] = thought_store.stats()
+    if stream_coalescer := current_app.config.get(CONFIG_STREAM_COALESCER):
+        metrics["stream_coalescing"] = stream_coalescer.stats()
+    if request_coalescer := current_app.config.get(CONFIG_REQUEST_COALESCER):
+        metrics["request_coalescing"] = request_coalescer.stats()
+    if speech_synthesis_service := current_app.config.get(CONFIG_SPEECH_SYNTHESIS_SERVICE):
+        metrics["speech"] = speech_synthesis_service.stats()
+    metrics["query_rewrite"] = current_app.config[CONFIG_CHAT_APPROACH].query_rewrite_stats()
+    return jsonify(metrics)
+
+
+@bp.route("/thoughts/<thoughts_id>", methods=["GET"])
+@authenticated
+async def thoughts(auth_claims: dict[str, Any], thoughts_id: str):
+    thought_store: Optional[ThoughtStore] = current_app.config.get(CONFIG_THOUGHT_STORE)
+    if thought_store is None:
+        abort(404)
+    # Thoughts of other users are reported as missing, so their ids can't be probed
+    thought_steps = await thought_store.get(thoughts_id, auth_claims.get("oid"))
+    if thought_steps is None:
+        abort(404)
+    return jsonify({"thoughts": thought_steps})
+
+
+@bp.route("/usage", methods=["GET"])
+@authenticated
+async def usage(auth_claims: dict[str, Any]):
+    chat_scheduler: Optional[FairShareScheduler] = current_app.config.get(CONFIG_FAIR_SHARE_SCHEDULER)
+    if chat_scheduler is None:
+        abort(404)
+    # Every user only sees their own usage
+    return jsonify({"usage": chat_scheduler.user_stats(auth_claims.get("oid"))})
+
+
 @bp.route("/speech", methods=["POST"])
 async def speech():
     if not request.is_json:
@@ -343,23 +760,23 @@ async def speech():
         speech_config = SpeechConfig(auth_token=auth_token, region=current_app.config[CONFIG_SPEECH_SERVICE_LOCATION])
         speech_config.speech_synthesis_voice_name = current_app.config[CONFIG_SPEECH_SERVICE_VOICE]
         speech_config.speech_synthesis_output_format = SpeechSynthesisOutputFormat.Audio16Khz32KBitRateMonoMp3
-        synthesizer = SpeechSynthesizer(speech_config=speech_config, audio_config=None)
-        result: SpeechSynthesisResult = synthesizer.speak_text_async(text).get()
-        if result.reason == ResultReason.SynthesizingAudioCompleted:
-            return result.audio_data, 200, {"Content-Type": "audio/mp3"}
-        elif result.reason == ResultReason.Canceled:
-            cancellation_details = result.cancellation_details
-            current_app.logger.error(
-                "Speech synthesis canceled: %s %s", cancellation_details.reason, cancellation_details.error_details
-            )
-            raise Exception("Speech synthesis canceled. Check logs for details.")
-        else:
-            current_app.logger.error("Unexpected result reason: %s", result.reason)
-            raise Exception("Speech synthesis failed. Check logs for details.")
+        speech_synthesis_service: SpeechSynthesisService = current_app.config[CONFIG_SPEECH_SYNTHESIS_SERVICE]
+        audio_chunks = speech_synthesis_service.synthesize(speech_config, text)
+        # Waiting for the first piece of audio means that failures to start the synthesis still get an error status
+        first_chunk = await audio_chunks.__anext__()
     except Exception as e:
         current_app.logger.exception("Exception in /speech")
         return jsonify({"error": str(e)}), 500
 
+    async def stream_audio() -> AsyncGenerator[bytes, None]:
+        yield first_chunk
+        async for chunk in audio_chunks:
+            yield chunk
+
+    response = await make_response(stream_audio(), 200, {"Content-Type": "audio/mp3"})
+    response.timeout = None  # type: ignore
+    return response
+
 
 @bp.post("/upload")
 @authenticated
@@ -483,12 +900,31 @@ async def setup_clients():
     USE_GPT4V = os.getenv("USE_GPT4V", "").lower() == "true"
     USE_USER_UPLOAD = os.getenv("USE_USER_UPLOAD", "").lower() == "true"
     ENABLE_LANGUAGE_PICKER = os.getenv("ENABLE_LANGUAGE_PICKER", "").lower() == "true"
+    ENABLE_METRICS_ENDPOINT = os.getenv("ENABLE_METRICS_ENDPOINT", "").lower() == "true"
     USE_SPEECH_INPUT_BROWSER = os.getenv("USE_SPEECH_INPUT_BROWSER", "").lower() == "true"
     USE_SPEECH_OUTPUT_BROWSER = os.getenv("USE_SPEECH_OUTPUT_BROWSER", "").lower() == "true"
     USE_SPEECH_OUTPUT_AZURE = os.getenv("USE_SPEECH_OUTPUT_AZURE", "").lower() == "true"
+    USE_SPEECH_AUDIO_CACHE = os.getenv("USE_SPEECH_AUDIO_CACHE", "").lower() == "true"
     USE_CHAT_HISTORY_BROWSER = os.getenv("USE_CHAT_HISTORY_BROWSER", "").lower() == "true"
     USE_CHAT_HISTORY_COSMOS = os.getenv("USE_CHAT_HISTORY_COSMOS", "").lower() == "true"
     USE_AGENTIC_RETRIEVAL = os.getenv("USE_AGENTIC_RETRIEVAL", "").lower() == "true"
+    USE_ANSWER_CACHE = os.getenv("USE_ANSWER_CACHE", "").lower() == "true"
+    USE_COMPACT_RESPONSES = os.getenv("USE_COMPACT_RESPONSES", "").lower() == "true"
+    USE_STREAM_COALESCING = os.getenv("USE_STREAM_COALESCING", "").lower() == "true"
+    USE_REQUEST_COALESCING = os.getenv("USE_REQUEST_COALESCING", "").lower() == "true"
+    USE_ADMISSION_CONTROL = os.getenv("USE_ADMISSION_CONTROL", "").lower() == "true"
+    USE_FAIR_SHARE_SCHEDULER = os.getenv("USE_FAIR_SHARE_SCHEDULER", "").lower() == "true"
+    USE_CONTEXT_PACKING = os.getenv("USE_CONTEXT_PACKING", "").lower() == "true"
+    USE_HISTORY_WINDOW = os.getenv("USE_HISTORY_WINDOW", "").lower() == "true"
+    QUERY_EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("QUERY_EMBEDDING_CACHE_MAX_ENTRIES") or 1000)
+    USE_SEARCH_RESULT_CACHE = os.getenv("USE_SEARCH_RESULT_CACHE", "").lower() == "true"
+    USE_CONTENT_FILE_CACHE = os.getenv("USE_CONTENT_FILE_CACHE", "").lower() == "true"
+    USE_CONTENT_SAS_REDIRECT = os.getenv("USE_CONTENT_SAS_REDIRECT", "").lower() == "true"
+    USE_PATH_AUTH_CACHE = os.getenv("USE_PATH_AUTH_CACHE", "").lower() == "true"
+    USE_GROUP_CACHE = os.getenv("USE_GROUP_CACHE", "").lower() == "true"
+    USE_SPECULATIVE_SEARCH = os.getenv("USE_SPECULATIVE_SEARCH", "").lower() == "true"
+    QUERY_REWRITE_MAX_SKIPPED_HISTORY = os.getenv("QUERY_REWRITE_MAX_SKIPPED_HISTORY")
+    USE_CHAT_STREAM_PROGRESS = os.getenv("USE_CHAT_STREAM_PROGRESS", "").lower() == "true"
 
     # WEBSITE_HOSTNAME is always set by App Service, RUNNING_IN_PRODUCTION is set in main.bicep
     RUNNING_ON_AZURE = os.getenv("WEBSITE_HOSTNAME") is not None or os.getenv("RUNNING_IN_PRODUCTION") is not None
@@ -521,18 +957,58 @@ async def setup_clients():
     # Set the Azure credential in the app config for use in other parts of the app
     current_app.config[CONFIG_CREDENTIAL] = azure_credential
 
+    admission_controller = None
+    openai_http_client = None
+    if USE_ADMISSION_CONTROL:
+        current_app.logger.info("USE_ADMISSION_CONTROL is true, setting up concurrency limits for downstream calls")
+
+        def create_limiter(downstream: str, max_concurrency: int) -> AdaptiveLimiter:
+            latency_target_ms = os.getenv(f"ADMISSION_{downstream.upper()}_LATENCY_TARGET_MS")
+            return AdaptiveLimiter(
+                downstream,
+                max_limit=int(os.getenv(f"ADMISSION_{downstream.upper()}_MAX_CONCURRENCY") or max_concurrency),
+                max_queue=int(os.getenv("ADMISSION_MAX_QUEUE") or 100),
+                queue_timeout_seconds=float(os.getenv("ADMISSION_QUEUE_TIMEOUT_SECONDS") or 10),
+                latency_target_seconds=int(latency_target_ms) / 1000 if latency_target_ms else None,
+            )
+
+        admission_controller = AdmissionController(
+            {
+                "chat": create_limiter("chat", 32),
+                "embeddings": create_limiter("embeddings", 32),
+                "search": create_limiter("search", 32),
+                "storage": create_limiter("storage", 64),
+                "cosmos": create_limiter("cosmos", 64),
+            }
+        )
+        openai_http_client = admission_controller.openai_http_client()
+    current_app.config[CONFIG_ADMISSION_CONTROLLER] = admission_controller
+
+    def admission_transport(downstream: str) -> dict[str, Any]:
+        # Azure SDK clients take their transport as a keyword argument
+        return {"transport": admission_controller.azure_transport(downstream)} if admission_controller else {}
+
     # Set up clients for AI Search and Storage
     search_client = SearchClient(
         endpoint=AZURE_SEARCH_ENDPOINT,
         index_name=AZURE_SEARCH_INDEX,
         credential=azure_credential,
+        **admission_transport("search"),
     )
     agent_client = KnowledgeAgentRetrievalClient(
-        endpoint=AZURE_SEARCH_ENDPOINT, agent_name=AZURE_SEARCH_AGENT, credential=azure_credential
+        endpoint=AZURE_SEARCH_ENDPOINT,
+        agent_name=AZURE_SEARCH_AGENT,
+        credential=azure_credential,
+        **admission_transport("search"),
     )
 
+    # The first request of a download buffers up to 32 MiB by default, which would defeat streaming in /content
     blob_container_client = ContainerClient(
-        f"https://{AZURE_STORAGE_ACCOUNT}.blob.core.windows.net", AZURE_STORAGE_CONTAINER, credential=azure_credential
+        f"https://{AZURE_STORAGE_ACCOUNT}.blob.core.windows.net",
+        AZURE_STORAGE_CONTAINER,
+        credential=azure_credential,
+        max_single_get_size=CONTENT_DOWNLOAD_CHUNK_SIZE,
+        **admission_transport("storage"),
     )
 
     # Set up authentication helper
@@ -545,6 +1021,30 @@ async def setup_clients():
         )
         search_index = await search_index_client.get_index(AZURE_SEARCH_INDEX)
         await search_index_client.close()
+
+    # One pooled session for the HTTP calls the backend makes itself (Graph, JWKS, Vision, Content Understanding)
+    http_session_pool = HttpSessionPool(
+        limit=int(os.getenv("HTTP_POOL_LIMIT") or 100),
+        limit_per_host=int(os.getenv("HTTP_POOL_LIMIT_PER_HOST") or 20),
+    )
+    current_app.config[CONFIG_HTTP_SESSION_POOL] = http_session_pool
+
+    path_auth_cache = None
+    if USE_PATH_AUTH_CACHE:
+        current_app.logger.info("USE_PATH_AUTH_CACHE is true, setting up path authorization cache")
+        path_auth_cache = PathAuthCache(
+            max_entries=int(os.getenv("PATH_AUTH_CACHE_MAX_ENTRIES") or 10000),
+            ttl_seconds=float(os.getenv("PATH_AUTH_CACHE_TTL_SECONDS") or 60),
+        )
+
+    group_cache = None
+    if USE_GROUP_CACHE:
+        current_app.logger.info("USE_GROUP_CACHE is true, setting up group membership cache")
+        group_cache = GroupMembershipCache(
+            ttl_seconds=float(os.getenv("GROUP_CACHE_TTL_SECONDS") or 300),
+            max_stale_seconds=float(os.getenv("GROUP_CACHE_MAX_STALE_SECONDS") or 3600),
+        )
+
     auth_helper = AuthenticationHelper(
         search_index=search_index,
         use_authentication=AZURE_USE_AUTHENTICATION,
@@ -555,7 +1055,142 @@ async def setup_clients():
         require_access_control=AZURE_ENFORCE_ACCESS_CONTROL,
         enable_global_documents=AZURE_ENABLE_GLOBAL_DOCUMENT_ACCESS,
         enable_unauthenticated_access=AZURE_ENABLE_UNAUTHENTICATED_ACCESS,
+        path_auth_cache=path_auth_cache,
+        obo_max_workers=int(os.getenv("AUTH_OBO_MAX_WORKERS") or 8),
+        group_cache=group_cache,
+        http_session=http_session_pool.session,
+    )
+    auth_helper.start()
+
+    answer_cache = None
+    if USE_ANSWER_CACHE:
+        current_app.logger.info("USE_ANSWER_CACHE is true, setting up answer cache")
+        answer_cache_similarity_threshold = os.getenv("ANSWER_CACHE_SIMILARITY_THRESHOLD")
+        answer_cache = AnswerCache(
+            max_entries=int(os.getenv("ANSWER_CACHE_MAX_ENTRIES") or 1000),
+            ttl_seconds=float(os.getenv("ANSWER_CACHE_TTL_SECONDS") or 3600),
+            similarity_threshold=(
+                float(answer_cache_similarity_threshold) if answer_cache_similarity_threshold else None
+            ),
+        )
+    current_app.config[CONFIG_ANSWER_CACHE] = answer_cache
+
+    thought_store = None
+    if USE_COMPACT_RESPONSES:
+        current_app.logger.info("USE_COMPACT_RESPONSES is true, setting up thought store")
+        thought_store = ThoughtStore(
+            max_entries=int(os.getenv("THOUGHT_STORE_MAX_ENTRIES") or 1000),
+            ttl_seconds=float(os.getenv("THOUGHT_STORE_TTL_SECONDS") or 3600),
+            # Shared by the workers of the instance, so any of them can return the thoughts of an answer
+            directory=os.getenv("THOUGHT_STORE_DIR") or Path(tempfile.gettempdir()) / "thought-store",
+        )
+    current_app.config[CONFIG_THOUGHT_STORE] = thought_store
+
+    stream_coalescer = None
+    if USE_STREAM_COALESCING:
+        current_app.logger.info("USE_STREAM_COALESCING is true, setting up delta coalescing for streamed answers")
+        stream_coalescer = DeltaCoalescer(
+            window_seconds=int(os.getenv("STREAM_COALESCING_WINDOW_MS") or 40) / 1000,
+            max_chars=int(os.getenv("STREAM_COALESCING_MAX_CHARS") or 200),
+        )
+    current_app.config[CONFIG_STREAM_COALESCER] = stream_coalescer
+
+    request_coalescer = None
+    if USE_REQUEST_COALESCING:
+        current_app.logger.info("USE_REQUEST_COALESCING is true, setting up coalescing of identical requests")
+        request_coalescer = RequestCoalescer()
+    current_app.config[CONFIG_REQUEST_COALESCER] = request_coalescer
+
+    chat_scheduler = None
+    if USE_FAIR_SHARE_SCHEDULER:
+        current_app.logger.info("USE_FAIR_SHARE_SCHEDULER is true, setting up fair sharing of chat completions")
+        fair_share_burst_tokens = os.getenv("FAIR_SHARE_BURST_TOKENS")
+        # Formatted as oid=weight pairs separated by commas, users not listed have a weight of 1
+        fair_share_weights = {
+            oid.strip(): int(weight)
+            for oid, weight in (
+                pair.split("=") for pair in (os.getenv("FAIR_SHARE_WEIGHTS") or "").split(",") if pair.strip()
+            )
+        }
+        chat_scheduler = FairShareScheduler(
+            max_concurrency=int(os.getenv("FAIR_SHARE_MAX_CONCURRENCY") or 16),
+            tokens_per_minute=int(os.getenv("FAIR_SHARE_TOKENS_PER_MINUTE") or 40000),
+            burst_tokens=int(fair_share_burst_tokens) if fair_share_burst_tokens else None,
+            weights=fair_share_weights,
+        )
+    current_app.config[CONFIG_FAIR_SHARE_SCHEDULER] = chat_scheduler
+
+    context_packer = None
+    if USE_CONTEXT_PACKING:
+        current_app.logger.info("USE_CONTEXT_PACKING is true, setting up token budget for answer prompts")
+        context_packer = ContextPacker(
+            max_prompt_tokens=int(os.getenv("CONTEXT_PACKING_MAX_PROMPT_TOKENS") or 8000),
+            min_source_tokens=int(os.getenv("CONTEXT_PACKING_MIN_SOURCE_TOKENS") or 100),
+        )
+    current_app.config[CONFIG_CONTEXT_PACKER] = context_packer
+
+    history_manager = None
+    if USE_HISTORY_WINDOW:
+        current_app.logger.info("USE_HISTORY_WINDOW is true, setting up token budgets for conversation history")
+        history_manager = HistoryManager(
+            rewrite_max_tokens=int(os.getenv("HISTORY_REWRITE_MAX_TOKENS") or 1000),
+            answer_max_tokens=int(os.getenv("HISTORY_ANSWER_MAX_TOKENS") or 3000),
+            max_turns=int(os.getenv("HISTORY_MAX_TURNS") or 6),
+            summary_max_tokens=int(os.getenv("HISTORY_SUMMARY_MAX_TOKENS") or 300),
+            max_entries=int(os.getenv("HISTORY_SUMMARY_CACHE_MAX_ENTRIES") or 1000),
+            ttl_seconds=float(os.getenv("HISTORY_SUMMARY_CACHE_TTL_SECONDS") or 3600),
+        )
+    current_app.config[CONFIG_HISTORY_MANAGER] = history_manager
+
+    # Query embeddings never go stale, so they are cached unless explicitly disabled with a size of 0
+    embedding_cache = (
+        QueryEmbeddingCache(max_entries=QUERY_EMBEDDING_CACHE_MAX_ENTRIES)
+        if QUERY_EMBEDDING_CACHE_MAX_ENTRIES > 0
+        else None
     )
+    current_app.config[CONFIG_EMBEDDING_CACHE] = embedding_cache
+
+    search_cache = None
+    if USE_SEARCH_RESULT_CACHE:
+        current_app.logger.info("USE_SEARCH_RESULT_CACHE is true, setting up search result cache")
+        search_cache = SearchResultCache(
+            max_entries=int(os.getenv("SEARCH_RESULT_CACHE_MAX_ENTRIES") or 1000),
+            ttl_seconds=float(os.getenv("SEARCH_RESULT_CACHE_TTL_SECONDS") or 300),
+        )
+    current_app.config[CONFIG_SEARCH_CACHE] = search_cache
+
+    content_file_cache = None
+    if USE_CONTENT_FILE_CACHE:
+        current_app.logger.info("USE_CONTENT_FILE_CACHE is true, setting up content file cache")
+        content_file_cache = ContentFileCache(
+            directory=os.getenv("CONTENT_FILE_CACHE_DIR") or Path(tempfile.gettempdir()) / "content-file-cache",
+            max_bytes=int(os.getenv("CONTENT_FILE_CACHE_MAX_BYTES") or 1024 * 1024 * 1024),
+            max_files=int(os.getenv("CONTENT_FILE_CACHE_MAX_FILES") or 1000),
+            max_file_bytes=int(os.getenv("CONTENT_FILE_CACHE_MAX_FILE_BYTES") or 100 * 1024 * 1024),
+        )
+    current_app.config[CONFIG_CONTENT_FILE_CACHE] = content_file_cache
+
+    content_sas_provider = None
+    if USE_CONTENT_SAS_REDIRECT:
+        current_app.logger.info("USE_CONTENT_SAS_REDIRECT is true, setting up user delegation SAS provider")
+        content_sas_provider = UserDelegationSasProvider(
+            BlobServiceClient(
+                f"https://{AZURE_STORAGE_ACCOUNT}.blob.core.windows.net",
+                credential=azure_credential,
+                **admission_transport("storage"),
+            ),
+            sas_ttl_seconds=int(os.getenv("CONTENT_SAS_TTL_SECONDS") or 300),
+        )
+        content_sas_provider.start()
+    current_app.config[CONFIG_CONTENT_SAS_PROVIDER] = content_sas_provider
+
+    def on_content_changed():
+        if answer_cache:
+            answer_cache.invalidate()
+        if search_cache:
+            search_cache.bump_generation()
+        if path_auth_cache:
+            path_auth_cache.invalidate()
 
     if USE_USER_UPLOAD:
         current_app.logger.info("USE_USER_UPLOAD is true, setting up user upload feature")
@@ -567,6 +1202,8 @@ async def setup_clients():
             f"https://{AZURE_USERSTORAGE_ACCOUNT}.dfs.core.windows.net",
             AZURE_USERSTORAGE_CONTAINER,
             credential=azure_credential,
+            max_single_get_size=CONTENT_DOWNLOAD_CHUNK_SIZE,
+            **admission_transport("storage"),
         )
         current_app.config[CONFIG_USER_BLOB_CONTAINER_CLIENT] = user_blob_container_client
 
@@ -577,6 +1214,7 @@ async def setup_clients():
             local_pdf_parser=os.getenv("USE_LOCAL_PDF_PARSER", "").lower() == "true",
             local_html_parser=os.getenv("USE_LOCAL_HTML_PARSER", "").lower() == "true",
             search_images=USE_GPT4V,
+            http_session=http_session_pool.session,
         )
         search_info = await setup_search_info(
             search_service=AZURE_SEARCH_SERVICE, index_name=AZURE_SEARCH_INDEX, azure_credential=azure_credential
@@ -592,6 +1230,7 @@ async def setup_clients():
             openai_api_version=AZURE_OPENAI_API_VERSION,
             openai_key=clean_key_if_exists(OPENAI_API_KEY),
             openai_org=OPENAI_ORGANIZATION,
+            http_client=openai_http_client,
             disable_vectors=os.getenv("USE_VECTORS", "").lower() == "false",
         )
         ingester = UploadUserFileStrategy(
@@ -599,6 +1238,7 @@ async def setup_clients():
             embeddings=text_embeddings_service,
             file_processors=file_processors,
             search_field_name_embedding=AZURE_SEARCH_FIELD_NAME_EMBEDDING,
+            on_content_changed=on_content_changed,
         )
         current_app.config[CONFIG_INGESTER] = ingester
 
@@ -616,6 +1256,16 @@ async def setup_clients():
         current_app.config[CONFIG_SPEECH_SERVICE_VOICE] = AZURE_SPEECH_SERVICE_VOICE
         # Wait until token is needed to fetch for the first time
         current_app.config[CONFIG_SPEECH_SERVICE_TOKEN] = None
+        speech_audio_cache = None
+        if USE_SPEECH_AUDIO_CACHE:
+            current_app.logger.info("USE_SPEECH_AUDIO_CACHE is true, setting up speech audio cache")
+            speech_audio_cache = SpeechAudioCache(
+                max_bytes=int(os.getenv("SPEECH_AUDIO_CACHE_MAX_BYTES") or 100 * 1024 * 1024),
+                max_audio_bytes=int(os.getenv("SPEECH_AUDIO_CACHE_MAX_AUDIO_BYTES") or 5 * 1024 * 1024),
+            )
+        current_app.config[CONFIG_SPEECH_SYNTHESIS_SERVICE] = SpeechSynthesisService(
+            max_workers=int(os.getenv("SPEECH_SYNTHESIS_MAX_WORKERS") or 4), audio_cache=speech_audio_cache
+        )
 
     if OPENAI_HOST.startswith("azure"):
         if OPENAI_HOST == "azure_custom":
@@ -631,7 +1281,10 @@ async def setup_clients():
         if api_key := os.getenv("AZURE_OPENAI_API_KEY_OVERRIDE"):
             current_app.logger.info("AZURE_OPENAI_API_KEY_OVERRIDE found, using as api_key for Azure OpenAI client")
             openai_client = AsyncAzureOpenAI(
-                api_version=AZURE_OPENAI_API_VERSION, azure_endpoint=endpoint, api_key=api_key
+                api_version=AZURE_OPENAI_API_VERSION,
+                azure_endpoint=endpoint,
+                api_key=api_key,
+                http_client=openai_http_client,
             )
         else:
             current_app.logger.info("Using Azure credential (passwordless authentication) for Azure OpenAI client")
@@ -640,12 +1293,14 @@ async def setup_clients():
                 api_version=AZURE_OPENAI_API_VERSION,
                 azure_endpoint=endpoint,
                 azure_ad_token_provider=token_provider,
+                http_client=openai_http_client,
             )
     elif OPENAI_HOST == "local":
         current_app.logger.info("OPENAI_HOST is local, setting up local OpenAI client for OPENAI_BASE_URL with no key")
         openai_client = AsyncOpenAI(
             base_url=os.environ["OPENAI_BASE_URL"],
             api_key="no-key-required",
+            http_client=openai_http_client,
         )
     else:
         current_app.logger.info(
@@ -654,6 +1309,7 @@ async def setup_clients():
         openai_client = AsyncOpenAI(
             api_key=OPENAI_API_KEY,
             organization=OPENAI_ORGANIZATION,
+            http_client=openai_http_client,
         )
 
     current_app.config[CONFIG_OPENAI_CLIENT] = openai_client
@@ -677,6 +1333,7 @@ async def setup_clients():
     current_app.config[CONFIG_VECTOR_SEARCH_ENABLED] = os.getenv("USE_VECTORS", "").lower() != "false"
     current_app.config[CONFIG_USER_UPLOAD_ENABLED] = bool(USE_USER_UPLOAD)
     current_app.config[CONFIG_LANGUAGE_PICKER_ENABLED] = ENABLE_LANGUAGE_PICKER
+    current_app.config[CONFIG_METRICS_ENABLED] = ENABLE_METRICS_ENDPOINT
     current_app.config[CONFIG_SPEECH_INPUT_ENABLED] = USE_SPEECH_INPUT_BROWSER
     current_app.config[CONFIG_SPEECH_OUTPUT_BROWSER_ENABLED] = USE_SPEECH_OUTPUT_BROWSER
     current_app.config[CONFIG_SPEECH_OUTPUT_AZURE_ENABLED] = USE_SPEECH_OUTPUT_AZURE
@@ -708,6 +1365,11 @@ async def setup_clients():
         query_speller=AZURE_SEARCH_QUERY_SPELLER,
         prompt_manager=prompt_manager,
         reasoning_effort=OPENAI_REASONING_EFFORT,
+        answer_cache=answer_cache,
+        embedding_cache=embedding_cache,
+        search_cache=search_cache,
+        chat_scheduler=chat_scheduler,
+        context_packer=context_packer,
     )
 
     # ChatReadRetrieveReadApproach is used by /chat for multi-turn conversation
@@ -731,6 +1393,17 @@ async def setup_clients():
         query_speller=AZURE_SEARCH_QUERY_SPELLER,
         prompt_manager=prompt_manager,
         reasoning_effort=OPENAI_REASONING_EFFORT,
+        answer_cache=answer_cache,
+        embedding_cache=embedding_cache,
+        search_cache=search_cache,
+        chat_scheduler=chat_scheduler,
+        context_packer=context_packer,
+        history_manager=history_manager,
+        speculative_search=USE_SPECULATIVE_SEARCH,
+        query_rewrite_max_skipped_history=(
+            int(QUERY_REWRITE_MAX_SKIPPED_HISTORY) if QUERY_REWRITE_MAX_SKIPPED_HISTORY else None
+        ),
+        stream_progress=USE_CHAT_STREAM_PROGRESS,
     )
 
     if USE_GPT4V:
@@ -759,6 +1432,7 @@ async def setup_clients():
             auth_helper=auth_helper,
             vision_endpoint=AZURE_VISION_ENDPOINT,
             vision_token_provider=token_provider,
+            http_session=http_session_pool.session,
             gpt4v_deployment=AZURE_OPENAI_GPT4V_DEPLOYMENT,
             gpt4v_model=AZURE_OPENAI_GPT4V_MODEL,
             embedding_model=OPENAI_EMB_MODEL,
@@ -770,6 +1444,8 @@ async def setup_clients():
             query_language=AZURE_SEARCH_QUERY_LANGUAGE,
             query_speller=AZURE_SEARCH_QUERY_SPELLER,
             prompt_manager=prompt_manager,
+            embedding_cache=embedding_cache,
+            search_cache=search_cache,
         )
 
         current_app.config[CONFIG_CHAT_VISION_APPROACH] = ChatReadRetrieveReadVisionApproach(
@@ -779,6 +1455,7 @@ async def setup_clients():
             auth_helper=auth_helper,
             vision_endpoint=AZURE_VISION_ENDPOINT,
             vision_token_provider=token_provider,
+            http_session=http_session_pool.session,
             chatgpt_model=OPENAI_CHATGPT_MODEL,
             chatgpt_deployment=AZURE_OPENAI_CHATGPT_DEPLOYMENT,
             gpt4v_deployment=AZURE_OPENAI_GPT4V_DEPLOYMENT,
@@ -792,6 +1469,9 @@ async def setup_clients():
             query_language=AZURE_SEARCH_QUERY_LANGUAGE,
             query_speller=AZURE_SEARCH_QUERY_SPELLER,
             prompt_manager=prompt_manager,
+            embedding_cache=embedding_cache,
+            search_cache=search_cache,
+            stream_progress=USE_CHAT_STREAM_PROGRESS,
         )
 
 
@@ -801,6 +1481,14 @@ async def close_clients():
     await current_app.config[CONFIG_BLOB_CONTAINER_CLIENT].close()
     if current_app.config.get(CONFIG_USER_BLOB_CONTAINER_CLIENT):
         await current_app.config[CONFIG_USER_BLOB_CONTAINER_CLIENT].close()
+    await current_app.config[CONFIG_AUTH_CLIENT].close()
+    await current_app.config[CONFIG_HTTP_SESSION_POOL].close()
+    if current_app.config.get(CONFIG_ADMISSION_CONTROLLER):
+        await current_app.config[CONFIG_ADMISSION_CONTROLLER].close()
+    if current_app.config.get(CONFIG_SPEECH_SYNTHESIS_SERVICE):
+        current_app.config[CONFIG_SPEECH_SYNTHESIS_SERVICE].close()
+    if current_app.config.get(CONFIG_CONTENT_SAS_PROVIDER):
+        await current_app.config[CONFIG_CONTENT_SAS_PROVIDER].close()
 
 
 def create_app():
@@ -0,0 +1,148 @@
+import hashlib
+import json
+import math
+import operator
+import re
+import unicodedata
+from collections.abc import Awaitable
+from dataclasses import dataclass
+from typing import Any, Callable, Optional
+
+from openai.types.chat import ChatCompletionMessageParam
+
+from core.cache import TTLCache
+
+
+@dataclass
+class CachedAnswer:
+    content: Optional[str]
+    role: str
+    context: Any
+    followup_questions: Optional[list[str]] = None
+
+
+@dataclass
+class AnswerCacheKey:
+    # Digest of everything that shapes the answer apart from the question itself:
+    # approach, overrides, search filter (including the security filter) and prior conversation turns
+    scope: str
+    question: str
+    embedding: Optional[list[float]] = None
+    # Generation of the cache when the key was built, so that answers started before an invalidation aren't kept
+    generation: int = 0
+
+
+@dataclass
+class _AnswerCacheEntry:
+    answer: CachedAnswer
+    # Unit-length embedding of the question, only present when similarity lookups are enabled
+    embedding: Optional[list[float]] = None
+
+
+class AnswerCache:
+    """
+    Caches final answers of the RAG approaches so that repeated questions skip query rewriting, embedding,
+    search and answer generation entirely.
+    Answers are only shared between requests with the same overrides and the same search filter,
+    so results trimmed by access control never leak to users with a different security scope.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1000,
+        ttl_seconds: Optional[float] = 3600,
+        similarity_threshold: Optional[float] = None,
+        similarity_scan_limit: int = 256,
+    ):
+        self.entries: TTLCache[tuple[str, str], _AnswerCacheEntry] = TTLCache(max_entries, ttl_seconds)
+        self.similarity_threshold = similarity_threshold
+        self.similarity_scan_limit = similarity_scan_limit
+        self.similar_hits = 0
+        self.generation = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def normalize_question(question: str) -> str:
+        # Case, punctuation, Hebrew vowel points and whitespace do not change the meaning of a question
+        question = unicodedata.normalize("NFKC", question).casefold()
+        question = re.sub(r"[\u0591-\u05C7]", "", question)
+        question = re.sub(r"[^\w\s]", " ", question)
+        return " ".join(question.split())
+
+    @staticmethod
+    def build_key(
+        namespace: str,
+        messages: list[ChatCompletionMessageParam],
+        overrides: dict[str, Any],
+        search_filter: Optional[str],
+        generation: int = 0,
+    ) -> Optional[AnswerCacheKey]:
+        question = messages[-1]["content"]
+        if not isinstance(question, str):
+            return None
+        scope = json.dumps(
+            {
+                "namespace": namespace,
+                "overrides": overrides,
+                "filter": search_filter,
+                "history": messages[:-1],
+            },
+            sort_keys=True,
+            ensure_ascii=False,
+            default=str,
+        )
+        return AnswerCacheKey(
+            scope=hashlib.sha256(scope.encode("utf-8")).hexdigest(),
+            question=AnswerCache.normalize_question(question),
+            generation=generation,
+        )
+
+    async def lookup(
+        self, key: AnswerCacheKey, embed: Optional[Callable[[str], Awaitable[list[float]]]] = None
+    ) -> Optional[CachedAnswer]:
+        entry = self.entries.get((key.scope, key.question))
+        if entry:
+            return entry.answer
+        if self.similarity_threshold is None or embed is None:
+            return None
+
+        # Fall back to the closest previously answered question in the same scope, if it is close enough
+        key.embedding = self._unit_vector(await embed(key.question))
+        best_entry, best_similarity = None, self.similarity_threshold
+        candidates = 0
+        for (scope, _), candidate in reversed(list(self.entries.items())):
+            if scope != key.scope or candidate.embedding is None:
+                continue
+            similarity = sum(map(operator.mul, key.embedding, candidate.embedding))
+            if similarity >= best_similarity:
+                best_entry, best_similarity = candidate, similarity
+            candidates += 1
+            if candidates >= self.similarity_scan_limit:
+                break
+        if best_entry:
+            self.similar_hits += 1
+            return best_entry.answer
+        return None
+
+    def store(self, key: AnswerCacheKey, answer: CachedAnswer) -> None:
+        # An answer that was started before the content changed may cite documents that are gone
+        if key.generation != self.generation:
+            return
+        self.entries.set((key.scope, key.question), _AnswerCacheEntry(answer, key.embedding))
+
+    def invalidate(self) -> None:
+        self.generation += 1
+        self.entries.clear()
+        self.invalidations += 1
+
+    def stats(self) -> dict[str, Any]:
+        return self.entries.stats() | {
+            "similar_hits": self.similar_hits,
+            "similarity_threshold": self.similarity_threshold,
+            "invalidations": self.invalidations,
+        }
+
+    @staticmethod
+    def _unit_vector(vector: list[float]) -> list[float]:
+        norm = math.sqrt(sum(value * value for value in vector))
+        return [value / norm for value in vector] if norm else vector
@@ -1,3 +1,4 @@
+import contextlib
 import os
 from abc import ABC
 from collections.abc import AsyncGenerator, Awaitable
@@ -33,7 +34,12 @@ from openai.types.chat import (
     ChatCompletionToolParam,
 )
 
+from approaches.answercache import AnswerCache, AnswerCacheKey, CachedAnswer
+from approaches.contextpacker import ContextPacker
+from approaches.embeddingcache import QueryEmbeddingCache
+from approaches.fairshare import FairShareScheduler, FairShareTicket
 from approaches.promptmanager import PromptManager
+from approaches.searchcache import SearchResultCache
 from core.authentication import AuthenticationHelper
 
 
@@ -50,6 +56,8 @@ class Document:
     score: Optional[float] = None
     reranker_score: Optional[float] = None
     search_agent_query: Optional[str] = None
+    # Tokens of the content, counted at ingestion (None for documents indexed before that)
+    token_count: Optional[int] = None
 
     def serialize_for_results(self) -> dict[str, Any]:
         result_dict = {
@@ -103,6 +111,10 @@ class ExtraInfo:
     followup_questions: Optional[list[Any]] = None
 
 
+# Called with the name of each retrieval stage as it finishes, and the context gathered up to that stage
+ProgressCallback = Callable[[str, ExtraInfo], None]
+
+
 @dataclass
 class TokenUsageProps:
     prompt_tokens: int
@@ -138,6 +150,18 @@ class Approach(ABC):
     # Set a higher token limit for GPT reasoning models
     RESPONSE_DEFAULT_TOKEN_LIMIT = 1024
     RESPONSE_REASONING_DEFAULT_TOKEN_LIMIT = 8192
+    # Optional cache of final answers, shared by approaches that opt in
+    answer_cache: Optional[AnswerCache] = None
+    # Optional cache of query embeddings, shared by all approaches using the same embedding model
+    embedding_cache: Optional[QueryEmbeddingCache] = None
+    # Optional cache of search results, shared by all approaches querying the same index
+    search_cache: Optional[SearchResultCache] = None
+    # Optional app-wide HTTP session, so that calls to Azure AI Vision reuse connections
+    http_session: Optional[aiohttp.ClientSession] = None
+    # Optional scheduler that shares the chat completion deployment fairly between users
+    chat_scheduler: Optional[FairShareScheduler] = None
+    # Optional packer that fits the sources of answer prompts into a token budget
+    context_packer: Optional[ContextPacker] = None
 
     def __init__(
         self,
@@ -185,74 +209,127 @@ class Approach(ABC):
             filters.append(security_filter)
         return None if len(filters) == 0 else " and ".join(filters)
 
-
-async def search(
-    self,
-    top: int,
-    query_text: Optional[str],
-    filter: Optional[str],
-    vectors: list[VectorQuery],
-    use_text_search: bool,
-    use_vector_search: bool,
-    use_semantic_ranker: bool,
-    use_semantic_captions: bool,
-    minimum_search_score: Optional[float] = None,
-    minimum_reranker_score: Optional[float] = None,
-    use_query_rewriting: Optional[bool] = None,
-) -> list[Document]:
-    # Add fuzzy matching for Hebrew - allow 2 character edits
-    if query_text and use_text_search:
-        # Add fuzzy matching to each word
-        words = query_text.split()
-        fuzzy_words = [f"{word}~2" for word in words if len(word) > 3]  # Only for words > 3 chars
-        search_text = " ".join(fuzzy_words) if fuzzy_words else query_text
-    else:
-        search_text = query_text if use_text_search else ""
-
-    search_vectors = vectors if use_vector_search else []
-
-    if use_semantic_ranker:
-        results = await self.search_client.search(
-            search_text=search_text,
-            filter=filter,
-            top=top,
-            query_caption="extractive|highlight-false" if use_semantic_captions else None,
-            query_rewrites="generative" if use_query_rewriting else None,
-            vector_queries=search_vectors,
-            query_type=QueryType.FULL,  # Enable Lucene syntax for fuzzy
-            query_language=self.query_language if self.query_language != "he-il" else None,  # Disable for Hebrew
-            query_speller=None,  # Disable speller for Hebrew
-            semantic_configuration_name="default",
-            semantic_query=query_text,  # Keep original for semantic
-        )
-    else:
-        results = await self.search_client.search(
-            search_text=search_text,
-            filter=filter,
-            top=top,
-            vector_queries=search_vectors,
-            query_type=QueryType.FULL,  # Enable Lucene syntax for fuzzy
+    def get_answer_cache_key(
+        self, messages: list[ChatCompletionMessageParam], overrides: dict[str, Any], auth_claims: dict[str, Any]
+    ) -> Optional[AnswerCacheKey]:
+        if self.answer_cache is None:
+            return None
+        # The search filter carries the security filter, so cached answers are never shared across security scopes
+        return self.answer_cache.build_key(
+            type(self).__name__,
+            messages,
+            overrides,
+            self.build_filter(overrides, auth_claims),
+            self.answer_cache.generation,
         )
 
-    documents = []
-    async for page in results.by_page():
-        async for document in page:
-            documents.append(
-                Document(
-                    id=document.get("id"),
-                    content=document.get("content"),
-                    category=document.get("category"),
-                    sourcepage=document.get("sourcepage"),
-                    sourcefile=document.get("sourcefile"),
-                    oids=document.get("oids"),
-                    groups=document.get("groups"),
-                    captions=cast(list[QueryCaptionResult], document.get("@search.captions")),
-                    score=document.get("@search.score"),
-                    reranker_score=document.get("@search.reranker_score"),
-                )
+    async def get_cached_answer(self, key: Optional[AnswerCacheKey]) -> Optional[CachedAnswer]:
+        if self.answer_cache is None or key is None:
+            return None
+
+        async def embed(question: str) -> list[float]:
+            return (await self.compute_text_embedding(question)).vector
+
+        return await self.answer_cache.lookup(key, embed)
+
+    def cache_answer(self, key: Optional[AnswerCacheKey], answer: CachedAnswer) -> None:
+        if self.answer_cache is None or key is None:
+            return
+        self.answer_cache.store(key, answer)
+
+    async def search(
+        self,
+        top: int,
+        query_text: Optional[str],
+        filter: Optional[str],
+        vectors: list[VectorQuery],
+        use_text_search: bool,
+        use_vector_search: bool,
+        use_semantic_ranker: bool,
+        use_semantic_captions: bool,
+        minimum_search_score: Optional[float] = None,
+        minimum_reranker_score: Optional[float] = None,
+        use_query_rewriting: Optional[bool] = None,
+    ) -> list[Document]:
+        # Add fuzzy matching for Hebrew - allow 2 character edits
+        if query_text and use_text_search:
+            # Add fuzzy matching to each word
+            words = query_text.split()
+            fuzzy_words = [f"{word}~2" for word in words if len(word) > 3]  # Only for words > 3 chars
+            search_text = " ".join(fuzzy_words) if fuzzy_words else query_text
+        else:
+            search_text = query_text if use_text_search else ""
+
+        search_vectors = vectors if use_vector_search else []
+
+        cache_key = None
+        if self.search_cache:
+            cache_key = self.search_cache.build_key(
+                search_text,
+                filter,
+                search_vectors,
+                top,
+                use_semantic_ranker,
+                use_semantic_captions,
+                use_query_rewriting,
+                self.query_language,
             )
+            if (cached_documents := self.search_cache.get(cache_key)) is not None:
+                return self.filter_by_score(cached_documents, minimum_search_score, minimum_reranker_score)
+
+        if use_semantic_ranker:
+            results = await self.search_client.search(
+                search_text=search_text,
+                filter=filter,
+                top=top,
+                query_caption="extractive|highlight-false" if use_semantic_captions else None,
+                query_rewrites="generative" if use_query_rewriting else None,
+                vector_queries=search_vectors,
+                query_type=QueryType.FULL,  # Enable Lucene syntax for fuzzy
+                query_language=self.query_language if self.query_language != "he-il" else None,  # Disable for Hebrew
+                query_speller=None,  # Disable speller for Hebrew
+                semantic_configuration_name="default",
+                semantic_query=query_text,  # Keep original for semantic
+            )
+        else:
+            results = await self.search_client.search(
+                search_text=search_text,
+                filter=filter,
+                top=top,
+                vector_queries=search_vectors,
+                query_type=QueryType.FULL,  # Enable Lucene syntax for fuzzy
+            )
+
+        documents = []
+        async for page in results.by_page():
+            async for document in page:
+                documents.append(
+                    Document(
+                        id=document.get("id"),
+                        content=document.get("content"),
+                        category=document.get("category"),
+                        sourcepage=document.get("sourcepage"),
+                        sourcefile=document.get("sourcefile"),
+                        oids=document.get("oids"),
+                        groups=document.get("groups"),
+                        captions=cast(list[QueryCaptionResult], document.get("@search.captions")),
+                        score=document.get("@search.score"),
+                        reranker_score=document.get("@search.reranker_score"),
+                        token_count=document.get("tokenCount"),
+                    )
+                )
 
-        qualified_documents = [
+        if self.search_cache and cache_key:
+            self.search_cache.store(cache_key, documents)
+        return self.filter_by_score(documents, minimum_search_score, minimum_reranker_score)
+
+    def filter_by_score(
+        self,
+        documents: list[Document],
+        minimum_search_score: Optional[float],
+        minimum_reranker_score: Optional[float],
+    ) -> list[Document]:
+        return [
             doc
             for doc in documents
             if (
@@ -261,8 +338,6 @@ async def search(
             )
         ]
 
-    return qualified_documents
-
     async def run_agentic_retrieval(
         self,
         messages: list[ChatCompletionMessageParam],
@@ -324,6 +399,7 @@ async def search(
                             content=reference.source_data["content"],
                             sourcepage=reference.source_data["sourcepage"],
                             search_agent_query=activity_mapping[reference.activity_source],
+                            token_count=reference.source_data.get("tokenCount"),
                         )
                     )
                 if top and len(results) == top:
@@ -351,6 +427,45 @@ async def search(
                 for doc in results
             ]
 
+    def get_source_token_budget(self, prompt: Any, variables: dict[str, Any]) -> Optional[int]:
+        """
+        Returns how many tokens the sources can take in the answer prompt, or None when there's no budget
+        """
+        if self.context_packer is None:
+            return None
+        return self.context_packer.get_source_token_budget(
+            self.prompt_manager.render_prompt(prompt, variables | {"text_sources": []})
+        )
+
+    def pack_sources(
+        self,
+        results: list[Document],
+        text_sources: list[str],
+        use_semantic_captions: bool,
+        source_token_budget: Optional[int],
+    ) -> tuple[list[str], Optional[ThoughtStep]]:
+        if self.context_packer is None or source_token_budget is None:
+            return text_sources, None
+        token_counts: list[Optional[int]] = []
+        for doc, source in zip(results, text_sources):
+            if doc.token_count is None or use_semantic_captions:
+                # Captions replace the content, so the stored count doesn't apply to them
+                token_counts.append(None)
+            else:
+                # Only the citation in front of the content is left to count
+                citation = source[: len(source) - len(doc.content or "")]
+                token_counts.append(doc.token_count + self.context_packer.count_tokens(citation))
+        packed_sources, decisions = self.context_packer.pack(text_sources, token_counts, source_token_budget)
+        return packed_sources, ThoughtStep(
+            "Pack sources into token budget",
+            decisions,
+            {
+                "max_prompt_tokens": self.context_packer.max_prompt_tokens,
+                "source_token_budget": source_token_budget,
+                "source_tokens": sum(decision["kept_tokens"] for decision in decisions),
+            },
+        )
+
     def get_citation(self, sourcepage: str, use_image_citation: bool) -> str:
         if use_image_citation:
             return sourcepage
@@ -376,13 +491,19 @@ async def search(
         dimensions_args: ExtraArgs = (
             {"dimensions": self.embedding_dimensions} if SUPPORTED_DIMENSIONS_MODEL[self.embedding_model] else {}
         )
-        embedding = await self.openai_client.embeddings.create(
-            # Azure OpenAI takes the deployment name as the model name
-            model=self.embedding_deployment if self.embedding_deployment else self.embedding_model,
-            input=q,
-            **dimensions_args,
-        )
-        query_vector = embedding.data[0].embedding
+        # Azure OpenAI takes the deployment name as the model name
+        model = self.embedding_deployment if self.embedding_deployment else self.embedding_model
+
+        async def create_embedding() -> list[float]:
+            embedding = await self.openai_client.embeddings.create(model=model, input=q, **dimensions_args)
+            return embedding.data[0].embedding
+
+        if self.embedding_cache:
+            query_vector = await self.embedding_cache.get_or_create(
+                (model, dimensions_args.get("dimensions"), q), create_embedding
+            )
+        else:
+            query_vector = await create_embedding()
         # This performs an oversampling due to how the search index was setup,
         # so we do not need to explicitly pass in an oversampling parameter here
         return VectorizedQuery(vector=query_vector, k_nearest_neighbors=50, fields=self.embedding_field)
@@ -395,7 +516,11 @@ async def search(
 
         headers["Authorization"] = "Bearer " + await self.vision_token_provider()
 
-        async with aiohttp.ClientSession() as session:
+        async with contextlib.AsyncExitStack() as stack:
+            # Without a shared session, one is only created for this call
+            session = self.http_session
+            if session is None:
+                session = await stack.enter_async_context(aiohttp.ClientSession())
             async with session.post(
                 url=endpoint, params=params, headers=headers, json=data, raise_for_status=True
             ) as response:
@@ -430,6 +555,7 @@ async def search(
         temperature: Optional[float] = None,
         n: Optional[int] = None,
         reasoning_effort: Optional[ChatCompletionReasoningEffort] = None,
+        auth_claims: Optional[dict[str, Any]] = None,
     ) -> Union[Awaitable[ChatCompletion], Awaitable[AsyncStream[ChatCompletionChunk]]]:
         if chatgpt_model in self.GPT_REASONING_MODELS:
             params: dict[str, Any] = {
@@ -456,15 +582,58 @@ async def search(
 
         params["tools"] = tools
 
-        # Azure OpenAI takes the deployment name as the model name
-        return self.openai_client.chat.completions.create(
-            model=chatgpt_deployment if chatgpt_deployment else chatgpt_model,
-            messages=messages,
-            seed=overrides.get("seed", None),
-            n=n or 1,
-            **params,
+        def create() -> Union[Awaitable[ChatCompletion], Awaitable[AsyncStream[ChatCompletionChunk]]]:
+            # Azure OpenAI takes the deployment name as the model name
+            return self.openai_client.chat.completions.create(
+                model=chatgpt_deployment if chatgpt_deployment else chatgpt_model,
+                messages=messages,
+                seed=overrides.get("seed", None),
+                n=n or 1,
+                **params,
+            )
+
+        if self.chat_scheduler is None:
+            return create()
+        return cast(
+            Union[Awaitable[ChatCompletion], Awaitable[AsyncStream[ChatCompletionChunk]]],
+            self.create_scheduled_chat_completion(
+                self.chat_scheduler, create, messages, response_token_limit, (auth_claims or {}).get("oid")
+            ),
         )
 
+    async def create_scheduled_chat_completion(
+        self,
+        scheduler: FairShareScheduler,
+        create: Callable[[], Union[Awaitable[ChatCompletion], Awaitable[AsyncStream[ChatCompletionChunk]]]],
+        messages: list[ChatCompletionMessageParam],
+        response_token_limit: int,
+        oid: Optional[str],
+    ) -> Union[ChatCompletion, AsyncGenerator[ChatCompletionChunk, None]]:
+        # The call only waits for its turn once it is awaited, so a speculative call that is never used costs nothing
+        ticket = await scheduler.acquire(oid, messages, response_token_limit)
+        try:
+            response = await create()
+        except BaseException:
+            scheduler.release(ticket, None)
+            raise
+        if isinstance(response, ChatCompletion):
+            scheduler.release(ticket, TokenUsageProps.from_completion_usage(response.usage) if response.usage else None)
+            return response
+        return self.release_after_stream(scheduler, ticket, response)
+
+    async def release_after_stream(
+        self, scheduler: FairShareScheduler, ticket: FairShareTicket, stream: AsyncStream[ChatCompletionChunk]
+    ) -> AsyncGenerator[ChatCompletionChunk, None]:
+        # A streamed call holds its slot until the last chunk, which carries the usage
+        usage = None
+        try:
+            async for chunk in stream:
+                if chunk.usage:
+                    usage = TokenUsageProps.from_completion_usage(chunk.usage)
+                yield chunk
+        finally:
+            scheduler.release(ticket, usage)
+
     def format_thought_step_for_chatcompletion(
         self,
         title: str,
@@ -487,6 +656,26 @@ async def search(
             properties["token_usage"] = TokenUsageProps.from_completion_usage(usage)
         return ThoughtStep(title, messages, properties)
 
+    async def stream_answer(
+        self,
+        extra_info: ExtraInfo,
+        chat_coroutine: Awaitable[AsyncStream[ChatCompletionChunk]],
+        session_state: Any = None,
+    ) -> AsyncGenerator[dict[str, Any], None]:
+        """
+        Yields the events of a streamed answer: the context first, then every content delta,
+        and the context again once the final chunk reports the token usage
+        """
+        yield {"delta": {"role": "assistant"}, "context": extra_info, "session_state": session_state}
+        async for event_chunk in await chat_coroutine:
+            if event_chunk.choices:
+                delta = event_chunk.choices[0].delta
+                yield {"delta": {"content": delta.content, "role": delta.role}}
+            elif event_chunk.usage and extra_info.thoughts and self.include_token_usage:
+                # Final chunk at end of streaming should contain usage
+                extra_info.thoughts[-1].update_token_usage(event_chunk.usage)
+                yield {"delta": {"role": "assistant"}, "context": extra_info, "session_state": session_state}
+
     async def run(
         self,
         messages: list[ChatCompletionMessageParam],
@@ -1,5 +1,8 @@
+import asyncio
+import dataclasses
 import json
 import re
+import time
 from abc import ABC, abstractmethod
 from collections.abc import AsyncGenerator, Awaitable
 from typing import Any, Optional, Union, cast
@@ -11,19 +14,33 @@ from openai.types.chat import (
     ChatCompletionMessageParam,
 )
 
+from approaches.answercache import CachedAnswer
 from approaches.approach import (
     Approach,
     ExtraInfo,
+    ProgressCallback,
 )
+from approaches.historywindow import HistoryManager
 
 
 class ChatApproach(Approach, ABC):
 
     NO_RESPONSE = "0"
 
+    # Whether streamed responses report each retrieval stage as soon as it finishes
+    stream_progress: bool = False
+    # Optional manager that keeps the history in prompts within token budgets, summarizing the earlier turns
+    history_manager: Optional[HistoryManager] = None
+
     @abstractmethod
     async def run_until_final_call(
-        self, messages, overrides, auth_claims, should_stream
+        self,
+        messages,
+        overrides,
+        auth_claims,
+        should_stream,
+        on_progress: Optional[ProgressCallback] = None,
+        session_state: Any = None,
     ) -> tuple[ExtraInfo, Union[Awaitable[ChatCompletion], Awaitable[AsyncStream[ChatCompletionChunk]]]]:
         pass
 
@@ -57,8 +74,18 @@ class ChatApproach(Approach, ABC):
         auth_claims: dict[str, Any],
         session_state: Any = None,
     ) -> dict[str, Any]:
+        cache_key = self.get_answer_cache_key(messages, overrides, auth_claims)
+        if cached_answer := await self.get_cached_answer(cache_key):
+            return {
+                "message": {"content": cached_answer.content, "role": cached_answer.role},
+                "context": dataclasses.replace(
+                    cached_answer.context, followup_questions=cached_answer.followup_questions
+                ),
+                "session_state": session_state,
+            }
+
         extra_info, chat_coroutine = await self.run_until_final_call(
-            messages, overrides, auth_claims, should_stream=False
+            messages, overrides, auth_claims, should_stream=False, session_state=session_state
         )
         chat_completion_response: ChatCompletion = await cast(Awaitable[ChatCompletion], chat_coroutine)
         content = chat_completion_response.choices[0].message.content
@@ -69,6 +96,7 @@ class ChatApproach(Approach, ABC):
         # Assume last thought is for generating answer
         if self.include_token_usage and extra_info.thoughts and chat_completion_response.usage:
             extra_info.thoughts[-1].update_token_usage(chat_completion_response.usage)
+        self.cache_answer(cache_key, CachedAnswer(content, role, extra_info, extra_info.followup_questions))
         chat_app_response = {
             "message": {"content": content, "role": role},
             "context": extra_info,
@@ -83,38 +111,85 @@ class ChatApproach(Approach, ABC):
         auth_claims: dict[str, Any],
         session_state: Any = None,
     ) -> AsyncGenerator[dict, None]:
-        extra_info, chat_coroutine = await self.run_until_final_call(
-            messages, overrides, auth_claims, should_stream=True
-        )
+        cache_key = self.get_answer_cache_key(messages, overrides, auth_claims)
+        if cached_answer := await self.get_cached_answer(cache_key):
+            # Replay the cached answer as a single delta
+            yield {"delta": {"role": "assistant"}, "context": cached_answer.context, "session_state": session_state}
+            yield {"delta": {"content": cached_answer.content, "role": cached_answer.role}}
+            if cached_answer.followup_questions:
+                yield {
+                    "delta": {"role": "assistant"},
+                    "context": {
+                        "context": cached_answer.context,
+                        "followup_questions": cached_answer.followup_questions,
+                    },
+                }
+            return
+
+        if self.stream_progress:
+            start_time = time.monotonic()
+            progress_events: asyncio.Queue[Optional[dict[str, Any]]] = asyncio.Queue()
+
+            def progress_event(stage: str, progress_info: ExtraInfo) -> dict[str, Any]:
+                return {
+                    "delta": {"role": "assistant"},
+                    "context": progress_info,
+                    "progress": {"stage": stage, "elapsed_ms": round((time.monotonic() - start_time) * 1000)},
+                    "session_state": session_state,
+                }
+
+            # Retrieval runs as a separate task so its stages can be streamed while it is still running
+            final_call = asyncio.create_task(
+                self.run_until_final_call(
+                    messages,
+                    overrides,
+                    auth_claims,
+                    should_stream=True,
+                    on_progress=lambda stage, progress_info: progress_events.put_nowait(
+                        progress_event(stage, progress_info)
+                    ),
+                    session_state=session_state,
+                )
+            )
+            final_call.add_done_callback(lambda _: progress_events.put_nowait(None))
+            try:
+                while (stage_event := await progress_events.get()) is not None:
+                    yield stage_event
+                extra_info, chat_coroutine = await final_call
+            finally:
+                final_call.cancel()
+            yield progress_event("answer", extra_info)
+        else:
+            extra_info, chat_coroutine = await self.run_until_final_call(
+                messages, overrides, auth_claims, should_stream=True, session_state=session_state
+            )
+            yield {"delta": {"role": "assistant"}, "context": extra_info, "session_state": session_state}
         chat_coroutine = cast(Awaitable[AsyncStream[ChatCompletionChunk]], chat_coroutine)
-        yield {"delta": {"role": "assistant"}, "context": extra_info, "session_state": session_state}
 
         followup_questions_started = False
         followup_content = ""
+        answer_content = []
         async for event_chunk in await chat_coroutine:
             # "2023-07-01-preview" API version has a bug where first response has empty choices
-            event = event_chunk.model_dump()  # Convert pydantic model to dict
-            if event["choices"]:
+            if event_chunk.choices:
                 # No usage during streaming
-                completion = {
-                    "delta": {
-                        "content": event["choices"][0]["delta"].get("content"),
-                        "role": event["choices"][0]["delta"]["role"],
-                    }
-                }
+                # Read from the typed chunk, since dumping every chunk to a dict costs more than the rest of the loop
+                delta = event_chunk.choices[0].delta
+                completion = {"delta": {"content": delta.content, "role": delta.role}}
                 # if event contains << and not >>, it is start of follow-up question, truncate
-                content = completion["delta"].get("content")
-                content = content or ""  # content may either not exist in delta, or explicitly be None
+                content = delta.content or ""  # content may either not exist in delta, or explicitly be None
                 if overrides.get("suggest_followup_questions") and "<<" in content:
                     followup_questions_started = True
                     earlier_content = content[: content.index("<<")]
                     if earlier_content:
                         completion["delta"]["content"] = earlier_content
+                        answer_content.append(earlier_content)
                         yield completion
                     followup_content += content[content.index("<<") :]
                 elif followup_questions_started:
                     followup_content += content
                 else:
+                    answer_content.append(content)
                     yield completion
             else:
                 # Final chunk at end of streaming should contain usage
@@ -123,6 +198,7 @@ class ChatApproach(Approach, ABC):
                     extra_info.thoughts[-1].update_token_usage(event_chunk.usage)
                     yield {"delta": {"role": "assistant"}, "context": extra_info, "session_state": session_state}
 
+        followup_questions: Optional[list[str]] = [] if overrides.get("suggest_followup_questions") else None
         if followup_content:
             _, followup_questions = self.extract_followup_questions(followup_content)
             yield {
@@ -130,6 +206,8 @@ class ChatApproach(Approach, ABC):
                 "context": {"context": extra_info, "followup_questions": followup_questions},
             }
 
+        self.cache_answer(cache_key, CachedAnswer("".join(answer_content), "assistant", extra_info, followup_questions))
+
     async def run(
         self,
         messages: list[ChatCompletionMessageParam],
@@ -1,3 +1,5 @@
+import asyncio
+import re
 from collections.abc import Awaitable
 from typing import Any, Optional, Union, cast
 
@@ -12,9 +14,22 @@ from openai.types.chat import (
     ChatCompletionToolParam,
 )
 
-from approaches.approach import DataPoints, ExtraInfo, ThoughtStep
+from approaches.answercache import AnswerCache
+from approaches.approach import (
+    DataPoints,
+    Document,
+    ExtraInfo,
+    ProgressCallback,
+    ThoughtStep,
+)
 from approaches.chatapproach import ChatApproach
+from approaches.contextpacker import ContextPacker
+from approaches.embeddingcache import QueryEmbeddingCache
+from approaches.fairshare import FairShareScheduler
+from approaches.historywindow import HistoryManager
 from approaches.promptmanager import PromptManager
+from approaches.searchcache import SearchResultCache
+from approaches.searchquery import build_search_query
 from core.authentication import AuthenticationHelper
 
 
@@ -47,6 +62,15 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         query_speller: str,
         prompt_manager: PromptManager,
         reasoning_effort: Optional[str] = None,
+        answer_cache: Optional[AnswerCache] = None,
+        embedding_cache: Optional[QueryEmbeddingCache] = None,
+        search_cache: Optional[SearchResultCache] = None,
+        chat_scheduler: Optional[FairShareScheduler] = None,
+        context_packer: Optional[ContextPacker] = None,
+        history_manager: Optional[HistoryManager] = None,
+        speculative_search: bool = False,
+        query_rewrite_max_skipped_history: Optional[int] = None,
+        stream_progress: bool = False,
     ):
         self.search_client = search_client
         self.search_index_name = search_index_name
@@ -69,8 +93,21 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         self.query_rewrite_prompt = self.prompt_manager.load_prompt("chat_query_rewrite.prompty")
         self.query_rewrite_tools = self.prompt_manager.load_tools("chat_query_rewrite_tools.json")
         self.answer_prompt = self.prompt_manager.load_prompt("chat_answer_question.prompty")
+        self.history_summary_prompt = self.prompt_manager.load_prompt("chat_history_summary.prompty")
         self.reasoning_effort = reasoning_effort
         self.include_token_usage = True
+        self.answer_cache = answer_cache
+        self.embedding_cache = embedding_cache
+        self.search_cache = search_cache
+        self.chat_scheduler = chat_scheduler
+        self.context_packer = context_packer
+        self.history_manager = history_manager
+        self.speculative_search = speculative_search
+        # Conversations with at most this many earlier messages skip the search query generation completion
+        self.query_rewrite_max_skipped_history = query_rewrite_max_skipped_history
+        self.query_rewrites_generated = 0
+        self.query_rewrites_skipped = 0
+        self.stream_progress = stream_progress
 
     async def run_until_final_call(
         self,
@@ -78,6 +115,8 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         overrides: dict[str, Any],
         auth_claims: dict[str, Any],
         should_stream: bool = False,
+        on_progress: Optional[ProgressCallback] = None,
+        session_state: Any = None,
     ) -> tuple[ExtraInfo, Union[Awaitable[ChatCompletion], Awaitable[AsyncStream[ChatCompletionChunk]]]]:
         use_agentic_retrieval = True if overrides.get("use_agentic_retrieval") else False
         original_user_query = messages[-1]["content"]
@@ -87,20 +126,28 @@ class ChatReadRetrieveReadApproach(ChatApproach):
             raise Exception(
                 f"{self.chatgpt_model} does not support streaming. Please use a different model or disable streaming."
             )
+        rewrite_messages, past_messages, history_thought = await self.window_history(
+            messages, overrides, auth_claims, session_state
+        )
+        prompt_variables = self.get_system_prompt_variables(overrides.get("prompt_template")) | {
+            "include_follow_up_questions": bool(overrides.get("suggest_followup_questions")),
+            "past_messages": past_messages,
+            "user_query": original_user_query,
+        }
+        source_token_budget = self.get_source_token_budget(self.answer_prompt, prompt_variables)
         if use_agentic_retrieval:
-            extra_info = await self.run_agentic_retrieval_approach(messages, overrides, auth_claims)
+            extra_info = await self.run_agentic_retrieval_approach(
+                rewrite_messages + [messages[-1]], overrides, auth_claims, on_progress, source_token_budget
+            )
         else:
-            extra_info = await self.run_search_approach(messages, overrides, auth_claims)
+            extra_info = await self.run_search_approach(
+                rewrite_messages + [messages[-1]], overrides, auth_claims, on_progress, source_token_budget
+            )
+        if history_thought:
+            extra_info.thoughts.insert(0, history_thought)
 
         messages = self.prompt_manager.render_prompt(
-            self.answer_prompt,
-            self.get_system_prompt_variables(overrides.get("prompt_template"))
-            | {
-                "include_follow_up_questions": bool(overrides.get("suggest_followup_questions")),
-                "past_messages": messages[:-1],
-                "user_query": original_user_query,
-                "text_sources": extra_info.data_points.text,
-            },
+            self.answer_prompt, prompt_variables | {"text_sources": extra_info.data_points.text}
         )
 
         chat_coroutine = cast(
@@ -112,6 +159,7 @@ class ChatReadRetrieveReadApproach(ChatApproach):
                 overrides,
                 self.get_response_token_limit(self.chatgpt_model, 1024),
                 should_stream,
+                auth_claims=auth_claims,
             ),
         )
         extra_info.thoughts.append(
@@ -126,8 +174,69 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         )
         return (extra_info, chat_coroutine)
 
+    async def window_history(
+        self,
+        messages: list[ChatCompletionMessageParam],
+        overrides: dict[str, Any],
+        auth_claims: dict[str, Any],
+        session_state: Any,
+    ) -> tuple[list[ChatCompletionMessageParam], list[ChatCompletionMessageParam], Optional[ThoughtStep]]:
+        """
+        Returns the history to put in the query rewrite prompt and in the answer prompt
+        """
+        history = messages[:-1]
+        if self.history_manager is None or not history:
+            return history, history, None
+        history_manager = self.history_manager
+
+        async def summarize(summary: Optional[str], new_messages: list[ChatCompletionMessageParam]) -> str:
+            chat_completion = cast(
+                ChatCompletion,
+                await self.create_chat_completion(
+                    self.chatgpt_deployment,
+                    self.chatgpt_model,
+                    messages=self.prompt_manager.render_prompt(
+                        self.history_summary_prompt, {"summary": summary, "past_messages": new_messages}
+                    ),
+                    overrides=overrides,
+                    response_token_limit=self.get_response_token_limit(
+                        self.chatgpt_model, history_manager.summary_max_tokens
+                    ),
+                    temperature=0.0,
+                    reasoning_effort="low",
+                    auth_claims=auth_claims,
+                ),
+            )
+            return chat_completion.choices[0].message.content or ""
+
+        window = await history_manager.get_window(
+            history, history_manager.build_key(auth_claims.get("oid"), session_state, history), summarize
+        )
+        return (
+            window.rewrite_messages,
+            window.answer_messages,
+            ThoughtStep(
+                "Window conversation history",
+                window.summary,
+                {
+                    "rewrite_max_tokens": history_manager.rewrite_max_tokens,
+                    "answer_max_tokens": history_manager.answer_max_tokens,
+                    "history_messages": len(history),
+                    "summarized_messages": window.summarized_messages,
+                    "summary_reused": window.summary_reused,
+                    "rewrite_messages": len(window.rewrite_messages),
+                    "answer_messages": len(window.answer_messages),
+                },
+            ),
+        )
+
     async def run_search_approach(
-        self, messages: list[ChatCompletionMessageParam], overrides: dict[str, Any], auth_claims: dict[str, Any]
+        self,
+        messages: list[ChatCompletionMessageParam],
+        overrides: dict[str, Any],
+        auth_claims: dict[str, Any],
+        on_progress: Optional[ProgressCallback] = None,
+        source_token_budget: Optional[int] = None,
     ):
         use_text_search = overrides.get("retrieval_mode") in ["text", "hybrid", None]
         use_vector_search = overrides.get("retrieval_mode") in ["vectors", "hybrid", None]
@@ -143,93 +252,184 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         if not isinstance(original_user_query, str):
             raise ValueError("The most recent message content must be a string.")
 
-        query_messages = self.prompt_manager.render_prompt(
-            self.query_rewrite_prompt, {"user_query": original_user_query, "past_messages": messages[:-1]}
-        )
-        tools: list[ChatCompletionToolParam] = self.query_rewrite_tools
+        async def search_for_query(query_text: str) -> list[Document]:
+            # If retrieval mode includes vectors, compute an embedding for the query
+            vectors: list[VectorQuery] = []
+            if use_vector_search:
+                vectors.append(await self.compute_text_embedding(query_text))
+
+            return await self.search(
+                top,
+                query_text,
+                search_index_filter,
+                vectors,
+                use_text_search,
+                use_vector_search,
+                use_semantic_ranker,
+                use_semantic_captions,
+                minimum_search_score,
+                minimum_reranker_score,
+                use_query_rewriting,
+            )
+
+        search_properties: dict[str, Any] = {}
+        speculative_task: Optional[asyncio.Task[list[Document]]] = None
 
         # STEP 1: Generate an optimized keyword search query based on the chat history and the last question
+        if self.can_skip_query_rewrite(messages):
+            # A short conversation has little context to resolve, so derive the query locally instead of asking the model
+            query_text = build_search_query(original_user_query) or original_user_query
+            query_thought = ThoughtStep(
+                "Skipped search query generation",
+                query_text,
+                {"history_messages": len(messages) - 1, "max_skipped_history": self.query_rewrite_max_skipped_history},
+            )
+            self.query_rewrites_skipped += 1
+        else:
+            query_messages = self.prompt_manager.render_prompt(
+                self.query_rewrite_prompt, {"user_query": original_user_query, "past_messages": messages[:-1]}
+            )
+            tools: list[ChatCompletionToolParam] = self.query_rewrite_tools
 
-        chat_completion = cast(
-            ChatCompletion,
-            await self.create_chat_completion(
-                self.chatgpt_deployment,
-                self.chatgpt_model,
+            # In speculative mode, search with the user's own question while the search query is being generated
+            if self.speculative_search:
+                speculative_task = asyncio.create_task(search_for_query(original_user_query))
+
+            try:
+                chat_completion = cast(
+                    ChatCompletion,
+                    await self.create_chat_completion(
+                        self.chatgpt_deployment,
+                        self.chatgpt_model,
+                        messages=query_messages,
+                        overrides=overrides,
+                        response_token_limit=self.get_response_token_limit(
+                            self.chatgpt_model, 100
+                        ),  # Setting too low risks malformed JSON, setting too high may affect performance
+                        temperature=0.0,  # Minimize creativity for search query generation
+                        tools=tools,
+                        reasoning_effort="low",  # Minimize reasoning for search query generation
+                        auth_claims=auth_claims,
+                    ),
+                )
+            except BaseException:
+                if speculative_task:
+                    speculative_task.cancel()
+                raise
+
+            query_text = self.get_search_query(chat_completion, original_user_query)
+            query_thought = self.format_thought_step_for_chatcompletion(
+                title="Prompt to generate search query",
                 messages=query_messages,
                 overrides=overrides,
-                response_token_limit=self.get_response_token_limit(
-                    self.chatgpt_model, 100
-                ),  # Setting too low risks malformed JSON, setting too high may affect performance
-                temperature=0.0,  # Minimize creativity for search query generation
-                tools=tools,
-                reasoning_effort="low",  # Minimize reasoning for search query generation
-            ),
-        )
+                model=self.chatgpt_model,
+                deployment=self.chatgpt_deployment,
+                usage=chat_completion.usage,
+                reasoning_effort="low",
+            )
+            self.query_rewrites_generated += 1
 
-        query_text = self.get_search_query(chat_completion, original_user_query)
+        if on_progress:
+            on_progress("search_query", ExtraInfo(DataPoints(), thoughts=[query_thought]))
 
         # STEP 2: Retrieve relevant documents from the search index with the GPT optimized query
+        if speculative_task is None:
+            results = await search_for_query(query_text)
+        elif self.is_similar_query(query_text, original_user_query):
+            results = await speculative_task
+            search_properties["speculative_search"] = "reused"
+        else:
+            speculative_results, query_results = await asyncio.gather(speculative_task, search_for_query(query_text))
+            results = self.fuse_results([query_results, speculative_results], top)
+            search_properties["speculative_search"] = "fused"
+
+        thoughts = [
+            query_thought,
+            ThoughtStep(
+                "Search using generated search query",
+                query_text,
+                {
+                    "use_semantic_captions": use_semantic_captions,
+                    "use_semantic_ranker": use_semantic_ranker,
+                    "use_query_rewriting": use_query_rewriting,
+                    "top": top,
+                    "filter": search_index_filter,
+                    "use_vector_search": use_vector_search,
+                    "use_text_search": use_text_search,
+                }
+                | search_properties,
+            ),
+            ThoughtStep(
+                "Search results",
+                [result.serialize_for_results() for result in results],
+            ),
+        ]
+        if on_progress:
+            on_progress("search_results", ExtraInfo(DataPoints(), thoughts=list(thoughts)))
 
-        # If retrieval mode includes vectors, compute an embedding for the query
-        vectors: list[VectorQuery] = []
-        if use_vector_search:
-            vectors.append(await self.compute_text_embedding(query_text))
-
-        results = await self.search(
-            top,
-            query_text,
-            search_index_filter,
-            vectors,
-            use_text_search,
-            use_vector_search,
-            use_semantic_ranker,
+        # STEP 3: Generate a contextual and content specific answer using the search results and chat history
+        text_sources, packing_thought = self.pack_sources(
+            results,
+            self.get_sources_content(results, use_semantic_captions, use_image_citation=False),
             use_semantic_captions,
-            minimum_search_score,
-            minimum_reranker_score,
-            use_query_rewriting,
+            source_token_budget,
         )
+        if packing_thought:
+            thoughts.append(packing_thought)
+        if on_progress:
+            on_progress("data_points", ExtraInfo(DataPoints(text=text_sources), thoughts=list(thoughts)))
 
-        # STEP 3: Generate a contextual and content specific answer using the search results and chat history
-        text_sources = self.get_sources_content(results, use_semantic_captions, use_image_citation=False)
-
-        extra_info = ExtraInfo(
-            DataPoints(text=text_sources),
-            thoughts=[
-                self.format_thought_step_for_chatcompletion(
-                    title="Prompt to generate search query",
-                    messages=query_messages,
-                    overrides=overrides,
-                    model=self.chatgpt_model,
-                    deployment=self.chatgpt_deployment,
-                    usage=chat_completion.usage,
-                    reasoning_effort="low",
-                ),
-                ThoughtStep(
-                    "Search using generated search query",
-                    query_text,
-                    {
-                        "use_semantic_captions": use_semantic_captions,
-                        "use_semantic_ranker": use_semantic_ranker,
-                        "use_query_rewriting": use_query_rewriting,
-                        "top": top,
-                        "filter": search_index_filter,
-                        "use_vector_search": use_vector_search,
-                        "use_text_search": use_text_search,
-                    },
-                ),
-                ThoughtStep(
-                    "Search results",
-                    [result.serialize_for_results() for result in results],
-                ),
-            ],
+        return ExtraInfo(DataPoints(text=text_sources), thoughts=thoughts)
+
+    def can_skip_query_rewrite(self, messages: list[ChatCompletionMessageParam]) -> bool:
+        return (
+            self.query_rewrite_max_skipped_history is not None
+            and len(messages) - 1 <= self.query_rewrite_max_skipped_history
         )
-        return extra_info
+
+    def query_rewrite_stats(self) -> dict[str, Any]:
+        total = self.query_rewrites_generated + self.query_rewrites_skipped
+        return {
+            "generated": self.query_rewrites_generated,
+            "skipped": self.query_rewrites_skipped,
+            "skip_rate": self.query_rewrites_skipped / total if total else 0.0,
+        }
+
+    @staticmethod
+    def is_similar_query(query_text: str, original_user_query: str, threshold: float = 0.8) -> bool:
+        """
+        Returns whether the generated search query has (nearly) the same terms as the user's question,
+        in which case searching for it would return (nearly) the same results
+        """
+        query_terms = set(re.findall(r"\w+", query_text.casefold()))
+        original_terms = set(re.findall(r"\w+", original_user_query.casefold()))
+        if not query_terms or not original_terms:
+            return query_terms == original_terms
+        return len(query_terms & original_terms) / len(query_terms | original_terms) >= threshold
+
+    @staticmethod
+    def fuse_results(result_lists: list[list[Document]], top: int, k: int = 60) -> list[Document]:
+        """
+        Merges ranked result lists with reciprocal rank fusion, keeping the first occurrence of each document.
+        Earlier lists win ties, so the results of the generated search query should be passed first.
+        """
+        scores: dict[str, float] = {}
+        documents: dict[str, Document] = {}
+        for results in result_lists:
+            for rank, document in enumerate(results):
+                document_key = document.id or f"{document.sourcepage}:{document.content}"
+                scores[document_key] = scores.get(document_key, 0) + 1 / (k + rank + 1)
+                documents.setdefault(document_key, document)
+        ranked_keys = sorted(scores, key=lambda document_key: scores[document_key], reverse=True)
+        return [documents[document_key] for document_key in ranked_keys[:top]]
 
     async def run_agentic_retrieval_approach(
         self,
         messages: list[ChatCompletionMessageParam],
         overrides: dict[str, Any],
         auth_claims: dict[str, Any],
+        on_progress: Optional[ProgressCallback] = None,
+        source_token_budget: Optional[int] = None,
     ):
         minimum_reranker_score = overrides.get("minimum_reranker_score", 0)
         search_index_filter = self.build_filter(overrides, auth_claims)
@@ -250,32 +450,39 @@ class ChatReadRetrieveReadApproach(ChatApproach):
             results_merge_strategy=results_merge_strategy,
         )
 
-        text_sources = self.get_sources_content(results, use_semantic_captions=False, use_image_citation=False)
-
-        extra_info = ExtraInfo(
-            DataPoints(text=text_sources),
-            thoughts=[
-                ThoughtStep(
-                    "Use agentic retrieval",
-                    messages,
-                    {
-                        "reranker_threshold": minimum_reranker_score,
-                        "max_docs_for_reranker": max_docs_for_reranker,
-                        "results_merge_strategy": results_merge_strategy,
-                        "filter": search_index_filter,
-                    },
-                ),
-                ThoughtStep(
-                    f"Agentic retrieval results (top {top})",
-                    [result.serialize_for_results() for result in results],
-                    {
-                        "query_plan": (
-                            [activity.as_dict() for activity in response.activity] if response.activity else None
-                        ),
-                        "model": self.agent_model,
-                        "deployment": self.agent_deployment,
-                    },
-                ),
-            ],
+        text_sources, packing_thought = self.pack_sources(
+            results,
+            self.get_sources_content(results, use_semantic_captions=False, use_image_citation=False),
+            False,
+            source_token_budget,
         )
+
+        thoughts = [
+            ThoughtStep(
+                "Use agentic retrieval",
+                messages,
+                {
+                    "reranker_threshold": minimum_reranker_score,
+                    "max_docs_for_reranker": max_docs_for_reranker,
+                    "results_merge_strategy": results_merge_strategy,
+                    "filter": search_index_filter,
+                },
+            ),
+            ThoughtStep(
+                f"Agentic retrieval results (top {top})",
+                [result.serialize_for_results() for result in results],
+                {
+                    "query_plan": (
+                        [activity.as_dict() for activity in response.activity] if response.activity else None
+                    ),
+                    "model": self.agent_model,
+                    "deployment": self.agent_deployment,
+                },
+            ),
+        ]
+        if packing_thought:
+            thoughts.append(packing_thought)
+        extra_info = ExtraInfo(DataPoints(text=text_sources), thoughts=thoughts)
+        if on_progress:
+            on_progress("data_points", extra_info)
         return extra_info
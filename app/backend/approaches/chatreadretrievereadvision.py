@@ -1,6 +1,7 @@
 from collections.abc import Awaitable
 from typing import Any, Callable, Optional, Union, cast
 
+import aiohttp
 from azure.search.documents.aio import SearchClient
 from azure.storage.blob.aio import ContainerClient
 from openai import AsyncOpenAI, AsyncStream
@@ -11,9 +12,11 @@ from openai.types.chat import (
     ChatCompletionToolParam,
 )
 
-from approaches.approach import DataPoints, ExtraInfo, ThoughtStep
+from approaches.approach import DataPoints, ExtraInfo, ProgressCallback, ThoughtStep
 from approaches.chatapproach import ChatApproach
+from approaches.embeddingcache import QueryEmbeddingCache
 from approaches.promptmanager import PromptManager
+from approaches.searchcache import SearchResultCache
 from core.authentication import AuthenticationHelper
 from core.imageshelper import fetch_image
 
@@ -47,6 +50,10 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
         vision_endpoint: str,
         vision_token_provider: Callable[[], Awaitable[str]],
         prompt_manager: PromptManager,
+        embedding_cache: Optional[QueryEmbeddingCache] = None,
+        search_cache: Optional[SearchResultCache] = None,
+        stream_progress: bool = False,
+        http_session: Optional[aiohttp.ClientSession] = None,
     ):
         self.search_client = search_client
         self.blob_container_client = blob_container_client
@@ -72,6 +79,10 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
         self.answer_prompt = self.prompt_manager.load_prompt("chat_answer_question_vision.prompty")
         # Currently disabled due to issues with rendering token usage in the UI
         self.include_token_usage = False
+        self.embedding_cache = embedding_cache
+        self.search_cache = search_cache
+        self.http_session = http_session
+        self.stream_progress = stream_progress
 
     async def run_until_final_call(
         self,
@@ -79,6 +90,8 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
         overrides: dict[str, Any],
         auth_claims: dict[str, Any],
         should_stream: bool = False,
+        on_progress: Optional[ProgressCallback] = None,
+        session_state: Any = None,
     ) -> tuple[ExtraInfo, Union[Awaitable[ChatCompletion], Awaitable[AsyncStream[ChatCompletionChunk]]]]:
         seed = overrides.get("seed", None)
         use_text_search = overrides.get("retrieval_mode") in ["text", "hybrid", None]
@@ -118,6 +131,17 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
         )
 
         query_text = self.get_search_query(chat_completion, original_user_query)
+        query_thought = ThoughtStep(
+            "Prompt to generate search query",
+            query_messages,
+            (
+                {"model": self.chatgpt_model, "deployment": self.chatgpt_deployment}
+                if self.chatgpt_deployment
+                else {"model": self.chatgpt_model}
+            ),
+        )
+        if on_progress:
+            on_progress("search_query", ExtraInfo(DataPoints(), [query_thought]))
 
         # STEP 2: Retrieve relevant documents from the search index with the GPT optimized query
 
@@ -142,6 +166,28 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
             minimum_reranker_score,
             use_query_rewriting,
         )
+        search_thoughts = [
+            query_thought,
+            ThoughtStep(
+                "Search using generated search query",
+                query_text,
+                {
+                    "use_semantic_captions": use_semantic_captions,
+                    "use_semantic_ranker": use_semantic_ranker,
+                    "use_query_rewriting": use_query_rewriting,
+                    "top": top,
+                    "filter": filter,
+                    "vector_fields": vector_fields,
+                    "use_text_search": use_text_search,
+                },
+            ),
+            ThoughtStep(
+                "Search results",
+                [result.serialize_for_results() for result in results],
+            ),
+        ]
+        if on_progress:
+            on_progress("search_results", ExtraInfo(DataPoints(), list(search_thoughts)))
 
         # STEP 3: Generate a contextual and content specific answer using the search results and chat history
         text_sources = []
@@ -153,6 +199,10 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
                 url = await fetch_image(self.blob_container_client, result)
                 if url:
                     image_sources.append(url)
+        if on_progress:
+            on_progress(
+                "data_points", ExtraInfo(DataPoints(text=text_sources, images=image_sources), list(search_thoughts))
+            )
 
         messages = self.prompt_manager.render_prompt(
             self.answer_prompt,
@@ -169,32 +219,7 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
         extra_info = ExtraInfo(
             DataPoints(text=text_sources, images=image_sources),
             [
-                ThoughtStep(
-                    "Prompt to generate search query",
-                    query_messages,
-                    (
-                        {"model": self.chatgpt_model, "deployment": self.chatgpt_deployment}
-                        if self.chatgpt_deployment
-                        else {"model": self.chatgpt_model}
-                    ),
-                ),
-                ThoughtStep(
-                    "Search using generated search query",
-                    query_text,
-                    {
-                        "use_semantic_captions": use_semantic_captions,
-                        "use_semantic_ranker": use_semantic_ranker,
-                        "use_query_rewriting": use_query_rewriting,
-                        "top": top,
-                        "filter": filter,
-                        "vector_fields": vector_fields,
-                        "use_text_search": use_text_search,
-                    },
-                ),
-                ThoughtStep(
-                    "Search results",
-                    [result.serialize_for_results() for result in results],
-                ),
+                *search_thoughts,
                 ThoughtStep(
                     "Prompt to generate answer",
                     messages,
@@ -0,0 +1,109 @@
+from typing import Any, Optional
+
+import tiktoken
+from openai.types.chat import ChatCompletionMessageParam
+
+# The encoding of the token counts stored with each chunk at ingestion. Newer models use o200k_base,
+# which takes fewer tokens for the same text, so counts err on the safe side for them.
+ENCODING_NAME = "cl100k_base"
+# Tokens the chat format adds to every message, and to prime the reply
+MESSAGE_OVERHEAD_TOKENS = 4
+REPLY_OVERHEAD_TOKENS = 3
+# Tokens of the line breaks around every source in the prompt
+SOURCE_OVERHEAD_TOKENS = 2
+
+
+class ContextPacker:
+    """
+    Packs the sources of an answer prompt into a token budget, so that long chunks (like tables)
+    don't push the prompt over the context length of the model or waste prompt tokens.
+    Sources are kept in the order they were ranked: the first source that doesn't fit whole is truncated
+    when enough of it fits to be useful, and every source ranked below it is dropped.
+    """
+
+    def __init__(self, max_prompt_tokens: int = 8000, min_source_tokens: int = 100):
+        if min_source_tokens <= 0 or max_prompt_tokens <= min_source_tokens:
+            raise ValueError("max_prompt_tokens must be greater than min_source_tokens, which must be greater than 0")
+        self.max_prompt_tokens = max_prompt_tokens
+        self.min_source_tokens = min_source_tokens
+        self.encoding = tiktoken.get_encoding(ENCODING_NAME)
+        self.prompts = 0
+        self.kept = 0
+        self.truncated = 0
+        self.dropped = 0
+        self.tokens_saved = 0
+
+    def count_tokens(self, text: str) -> int:
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+    def count_message_tokens(self, messages: list[ChatCompletionMessageParam]) -> int:
+        tokens = REPLY_OVERHEAD_TOKENS
+        for message in messages:
+            tokens += MESSAGE_OVERHEAD_TOKENS
+            content = message.get("content")
+            if isinstance(content, str):
+                tokens += self.count_tokens(content)
+            elif isinstance(content, list):
+                tokens += sum(self.count_tokens(part.get("text", "")) for part in content if isinstance(part, dict))
+        return tokens
+
+    def get_source_token_budget(self, messages: list[ChatCompletionMessageParam]) -> int:
+        """
+        Returns how many tokens are left for the sources, given the prompt rendered without them.
+        The top source always gets at least min_source_tokens, even when the rest of the prompt is over the budget.
+        """
+        return max(
+            self.max_prompt_tokens - self.count_message_tokens(messages),
+            self.min_source_tokens + SOURCE_OVERHEAD_TOKENS,
+        )
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        # A cut can split a multi-byte character, which decodes as a replacement character
+        return self.encoding.decode(self.encoding.encode(text, disallowed_special=())[:max_tokens]).rstrip("\ufffd")
+
+    def pack(
+        self, sources: list[str], token_counts: list[Optional[int]], budget: int
+    ) -> tuple[list[str], list[dict[str, Any]]]:
+        """
+        Returns the sources that fit in the budget, and the decision made for each source.
+        Sources without a token count (stored at ingestion) are counted here.
+        """
+        packed: list[str] = []
+        decisions: list[dict[str, Any]] = []
+        remaining = budget
+        for source, token_count in zip(sources, token_counts):
+            tokens = (token_count if token_count is not None else self.count_tokens(source)) + SOURCE_OVERHEAD_TOKENS
+            decision: dict[str, Any] = {"source": source.partition(": ")[0], "tokens": tokens}
+            if tokens <= remaining:
+                packed.append(source)
+                remaining -= tokens
+                decision["action"] = "kept"
+                decision["kept_tokens"] = tokens
+                self.kept += 1
+            elif remaining - SOURCE_OVERHEAD_TOKENS >= self.min_source_tokens:
+                packed.append(self.truncate(source, remaining - SOURCE_OVERHEAD_TOKENS))
+                decision["action"] = "truncated"
+                decision["kept_tokens"] = remaining
+                self.truncated += 1
+                self.tokens_saved += tokens - remaining
+                # Sources ranked lower are dropped, even the ones small enough to fit
+                remaining = 0
+            else:
+                decision["action"] = "dropped"
+                decision["kept_tokens"] = 0
+                self.dropped += 1
+                self.tokens_saved += tokens
+                remaining = 0
+            decisions.append(decision)
+        self.prompts += 1
+        return packed, decisions
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "max_prompt_tokens": self.max_prompt_tokens,
+            "prompts": self.prompts,
+            "kept": self.kept,
+            "truncated": self.truncated,
+            "dropped": self.dropped,
+            "tokens_saved": self.tokens_saved,
+        }
@@ -0,0 +1,35 @@
+from collections.abc import Awaitable
+from typing import Any, Callable, Optional
+
+from core.cache import SingleFlight, TTLCache
+
+# (model or deployment, dimensions, text)
+EmbeddingCacheKey = tuple[str, Optional[int], str]
+
+
+class QueryEmbeddingCache:
+    """
+    Caches the embeddings of search queries, so that a query that was recently embedded does not need
+    another round trip to the embeddings API. Concurrent requests for the same query share a single call.
+    """
+
+    def __init__(self, max_entries: int = 1000, ttl_seconds: Optional[float] = None):
+        self.entries: TTLCache[EmbeddingCacheKey, list[float]] = TTLCache(max_entries, ttl_seconds)
+        self.in_flight: SingleFlight[EmbeddingCacheKey, list[float]] = SingleFlight()
+
+    async def get_or_create(self, key: EmbeddingCacheKey, create: Callable[[], Awaitable[list[float]]]) -> list[float]:
+        if (embedding := self.entries.get(key)) is not None:
+            return embedding
+
+        async def create_and_store() -> list[float]:
+            embedding = await create()
+            self.entries.set(key, embedding)
+            return embedding
+
+        return await self.in_flight.do(key, create_and_store)
+
+    def stats(self) -> dict[str, Any]:
+        return self.entries.stats() | {
+            "calls": self.in_flight.calls,
+            "coalesced": self.in_flight.coalesced,
+        }
@@ -0,0 +1,211 @@
+import asyncio
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any, Callable, Optional
+
+from openai.types.chat import ChatCompletionMessageParam
+
+from core.cache import TTLCache
+
+if TYPE_CHECKING:
+    from approaches.approach import TokenUsageProps
+
+# Users without an oid (when authentication is off) share one budget
+ANONYMOUS_USER = "anonymous"
+
+
+@dataclass(eq=False)
+class _UserShare:
+    oid: str
+    weight: int
+    balance: float
+    updated_at: float
+    # Calls waiting for a slot, with their estimated tokens
+    waiters: deque[tuple[asyncio.Future[None], int]] = field(default_factory=deque)
+    # Calls left in the user's current round-robin turn
+    credits: int = 0
+    requests: int = 0
+    queued: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    reasoning_tokens: int = 0
+    total_tokens: int = 0
+
+
+@dataclass
+class FairShareTicket:
+    share: _UserShare
+    estimated_tokens: int
+    prompt_chars: int
+
+
+class FairShareScheduler:
+    """
+    Shares the chat completion deployment fairly between users, so that a few heavy users can't use up
+    the tokens-per-minute quota for everyone else.
+    Every user (by oid) has a token bucket that refills at tokens_per_minute, and every call is charged
+    its estimated tokens (prompt and response_token_limit) when it starts, corrected by its actual usage once it ends.
+    While fewer than max_concurrency calls are in flight, calls start right away. Once the deployment is saturated,
+    calls wait and are started in weighted round-robin order between users, preferring users that are within their budget.
+    Not thread-safe: it is meant to be used from a single event loop.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = 16,
+        tokens_per_minute: int = 40000,
+        burst_tokens: Optional[int] = None,
+        weights: Optional[dict[str, int]] = None,
+        max_users: int = 10000,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        if max_concurrency <= 0 or tokens_per_minute <= 0:
+            raise ValueError("max_concurrency and tokens_per_minute must be greater than 0")
+        self.max_concurrency = max_concurrency
+        self.tokens_per_second = tokens_per_minute / 60
+        self.burst_tokens = burst_tokens or tokens_per_minute
+        self.weights = weights or {}
+        self.clock = clock
+        # Idle users are forgotten long after their bucket would be full again, even from a deficit
+        self.users: TTLCache[str, _UserShare] = TTLCache(max_users, 10 * self.burst_tokens / self.tokens_per_second)
+        # Users with waiting calls, in round-robin order
+        self.active: deque[_UserShare] = deque()
+        self.in_flight = 0
+        # Learned from the actual usage, since the ratio differs between languages (Hebrew takes more tokens)
+        self.tokens_per_char = 0.25
+        self.dispatched_over_budget = 0
+
+    def _get_share(self, oid: str) -> _UserShare:
+        share = self.users.get(oid)
+        if share is None:
+            share = _UserShare(oid, self.weights.get(oid, 1), float(self.burst_tokens), self.clock())
+        # Set again on every call, so that only idle users expire
+        self.users.set(oid, share)
+        return share
+
+    def _refill(self, share: _UserShare) -> None:
+        now = self.clock()
+        share.balance = min(float(self.burst_tokens), share.balance + (now - share.updated_at) * self.tokens_per_second)
+        share.updated_at = now
+
+    @staticmethod
+    def count_prompt_chars(messages: list[ChatCompletionMessageParam]) -> int:
+        chars = 0
+        for message in messages:
+            content = message.get("content")
+            if isinstance(content, str):
+                chars += len(content)
+            elif isinstance(content, list):
+                chars += sum(len(part.get("text", "")) for part in content if isinstance(part, dict))
+        return chars
+
+    def _start(self, share: _UserShare, estimated_tokens: int) -> None:
+        self._refill(share)
+        if share.balance <= 0:
+            self.dispatched_over_budget += 1
+        share.balance -= estimated_tokens
+        self.in_flight += 1
+
+    def _pick(self) -> _UserShare:
+        # Users within their budget go first, but the deployment isn't left idle when everyone waiting is over it
+        for _ in range(len(self.active)):
+            self._refill(self.active[0])
+            if self.active[0].balance > 0:
+                break
+            self.active.rotate(-1)
+        share = self.active[0]
+        share.credits -= 1
+        if share.credits <= 0:
+            share.credits = share.weight
+            self.active.rotate(-1)
+        return share
+
+    def _dispatch(self) -> None:
+        while self.active and self.in_flight < self.max_concurrency:
+            share = self._pick()
+            waiter, estimated_tokens = share.waiters.popleft()
+            if not share.waiters:
+                self.active.remove(share)
+            # A cancelled call only leaves the queue once its task runs again, so it can still be picked here
+            if waiter.done():
+                continue
+            self._start(share, estimated_tokens)
+            waiter.set_result(None)
+
+    async def acquire(
+        self, oid: Optional[str], messages: list[ChatCompletionMessageParam], response_token_limit: int
+    ) -> FairShareTicket:
+        share = self._get_share(oid or ANONYMOUS_USER)
+        share.requests += 1
+        prompt_chars = self.count_prompt_chars(messages)
+        ticket = FairShareTicket(share, round(prompt_chars * self.tokens_per_char) + response_token_limit, prompt_chars)
+        if self.in_flight < self.max_concurrency and not self.active:
+            self._start(share, ticket.estimated_tokens)
+            return ticket
+
+        waiter = asyncio.get_running_loop().create_future()
+        share.waiters.append((waiter, ticket.estimated_tokens))
+        share.queued += 1
+        if share not in self.active:
+            share.credits = share.weight
+            self.active.append(share)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # The call was started just as it was cancelled
+                self.release(ticket, None)
+            else:
+                share.waiters = deque(entry for entry in share.waiters if entry[0] is not waiter)
+                if not share.waiters and share in self.active:
+                    self.active.remove(share)
+            raise
+        return ticket
+
+    def release(self, ticket: FairShareTicket, usage: Optional["TokenUsageProps"]) -> None:
+        self.in_flight -= 1
+        share = ticket.share
+        if usage:
+            share.balance += ticket.estimated_tokens - usage.total_tokens
+            share.prompt_tokens += usage.prompt_tokens
+            share.completion_tokens += usage.completion_tokens
+            share.reasoning_tokens += usage.reasoning_tokens or 0
+            share.total_tokens += usage.total_tokens
+            if ticket.prompt_chars:
+                self.tokens_per_char = 0.9 * self.tokens_per_char + 0.1 * usage.prompt_tokens / ticket.prompt_chars
+        self._dispatch()
+
+    def user_stats(self, oid: Optional[str]) -> Optional[dict[str, Any]]:
+        """
+        Returns the budget and token usage of one user, or None if the user has no recent calls
+        """
+        share = self.users.get(oid or ANONYMOUS_USER)
+        if share is None:
+            return None
+        self._refill(share)
+        return {
+            "weight": share.weight,
+            "balance": round(share.balance),
+            "requests": share.requests,
+            "queued": share.queued,
+            "prompt_tokens": share.prompt_tokens,
+            "completion_tokens": share.completion_tokens,
+            "reasoning_tokens": share.reasoning_tokens,
+            "total_tokens": share.total_tokens,
+        }
+
+    def stats(self) -> dict[str, Any]:
+        # Only totals, since the usage of single users is nobody else's business
+        users = [share for _, share in self.users.items()]
+        return {
+            "in_flight": self.in_flight,
+            "max_concurrency": self.max_concurrency,
+            "waiting": sum(len(share.waiters) for share in self.active),
+            "active_users": len(self.active),
+            "users": len(users),
+            "requests": sum(share.requests for share in users),
+            "total_tokens": sum(share.total_tokens for share in users),
+            "tokens_per_char": round(self.tokens_per_char, 3),
+            "dispatched_over_budget": self.dispatched_over_budget,
+        }
@@ -0,0 +1,182 @@
+import hashlib
+import json
+from collections.abc import Awaitable
+from dataclasses import dataclass
+from typing import Any, Callable, Optional
+
+import tiktoken
+from openai.types.chat import ChatCompletionMessageParam
+
+from approaches.contextpacker import ENCODING_NAME, MESSAGE_OVERHEAD_TOKENS
+from core.cache import SingleFlight, TTLCache
+
+# Put in front of the summary, which stands in for the earlier messages of the conversation in prompts
+HISTORY_SUMMARY_PREFIX = "Summary of the earlier conversation:\n"
+
+# Summarizes messages, given the summary of the messages before them (if any)
+HistorySummarizer = Callable[[Optional[str], list[ChatCompletionMessageParam]], Awaitable[str]]
+
+
+@dataclass
+class HistoryWindow:
+    # The history to put in the query rewrite and answer prompts, after the summary message (if any)
+    rewrite_messages: list[ChatCompletionMessageParam]
+    answer_messages: list[ChatCompletionMessageParam]
+    # How many of the earliest messages the summary stands in for
+    summarized_messages: int = 0
+    summary: Optional[str] = None
+    summary_reused: bool = False
+
+
+@dataclass
+class _CachedSummary:
+    summarized_messages: int
+    # Digest of the summarized messages, so that a summary is only used for the conversation it was made from
+    digest: str
+    summary: str
+
+
+class HistoryManager:
+    """
+    Keeps the prompts of long conversations from growing without bound. The last max_turns turns are kept verbatim,
+    as far as they fit in the token budget of each prompt, and the earlier messages are replaced by a rolling summary.
+    The summary is cached per conversation, and only the messages that dropped out of the window
+    since the last summary are summarized on later turns.
+    """
+
+    def __init__(
+        self,
+        rewrite_max_tokens: int = 1000,
+        answer_max_tokens: int = 3000,
+        max_turns: int = 6,
+        summary_max_tokens: int = 300,
+        summary_input_max_tokens: int = 8000,
+        max_entries: int = 1000,
+        ttl_seconds: float = 3600,
+    ):
+        if min(rewrite_max_tokens, answer_max_tokens) <= summary_max_tokens:
+            raise ValueError("The token budgets of the prompts must be greater than summary_max_tokens")
+        self.rewrite_max_tokens = rewrite_max_tokens
+        self.answer_max_tokens = answer_max_tokens
+        self.max_turns = max_turns
+        self.summary_max_tokens = summary_max_tokens
+        self.summary_input_max_tokens = summary_input_max_tokens
+        self.encoding = tiktoken.get_encoding(ENCODING_NAME)
+        self.summaries: TTLCache[str, _CachedSummary] = TTLCache(max_entries, ttl_seconds)
+        self.in_flight: SingleFlight[str, _CachedSummary] = SingleFlight()
+        self.windows = 0
+        self.trimmed = 0
+        self.summaries_reused = 0
+        self.summaries_rolled = 0
+
+    def count_message_tokens(self, message: ChatCompletionMessageParam) -> int:
+        content = message.get("content")
+        if isinstance(content, str):
+            text = content
+        elif isinstance(content, list):
+            text = " ".join(part.get("text", "") for part in content if isinstance(part, dict))
+        else:
+            text = ""
+        return MESSAGE_OVERHEAD_TOKENS + len(self.encoding.encode(text, disallowed_special=()))
+
+    def get_window_start(
+        self, history: list[ChatCompletionMessageParam], max_tokens: int, max_messages: Optional[int] = None
+    ) -> int:
+        """
+        Returns the index of the earliest message that fits in the window, counting back from the latest one
+        """
+        start = len(history)
+        tokens = 0
+        while start > 0 and (max_messages is None or len(history) - start < max_messages):
+            tokens += self.count_message_tokens(history[start - 1])
+            if tokens > max_tokens:
+                break
+            start -= 1
+        return start
+
+    def get_turn_window_start(self, history: list[ChatCompletionMessageParam], max_tokens: int) -> int:
+        start = self.get_window_start(history, max_tokens, 2 * self.max_turns)
+        if start > 0:
+            # Room for the summary of the messages before the window
+            start = self.get_window_start(history, max_tokens - self.summary_max_tokens, 2 * self.max_turns)
+            # The window starts with a question, rather than with the answer to a question it doesn't have
+            while start < len(history) and history[start]["role"] != "user":
+                start += 1
+        return start
+
+    @staticmethod
+    def digest(messages: list[ChatCompletionMessageParam]) -> str:
+        return hashlib.sha256(
+            json.dumps([[message["role"], message.get("content")] for message in messages]).encode()
+        ).hexdigest()
+
+    def build_key(self, oid: Optional[str], session_state: Any, history: list[ChatCompletionMessageParam]) -> str:
+        # Without a session (when chat history is off), the first message tells the conversations apart
+        conversation = session_state if isinstance(session_state, str) and session_state else self.digest(history[:1])
+        return f"{oid or ''}:{conversation}"
+
+    async def get_summary(
+        self, key: str, messages: list[ChatCompletionMessageParam], summarize: HistorySummarizer
+    ) -> tuple[str, bool]:
+        """
+        Returns the summary of the messages, and whether it was already cached
+        """
+        digest = self.digest(messages)
+        cached = self.summaries.get(key)
+        if cached and cached.summarized_messages == len(messages) and cached.digest == digest:
+            self.summaries_reused += 1
+            return cached.summary, True
+
+        previous_summary = None
+        new_messages = messages
+        if (
+            cached
+            and cached.summarized_messages < len(messages)
+            and cached.digest == self.digest(messages[: cached.summarized_messages])
+        ):
+            # Only the messages that dropped out of the window since the last summary are summarized
+            previous_summary = cached.summary
+            new_messages = messages[cached.summarized_messages :]
+            self.summaries_rolled += 1
+        # A conversation summarized for the first time can be too long for one prompt, so only its end is summarized
+        new_messages = new_messages[self.get_window_start(new_messages, self.summary_input_max_tokens) :]
+
+        async def create() -> _CachedSummary:
+            summary = _CachedSummary(len(messages), digest, await summarize(previous_summary, new_messages))
+            self.summaries.set(key, summary)
+            return summary
+
+        return (await self.in_flight.do(f"{key}:{digest}", create)).summary, False
+
+    async def get_window(
+        self, history: list[ChatCompletionMessageParam], key: str, summarize: HistorySummarizer
+    ) -> HistoryWindow:
+        self.windows += 1
+        answer_start = self.get_turn_window_start(history, self.answer_max_tokens)
+        rewrite_start = self.get_turn_window_start(history, self.rewrite_max_tokens)
+        if answer_start == 0:
+            return HistoryWindow(rewrite_messages=history[rewrite_start:], answer_messages=history)
+
+        self.trimmed += 1
+        summary, reused = await self.get_summary(key, history[:answer_start], summarize)
+        summary_message: ChatCompletionMessageParam = {"role": "system", "content": HISTORY_SUMMARY_PREFIX + summary}
+        return HistoryWindow(
+            # The summary covers everything before the answer window, which the rewrite window never goes back past
+            rewrite_messages=[summary_message] + history[max(rewrite_start, answer_start) :],
+            answer_messages=[summary_message] + history[answer_start:],
+            summarized_messages=answer_start,
+            summary=summary,
+            summary_reused=reused,
+        )
+
+    def stats(self) -> dict[str, Any]:
+        in_flight = self.in_flight.stats()
+        return {
+            "windows": self.windows,
+            "trimmed": self.trimmed,
+            "summaries": len(self.summaries),
+            "summaries_computed": in_flight["calls"],
+            "summaries_rolled": self.summaries_rolled,
+            "summaries_reused": self.summaries_reused,
+            "summaries_coalesced": in_flight["coalesced"],
+        }
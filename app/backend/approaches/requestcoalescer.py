@@ -0,0 +1,151 @@
+import asyncio
+from collections.abc import AsyncGenerator
+from typing import Any, Optional
+
+from openai.types.chat import ChatCompletionMessageParam
+
+from approaches.answercache import AnswerCache
+from approaches.approach import Approach
+from core.cache import SingleFlight
+
+# (digest of the approach, overrides and search filter, normalized question)
+RequestCoalescerKey = tuple[str, str]
+
+
+class _SharedStream:
+    """
+    Runs one streamed answer and keeps its events, so that every request attached to it
+    gets all of them from the start, whenever it attached.
+    """
+
+    def __init__(self, events: AsyncGenerator[dict[str, Any], None]):
+        self.events: list[dict[str, Any]] = []
+        self.finished = False
+        self.error: Optional[Exception] = None
+        # Requests attached to the answer, counted when they attach so that none is cut off before it starts reading
+        self.subscribers = 0
+        self.cancelled = False
+        self.changed = asyncio.Event()
+        self.task = asyncio.create_task(self._run(events))
+
+    async def _run(self, events: AsyncGenerator[dict[str, Any], None]):
+        try:
+            async for event in events:
+                self.events.append(event)
+                self._notify()
+        except Exception as error:
+            self.error = error
+        finally:
+            self.finished = True
+            self._notify()
+
+    def _notify(self):
+        # Setting the event wakes up every subscriber waiting right now, clearing it lets them wait again
+        self.changed.set()
+        self.changed.clear()
+
+    async def subscribe(self, session_state: Any) -> AsyncGenerator[dict[str, Any], None]:
+        index = 0
+        try:
+            while True:
+                if index < len(self.events):
+                    event = self.events[index]
+                    index += 1
+                    # Every request keeps its own session
+                    yield {**event, "session_state": session_state} if "session_state" in event else event
+                elif self.error:
+                    raise self.error
+                elif self.finished:
+                    return
+                else:
+                    await self.changed.wait()
+        finally:
+            self.subscribers -= 1
+            # The answer is only generated as long as someone is still reading it
+            if self.subscribers == 0 and not self.finished:
+                self.cancelled = True
+                self.task.cancel()
+
+
+class RequestCoalescer:
+    """
+    Lets concurrent identical requests share one run of an approach, so that a burst of users asking
+    the same question costs a single query rewrite, embedding, search and answer.
+    Only requests without history are coalesced, and only with requests for the same approach,
+    with the same overrides and the same search filter, so answers never cross security scopes.
+    Streamed requests get every event of the shared answer, with their own session state.
+    """
+
+    def __init__(self):
+        self.in_flight: SingleFlight[RequestCoalescerKey, dict[str, Any]] = SingleFlight()
+        self.streams: dict[RequestCoalescerKey, _SharedStream] = {}
+        self.stream_runs = 0
+        self.streams_coalesced = 0
+        self.skipped = 0
+
+    def build_key(
+        self, approach: Approach, messages: list[ChatCompletionMessageParam], context: dict[str, Any]
+    ) -> Optional[RequestCoalescerKey]:
+        if len(messages) != 1:
+            self.skipped += 1
+            return None
+        overrides = context.get("overrides", {})
+        # The search filter carries the security filter of the user
+        search_filter = approach.build_filter(overrides, context.get("auth_claims", {}))
+        key = AnswerCache.build_key(type(approach).__name__, messages, overrides, search_filter)
+        if key is None:
+            self.skipped += 1
+            return None
+        return (key.scope, key.question)
+
+    async def run(
+        self,
+        approach: Approach,
+        messages: list[ChatCompletionMessageParam],
+        context: dict[str, Any],
+        session_state: Any = None,
+    ) -> dict[str, Any]:
+        key = self.build_key(approach, messages, context)
+        if key is None:
+            return await approach.run(messages, context=context, session_state=session_state)
+        response = await self.in_flight.do(key, lambda: approach.run(messages, context=context))
+        return {**response, "session_state": session_state}
+
+    async def run_stream(
+        self,
+        approach: Approach,
+        messages: list[ChatCompletionMessageParam],
+        context: dict[str, Any],
+        session_state: Any = None,
+    ) -> AsyncGenerator[dict[str, Any], None]:
+        key = self.build_key(approach, messages, context)
+        if key is None:
+            return await approach.run_stream(messages, context=context, session_state=session_state)
+        stream = self.streams.get(key)
+        if stream is None or stream.cancelled:
+            self.stream_runs += 1
+            stream = _SharedStream(await approach.run_stream(messages, context=context))
+            self.streams[key] = stream
+            stream.task.add_done_callback(lambda _: self._forget(key, stream))
+        else:
+            self.streams_coalesced += 1
+        stream.subscribers += 1
+        return stream.subscribe(session_state)
+
+    def _forget(self, key: RequestCoalescerKey, stream: _SharedStream) -> None:
+        if self.streams.get(key) is stream:
+            del self.streams[key]
+
+    def stats(self) -> dict[str, Any]:
+        in_flight = self.in_flight.stats()
+        return {
+            "in_flight": in_flight["in_flight"],
+            "runs": in_flight["calls"],
+            "coalesced": in_flight["coalesced"],
+            "streams_in_flight": len(self.streams),
+            "stream_runs": self.stream_runs,
+            "streams_coalesced": self.streams_coalesced,
+            # Every coalesced request saved a whole run of the approach, with all its downstream calls
+            "saved_runs": in_flight["coalesced"] + self.streams_coalesced,
+            "skipped": self.skipped,
+        }
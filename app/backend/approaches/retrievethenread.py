@@ -1,13 +1,23 @@
-from typing import Any, Optional, cast
+from collections.abc import AsyncGenerator, Awaitable
+from typing import Any, Optional, Union, cast
 
 from azure.search.documents.agent.aio import KnowledgeAgentRetrievalClient
 from azure.search.documents.aio import SearchClient
 from azure.search.documents.models import VectorQuery
-from openai import AsyncOpenAI
-from openai.types.chat import ChatCompletion, ChatCompletionMessageParam
+from openai import AsyncOpenAI, AsyncStream
+from openai.types.chat import (
+    ChatCompletion,
+    ChatCompletionChunk,
+    ChatCompletionMessageParam,
+)
 
+from approaches.answercache import AnswerCache, CachedAnswer
 from approaches.approach import Approach, DataPoints, ExtraInfo, ThoughtStep
+from approaches.contextpacker import ContextPacker
+from approaches.embeddingcache import QueryEmbeddingCache
+from approaches.fairshare import FairShareScheduler
 from approaches.promptmanager import PromptManager
+from approaches.searchcache import SearchResultCache
 from core.authentication import AuthenticationHelper
 
 
@@ -40,6 +50,11 @@ class RetrieveThenReadApproach(Approach):
         query_speller: str,
         prompt_manager: PromptManager,
         reasoning_effort: Optional[str] = None,
+        answer_cache: Optional[AnswerCache] = None,
+        embedding_cache: Optional[QueryEmbeddingCache] = None,
+        search_cache: Optional[SearchResultCache] = None,
+        chat_scheduler: Optional[FairShareScheduler] = None,
+        context_packer: Optional[ContextPacker] = None,
     ):
         self.search_client = search_client
         self.search_index_name = search_index_name
@@ -63,41 +78,51 @@ class RetrieveThenReadApproach(Approach):
         self.answer_prompt = self.prompt_manager.load_prompt("ask_answer_question.prompty")
         self.reasoning_effort = reasoning_effort
         self.include_token_usage = True
+        self.answer_cache = answer_cache
+        self.embedding_cache = embedding_cache
+        self.search_cache = search_cache
+        self.chat_scheduler = chat_scheduler
+        self.context_packer = context_packer
 
-    async def run(
+    async def run_until_final_call(
         self,
         messages: list[ChatCompletionMessageParam],
-        session_state: Any = None,
-        context: dict[str, Any] = {},
-    ) -> dict[str, Any]:
-        overrides = context.get("overrides", {})
-        auth_claims = context.get("auth_claims", {})
+        overrides: dict[str, Any],
+        auth_claims: dict[str, Any],
+        should_stream: bool = False,
+    ) -> tuple[ExtraInfo, Union[Awaitable[ChatCompletion], Awaitable[AsyncStream[ChatCompletionChunk]]]]:
         use_agentic_retrieval = True if overrides.get("use_agentic_retrieval") else False
         q = messages[-1]["content"]
         if not isinstance(q, str):
             raise ValueError("The most recent message content must be a string.")
 
+        reasoning_model_support = self.GPT_REASONING_MODELS.get(self.chatgpt_model)
+        if reasoning_model_support and (not reasoning_model_support.streaming and should_stream):
+            raise Exception(
+                f"{self.chatgpt_model} does not support streaming. Please use a different model or disable streaming."
+            )
+        prompt_variables = self.get_system_prompt_variables(overrides.get("prompt_template")) | {"user_query": q}
+        source_token_budget = self.get_source_token_budget(self.answer_prompt, prompt_variables)
         if use_agentic_retrieval:
-            extra_info = await self.run_agentic_retrieval_approach(messages, overrides, auth_claims)
+            extra_info = await self.run_agentic_retrieval_approach(
+                messages, overrides, auth_claims, source_token_budget
+            )
         else:
-            extra_info = await self.run_search_approach(messages, overrides, auth_claims)
+            extra_info = await self.run_search_approach(messages, overrides, auth_claims, source_token_budget)
 
         # Process results
         messages = self.prompt_manager.render_prompt(
-            self.answer_prompt,
-            self.get_system_prompt_variables(overrides.get("prompt_template"))
-            | {"user_query": q, "text_sources": extra_info.data_points.text},
+            self.answer_prompt, prompt_variables | {"text_sources": extra_info.data_points.text}
         )
 
-        chat_completion = cast(
-            ChatCompletion,
-            await self.create_chat_completion(
-                self.chatgpt_deployment,
-                self.chatgpt_model,
-                messages=messages,
-                overrides=overrides,
-                response_token_limit=self.get_response_token_limit(self.chatgpt_model, 1024),
-            ),
+        chat_coroutine = self.create_chat_completion(
+            self.chatgpt_deployment,
+            self.chatgpt_model,
+            messages=messages,
+            overrides=overrides,
+            response_token_limit=self.get_response_token_limit(self.chatgpt_model, 1024),
+            should_stream=should_stream,
+            auth_claims=auth_claims,
         )
         extra_info.thoughts.append(
             self.format_thought_step_for_chatcompletion(
@@ -106,20 +131,88 @@ class RetrieveThenReadApproach(Approach):
                 overrides=overrides,
                 model=self.chatgpt_model,
                 deployment=self.chatgpt_deployment,
-                usage=chat_completion.usage,
             )
         )
+        return (extra_info, chat_coroutine)
+
+    async def run(
+        self,
+        messages: list[ChatCompletionMessageParam],
+        session_state: Any = None,
+        context: dict[str, Any] = {},
+    ) -> dict[str, Any]:
+        overrides = context.get("overrides", {})
+        auth_claims = context.get("auth_claims", {})
+
+        cache_key = self.get_answer_cache_key(messages, overrides, auth_claims)
+        if cached_answer := await self.get_cached_answer(cache_key):
+            return {
+                "message": {"content": cached_answer.content, "role": cached_answer.role},
+                "context": cached_answer.context,
+                "session_state": session_state,
+            }
+
+        extra_info, chat_coroutine = await self.run_until_final_call(
+            messages, overrides, auth_claims, should_stream=False
+        )
+        chat_completion = await cast(Awaitable[ChatCompletion], chat_coroutine)
+        if extra_info.thoughts and chat_completion.usage:
+            extra_info.thoughts[-1].update_token_usage(chat_completion.usage)
+        content = chat_completion.choices[0].message.content
+        role = chat_completion.choices[0].message.role
+        self.cache_answer(cache_key, CachedAnswer(content, role, extra_info))
         return {
             "message": {
-                "content": chat_completion.choices[0].message.content,
-                "role": chat_completion.choices[0].message.role,
+                "content": content,
+                "role": role,
             },
             "context": extra_info,
             "session_state": session_state,
         }
 
+    async def run_stream(
+        self,
+        messages: list[ChatCompletionMessageParam],
+        session_state: Any = None,
+        context: dict[str, Any] = {},
+    ) -> AsyncGenerator[dict[str, Any], None]:
+        overrides = context.get("overrides", {})
+        auth_claims = context.get("auth_claims", {})
+        return self.run_with_streaming(messages, overrides, auth_claims, session_state)
+
+    async def run_with_streaming(
+        self,
+        messages: list[ChatCompletionMessageParam],
+        overrides: dict[str, Any],
+        auth_claims: dict[str, Any],
+        session_state: Any = None,
+    ) -> AsyncGenerator[dict, None]:
+        cache_key = self.get_answer_cache_key(messages, overrides, auth_claims)
+        if cached_answer := await self.get_cached_answer(cache_key):
+            # Replay the cached answer as a single delta
+            yield {"delta": {"role": "assistant"}, "context": cached_answer.context, "session_state": session_state}
+            yield {"delta": {"content": cached_answer.content, "role": cached_answer.role}}
+            return
+
+        extra_info, chat_coroutine = await self.run_until_final_call(
+            messages, overrides, auth_claims, should_stream=True
+        )
+        answer_content = []
+        async for event in self.stream_answer(
+            extra_info, cast(Awaitable[AsyncStream[ChatCompletionChunk]], chat_coroutine), session_state
+        ):
+            if content := event["delta"].get("content"):
+                answer_content.append(content)
+            yield event
+
+        self.cache_answer(cache_key, CachedAnswer("".join(answer_content), "assistant", extra_info))
+
     async def run_search_approach(
-        self, messages: list[ChatCompletionMessageParam], overrides: dict[str, Any], auth_claims: dict[str, Any]
+        self,
+        messages: list[ChatCompletionMessageParam],
+        overrides: dict[str, Any],
+        auth_claims: dict[str, Any],
+        source_token_budget: Optional[int] = None,
     ):
         use_text_search = overrides.get("retrieval_mode") in ["text", "hybrid", None]
         use_vector_search = overrides.get("retrieval_mode") in ["vectors", "hybrid", None]
@@ -151,36 +244,42 @@ class RetrieveThenReadApproach(Approach):
             use_query_rewriting,
         )
 
-        text_sources = self.get_sources_content(results, use_semantic_captions, use_image_citation=False)
-
-        return ExtraInfo(
-            DataPoints(text=text_sources),
-            thoughts=[
-                ThoughtStep(
-                    "Search using user query",
-                    q,
-                    {
-                        "use_semantic_captions": use_semantic_captions,
-                        "use_semantic_ranker": use_semantic_ranker,
-                        "use_query_rewriting": use_query_rewriting,
-                        "top": top,
-                        "filter": filter,
-                        "use_vector_search": use_vector_search,
-                        "use_text_search": use_text_search,
-                    },
-                ),
-                ThoughtStep(
-                    "Search results",
-                    [result.serialize_for_results() for result in results],
-                ),
-            ],
+        text_sources, packing_thought = self.pack_sources(
+            results,
+            self.get_sources_content(results, use_semantic_captions, use_image_citation=False),
+            use_semantic_captions,
+            source_token_budget,
         )
 
+        thoughts = [
+            ThoughtStep(
+                "Search using user query",
+                q,
+                {
+                    "use_semantic_captions": use_semantic_captions,
+                    "use_semantic_ranker": use_semantic_ranker,
+                    "use_query_rewriting": use_query_rewriting,
+                    "top": top,
+                    "filter": filter,
+                    "use_vector_search": use_vector_search,
+                    "use_text_search": use_text_search,
+                },
+            ),
+            ThoughtStep(
+                "Search results",
+                [result.serialize_for_results() for result in results],
+            ),
+        ]
+        if packing_thought:
+            thoughts.append(packing_thought)
+        return ExtraInfo(DataPoints(text=text_sources), thoughts=thoughts)
+
     async def run_agentic_retrieval_approach(
         self,
         messages: list[ChatCompletionMessageParam],
         overrides: dict[str, Any],
         auth_claims: dict[str, Any],
+        source_token_budget: Optional[int] = None,
     ):
         minimum_reranker_score = overrides.get("minimum_reranker_score", 0)
         search_index_filter = self.build_filter(overrides, auth_claims)
@@ -201,32 +300,37 @@ class RetrieveThenReadApproach(Approach):
             results_merge_strategy=results_merge_strategy,
         )
 
-        text_sources = self.get_sources_content(results, use_semantic_captions=False, use_image_citation=False)
-
-        extra_info = ExtraInfo(
-            DataPoints(text=text_sources),
-            thoughts=[
-                ThoughtStep(
-                    "Use agentic retrieval",
-                    messages,
-                    {
-                        "reranker_threshold": minimum_reranker_score,
-                        "max_docs_for_reranker": max_docs_for_reranker,
-                        "results_merge_strategy": results_merge_strategy,
-                        "filter": search_index_filter,
-                    },
-                ),
-                ThoughtStep(
-                    f"Agentic retrieval results (top {top})",
-                    [result.serialize_for_results() for result in results],
-                    {
-                        "query_plan": (
-                            [activity.as_dict() for activity in response.activity] if response.activity else None
-                        ),
-                        "model": self.agent_model,
-                        "deployment": self.agent_deployment,
-                    },
-                ),
-            ],
+        text_sources, packing_thought = self.pack_sources(
+            results,
+            self.get_sources_content(results, use_semantic_captions=False, use_image_citation=False),
+            False,
+            source_token_budget,
         )
+
+        thoughts = [
+            ThoughtStep(
+                "Use agentic retrieval",
+                messages,
+                {
+                    "reranker_threshold": minimum_reranker_score,
+                    "max_docs_for_reranker": max_docs_for_reranker,
+                    "results_merge_strategy": results_merge_strategy,
+                    "filter": search_index_filter,
+                },
+            ),
+            ThoughtStep(
+                f"Agentic retrieval results (top {top})",
+                [result.serialize_for_results() for result in results],
+                {
+                    "query_plan": (
+                        [activity.as_dict() for activity in response.activity] if response.activity else None
+                    ),
+                    "model": self.agent_model,
+                    "deployment": self.agent_deployment,
+                },
+            ),
+        ]
+        if packing_thought:
+            thoughts.append(packing_thought)
+        extra_info = ExtraInfo(DataPoints(text=text_sources), thoughts=thoughts)
         return extra_info
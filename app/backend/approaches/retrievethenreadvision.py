@@ -1,15 +1,20 @@
-from collections.abc import Awaitable
-from typing import Any, Callable, Optional
+from collections.abc import AsyncGenerator, Awaitable
+from typing import Any, Callable, Optional, Union, cast
 
+import aiohttp
 from azure.search.documents.aio import SearchClient
 from azure.storage.blob.aio import ContainerClient
-from openai import AsyncOpenAI
+from openai import AsyncOpenAI, AsyncStream
 from openai.types.chat import (
+    ChatCompletion,
+    ChatCompletionChunk,
     ChatCompletionMessageParam,
 )
 
 from approaches.approach import Approach, DataPoints, ExtraInfo, ThoughtStep
+from approaches.embeddingcache import QueryEmbeddingCache
 from approaches.promptmanager import PromptManager
+from approaches.searchcache import SearchResultCache
 from core.authentication import AuthenticationHelper
 from core.imageshelper import fetch_image
 
@@ -41,6 +46,9 @@ class RetrieveThenReadVisionApproach(Approach):
         vision_endpoint: str,
         vision_token_provider: Callable[[], Awaitable[str]],
         prompt_manager: PromptManager,
+        embedding_cache: Optional[QueryEmbeddingCache] = None,
+        search_cache: Optional[SearchResultCache] = None,
+        http_session: Optional[aiohttp.ClientSession] = None,
     ):
         self.search_client = search_client
         self.blob_container_client = blob_container_client
@@ -62,20 +70,22 @@ class RetrieveThenReadVisionApproach(Approach):
         self.answer_prompt = self.prompt_manager.load_prompt("ask_answer_question_vision.prompty")
         # Currently disabled due to issues with rendering token usage in the UI
         self.include_token_usage = False
+        self.embedding_cache = embedding_cache
+        self.search_cache = search_cache
+        self.http_session = http_session
 
-    async def run(
+    async def run_until_final_call(
         self,
         messages: list[ChatCompletionMessageParam],
-        session_state: Any = None,
-        context: dict[str, Any] = {},
-    ) -> dict[str, Any]:
+        overrides: dict[str, Any],
+        auth_claims: dict[str, Any],
+        should_stream: bool = False,
+    ) -> tuple[ExtraInfo, Union[Awaitable[ChatCompletion], Awaitable[AsyncStream[ChatCompletionChunk]]]]:
         q = messages[-1]["content"]
         if not isinstance(q, str):
             raise ValueError("The most recent message content must be a string.")
 
-        overrides = context.get("overrides", {})
         seed = overrides.get("seed", None)
-        auth_claims = context.get("auth_claims", {})
         use_text_search = overrides.get("retrieval_mode") in ["text", "hybrid", None]
         use_vector_search = overrides.get("retrieval_mode") in ["vectors", "hybrid", None]
         use_semantic_ranker = True if overrides.get("semantic_ranker") else False
@@ -129,13 +139,17 @@ class RetrieveThenReadVisionApproach(Approach):
             | {"user_query": q, "text_sources": text_sources, "image_sources": image_sources},
         )
 
-        chat_completion = await self.openai_client.chat.completions.create(
-            model=self.gpt4v_deployment if self.gpt4v_deployment else self.gpt4v_model,
-            messages=messages,
-            temperature=overrides.get("temperature", 0.3),
-            max_tokens=1024,
-            n=1,
-            seed=seed,
+        chat_coroutine = cast(
+            Union[Awaitable[ChatCompletion], Awaitable[AsyncStream[ChatCompletionChunk]]],
+            self.openai_client.chat.completions.create(
+                model=self.gpt4v_deployment if self.gpt4v_deployment else self.gpt4v_model,
+                messages=messages,
+                temperature=overrides.get("temperature", 0.3),
+                max_tokens=1024,
+                n=1,
+                seed=seed,
+                stream=should_stream,
+            ),
         )
 
         extra_info = ExtraInfo(
@@ -170,6 +184,20 @@ class RetrieveThenReadVisionApproach(Approach):
                 ),
             ],
         )
+        return (extra_info, chat_coroutine)
+
+    async def run(
+        self,
+        messages: list[ChatCompletionMessageParam],
+        session_state: Any = None,
+        context: dict[str, Any] = {},
+    ) -> dict[str, Any]:
+        overrides = context.get("overrides", {})
+        auth_claims = context.get("auth_claims", {})
+        extra_info, chat_coroutine = await self.run_until_final_call(
+            messages, overrides, auth_claims, should_stream=False
+        )
+        chat_completion = await cast(Awaitable[ChatCompletion], chat_coroutine)
 
         return {
             "message": {
@@ -179,3 +207,18 @@ class RetrieveThenReadVisionApproach(Approach):
             "context": extra_info,
             "session_state": session_state,
         }
+
+    async def run_stream(
+        self,
+        messages: list[ChatCompletionMessageParam],
+        session_state: Any = None,
+        context: dict[str, Any] = {},
+    ) -> AsyncGenerator[dict[str, Any], None]:
+        overrides = context.get("overrides", {})
+        auth_claims = context.get("auth_claims", {})
+        extra_info, chat_coroutine = await self.run_until_final_call(
+            messages, overrides, auth_claims, should_stream=True
+        )
+        return self.stream_answer(
+            extra_info, cast(Awaitable[AsyncStream[ChatCompletionChunk]], chat_coroutine), session_state
+        )
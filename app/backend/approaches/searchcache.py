@@ -0,0 +1,89 @@
+import hashlib
+import json
+import struct
+from typing import TYPE_CHECKING, Any, Optional
+
+from azure.search.documents.models import VectorizedQuery, VectorQuery
+
+from core.cache import TTLCache
+
+if TYPE_CHECKING:
+    from approaches.approach import Document
+
+# Rough per-object overhead of a cached Document and each of its strings, used to estimate the memory footprint
+DOCUMENT_OVERHEAD_BYTES = 200
+STRING_OVERHEAD_BYTES = 50
+
+
+class SearchResultCache:
+    """
+    Caches the documents returned by Azure AI Search for a query, keyed by everything that is sent with the query.
+    Every key includes the current index generation, which is bumped whenever documents are added to or removed
+    from the index, so results from before the change are never returned and age out of the cache.
+    """
+
+    def __init__(self, max_entries: int = 1000, ttl_seconds: Optional[float] = 300):
+        self.entries: TTLCache[str, tuple[int, list[Document]]] = TTLCache(max_entries, ttl_seconds)
+        self.generation = 0
+
+    def build_key(
+        self,
+        search_text: Optional[str],
+        filter: Optional[str],
+        vectors: list[VectorQuery],
+        top: int,
+        use_semantic_ranker: bool,
+        use_semantic_captions: bool,
+        use_query_rewriting: Optional[bool],
+        query_language: Optional[str],
+    ) -> str:
+        key = json.dumps(
+            [
+                self.generation,
+                search_text,
+                filter,
+                [self._hash_vector_query(vector) for vector in vectors],
+                top,
+                use_semantic_ranker,
+                use_semantic_captions,
+                bool(use_query_rewriting),
+                query_language,
+            ],
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[list["Document"]]:
+        entry = self.entries.get(key)
+        # Callers may reorder or trim the list, so always hand out a copy
+        return list(entry[1]) if entry else None
+
+    def store(self, key: str, documents: list["Document"]) -> None:
+        self.entries.set(key, (sum(self._estimate_size(document) for document in documents), list(documents)))
+
+    def bump_generation(self) -> None:
+        self.generation += 1
+
+    def stats(self) -> dict[str, Any]:
+        return self.entries.stats() | {
+            "generation": self.generation,
+            "estimated_bytes": sum(size for _, (size, _) in self.entries.items()),
+        }
+
+    @staticmethod
+    def _hash_vector_query(vector_query: VectorQuery) -> str:
+        if isinstance(vector_query, VectorizedQuery) and vector_query.vector:
+            vector_hash = hashlib.sha256(struct.pack(f"{len(vector_query.vector)}d", *vector_query.vector))
+            return f"{vector_query.fields}:{vector_query.k_nearest_neighbors}:{vector_hash.hexdigest()}"
+        return hashlib.sha256(json.dumps(vector_query.as_dict(), sort_keys=True).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _estimate_size(document: "Document") -> int:
+        strings = [document.id, document.content, document.category, document.sourcepage, document.sourcefile]
+        strings += document.oids or []
+        strings += document.groups or []
+        strings += [caption.text for caption in document.captions or []]
+        strings += [caption.highlights for caption in document.captions or []]
+        return DOCUMENT_OVERHEAD_BYTES + sum(
+            STRING_OVERHEAD_BYTES + len(string.encode("utf-8")) for string in strings if string
+        )
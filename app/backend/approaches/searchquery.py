@@ -0,0 +1,65 @@
+import re
+
+# Question words, pronouns, auxiliaries and prepositions that only add noise to a keyword search
+ENGLISH_STOPWORDS = frozenset(
+    """
+    a about an and any are as at be been being but by can could did do does for from had has have how i if in into
+    is it its me my of on or our please should so some tell than that the their them there these they this those to
+    us was we were what when where which who whom whose why will with would you your
+    """.split()
+)
+
+HEBREW_STOPWORDS = frozenset(
+    """
+    אבל אותו אותי אותה אותם אז אחרי איזה איך אין איפה אם אנחנו אני אצל את אתה אתם אתן בבקשה בין גם האם הוא היא הם הן הזה הזאת
+    היה היו זה זאת זו יש כדי כל כמה כן לא לי לך לנו לפי לפני למה מה מהו מהי מי מתי נא עוד עם על עד רק של שלי שלך שלנו תגיד תגידי תסביר
+    """.split()
+)
+
+# Conjunction prefixes ("and", "and the", "and in", ...) that are attached to the following Hebrew word.
+# Single-letter prepositions such as ב/ל/מ/ש/כ/ה are kept, since many roots start with the same letters
+# and the fuzzy matching in Approach.search already tolerates one extra leading letter.
+HEBREW_PREFIXES = ("וה", "וב", "ול", "ומ", "וש", "וכ")
+# "And" on its own, which can't be told apart from the many roots that start with ו (ועדה, ועד, וילון),
+# so words starting with it are searched both with and without it
+HEBREW_CONJUNCTION = "ו"
+
+HEBREW_WORD = re.compile(r"^[א-ת]+$")
+
+
+def strip_hebrew_prefix(word: str) -> str:
+    if not HEBREW_WORD.match(word):
+        return word
+    for prefix in HEBREW_PREFIXES:
+        if word.startswith(prefix) and len(word) - len(prefix) >= 3:
+            return word[len(prefix) :]
+    return word
+
+
+def hebrew_word_forms(word: str) -> list[str]:
+    stripped = strip_hebrew_prefix(word)
+    if stripped != word:
+        return [stripped]
+    if HEBREW_WORD.match(word) and word.startswith(HEBREW_CONJUNCTION) and len(word) - len(HEBREW_CONJUNCTION) >= 3:
+        return [word, word[len(HEBREW_CONJUNCTION) :]]
+    return [word]
+
+
+def build_search_query(question: str) -> str:
+    """
+    Derives a keyword search query from a question without calling a model,
+    by dropping punctuation, stopwords and Hebrew conjunction prefixes.
+    Returns an empty string when nothing but stopwords is left.
+    """
+    # Drop Hebrew vowel points and cantillation marks, which are not part of the indexed text
+    question = re.sub(r"[֑-ׇ]", "", question)
+    terms: list[str] = []
+    for word in re.findall(r"\w+", question.casefold()):
+        if word in ENGLISH_STOPWORDS or word in HEBREW_STOPWORDS:
+            continue
+        forms = hebrew_word_forms(word)
+        # "And" followed by a stopword (וכמה, ומה) is still a stopword
+        if any(form in HEBREW_STOPWORDS for form in forms):
+            continue
+        terms.extend(form for form in forms if form not in terms)
+    return " ".join(terms)
@@ -0,0 +1,165 @@
+import asyncio
+import contextlib
+import dataclasses
+import json
+import os
+import re
+import time
+import uuid
+from collections.abc import AsyncGenerator
+from pathlib import Path
+from typing import Any, Optional, Union
+
+from approaches.approach import ExtraInfo, ThoughtStep
+from core.cache import TTLCache
+
+THOUGHTS_FILE_SUFFIX = ".thoughts.json"
+PARTIAL_FILE_SUFFIX = ".partial"
+# Ids are only ever created by the store, so anything else is rejected before it gets near the file system
+THOUGHTS_ID_PATTERN = re.compile(r"[0-9a-f]{32}")
+# Expired files are removed every this many stores
+PRUNE_INTERVAL = 100
+
+
+def serialize_thought_value(value: Any) -> Any:
+    if dataclasses.is_dataclass(value) and not isinstance(value, type):
+        return {field.name: getattr(value, field.name) for field in dataclasses.fields(value)}
+    return str(value)
+
+
+class ThoughtStore:
+    """
+    Keeps the thought steps of answers on the server for a while, so that responses only carry a thoughts_id
+    and the client fetches the thoughts when the thought process is opened.
+    The rendered prompts in the thoughts make up most of a response, and they are rarely looked at.
+    Thoughts are kept in memory, and also written to a directory when one is given, so that every worker process
+    sharing the directory can hand them out, not only the one that answered.
+    Thoughts are only handed out to the user they were created for.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1000,
+        ttl_seconds: Optional[float] = 3600,
+        directory: Optional[Union[str, Path]] = None,
+    ):
+        self.entries: TTLCache[str, tuple[Optional[str], list[Any]]] = TTLCache(max_entries, ttl_seconds)
+        self.ttl_seconds = ttl_seconds
+        self.directory = Path(directory) if directory else None
+        if self.directory:
+            self.directory.mkdir(parents=True, exist_ok=True)
+        self.stores = 0
+        self.file_hits = 0
+        self.skipped_events = 0
+
+    def _file_path(self, thoughts_id: str) -> Path:
+        assert self.directory is not None
+        return self.directory / f"{thoughts_id}{THOUGHTS_FILE_SUFFIX}"
+
+    def _write(self, thoughts_id: str, owner: Optional[str], thoughts: list[ThoughtStep]) -> None:
+        expires_at = time.time() + self.ttl_seconds if self.ttl_seconds is not None else None
+        file_path = self._file_path(thoughts_id)
+        # Written under another name first, so that other workers never read a half written file
+        partial_path = file_path.with_name(f"{file_path.name}.{uuid.uuid4().hex}{PARTIAL_FILE_SUFFIX}")
+        partial_path.write_text(
+            json.dumps(
+                {"owner": owner, "expires_at": expires_at, "thoughts": thoughts},
+                default=serialize_thought_value,
+                ensure_ascii=False,
+            ),
+            encoding="utf-8",
+        )
+        os.replace(partial_path, file_path)
+        if self.stores % PRUNE_INTERVAL == 0:
+            self._prune()
+
+    def _read(self, thoughts_id: str) -> Optional[dict[str, Any]]:
+        try:
+            entry = json.loads(self._file_path(thoughts_id).read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return None
+        if entry["expires_at"] is not None and entry["expires_at"] <= time.time():
+            return None
+        return entry
+
+    def _prune(self) -> None:
+        if self.ttl_seconds is None:
+            return
+        assert self.directory is not None
+        # Files are written again whenever their thoughts change, so their age tells when they expire
+        expired_before = time.time() - self.ttl_seconds
+        for file_path in self.directory.iterdir():
+            with contextlib.suppress(OSError):
+                if file_path.stat().st_mtime < expired_before:
+                    file_path.unlink()
+
+    async def store(
+        self, thoughts: Optional[list[ThoughtStep]], owner: Optional[str], thoughts_id: Optional[str] = None
+    ) -> str:
+        thoughts_id = thoughts_id or uuid.uuid4().hex
+        self.entries.set(thoughts_id, (owner, thoughts or []))
+        self.stores += 1
+        if self.directory:
+            await asyncio.to_thread(self._write, thoughts_id, owner, thoughts or [])
+        return thoughts_id
+
+    async def get(self, thoughts_id: str, owner: Optional[str]) -> Optional[list[Any]]:
+        """
+        Returns the thought steps, as stored in memory or as read back from the directory
+        """
+        entry = self.entries.get(thoughts_id)
+        if entry is None and self.directory and THOUGHTS_ID_PATTERN.fullmatch(thoughts_id):
+            if file_entry := await asyncio.to_thread(self._read, thoughts_id):
+                self.file_hits += 1
+                entry = (file_entry["owner"], file_entry["thoughts"])
+        if entry is None or entry[0] != owner:
+            return None
+        return entry[1]
+
+    @staticmethod
+    def compact_context(extra_info: ExtraInfo, thoughts_id: str) -> dict[str, Any]:
+        return {
+            "data_points": extra_info.data_points,
+            "thoughts_id": thoughts_id,
+            "followup_questions": extra_info.followup_questions,
+        }
+
+    async def compact_response(self, response: dict[str, Any], owner: Optional[str]) -> dict[str, Any]:
+        extra_info = response.get("context")
+        if not isinstance(extra_info, ExtraInfo):
+            return response
+        thoughts_id = await self.store(extra_info.thoughts, owner)
+        return {**response, "context": self.compact_context(extra_info, thoughts_id)}
+
+    async def compact_events(
+        self, events: AsyncGenerator[dict[str, Any], None], owner: Optional[str]
+    ) -> AsyncGenerator[dict[str, Any], None]:
+        """
+        Passes the events of a streamed answer on with every context reduced to its changes,
+        and the thoughts stored under one thoughts_id for the whole answer
+        """
+        thoughts_id = uuid.uuid4().hex
+        last_context: Optional[dict[str, Any]] = None
+        async for event in events:
+            context = event.get("context")
+            if isinstance(context, ExtraInfo):
+                # The thoughts are stored again for every context, since later ones add steps or token usage
+                await self.store(context.thoughts, owner, thoughts_id)
+                compact_context = self.compact_context(context, thoughts_id)
+                # The context is repeated once the token usage is known, which only changes the stored thoughts
+                if compact_context == last_context and "progress" not in event:
+                    self.skipped_events += 1
+                    continue
+                last_context = compact_context
+                event = {**event, "context": compact_context}
+            elif isinstance(context, dict) and isinstance(context.get("context"), ExtraInfo):
+                # The follow-up questions come with the whole context again, but only the questions are new
+                event = {**event, "context": {"followup_questions": context.get("followup_questions")}}
+            yield event
+
+    def stats(self) -> dict[str, Any]:
+        return self.entries.stats() | {
+            "stores": self.stores,
+            "file_hits": self.file_hits,
+            "skipped_events": self.skipped_events,
+        }
@@ -0,0 +1,153 @@
+import time
+from typing import Any, Optional
+
+from azure.cosmos.aio import ContainerProxy
+from openai.types.chat import ChatCompletionMessageParam
+
+from core.cache import TTLCache
+
+
+def build_session_item(session_id: str, entra_oid: str, version: str, first_question: str) -> dict[str, Any]:
+    return {
+        "id": session_id,
+        "version": version,
+        "session_id": session_id,
+        "entra_oid": entra_oid,
+        "type": "session",
+        "title": first_question + "..." if len(first_question) > 50 else first_question,
+        "timestamp": int(time.time() * 1000),
+    }
+
+
+def build_message_pair_item(
+    session_id: str, entra_oid: str, version: str, index: int, question: Any, response: Any
+) -> dict[str, Any]:
+    return {
+        "id": f"{session_id}-{index}",
+        "version": version,
+        "session_id": session_id,
+        "entra_oid": entra_oid,
+        "type": "message_pair",
+        "question": question,
+        "response": response,
+    }
+
+
+class ConversationStore:
+    """
+    Keeps the conversations of /chat on the server, keyed by session_state, so that clients only send the new message.
+    Conversations are kept in memory, and every turn is also written to the chat history container in Cosmos DB
+    (when Cosmos DB chat history is enabled and the user is signed in), where conversations that dropped out
+    of memory (or were started on another instance) are loaded from.
+    """
+
+    def __init__(
+        self,
+        container: Optional[ContainerProxy] = None,
+        version: Optional[str] = None,
+        max_entries: int = 1000,
+        ttl_seconds: float = 3600,
+    ):
+        self.container = container
+        self.version = version
+        self.conversations: TTLCache[str, list[ChatCompletionMessageParam]] = TTLCache(max_entries, ttl_seconds)
+        self.loaded = 0
+        self.turns_saved = 0
+        self.turns_persisted = 0
+
+    @staticmethod
+    def build_key(entra_oid: Optional[str], session_id: str) -> str:
+        # The oid is part of the key, so that a session id alone doesn't give access to someone else's conversation
+        return f"{entra_oid or ''}:{session_id}"
+
+    async def load_messages(self, entra_oid: str, session_id: str) -> list[ChatCompletionMessageParam]:
+        assert self.container is not None
+        res = self.container.query_items(
+            query="SELECT * FROM c WHERE c.session_id = @session_id AND c.type = @type",
+            parameters=[dict(name="@session_id", value=session_id), dict(name="@type", value="message_pair")],
+            partition_key=[entra_oid, session_id],
+        )
+        message_pairs: list[tuple[int, Any, str]] = []
+        async for page in res.by_page():
+            async for item in page:
+                response = item.get("response")
+                answer = response.get("message", {}).get("content", "") if isinstance(response, dict) else response
+                message_pairs.append((int(item["id"].rsplit("-", 1)[1]), item["question"], answer or ""))
+        messages: list[ChatCompletionMessageParam] = []
+        for _, question, answer in sorted(message_pairs, key=lambda message_pair: message_pair[0]):
+            messages.append({"role": "user", "content": question})
+            messages.append({"role": "assistant", "content": answer})
+        return messages
+
+    async def get_messages(
+        self, entra_oid: Optional[str], session_id: str
+    ) -> Optional[list[ChatCompletionMessageParam]]:
+        """
+        Returns the messages of the conversation so far, or None if the conversation isn't known
+        """
+        key = self.build_key(entra_oid, session_id)
+        messages = self.conversations.get(key)
+        if messages is None and self.container and entra_oid:
+            messages = await self.load_messages(entra_oid, session_id)
+            if not messages:
+                return None
+            self.conversations.set(key, messages)
+            self.loaded += 1
+        return messages
+
+    async def save_turn(
+        self,
+        entra_oid: Optional[str],
+        session_id: str,
+        messages: list[ChatCompletionMessageParam],
+        response: dict[str, Any],
+    ) -> None:
+        """
+        Saves the turn that answered the last of the messages with the response (as it was sent to the client)
+        """
+        answer: ChatCompletionMessageParam = {"role": "assistant", "content": response["message"]["content"] or ""}
+        self.conversations.set(self.build_key(entra_oid, session_id), messages + [answer])
+        self.turns_saved += 1
+        if self.container and entra_oid and self.version:
+            first_question = messages[0]["content"]
+            # Only the session and the new message pair are written, rather than the whole conversation
+            batch_operations = [
+                (
+                    "upsert",
+                    (
+                        build_session_item(
+                            session_id,
+                            entra_oid,
+                            self.version,
+                            first_question if isinstance(first_question, str) else "",
+                        ),
+                    ),
+                ),
+                (
+                    "upsert",
+                    (
+                        build_message_pair_item(
+                            session_id,
+                            entra_oid,
+                            self.version,
+                            (len(messages) - 1) // 2,
+                            messages[-1]["content"],
+                            response,
+                        ),
+                    ),
+                ),
+            ]
+            await self.container.execute_item_batch(
+                batch_operations=batch_operations, partition_key=[entra_oid, session_id]
+            )
+            self.turns_persisted += 1
+
+    def forget(self, entra_oid: Optional[str], session_id: str) -> None:
+        self.conversations.pop(self.build_key(entra_oid, session_id))
+
+    def stats(self) -> dict[str, Any]:
+        return self.conversations.stats() | {
+            "loaded": self.loaded,
+            "turns_saved": self.turns_saved,
+            "turns_persisted": self.turns_persisted,
+        }
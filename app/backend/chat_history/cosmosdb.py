@@ -1,18 +1,25 @@
 import os
-import time
-from typing import Any, Union
+from typing import Any, Optional, Union
 
 from azure.cosmos.aio import ContainerProxy, CosmosClient
 from azure.identity.aio import AzureDeveloperCliCredential, ManagedIdentityCredential
 from quart import Blueprint, current_app, jsonify, make_response, request
 
+from chat_history.conversationstore import (
+    ConversationStore,
+    build_message_pair_item,
+    build_session_item,
+)
 from config import (
+    CONFIG_ADMISSION_CONTROLLER,
     CONFIG_CHAT_HISTORY_COSMOS_ENABLED,
+    CONFIG_CONVERSATION_STORE,
     CONFIG_COSMOS_HISTORY_CLIENT,
     CONFIG_COSMOS_HISTORY_CONTAINER,
     CONFIG_COSMOS_HISTORY_VERSION,
     CONFIG_CREDENTIAL,
 )
+from core.admission import AdmissionController
 from decorators import authenticated
 from error import error_response
 
@@ -37,34 +44,16 @@ async def post_chat_history(auth_claims: dict[str, Any]):
         request_json = await request.get_json()
         session_id = request_json.get("id")
         message_pairs = request_json.get("answers")
-        first_question = message_pairs[0][0]
-        title = first_question + "..." if len(first_question) > 50 else first_question
-        timestamp = int(time.time() * 1000)
+        version = current_app.config[CONFIG_COSMOS_HISTORY_VERSION]
 
         # Insert the session item:
-        session_item = {
-            "id": session_id,
-            "version": current_app.config[CONFIG_COSMOS_HISTORY_VERSION],
-            "session_id": session_id,
-            "entra_oid": entra_oid,
-            "type": "session",
-            "title": title,
-            "timestamp": timestamp,
-        }
+        session_item = build_session_item(session_id, entra_oid, version, message_pairs[0][0])
 
         message_pair_items = []
         # Now insert a message item for each question/response pair:
         for ind, message_pair in enumerate(message_pairs):
             message_pair_items.append(
-                {
-                    "id": f"{session_id}-{ind}",
-                    "version": current_app.config[CONFIG_COSMOS_HISTORY_VERSION],
-                    "session_id": session_id,
-                    "entra_oid": entra_oid,
-                    "type": "message_pair",
-                    "question": message_pair[0],
-                    "response": message_pair[1],
-                }
+                build_message_pair_item(session_id, entra_oid, version, ind, message_pair[0], message_pair[1])
             )
 
         batch_operations = [("upsert", (session_item,))] + [
@@ -197,6 +186,8 @@ async def delete_chat_history_session(auth_claims: dict[str, Any], session_id: s
 
         batch_operations = [("delete", (id,)) for id in ids_to_delete]
         await container.execute_item_batch(batch_operations=batch_operations, partition_key=[entra_oid, session_id])
+        if conversation_store := current_app.config.get(CONFIG_CONVERSATION_STORE):
+            conversation_store.forget(entra_oid, session_id)
         return await make_response("", 204)
     except Exception as error:
         return error_response(error, f"/chat_history/sessions/{session_id}")
@@ -208,6 +199,7 @@ async def setup_clients():
     AZURE_COSMOSDB_ACCOUNT = os.getenv("AZURE_COSMOSDB_ACCOUNT")
     AZURE_CHAT_HISTORY_DATABASE = os.getenv("AZURE_CHAT_HISTORY_DATABASE")
     AZURE_CHAT_HISTORY_CONTAINER = os.getenv("AZURE_CHAT_HISTORY_CONTAINER")
+    USE_CHAT_CONVERSATION_STATE = os.getenv("USE_CHAT_CONVERSATION_STATE", "").lower() == "true"
 
     azure_credential: Union[AzureDeveloperCliCredential, ManagedIdentityCredential] = current_app.config[
         CONFIG_CREDENTIAL
@@ -221,8 +213,12 @@ async def setup_clients():
             raise ValueError("AZURE_CHAT_HISTORY_DATABASE must be set when USE_CHAT_HISTORY_COSMOS is true")
         if not AZURE_CHAT_HISTORY_CONTAINER:
             raise ValueError("AZURE_CHAT_HISTORY_CONTAINER must be set when USE_CHAT_HISTORY_COSMOS is true")
+        # Cosmos DB calls go through admission control too, if it is enabled
+        admission_controller: Optional[AdmissionController] = current_app.config.get(CONFIG_ADMISSION_CONTROLLER)
         cosmos_client = CosmosClient(
-            url=f"https://{AZURE_COSMOSDB_ACCOUNT}.documents.azure.com:443/", credential=azure_credential
+            url=f"https://{AZURE_COSMOSDB_ACCOUNT}.documents.azure.com:443/",
+            credential=azure_credential,
+            **({"transport": admission_controller.azure_transport("cosmos")} if admission_controller else {}),
         )
         cosmos_db = cosmos_client.get_database_client(AZURE_CHAT_HISTORY_DATABASE)
         cosmos_container = cosmos_db.get_container_client(AZURE_CHAT_HISTORY_CONTAINER)
@@ -231,6 +227,18 @@ async def setup_clients():
         current_app.config[CONFIG_COSMOS_HISTORY_CONTAINER] = cosmos_container
         current_app.config[CONFIG_COSMOS_HISTORY_VERSION] = os.environ["AZURE_CHAT_HISTORY_VERSION"]
 
+    # Set up here rather than with the other clients, since it writes to the Cosmos DB container set up above
+    conversation_store = None
+    if USE_CHAT_CONVERSATION_STATE:
+        current_app.logger.info("USE_CHAT_CONVERSATION_STATE is true, setting up server-side conversation state")
+        conversation_store = ConversationStore(
+            container=current_app.config.get(CONFIG_COSMOS_HISTORY_CONTAINER),
+            version=current_app.config.get(CONFIG_COSMOS_HISTORY_VERSION),
+            max_entries=int(os.getenv("CHAT_CONVERSATION_STATE_MAX_ENTRIES") or 1000),
+            ttl_seconds=float(os.getenv("CHAT_CONVERSATION_STATE_TTL_SECONDS") or 3600),
+        )
+    current_app.config[CONFIG_CONVERSATION_STORE] = conversation_store
+
 
 @chat_history_cosmosdb_bp.after_app_serving
 async def close_clients():
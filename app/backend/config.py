@@ -20,6 +20,7 @@ CONFIG_OPENAI_CLIENT = "openai_client"
 CONFIG_AGENT_CLIENT = "agent_client"
 CONFIG_INGESTER = "ingester"
 CONFIG_LANGUAGE_PICKER_ENABLED = "language_picker_enabled"
+CONFIG_METRICS_ENABLED = "metrics_enabled"
 CONFIG_SPEECH_INPUT_ENABLED = "speech_input_enabled"
 CONFIG_SPEECH_OUTPUT_BROWSER_ENABLED = "speech_output_browser_enabled"
 CONFIG_SPEECH_OUTPUT_AZURE_ENABLED = "speech_output_azure_enabled"
@@ -34,3 +35,18 @@ CONFIG_AGENTIC_RETRIEVAL_ENABLED = "agentic_retrieval"
 CONFIG_COSMOS_HISTORY_CLIENT = "cosmos_history_client"
 CONFIG_COSMOS_HISTORY_CONTAINER = "cosmos_history_container"
 CONFIG_COSMOS_HISTORY_VERSION = "cosmos_history_version"
+CONFIG_ANSWER_CACHE = "answer_cache"
+CONFIG_EMBEDDING_CACHE = "embedding_cache"
+CONFIG_SEARCH_CACHE = "search_cache"
+CONFIG_CONTENT_FILE_CACHE = "content_file_cache"
+CONFIG_CONTENT_SAS_PROVIDER = "content_sas_provider"
+CONFIG_HTTP_SESSION_POOL = "http_session_pool"
+CONFIG_SPEECH_SYNTHESIS_SERVICE = "speech_synthesis_service"
+CONFIG_THOUGHT_STORE = "thought_store"
+CONFIG_STREAM_COALESCER = "stream_coalescer"
+CONFIG_REQUEST_COALESCER = "request_coalescer"
+CONFIG_ADMISSION_CONTROLLER = "admission_controller"
+CONFIG_FAIR_SHARE_SCHEDULER = "fair_share_scheduler"
+CONFIG_CONTEXT_PACKER = "context_packer"
+CONFIG_HISTORY_MANAGER = "history_manager"
+CONFIG_CONVERSATION_STORE = "conversation_store"
@@ -0,0 +1,315 @@
+import asyncio
+import math
+import time
+from collections import deque
+from collections.abc import AsyncIterator
+from typing import Any, Callable, Optional
+
+import httpx
+from azure.core.pipeline.transport import AioHttpTransport
+from openai import DEFAULT_CONNECTION_LIMITS, DefaultAsyncHttpxClient, RateLimitError
+
+from core.metrics import LatencyRecorder
+
+# Error code of the responses that stand in for OpenAI calls rejected by admission control
+ADMISSION_REJECTED_CODE = "admission_rejected"
+
+
+class AdmissionRejectedError(Exception):
+    """
+    Raised when a call to a downstream service is shed, because too many calls are already waiting for it
+    """
+
+    def __init__(self, downstream: str, retry_after_seconds: int):
+        super().__init__(f"Too many calls to {downstream}, retry after {retry_after_seconds} seconds")
+        self.downstream = downstream
+        self.retry_after_seconds = retry_after_seconds
+
+
+def get_retry_after_seconds(error: Exception) -> Optional[int]:
+    """
+    Returns how long the client should wait before trying again, if the error comes from shed load
+    """
+    if isinstance(error, AdmissionRejectedError):
+        return error.retry_after_seconds
+    if isinstance(error, RateLimitError) and error.code == ADMISSION_REJECTED_CODE:
+        return int(error.response.headers.get("retry-after") or 1)
+    return None
+
+
+class AdaptiveLimiter:
+    """
+    Caps the concurrent calls to one downstream service, and adapts the cap to how the service copes (AIMD):
+    the cap grows by about one call for every cap calls that went well, and is cut by backoff_factor when the service
+    throttles (429) or answers slower than the latency target, at most once per decrease interval.
+    Calls over the cap wait their turn in a bounded queue. They are rejected right away when the queue is full
+    or when they would not get a slot within queue_timeout_seconds, and once they have waited that long.
+    Not thread-safe: it is meant to be used from a single event loop.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_limit: int = 32,
+        min_limit: int = 1,
+        max_queue: int = 100,
+        queue_timeout_seconds: float = 10.0,
+        latency_target_seconds: Optional[float] = None,
+        backoff_factor: float = 0.5,
+        decrease_interval_seconds: float = 1.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        if min_limit <= 0 or min_limit > max_limit:
+            raise ValueError("min_limit must be greater than 0 and not greater than max_limit")
+        self.name = name
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.max_queue = max_queue
+        self.queue_timeout_seconds = queue_timeout_seconds
+        self.latency_target_seconds = latency_target_seconds
+        self.backoff_factor = backoff_factor
+        self.decrease_interval_seconds = decrease_interval_seconds
+        self.clock = clock
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        self.waiters: deque[asyncio.Future[None]] = deque()
+        self.last_decrease_at = -math.inf
+        self.wait_time = LatencyRecorder()
+        self.latency = LatencyRecorder()
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.throttled = 0
+        self.slow = 0
+        self.decreases = 0
+
+    def _has_capacity(self) -> bool:
+        return self.in_flight < int(self.limit)
+
+    def _estimated_wait_seconds(self, position: int) -> float:
+        # Every slot frees up about once per call, so the queue moves by limit calls per mean call latency
+        if not self.latency.count:
+            return 0.0
+        return position / int(self.limit) * self.latency.total_seconds / self.latency.count
+
+    def _reject(self, position: int) -> AdmissionRejectedError:
+        self.rejected += 1
+        return AdmissionRejectedError(self.name, max(1, math.ceil(self._estimated_wait_seconds(position))))
+
+    def _grant(self) -> None:
+        while self.waiters and self._has_capacity():
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+    async def acquire(self) -> None:
+        if self._has_capacity() and not self.waiters:
+            self.in_flight += 1
+            self.admitted += 1
+            self.wait_time.record(0.0)
+            return
+        position = len(self.waiters) + 1
+        if position > self.max_queue or self._estimated_wait_seconds(position) > self.queue_timeout_seconds:
+            raise self._reject(position)
+
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        self.queued += 1
+        started_at = self.clock()
+        try:
+            # Shielded, so that a slot granted just as the wait ends is not lost
+            await asyncio.wait_for(asyncio.shield(waiter), self.queue_timeout_seconds)
+        except asyncio.TimeoutError:
+            if not waiter.done():
+                waiter.cancel()
+                self.waiters.remove(waiter)
+                self.timed_out += 1
+                raise self._reject(len(self.waiters) + 1)
+        except asyncio.CancelledError:
+            if waiter.done():
+                self.release(None)
+            else:
+                waiter.cancel()
+                self.waiters.remove(waiter)
+            raise
+        self.wait_time.record(self.clock() - started_at)
+        self.admitted += 1
+
+    def release(self, latency_seconds: Optional[float], throttled: bool = False) -> None:
+        """
+        Frees the slot of a call, given how long the call took (None if it failed without an answer)
+        and whether the service throttled it
+        """
+        self.in_flight -= 1
+        self.report(latency_seconds, throttled)
+        self._grant()
+
+    def report(self, latency_seconds: Optional[float], throttled: bool = False) -> None:
+        """
+        Adapts the cap to how long a call took and whether the service throttled it,
+        for calls that keep their slot after that is known
+        """
+        if latency_seconds is not None:
+            self.latency.record(latency_seconds)
+        slow = (
+            self.latency_target_seconds is not None
+            and latency_seconds is not None
+            and latency_seconds > self.latency_target_seconds
+        )
+        if throttled or slow:
+            self.throttled += throttled
+            self.slow += slow
+            # The calls in flight all report the same overload, so it only counts once per interval
+            now = self.clock()
+            if now - self.last_decrease_at >= self.decrease_interval_seconds:
+                self.limit = max(float(self.min_limit), self.limit * self.backoff_factor)
+                self.last_decrease_at = now
+                self.decreases += 1
+        elif latency_seconds is not None:
+            self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "limit": round(self.limit, 1),
+            "min_limit": self.min_limit,
+            "max_limit": self.max_limit,
+            "in_flight": self.in_flight,
+            "queue_depth": len(self.waiters),
+            "max_queue": self.max_queue,
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "throttled": self.throttled,
+            "slow": self.slow,
+            "decreases": self.decreases,
+            "wait": self.wait_time.stats(),
+            "latency": self.latency.stats(),
+        }
+
+
+class ReleasingByteStream(httpx.AsyncByteStream):
+    """
+    Passes the body of a streamed response on, and calls release once the stream is closed
+    """
+
+    def __init__(self, stream: httpx.AsyncByteStream, release: Callable[[], None]):
+        self.stream = stream
+        self.release: Optional[Callable[[], None]] = release
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        async for chunk in self.stream:
+            yield chunk
+
+    async def aclose(self) -> None:
+        try:
+            await self.stream.aclose()
+        finally:
+            # Responses can be closed more than once, but the slot must only be freed once
+            if self.release:
+                release, self.release = self.release, None
+                release()
+
+
+class AdmissionHttpxTransport(httpx.AsyncBaseTransport):
+    """
+    Lets the calls of an OpenAI client through the limiter of their downstream, picked by the end of the URL path.
+    The OpenAI SDK retries any error raised by its transport, so shed calls get a 429 response that it doesn't retry.
+    """
+
+    def __init__(self, limiters: dict[str, AdaptiveLimiter], transport: httpx.AsyncBaseTransport):
+        self.limiters = limiters
+        self.transport = transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        limiter = next(
+            (limiter for suffix, limiter in self.limiters.items() if request.url.path.endswith(suffix)), None
+        )
+        if limiter is None:
+            return await self.transport.handle_async_request(request)
+        try:
+            await limiter.acquire()
+        except AdmissionRejectedError as error:
+            return httpx.Response(
+                429,
+                headers={"retry-after": str(error.retry_after_seconds), "x-should-retry": "false"},
+                json={"error": {"code": ADMISSION_REJECTED_CODE, "message": str(error)}},
+                request=request,
+            )
+        started_at = time.monotonic()
+        try:
+            response = await self.transport.handle_async_request(request)
+        except BaseException:
+            limiter.release(None)
+            raise
+        # Streamed answers return once the headers arrive, so the latency is the time to the first token
+        latency_seconds = time.monotonic() - started_at
+        throttled = response.status_code == 429
+        if response.headers.get("content-type", "").startswith("text/event-stream") and isinstance(
+            response.stream, httpx.AsyncByteStream
+        ):
+            # The service keeps generating the answer until the stream ends, so the call keeps its slot until then
+            limiter.report(latency_seconds, throttled)
+            response.stream = ReleasingByteStream(response.stream, lambda: limiter.release(None))
+        else:
+            limiter.release(latency_seconds, throttled)
+        return response
+
+    async def aclose(self) -> None:
+        await self.transport.aclose()
+
+
+class AdmissionAioHttpTransport(AioHttpTransport):
+    """
+    Azure SDK transport that lets every call (including the SDK's own retries) through the limiter of its downstream
+    """
+
+    def __init__(self, limiter: AdaptiveLimiter, **kwargs):
+        super().__init__(**kwargs)
+        self.limiter = limiter
+
+    async def send(self, request, **kwargs):
+        await self.limiter.acquire()
+        started_at = time.monotonic()
+        latency_seconds = None
+        throttled = False
+        try:
+            response = await super().send(request, **kwargs)
+            latency_seconds = time.monotonic() - started_at
+            throttled = response.status_code == 429
+            return response
+        finally:
+            self.limiter.release(latency_seconds, throttled)
+
+
+class AdmissionController:
+    """
+    Holds one AdaptiveLimiter per downstream service and hands out the transports that go through them
+    """
+
+    def __init__(self, limiters: dict[str, AdaptiveLimiter]):
+        self.limiters = limiters
+        self.http_clients: list[httpx.AsyncClient] = []
+
+    def azure_transport(self, downstream: str) -> AdmissionAioHttpTransport:
+        # Azure SDK clients close their transport when they are closed, so every client gets its own
+        return AdmissionAioHttpTransport(self.limiters[downstream])
+
+    def openai_http_client(self) -> httpx.AsyncClient:
+        http_client = DefaultAsyncHttpxClient(
+            transport=AdmissionHttpxTransport(
+                {"/chat/completions": self.limiters["chat"], "/embeddings": self.limiters["embeddings"]},
+                httpx.AsyncHTTPTransport(limits=DEFAULT_CONNECTION_LIMITS),
+            )
+        )
+        self.http_clients.append(http_client)
+        return http_client
+
+    async def close(self) -> None:
+        for http_client in self.http_clients:
+            await http_client.aclose()
+
+    def stats(self) -> dict[str, Any]:
+        return {downstream: limiter.stats() for downstream, limiter in self.limiters.items()}
@@ -1,24 +1,27 @@
 # Refactored from https://github.com/Azure-Samples/ms-identity-python-on-behalf-of
 
-import base64
+import asyncio
+import contextlib
+import functools
+import hashlib
 import json
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any, Optional
 
 import aiohttp
 import jwt
 from azure.search.documents.aio import SearchClient
 from azure.search.documents.indexes.models import SearchIndex
-from cryptography.hazmat.primitives import serialization
-from cryptography.hazmat.primitives.asymmetric import rsa
 from msal import ConfidentialClientApplication
 from msal.token_cache import TokenCache
-from tenacity import (
-    AsyncRetrying,
-    retry_if_exception_type,
-    stop_after_attempt,
-    wait_random_exponential,
-)
+
+from core.cache import SingleFlight, TTLCache
+from core.groupcache import GroupMembershipCache
+from core.jwkscache import JwksCache, JwksRefreshError
+from core.metrics import LatencyRecorder
+from core.pathauthcache import PathAuthCache
 
 
 # AuthError is raised when the authentication token sent by the client UI cannot be parsed or there is an authentication error accessing the graph API
@@ -45,8 +48,18 @@ class AuthenticationHelper:
         require_access_control: bool = False,
         enable_global_documents: bool = False,
         enable_unauthenticated_access: bool = False,
+        path_auth_cache: Optional[PathAuthCache] = None,
+        validated_token_cache_max_entries: int = 10000,
+        obo_max_workers: int = 8,
+        group_cache: Optional[GroupMembershipCache] = None,
+        graph_endpoint: str = "https://graph.microsoft.com",
+        http_session: Optional[aiohttp.ClientSession] = None,
     ):
         self.use_authentication = use_authentication
+        self.http_session = http_session
+        self.path_auth_cache = path_auth_cache
+        self.group_cache = group_cache
+        self.graph_endpoint = graph_endpoint
         self.server_app_id = server_app_id
         self.server_app_secret = server_app_secret
         self.client_app_id = client_app_id
@@ -61,6 +74,14 @@ class AuthenticationHelper:
         self.valid_audiences = [f"api://{server_app_id}", str(server_app_id)]
         # See https://learn.microsoft.com/entra/identity-platform/access-tokens#validate-the-issuer for more information on token validation
         self.key_url = f"{self.authority}/discovery/v2.0/keys"
+        self.jwks_cache = JwksCache(self.key_url, http_session=http_session)
+        # Claims of tokens that passed validation and the auth claims they were exchanged for,
+        # both keyed by the digest of the token and kept until the token expires
+        self.validated_tokens: TTLCache[str, dict[str, Any]] = TTLCache(validated_token_cache_max_entries)
+        self.auth_claims_cache: TTLCache[str, dict[str, Any]] = TTLCache(validated_token_cache_max_entries)
+        self.auth_claims_in_flight: SingleFlight[str, dict[str, Any]] = SingleFlight()
+        self.obo_latency = LatencyRecorder()
+        self.obo_executor: Optional[ThreadPoolExecutor] = None
 
         if self.use_authentication:
             field_names = [field.name for field in search_index.fields] if search_index else []
@@ -71,12 +92,37 @@ class AuthenticationHelper:
             self.confidential_client = ConfidentialClientApplication(
                 server_app_id, authority=self.authority, client_credential=server_app_secret, token_cache=TokenCache()
             )
+            # MSAL only has a blocking API, so token exchanges run on a few threads of their own
+            self.obo_executor = ThreadPoolExecutor(max_workers=obo_max_workers, thread_name_prefix="obo")
         else:
             self.has_auth_fields = False
             self.require_access_control = False
             self.enable_global_documents = True
             self.enable_unauthenticated_access = True
 
+    def start(self) -> None:
+        if self.use_authentication:
+            self.jwks_cache.start()
+
+    async def close(self) -> None:
+        await self.jwks_cache.close()
+        if self.group_cache:
+            await self.group_cache.close()
+        if self.obo_executor:
+            self.obo_executor.shutdown(wait=False)
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "jwks": self.jwks_cache.stats(),
+            "validated_tokens": self.validated_tokens.stats(),
+            "auth_claims": self.auth_claims_cache.stats() | self.auth_claims_in_flight.stats(),
+            "obo_latency": self.obo_latency.stats(),
+        }
+
+    @staticmethod
+    def get_token_digest(token: str) -> str:
+        return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
     def get_auth_setup_for_client(self) -> dict[str, Any]:
         # returns MSAL.js settings used by the client app
         return {
@@ -179,13 +225,23 @@ class AuthenticationHelper:
         return security_filter
 
     @staticmethod
-    async def list_groups(graph_resource_access_token: dict) -> list[str]:
+    async def list_groups(
+        graph_resource_access_token: dict,
+        graph_endpoint: str = "https://graph.microsoft.com",
+        session: Optional[aiohttp.ClientSession] = None,
+    ) -> list[str]:
         headers = {"Authorization": "Bearer " + graph_resource_access_token["access_token"]}
         groups = []
-        async with aiohttp.ClientSession(headers=headers) as session:
+        async with contextlib.AsyncExitStack() as stack:
+            # Without a shared session, one is only created for this call
+            if session is None:
+                session = await stack.enter_async_context(aiohttp.ClientSession())
             resp_json = None
             resp_status = None
-            async with session.get(url="https://graph.microsoft.com/v1.0/me/transitiveMemberOf?$select=id") as resp:
+            # Ask for the largest page size Graph allows, so that users in hundreds of groups need a single call
+            async with session.get(
+                url=f"{graph_endpoint}/v1.0/me/transitiveMemberOf?$select=id&$top=999", headers=headers
+            ) as resp:
                 resp_json = await resp.json()
                 resp_status = resp.status
                 if resp_status != 200:
@@ -197,7 +253,7 @@ class AuthenticationHelper:
                     groups.append(group["id"])
                 next_link = resp_json.get("@odata.nextLink")
                 if next_link:
-                    async with session.get(url=next_link) as resp:
+                    async with session.get(url=next_link, headers=headers) as resp:
                         resp_json = await resp.json()
                         resp_status = resp.status
                 else:
@@ -216,34 +272,19 @@ class AuthenticationHelper:
             # https://learn.microsoft.com/entra/identity-platform/v2-oauth2-on-behalf-of-flow
             auth_token = AuthenticationHelper.get_token_auth_header(headers)
             # Validate the token before use
-            await self.validate_access_token(auth_token)
+            token_claims = await self.validate_access_token(auth_token)
 
-            # Use the on-behalf-of-flow to acquire another token for use with Microsoft Graph
-            # See https://learn.microsoft.com/entra/identity-platform/v2-oauth2-on-behalf-of-flow for more information
-            graph_resource_access_token = self.confidential_client.acquire_token_on_behalf_of(
-                user_assertion=auth_token, scopes=["https://graph.microsoft.com/.default"]
-            )
-            if "error" in graph_resource_access_token:
-                raise AuthError(error=str(graph_resource_access_token), status_code=401)
-
-            # Read the claims from the response. The oid and groups claims are used for security filtering
-            # https://learn.microsoft.com/entra/identity-platform/id-token-claims-reference
-            id_token_claims = graph_resource_access_token["id_token_claims"]
-            auth_claims = {"oid": id_token_claims["oid"], "groups": id_token_claims.get("groups", [])}
-
-            # A groups claim may have been omitted either because it was not added in the application manifest for the API application,
-            # or a groups overage claim may have been emitted.
-            # https://learn.microsoft.com/entra/identity-platform/id-token-claims-reference#groups-overage-claim
-            missing_groups_claim = "groups" not in id_token_claims
-            has_group_overage_claim = (
-                missing_groups_claim
-                and "_claim_names" in id_token_claims
-                and "groups" in id_token_claims["_claim_names"]
-            )
-            if missing_groups_claim or has_group_overage_claim:
-                # Read the user's groups from Microsoft Graph
-                auth_claims["groups"] = await AuthenticationHelper.list_groups(graph_resource_access_token)
-            return auth_claims
+            # Tokens are exchanged once, and then reused for as long as the token is valid
+            token_digest = AuthenticationHelper.get_token_digest(auth_token)
+            if (auth_claims := self.auth_claims_cache.get(token_digest)) is not None:
+                return auth_claims
+
+            async def acquire_and_store() -> dict[str, Any]:
+                auth_claims = await self.acquire_auth_claims(auth_token)
+                self.auth_claims_cache.set(token_digest, auth_claims, ttl_seconds=token_claims["exp"] - time.time())
+                return auth_claims
+
+            return await self.auth_claims_in_flight.do(token_digest, acquire_and_store)
         except AuthError as e:
             logging.exception("Exception getting authorization information - " + json.dumps(e.error))
             if self.require_access_control and not self.enable_unauthenticated_access:
@@ -255,6 +296,49 @@ class AuthenticationHelper:
                 raise
             return {}
 
+    async def acquire_auth_claims(self, auth_token: str) -> dict[str, Any]:
+        # Use the on-behalf-of-flow to acquire another token for use with Microsoft Graph
+        # See https://learn.microsoft.com/entra/identity-platform/v2-oauth2-on-behalf-of-flow for more information
+        start_time = time.monotonic()
+        graph_resource_access_token = await asyncio.get_running_loop().run_in_executor(
+            self.obo_executor,
+            functools.partial(
+                self.confidential_client.acquire_token_on_behalf_of,
+                user_assertion=auth_token,
+                scopes=["https://graph.microsoft.com/.default"],
+            ),
+        )
+        self.obo_latency.record(time.monotonic() - start_time)
+        if "error" in graph_resource_access_token:
+            raise AuthError(error=str(graph_resource_access_token), status_code=401)
+
+        # Read the claims from the response. The oid and groups claims are used for security filtering
+        # https://learn.microsoft.com/entra/identity-platform/id-token-claims-reference
+        id_token_claims = graph_resource_access_token["id_token_claims"]
+        auth_claims = {"oid": id_token_claims["oid"], "groups": id_token_claims.get("groups", [])}
+
+        # A groups claim may have been omitted either because it was not added in the application manifest for the API application,
+        # or a groups overage claim may have been emitted.
+        # https://learn.microsoft.com/entra/identity-platform/id-token-claims-reference#groups-overage-claim
+        missing_groups_claim = "groups" not in id_token_claims
+        has_group_overage_claim = (
+            missing_groups_claim and "_claim_names" in id_token_claims and "groups" in id_token_claims["_claim_names"]
+        )
+        if missing_groups_claim or has_group_overage_claim:
+            # Read the user's groups from Microsoft Graph
+            if self.group_cache:
+                auth_claims["groups"] = await self.group_cache.get_or_fetch(
+                    id_token_claims["oid"],
+                    lambda: AuthenticationHelper.list_groups(
+                        graph_resource_access_token, self.graph_endpoint, self.http_session
+                    ),
+                )
+            else:
+                auth_claims["groups"] = await AuthenticationHelper.list_groups(
+                    graph_resource_access_token, self.graph_endpoint, self.http_session
+                )
+        return auth_claims
+
     async def check_path_auth(self, path: str, auth_claims: dict[str, Any], search_client: SearchClient) -> bool:
         # Start with the standard security filter for all queries
         security_filter = self.build_security_filters(overrides={}, auth_claims=auth_claims)
@@ -276,86 +360,57 @@ class AuthenticationHelper:
 
         # If the filter returns any results, the user is allowed to access the document
         # Otherwise, access is denied
-        results = await search_client.search(search_text="*", top=1, filter=filter)
-        allowed = False
-        async for _ in results:
-            allowed = True
-            break
-
-        return allowed
-
-    async def create_pem_format(self, jwks, token):
-        unverified_header = jwt.get_unverified_header(token)
-        for key in jwks["keys"]:
-            if key["kid"] == unverified_header["kid"]:
-                # Construct the RSA public key
-                public_numbers = rsa.RSAPublicNumbers(
-                    e=int.from_bytes(base64.urlsafe_b64decode(key["e"] + "=="), byteorder="big"),
-                    n=int.from_bytes(base64.urlsafe_b64decode(key["n"] + "=="), byteorder="big"),
-                )
-                public_key = public_numbers.public_key()
-
-                # Convert to PEM format
-                pem_key = public_key.public_bytes(
-                    encoding=serialization.Encoding.PEM, format=serialization.PublicFormat.SubjectPublicKeyInfo
-                )
-                rsa_key = pem_key
-                return rsa_key
+        async def search_for_path() -> bool:
+            results = await search_client.search(search_text="*", top=1, filter=filter, select=["id"])
+            allowed = False
+            async for _ in results:
+                allowed = True
+                break
+            return allowed
+
+        if self.path_auth_cache:
+            return await self.path_auth_cache.get_or_check(auth_claims, path, search_for_path)
+        return await search_for_path()
 
     # See https://github.com/Azure-Samples/ms-identity-python-on-behalf-of/blob/939be02b11f1604814532fdacc2c2eccd198b755/FlaskAPI/helpers/authorization.py#L44
-    async def validate_access_token(self, token: str):
+    async def validate_access_token(self, token: str) -> dict[str, Any]:
         """
         Validate an access token is issued by Entra
         """
-        jwks = None
-        async for attempt in AsyncRetrying(
-            retry=retry_if_exception_type(AuthError),
-            wait=wait_random_exponential(min=15, max=60),
-            stop=stop_after_attempt(5),
-        ):
-            with attempt:
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(url=self.key_url) as resp:
-                        resp_status = resp.status
-                        if resp_status in [500, 502, 503, 504]:
-                            raise AuthError(
-                                error=f"Failed to get keys info: {await resp.text()}", status_code=resp_status
-                            )
-                        jwks = await resp.json()
-
-        if not jwks or "keys" not in jwks:
-            raise AuthError("Unable to get keys to validate auth token.", 401)
-
-        rsa_key = None
-        issuer = None
-        audience = None
+        token_digest = AuthenticationHelper.get_token_digest(token)
+        if (cached_claims := self.validated_tokens.get(token_digest)) is not None:
+            return cached_claims
+
         try:
-            unverified_claims = jwt.decode(token, options={"verify_signature": False})
-            issuer = unverified_claims.get("iss")
-            audience = unverified_claims.get("aud")
-            rsa_key = await self.create_pem_format(jwks, token)
+            kid = jwt.get_unverified_header(token).get("kid")
         except jwt.PyJWTError as exc:
             raise AuthError("Unable to parse authorization token.", 401) from exc
-        if not rsa_key:
+        try:
+            public_key = await self.jwks_cache.get_key(kid) if kid else None
+        except JwksRefreshError as exc:
+            raise AuthError(exc.error, exc.status_code) from exc
+        if not public_key:
             raise AuthError("Unable to find appropriate key", 401)
 
-        if issuer not in self.valid_issuers:
-            raise AuthError(f"Issuer {issuer} not in {','.join(self.valid_issuers)}", 401)
-
-        if audience not in self.valid_audiences:
-            raise AuthError(
-                f"Audience {audience} not in {','.join(self.valid_audiences)}",
-                401,
-            )
-
         try:
-            jwt.decode(token, rsa_key, algorithms=["RS256"], audience=audience, issuer=issuer)
+            claims = jwt.decode(
+                token,
+                public_key,
+                algorithms=["RS256"],
+                audience=self.valid_audiences,
+                issuer=self.valid_issuers,
+                options={"require": ["exp"]},
+            )
         except jwt.ExpiredSignatureError as jwt_expired_exc:
             raise AuthError("Token is expired", 401) from jwt_expired_exc
-        except (jwt.InvalidAudienceError, jwt.InvalidIssuerError) as jwt_claims_exc:
-            raise AuthError(
-                "Incorrect claims: please check the audience and issuer",
-                401,
-            ) from jwt_claims_exc
+        except jwt.InvalidIssuerError as jwt_issuer_exc:
+            issuer = jwt.decode(token, options={"verify_signature": False}).get("iss")
+            raise AuthError(f"Issuer {issuer} not in {','.join(self.valid_issuers)}", 401) from jwt_issuer_exc
+        except jwt.InvalidAudienceError as jwt_audience_exc:
+            audience = jwt.decode(token, options={"verify_signature": False}).get("aud")
+            raise AuthError(f"Audience {audience} not in {','.join(self.valid_audiences)}", 401) from jwt_audience_exc
         except Exception as exc:
             raise AuthError("Unable to parse authorization token.", 401) from exc
+
+        self.validated_tokens.set(token_digest, claims, ttl_seconds=claims["exp"] - time.time())
+        return claims
@@ -0,0 +1,116 @@
+import asyncio
+import contextlib
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Any, Optional
+
+from azure.storage.blob import BlobSasPermissions, UserDelegationKey, generate_blob_sas
+from azure.storage.blob.aio import BlobClient, BlobServiceClient
+
+logger = logging.getLogger("scripts")
+
+# Signed URLs start a little in the past, so they are valid right away even if the storage clock is behind
+CLOCK_SKEW = timedelta(minutes=5)
+
+
+class UserDelegationSasProvider:
+    """
+    Creates short-lived, read-only SAS URLs for blobs, signed with a user delegation key of the app's identity.
+    The key is requested once and then refreshed in the background well before it expires,
+    so signing a URL doesn't need a request to storage.
+    """
+
+    def __init__(
+        self,
+        blob_service_client: BlobServiceClient,
+        sas_ttl_seconds: int = 300,
+        key_ttl_seconds: int = 24 * 3600,
+        key_refresh_margin_seconds: int = 3600,
+        retry_delay_seconds: int = 60,
+    ):
+        if sas_ttl_seconds >= key_refresh_margin_seconds or key_refresh_margin_seconds >= key_ttl_seconds:
+            raise ValueError("sas_ttl_seconds < key_refresh_margin_seconds < key_ttl_seconds must hold")
+        self.blob_service_client = blob_service_client
+        self.sas_ttl = timedelta(seconds=sas_ttl_seconds)
+        self.key_ttl = timedelta(seconds=key_ttl_seconds)
+        self.key_refresh_margin = timedelta(seconds=key_refresh_margin_seconds)
+        self.retry_delay_seconds = retry_delay_seconds
+        self.user_delegation_key: Optional[UserDelegationKey] = None
+        self.key_expiry: Optional[datetime] = None
+        self._key_lock = asyncio.Lock()
+        self._refresh_task: Optional[asyncio.Task[None]] = None
+        self.key_refreshes = 0
+        self.key_refresh_failures = 0
+        self.urls_signed = 0
+
+    def start(self) -> None:
+        self._refresh_task = asyncio.create_task(self._refresh_periodically())
+
+    async def close(self) -> None:
+        if self._refresh_task:
+            self._refresh_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._refresh_task
+        await self.blob_service_client.close()
+
+    async def _refresh_key(self) -> None:
+        now = datetime.now(timezone.utc)
+        expiry = now + self.key_ttl
+        self.user_delegation_key = await self.blob_service_client.get_user_delegation_key(now - CLOCK_SKEW, expiry)
+        self.key_expiry = expiry
+        self.key_refreshes += 1
+
+    async def _refresh_periodically(self) -> None:
+        while True:
+            try:
+                async with self._key_lock:
+                    await self._refresh_key()
+            except Exception:
+                logger.exception(
+                    "Failed to refresh the user delegation key, retrying in %d seconds", self.retry_delay_seconds
+                )
+                self.key_refresh_failures += 1
+                await asyncio.sleep(self.retry_delay_seconds)
+                continue
+            if self.key_expiry:
+                refresh_at = self.key_expiry - self.key_refresh_margin
+                await asyncio.sleep(max((refresh_at - datetime.now(timezone.utc)).total_seconds(), 0))
+
+    async def get_user_delegation_key(self) -> UserDelegationKey:
+        # Only wait for a new key if the background refresh has not managed to replace one that is about to expire
+        async with self._key_lock:
+            if (
+                self.user_delegation_key is None
+                or self.key_expiry is None
+                or self.key_expiry - self.sas_ttl <= datetime.now(timezone.utc)
+            ):
+                await self._refresh_key()
+        # _refresh_key either set the key or raised
+        assert self.user_delegation_key is not None
+        return self.user_delegation_key
+
+    async def generate_read_url(self, blob_client: BlobClient, content_type: Optional[str] = None) -> str:
+        if not blob_client.account_name:
+            raise ValueError("The blob client must have an account name to sign a URL for")
+        user_delegation_key = await self.get_user_delegation_key()
+        now = datetime.now(timezone.utc)
+        sas_token = generate_blob_sas(
+            account_name=blob_client.account_name,
+            container_name=blob_client.container_name,
+            blob_name=blob_client.blob_name,
+            user_delegation_key=user_delegation_key,
+            permission=BlobSasPermissions(read=True),
+            start=now - CLOCK_SKEW,
+            expiry=now + self.sas_ttl,
+            content_type=content_type,
+        )
+        self.urls_signed += 1
+        return f"{blob_client.url}?{sas_token}"
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "urls_signed": self.urls_signed,
+            "key_refreshes": self.key_refreshes,
+            "key_refresh_failures": self.key_refresh_failures,
+            "key_expiry": self.key_expiry.isoformat() if self.key_expiry else None,
+        }
@@ -0,0 +1,137 @@
+import asyncio
+import time
+from collections import OrderedDict
+from collections.abc import Awaitable, Iterator
+from typing import Any, Callable, Generic, Optional, TypeVar, cast
+
+K = TypeVar("K")
+V = TypeVar("V")
+
+
+class TTLCache(Generic[K, V]):
+    """
+    In-process cache bounded by entry count (least recently used entries are evicted first),
+    where every entry also expires after a fixed time-to-live.
+    Not thread-safe: it is meant to be used from a single event loop.
+    """
+
+    def __init__(
+        self,
+        max_entries: int,
+        ttl_seconds: Optional[float] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        if max_entries <= 0:
+            raise ValueError("max_entries must be greater than 0")
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        self._entries: OrderedDict[K, tuple[float, V]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _is_expired(self, expires_at: float) -> bool:
+        return self.ttl_seconds is not None and expires_at <= self.clock()
+
+    def get(self, key: K) -> Optional[V]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, value = entry
+        if self._is_expired(expires_at):
+            del self._entries[key]
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: K, value: V, ttl_seconds: Optional[float] = None) -> None:
+        ttl = ttl_seconds if ttl_seconds is not None else self.ttl_seconds
+        expires_at = self.clock() + ttl if ttl is not None else float("inf")
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key: K) -> Optional[V]:
+        entry = self._entries.pop(key, None)
+        return entry[1] if entry else None
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def items(self) -> Iterator[tuple[K, V]]:
+        """
+        Iterates over the live entries without touching their recency or the hit/miss counters
+        """
+        for key, (expires_at, value) in list(self._entries.items()):
+            if self._is_expired(expires_at):
+                del self._entries[key]
+                self.expirations += 1
+                continue
+            yield key, value
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: object) -> bool:
+        entry = self._entries.get(cast(K, key))
+        return entry is not None and not self._is_expired(entry[0])
+
+    def stats(self) -> dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+class SingleFlight(Generic[K, V]):
+    """
+    Coalesces concurrent calls for the same key, so that only the first caller runs the coroutine
+    and every other caller awaits its result (or its exception).
+    """
+
+    def __init__(self):
+        self._in_flight: dict[K, asyncio.Future[V]] = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    async def do(self, key: K, create: Callable[[], Awaitable[V]]) -> V:
+        task = self._in_flight.get(key)
+        if task is None:
+            self.calls += 1
+            task = asyncio.ensure_future(create())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+        else:
+            self.coalesced += 1
+        # Shielded so that a cancelled caller does not cancel the call for the callers still waiting on it
+        return await asyncio.shield(task)
+
+    def _forget(self, key: K, task: "asyncio.Future[V]") -> None:
+        self._in_flight.pop(key, None)
+        if not task.cancelled():
+            # Mark the exception as retrieved even if every caller has been cancelled in the meantime
+            task.exception()
+
+    def __len__(self) -> int:
+        return len(self._in_flight)
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._in_flight
+
+    def stats(self) -> dict[str, Any]:
+        return {"in_flight": len(self._in_flight), "calls": self.calls, "coalesced": self.coalesced}
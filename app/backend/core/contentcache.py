@@ -0,0 +1,145 @@
+import asyncio
+import contextlib
+import uuid
+from collections import OrderedDict
+from collections.abc import AsyncGenerator, AsyncIterator
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Optional, Union
+
+CACHED_FILE_SUFFIX = ".content"
+PARTIAL_FILE_SUFFIX = ".partial"
+
+
+@dataclass
+class CachedContentFile:
+    file_path: Path
+    etag: str
+    last_modified: Optional[datetime]
+    content_type: str
+    size: int
+
+
+class ContentFileCache:
+    """
+    Keeps copies of the files served by /content on local disk, bounded by total size and file count
+    (least recently used files are evicted first).
+    A cached copy is only served after storage confirms that its ETag is still current,
+    so the cache saves downloading the file but never serves a file that has changed.
+    Not thread-safe: it is meant to be used from a single event loop.
+    """
+
+    def __init__(
+        self,
+        directory: Union[str, Path],
+        max_bytes: int,
+        max_files: int = 1000,
+        max_file_bytes: Optional[int] = None,
+    ):
+        if max_bytes <= 0 or max_files <= 0:
+            raise ValueError("max_bytes and max_files must be greater than 0")
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.max_file_bytes = min(max_file_bytes, max_bytes) if max_file_bytes else max_bytes
+        self._entries: OrderedDict[str, CachedContentFile] = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.stores = 0
+        self.evictions = 0
+
+        # The index of cached files only lives in memory, so files left behind by a previous process are removed
+        self.directory.mkdir(parents=True, exist_ok=True)
+        for leftover_path in self.directory.iterdir():
+            if leftover_path.suffix in (CACHED_FILE_SUFFIX, PARTIAL_FILE_SUFFIX):
+                self._unlink(leftover_path)
+
+    def get(self, key: str) -> Optional[CachedContentFile]:
+        cached_file = self._entries.get(key)
+        if cached_file:
+            self._entries.move_to_end(key)
+        return cached_file
+
+    def record_hit(self, served_bytes: int) -> None:
+        self.hits += 1
+        self.bytes_saved += served_bytes
+
+    def record_miss(self) -> None:
+        self.misses += 1
+
+    def remove(self, key: str) -> None:
+        cached_file = self._entries.pop(key, None)
+        if cached_file:
+            self.total_bytes -= cached_file.size
+            self._unlink(cached_file.file_path)
+
+    async def store_while_streaming(
+        self,
+        key: str,
+        chunks: AsyncIterator[bytes],
+        etag: str,
+        last_modified: Optional[datetime],
+        content_type: str,
+        size: int,
+    ) -> AsyncGenerator[bytes, None]:
+        """
+        Passes the chunks of a downloaded file through, while writing them to the cache.
+        The file is only added to the cache once all of it has been received.
+        """
+        if size > self.max_file_bytes:
+            async for chunk in chunks:
+                yield chunk
+            return
+
+        # Every version of a file gets a new name, so replacing or evicting it never affects responses still reading it
+        file_path = self.directory / f"{uuid.uuid4().hex}{PARTIAL_FILE_SUFFIX}"
+        file = await asyncio.to_thread(file_path.open, "wb")
+        received_bytes = 0
+        try:
+            async for chunk in chunks:
+                await asyncio.to_thread(file.write, chunk)
+                received_bytes += len(chunk)
+                yield chunk
+        finally:
+            file.close()
+            if received_bytes == size:
+                cached_file_path = file_path.with_suffix(CACHED_FILE_SUFFIX)
+                file_path.rename(cached_file_path)
+                self._add(key, CachedContentFile(cached_file_path, etag, last_modified, content_type, size))
+            else:
+                self._unlink(file_path)
+
+    def _add(self, key: str, cached_file: CachedContentFile) -> None:
+        self.remove(key)
+        self._entries[key] = cached_file
+        self.total_bytes += cached_file.size
+        self.stores += 1
+        while len(self._entries) > self.max_files or self.total_bytes > self.max_bytes:
+            _, evicted_file = self._entries.popitem(last=False)
+            self.total_bytes -= evicted_file.size
+            self._unlink(evicted_file.file_path)
+            self.evictions += 1
+
+    @staticmethod
+    def _unlink(file_path: Path) -> None:
+        # A file that is still being sent can't be removed on Windows, it is then cleaned up on the next start
+        with contextlib.suppress(OSError):
+            file_path.unlink()
+
+    def stats(self) -> dict[str, Any]:
+        requests = self.hits + self.misses
+        return {
+            "files": len(self._entries),
+            "max_files": self.max_files,
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / requests if requests else 0.0,
+            "bytes_saved": self.bytes_saved,
+            "stores": self.stores,
+            "evictions": self.evictions,
+        }
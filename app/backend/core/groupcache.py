@@ -0,0 +1,82 @@
+import asyncio
+import logging
+import time
+from collections.abc import Awaitable
+from typing import Any, Callable
+
+from core.cache import SingleFlight, TTLCache
+
+
+class GroupMembershipCache:
+    """
+    Caches the groups of users whose token doesn't list them (the groups overage case), keyed by the user's oid,
+    so that Microsoft Graph isn't paged through on every request.
+    Groups that are older than ttl_seconds are still returned while they are refreshed in the background
+    (stale-while-revalidate), until they are older than max_stale_seconds and have to be fetched again before use.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 10000,
+        ttl_seconds: float = 300,
+        max_stale_seconds: float = 3600,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        if ttl_seconds > max_stale_seconds:
+            raise ValueError("ttl_seconds must not be greater than max_stale_seconds")
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        # (fetched at, groups), dropped once the groups are too old to be returned at all
+        self.entries: TTLCache[str, tuple[float, list[str]]] = TTLCache(max_entries, max_stale_seconds, clock=clock)
+        self.in_flight: SingleFlight[str, list[str]] = SingleFlight()
+        self._refresh_tasks: dict[str, asyncio.Task[None]] = {}
+        self.stale_hits = 0
+        self.background_refreshes = 0
+        self.background_refresh_failures = 0
+
+    async def get_or_fetch(self, oid: str, fetch: Callable[[], Awaitable[list[str]]]) -> list[str]:
+        entry = self.entries.get(oid)
+        if entry is not None:
+            fetched_at, groups = entry
+            if self.clock() - fetched_at >= self.ttl_seconds:
+                self.stale_hits += 1
+                self._refresh_in_background(oid, fetch)
+            return groups
+        return await self.in_flight.do(oid, lambda: self._fetch_and_store(oid, fetch))
+
+    async def _fetch_and_store(self, oid: str, fetch: Callable[[], Awaitable[list[str]]]) -> list[str]:
+        groups = await fetch()
+        self.entries.set(oid, (self.clock(), groups))
+        return groups
+
+    def _refresh_in_background(self, oid: str, fetch: Callable[[], Awaitable[list[str]]]) -> None:
+        if oid in self._refresh_tasks or oid in self.in_flight:
+            return
+
+        async def refresh() -> None:
+            try:
+                await self.in_flight.do(oid, lambda: self._fetch_and_store(oid, fetch))
+                self.background_refreshes += 1
+            except Exception:
+                # The stale groups keep being used until a refresh succeeds or they are too old
+                logging.exception("Failed to refresh the groups of user %s", oid)
+                self.background_refresh_failures += 1
+
+        task = asyncio.create_task(refresh())
+        self._refresh_tasks[oid] = task
+        task.add_done_callback(lambda _: self._refresh_tasks.pop(oid, None))
+
+    async def close(self) -> None:
+        tasks = list(self._refresh_tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self) -> dict[str, Any]:
+        return self.entries.stats() | {
+            "stale_hits": self.stale_hits,
+            "background_refreshes": self.background_refreshes,
+            "background_refresh_failures": self.background_refresh_failures,
+            "fetches": self.in_flight.calls,
+            "coalesced": self.in_flight.coalesced,
+        }
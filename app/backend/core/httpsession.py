@@ -0,0 +1,83 @@
+import time
+from types import SimpleNamespace
+from typing import Any
+
+import aiohttp
+
+from core.metrics import LatencyRecorder
+
+
+class HttpSessionPool:
+    """
+    App-wide aiohttp session for the backend's own HTTP calls (Microsoft Graph, Entra signing keys, Azure AI Vision),
+    so that connections, DNS lookups and TLS sessions are reused between requests instead of being set up for every call.
+    Requests that find every connection to a host in use wait for one, and /metrics reports how long they waited.
+    Must be created and closed on the event loop that uses it.
+    """
+
+    def __init__(
+        self,
+        limit: int = 100,
+        limit_per_host: int = 20,
+        keepalive_timeout: float = 30,
+        dns_cache_ttl_seconds: int = 300,
+    ):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.pool_wait = LatencyRecorder()
+        self.requests = 0
+        self.connections_created = 0
+        self.connections_reused = 0
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(self._on_request_start)
+        trace_config.on_connection_queued_start.append(self._on_connection_queued_start)
+        trace_config.on_connection_queued_end.append(self._on_connection_queued_end)
+        trace_config.on_connection_create_end.append(self._on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(self._on_connection_reuseconn)
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=limit,
+                limit_per_host=limit_per_host,
+                keepalive_timeout=keepalive_timeout,
+                ttl_dns_cache=dns_cache_ttl_seconds,
+            ),
+            trace_configs=[trace_config],
+        )
+
+    async def _on_request_start(self, session: aiohttp.ClientSession, context: SimpleNamespace, params: Any) -> None:
+        self.requests += 1
+
+    async def _on_connection_queued_start(
+        self, session: aiohttp.ClientSession, context: SimpleNamespace, params: Any
+    ) -> None:
+        context.queued_at = time.monotonic()
+
+    async def _on_connection_queued_end(
+        self, session: aiohttp.ClientSession, context: SimpleNamespace, params: Any
+    ) -> None:
+        self.pool_wait.record(time.monotonic() - context.queued_at)
+
+    async def _on_connection_create_end(
+        self, session: aiohttp.ClientSession, context: SimpleNamespace, params: Any
+    ) -> None:
+        self.connections_created += 1
+
+    async def _on_connection_reuseconn(
+        self, session: aiohttp.ClientSession, context: SimpleNamespace, params: Any
+    ) -> None:
+        self.connections_reused += 1
+
+    async def close(self) -> None:
+        await self.session.close()
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "limit": self.limit,
+            "limit_per_host": self.limit_per_host,
+            "requests": self.requests,
+            "connections_created": self.connections_created,
+            "connections_reused": self.connections_reused,
+            # Only requests that had to wait for a free connection are counted
+            "pool_wait": self.pool_wait.stats(),
+        }
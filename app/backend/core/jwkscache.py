@@ -0,0 +1,144 @@
+import asyncio
+import base64
+import contextlib
+import logging
+import time
+from typing import Any, Optional
+
+import aiohttp
+from cryptography.hazmat.primitives.asymmetric import rsa
+from tenacity import (
+    AsyncRetrying,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_random_exponential,
+)
+
+
+class JwksRefreshError(Exception):
+    def __init__(self, error: str, status_code: int):
+        self.error = error
+        self.status_code = status_code
+
+    def __str__(self) -> str:
+        return self.error
+
+
+class JwksCache:
+    """
+    Keeps the signing keys of the identity provider in memory as ready-to-use public keys, indexed by key id.
+    The key set is refreshed in the background, and also right away when a token is signed with a key id
+    that is not known yet (as happens after a key rollover), at most once per min_refresh_interval_seconds.
+    """
+
+    def __init__(
+        self,
+        key_url: str,
+        refresh_interval_seconds: float = 24 * 3600,
+        min_refresh_interval_seconds: float = 60,
+        http_session: Optional[aiohttp.ClientSession] = None,
+    ):
+        self.key_url = key_url
+        self.http_session = http_session
+        self.refresh_interval_seconds = refresh_interval_seconds
+        self.min_refresh_interval_seconds = min_refresh_interval_seconds
+        self.keys: dict[str, rsa.RSAPublicKey] = {}
+        self.last_refresh: Optional[float] = None
+        self._refresh_lock = asyncio.Lock()
+        self._refresh_task: Optional[asyncio.Task[None]] = None
+        self.refreshes = 0
+        self.refresh_failures = 0
+        self.unknown_kid_refreshes = 0
+
+    @staticmethod
+    def build_public_key(jwk: dict[str, Any]) -> rsa.RSAPublicKey:
+        public_numbers = rsa.RSAPublicNumbers(
+            e=int.from_bytes(base64.urlsafe_b64decode(jwk["e"] + "=="), byteorder="big"),
+            n=int.from_bytes(base64.urlsafe_b64decode(jwk["n"] + "=="), byteorder="big"),
+        )
+        return public_numbers.public_key()
+
+    async def fetch_jwks(self) -> dict[str, Any]:
+        jwks = None
+        async for attempt in AsyncRetrying(
+            retry=retry_if_exception_type(JwksRefreshError),
+            wait=wait_random_exponential(min=15, max=60),
+            stop=stop_after_attempt(5),
+        ):
+            with attempt:
+                async with contextlib.AsyncExitStack() as stack:
+                    # Without a shared session, one is only created for this call
+                    session = self.http_session
+                    if session is None:
+                        session = await stack.enter_async_context(aiohttp.ClientSession())
+                    async with session.get(url=self.key_url) as resp:
+                        resp_status = resp.status
+                        if resp_status in [500, 502, 503, 504]:
+                            raise JwksRefreshError(
+                                error=f"Failed to get keys info: {await resp.text()}", status_code=resp_status
+                            )
+                        jwks = await resp.json()
+
+        if not jwks or "keys" not in jwks:
+            raise JwksRefreshError("Unable to get keys to validate auth token.", 401)
+        return jwks
+
+    async def refresh(self) -> None:
+        jwks = await self.fetch_jwks()
+        keys = {}
+        for jwk in jwks["keys"]:
+            if jwk.get("kty") != "RSA" or "kid" not in jwk:
+                continue
+            try:
+                keys[jwk["kid"]] = self.build_public_key(jwk)
+            except (KeyError, ValueError):
+                logging.warning("Skipping signing key %s that is not a valid RSA public key", jwk["kid"])
+        self.keys = keys
+        self.last_refresh = time.monotonic()
+        self.refreshes += 1
+
+    async def get_key(self, kid: str) -> Optional[rsa.RSAPublicKey]:
+        if (key := self.keys.get(kid)) is not None:
+            return key
+        async with self._refresh_lock:
+            # Another request may have refreshed the keys while this one was waiting for the lock
+            if (key := self.keys.get(kid)) is not None:
+                return key
+            # Tokens with made-up key ids must not make every request download the key set
+            if self.last_refresh is None or time.monotonic() - self.last_refresh >= self.min_refresh_interval_seconds:
+                if self.last_refresh is not None:
+                    self.unknown_kid_refreshes += 1
+                await self.refresh()
+        return self.keys.get(kid)
+
+    def start(self) -> None:
+        self._refresh_task = asyncio.create_task(self._refresh_periodically())
+
+    async def close(self) -> None:
+        if self._refresh_task:
+            self._refresh_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._refresh_task
+
+    async def _refresh_periodically(self) -> None:
+        # The first request fetches the keys, so that the app starts without waiting on the identity provider
+        delay = self.refresh_interval_seconds
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                async with self._refresh_lock:
+                    await self.refresh()
+                delay = self.refresh_interval_seconds
+            except Exception:
+                # The keys that were fetched before are still used until a refresh succeeds
+                logging.exception("Failed to refresh the signing keys")
+                self.refresh_failures += 1
+                delay = self.min_refresh_interval_seconds
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "keys": len(self.keys),
+            "refreshes": self.refreshes,
+            "refresh_failures": self.refresh_failures,
+            "unknown_kid_refreshes": self.unknown_kid_refreshes,
+        }
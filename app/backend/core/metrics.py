@@ -0,0 +1,37 @@
+import math
+from collections import deque
+from typing import Any
+
+
+class LatencyRecorder:
+    """
+    Keeps count of how long calls take, with percentiles over the most recent calls.
+    Not thread-safe: it is meant to be used from a single event loop.
+    """
+
+    def __init__(self, max_samples: int = 1000):
+        self.samples: deque[float] = deque(maxlen=max_samples)
+        self.count = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def record(self, seconds: float) -> None:
+        self.samples.append(seconds)
+        self.count += 1
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+
+    def percentile(self, fraction: float) -> float:
+        if not self.samples:
+            return 0.0
+        samples = sorted(self.samples)
+        return samples[max(math.ceil(fraction * len(samples)) - 1, 0)]
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "count": self.count,
+            "mean_ms": round(self.total_seconds / self.count * 1000, 1) if self.count else 0.0,
+            "p50_ms": round(self.percentile(0.5) * 1000, 1),
+            "p95_ms": round(self.percentile(0.95) * 1000, 1),
+            "max_ms": round(self.max_seconds * 1000, 1),
+        }
@@ -0,0 +1,58 @@
+import hashlib
+import json
+from collections.abc import Awaitable
+from typing import Any, Callable, Optional
+
+from core.cache import SingleFlight, TTLCache
+
+# (principal fingerprint, path)
+PathAuthCacheKey = tuple[str, str]
+
+
+class PathAuthCache:
+    """
+    Caches whether a user may open a file, so that a user paging through a document does not need
+    an Azure AI Search query for every request. Concurrent checks for the same user and file share a single query.
+    Decisions expire after a short time-to-live, as access control lists can also change outside the app,
+    and all of them are dropped whenever the app itself changes the index.
+    """
+
+    def __init__(self, max_entries: int = 10000, ttl_seconds: Optional[float] = 60):
+        self.entries: TTLCache[PathAuthCacheKey, bool] = TTLCache(max_entries, ttl_seconds)
+        self.in_flight: SingleFlight[tuple[int, PathAuthCacheKey], bool] = SingleFlight()
+        self.generation = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def principal_fingerprint(auth_claims: dict[str, Any]) -> str:
+        # The security filter only depends on the user and the groups they are a member of
+        principal = json.dumps([auth_claims.get("oid"), sorted(auth_claims.get("groups") or [])])
+        return hashlib.sha256(principal.encode("utf-8")).hexdigest()
+
+    async def get_or_check(self, auth_claims: dict[str, Any], path: str, check: Callable[[], Awaitable[bool]]) -> bool:
+        key = (self.principal_fingerprint(auth_claims), path)
+        if (allowed := self.entries.get(key)) is not None:
+            return allowed
+
+        generation = self.generation
+
+        async def check_and_store() -> bool:
+            allowed = await check()
+            # A decision that was made before the index changed is still returned, but not kept
+            if generation == self.generation:
+                self.entries.set(key, allowed)
+            return allowed
+
+        return await self.in_flight.do((generation, key), check_and_store)
+
+    def invalidate(self) -> None:
+        self.generation += 1
+        self.entries.clear()
+        self.invalidations += 1
+
+    def stats(self) -> dict[str, Any]:
+        return self.entries.stats() | {
+            "calls": self.in_flight.calls,
+            "coalesced": self.in_flight.coalesced,
+            "invalidations": self.invalidations,
+        }
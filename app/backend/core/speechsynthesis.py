@@ -0,0 +1,162 @@
+import asyncio
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+from collections.abc import AsyncGenerator
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Optional
+
+from azure.cognitiveservices.speech import (
+    ResultReason,
+    SpeechConfig,
+    SpeechSynthesisResult,
+    SpeechSynthesizer,
+)
+
+from core.metrics import LatencyRecorder
+
+logger = logging.getLogger("scripts")
+
+
+class SpeechSynthesisError(Exception):
+    pass
+
+
+class SpeechAudioCache:
+    """
+    Keeps synthesized audio in memory, keyed by a hash of the voice and the text,
+    bounded by total size (least recently used audio is evicted first).
+    Not thread-safe: it is meant to be used from a single event loop.
+    """
+
+    def __init__(self, max_bytes: int, max_audio_bytes: Optional[int] = None):
+        if max_bytes <= 0:
+            raise ValueError("max_bytes must be greater than 0")
+        self.max_bytes = max_bytes
+        self.max_audio_bytes = min(max_audio_bytes, max_bytes) if max_audio_bytes else max_bytes
+        self._entries: OrderedDict[str, bytes] = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def build_key(voice: str, text: str) -> str:
+        return voice + ":" + hashlib.sha256(text.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[bytes]:
+        audio = self._entries.get(key)
+        if audio is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return audio
+
+    def set(self, key: str, audio: bytes) -> None:
+        if len(audio) > self.max_audio_bytes:
+            return
+        if key in self._entries:
+            self.total_bytes -= len(self._entries.pop(key))
+        self._entries[key] = audio
+        self.total_bytes += len(audio)
+        while self.total_bytes > self.max_bytes:
+            _, evicted_audio = self._entries.popitem(last=False)
+            self.total_bytes -= len(evicted_audio)
+            self.evictions += 1
+
+    def stats(self) -> dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+        }
+
+
+class SpeechSynthesisService:
+    """
+    Runs Azure speech synthesis on a bounded thread pool, since the Speech SDK can only be waited on by blocking,
+    and passes the audio on in pieces as the service produces it.
+    Completed audio is kept in the audio cache, if one is given, so that replaying an answer needs no synthesis.
+    """
+
+    def __init__(self, max_workers: int = 4, audio_cache: Optional[SpeechAudioCache] = None):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="speech")
+        self.max_workers = max_workers
+        self.audio_cache = audio_cache
+        self.synthesis_latency = LatencyRecorder()
+        self.syntheses = 0
+        self.failures = 0
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=False)
+
+    async def synthesize(self, speech_config: SpeechConfig, text: str) -> AsyncGenerator[bytes, None]:
+        cache_key = None
+        if self.audio_cache:
+            cache_key = self.audio_cache.build_key(speech_config.speech_synthesis_voice_name, text)
+            if (audio := self.audio_cache.get(cache_key)) is not None:
+                yield audio
+                return
+
+        loop = asyncio.get_running_loop()
+        chunks: asyncio.Queue[Optional[bytes]] = asyncio.Queue()
+        synthesizer = SpeechSynthesizer(speech_config=speech_config, audio_config=None)
+        # The SDK reports each piece of audio from its own threads while the synthesis is still running
+        synthesizer.synthesizing.connect(
+            lambda event: loop.call_soon_threadsafe(chunks.put_nowait, event.result.audio_data)
+        )
+        started_at = time.monotonic()
+        result_future = loop.run_in_executor(self.executor, lambda: synthesizer.speak_text_async(text).get())
+        # The result is handled even if the client goes away, so the audio is still cached
+        result_future.add_done_callback(lambda future: self._on_synthesis_done(future, cache_key, started_at))
+        result_future.add_done_callback(lambda _: chunks.put_nowait(None))
+
+        streamed_bytes = 0
+        while (chunk := await chunks.get()) is not None:
+            streamed_bytes += len(chunk)
+            yield chunk
+
+        result: SpeechSynthesisResult = await result_future
+        if result.reason == ResultReason.SynthesizingAudioCompleted:
+            # Anything the SDK didn't report piece by piece is only in the final result
+            if streamed_bytes == 0 or len(result.audio_data) > streamed_bytes:
+                yield result.audio_data[streamed_bytes:]
+        elif result.reason == ResultReason.Canceled:
+            cancellation_details = result.cancellation_details
+            logger.error(
+                "Speech synthesis canceled: %s %s", cancellation_details.reason, cancellation_details.error_details
+            )
+            raise SpeechSynthesisError("Speech synthesis canceled. Check logs for details.")
+        else:
+            logger.error("Unexpected result reason: %s", result.reason)
+            raise SpeechSynthesisError("Speech synthesis failed. Check logs for details.")
+
+    def _on_synthesis_done(self, future: asyncio.Future, cache_key: Optional[str], started_at: float) -> None:
+        self.syntheses += 1
+        self.synthesis_latency.record(time.monotonic() - started_at)
+        if future.cancelled() or future.exception():
+            self.failures += 1
+            return
+        result: SpeechSynthesisResult = future.result()
+        if result.reason != ResultReason.SynthesizingAudioCompleted:
+            self.failures += 1
+        elif self.audio_cache and cache_key:
+            self.audio_cache.set(cache_key, result.audio_data)
+
+    def stats(self) -> dict[str, Any]:
+        stats: dict[str, Any] = {
+            "max_workers": self.max_workers,
+            "syntheses": self.syntheses,
+            "failures": self.failures,
+            "latency": self.synthesis_latency.stats(),
+        }
+        if self.audio_cache:
+            stats["audio_cache"] = self.audio_cache.stats()
+        return stats
@@ -0,0 +1,117 @@
+import asyncio
+import contextlib
+from collections.abc import AsyncGenerator
+from typing import Any, Optional
+
+# An event read from the stream, None once the stream has ended, or the error the stream raised
+QueuedEvent = tuple[Optional[dict[str, Any]], Optional[Exception]]
+
+
+class DeltaCoalescer:
+    """
+    Merges the content deltas of a streamed answer into fewer, larger events, so that a response needs
+    far fewer lines and socket writes than the model sends tokens.
+    Merged content is sent once it is window_seconds old or max_chars long, whichever comes first.
+    The first content is sent right away, so the time to the first token doesn't change,
+    and any other event, like a context event, is sent right away after the content before it.
+    """
+
+    # Bounds how far the events are read ahead of a slow client
+    max_queued_events = 64
+
+    def __init__(self, window_seconds: float = 0.04, max_chars: int = 200):
+        if window_seconds <= 0 or max_chars <= 0:
+            raise ValueError("window_seconds and max_chars must be greater than 0")
+        self.window_seconds = window_seconds
+        self.max_chars = max_chars
+        self.deltas = 0
+        self.frames = 0
+
+    @staticmethod
+    def _is_content_delta(event: dict[str, Any]) -> bool:
+        return len(event) == 1 and (delta := event.get("delta")) is not None and tuple(delta) == ("content", "role")
+
+    def _frame(self, role: Optional[str], parts: list[str]) -> dict[str, Any]:
+        self.frames += 1
+        return {"delta": {"content": "".join(parts), "role": role}}
+
+    async def coalesce(self, events: AsyncGenerator[dict[str, Any], None]) -> AsyncGenerator[dict[str, Any], None]:
+        loop = asyncio.get_running_loop()
+        # One task reads the events into a queue, so that waiting for the next one can time out without losing it
+        queue: asyncio.Queue[QueuedEvent] = asyncio.Queue(maxsize=self.max_queued_events)
+        reader = asyncio.create_task(self._read(events, queue))
+        pending_parts: list[str] = []
+        pending_role: Optional[str] = None
+        pending_chars = 0
+        flush_at = 0.0
+        first_content_sent = False
+        try:
+            while True:
+                if not pending_parts:
+                    event, error = await queue.get()
+                elif not queue.empty():
+                    event, error = queue.get_nowait()
+                else:
+                    try:
+                        event, error = await asyncio.wait_for(queue.get(), max(flush_at - loop.time(), 0))
+                    except asyncio.TimeoutError:
+                        yield self._frame(pending_role, pending_parts)
+                        pending_parts, pending_chars = [], 0
+                        continue
+                if error is not None:
+                    if pending_parts:
+                        yield self._frame(pending_role, pending_parts)
+                    raise error
+                if event is None:
+                    break
+
+                if not self._is_content_delta(event):
+                    if pending_parts:
+                        yield self._frame(pending_role, pending_parts)
+                        pending_parts, pending_chars = [], 0
+                    yield event
+                    continue
+
+                self.deltas += 1
+                content = event["delta"]["content"] or ""
+                role = event["delta"]["role"]
+                if pending_parts and role != pending_role:
+                    yield self._frame(pending_role, pending_parts)
+                    pending_parts, pending_chars = [], 0
+                if not pending_parts:
+                    pending_role = role
+                    flush_at = loop.time() + self.window_seconds
+                pending_parts.append(content)
+                pending_chars += len(content)
+                if (content and not first_content_sent) or pending_chars >= self.max_chars:
+                    first_content_sent = first_content_sent or bool(content)
+                    yield self._frame(pending_role, pending_parts)
+                    pending_parts, pending_chars = [], 0
+
+            if pending_parts:
+                yield self._frame(pending_role, pending_parts)
+        finally:
+            # The client may have gone away while the model was still answering
+            reader.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await reader
+
+    @staticmethod
+    async def _read(events: AsyncGenerator[dict[str, Any], None], queue: "asyncio.Queue[QueuedEvent]"):
+        try:
+            async for event in events:
+                await queue.put((event, None))
+            await queue.put((None, None))
+        except Exception as error:
+            await queue.put((None, error))
+        finally:
+            await events.aclose()
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "window_ms": round(self.window_seconds * 1000),
+            "max_chars": self.max_chars,
+            "deltas": self.deltas,
+            "frames": self.frames,
+            "deltas_per_frame": self.deltas / self.frames if self.frames else 0.0,
+        }
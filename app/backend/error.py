@@ -3,24 +3,38 @@ import logging
 from openai import APIError
 from quart import jsonify
 
+from core.admission import get_retry_after_seconds
+
 ERROR_MESSAGE = """The app encountered an error processing your request.
 If you are an administrator of the app, view the full error in the logs. See aka.ms/appservice-logs for more information.
 Error type: {error_type}
 """
 ERROR_MESSAGE_FILTER = """Your message contains content that was flagged by the OpenAI content filter."""
 
+ERROR_MESSAGE_BUSY = """The app is too busy to answer right now. Please try again in {retry_after_seconds} seconds."""
+
 ERROR_MESSAGE_LENGTH = """Your message exceeded the context length limit for this OpenAI model. Please shorten your message or change your settings to retrieve fewer search results."""
 
+ERROR_MESSAGE_CONVERSATION_NOT_FOUND = (
+    """The conversation was not found on the server. Please send the whole conversation."""
+)
+
 
 def error_dict(error: Exception) -> dict:
     if isinstance(error, APIError) and error.code == "content_filter":
         return {"error": ERROR_MESSAGE_FILTER}
     if isinstance(error, APIError) and error.code == "context_length_exceeded":
         return {"error": ERROR_MESSAGE_LENGTH}
+    if (retry_after_seconds := get_retry_after_seconds(error)) is not None:
+        return {"error": ERROR_MESSAGE_BUSY.format(retry_after_seconds=retry_after_seconds)}
     return {"error": ERROR_MESSAGE.format(error_type=type(error))}
 
 
 def error_response(error: Exception, route: str, status_code: int = 500):
+    if (retry_after_seconds := get_retry_after_seconds(error)) is not None:
+        # Shed load is expected under a spike, and the client is told when to come back
+        logging.warning("Shed load in %s: %s", route, error)
+        return jsonify(error_dict(error)), 503, {"Retry-After": str(retry_after_seconds)}
     logging.exception("Exception in %s: %s", route, error)
     if isinstance(error, APIError) and error.code == "content_filter":
         status_code = 400
@@ -4,6 +4,8 @@ import logging
 import os
 from typing import Optional, Union
 
+import aiohttp
+import httpx
 from azure.core.credentials import AzureKeyCredential
 from azure.core.credentials_async import AsyncTokenCredential
 from azure.identity.aio import AzureDeveloperCliCredential, get_bearer_token_provider
@@ -158,6 +160,7 @@ def setup_embeddings_service(
     openai_org: Union[str, None],
     disable_vectors: bool = False,
     disable_batch_vectors: bool = False,
+    http_client: Optional[httpx.AsyncClient] = None,
 ):
     if disable_vectors:
         logger.info("Not setting up embeddings service")
@@ -176,6 +179,7 @@ def setup_embeddings_service(
             open_ai_api_version=openai_api_version,
             credential=azure_open_ai_credential,
             disable_batch=disable_batch_vectors,
+            http_client=http_client,
         )
     else:
         if openai_key is None:
@@ -186,6 +190,7 @@ def setup_embeddings_service(
             credential=openai_key,
             organization=openai_org,
             disable_batch=disable_batch_vectors,
+            http_client=http_client,
         )
 
 
@@ -198,6 +203,7 @@ def setup_file_processors(
     search_images: bool = False,
     use_content_understanding: bool = False,
     content_understanding_endpoint: Union[str, None] = None,
+    http_session: Optional[aiohttp.ClientSession] = None,
 ):
     sentence_text_splitter = SentenceTextSplitter()
 
@@ -212,6 +218,7 @@ def setup_file_processors(
             credential=documentintelligence_creds,
             use_content_understanding=use_content_understanding,
             content_understanding_endpoint=content_understanding_endpoint,
+            http_session=http_session,
         )
 
     pdf_parser: Optional[Parser] = None
@@ -261,7 +268,10 @@ def setup_file_processors(
 
 
 def setup_image_embeddings_service(
-    azure_credential: AsyncTokenCredential, vision_endpoint: Union[str, None], search_images: bool
+    azure_credential: AsyncTokenCredential,
+    vision_endpoint: Union[str, None],
+    search_images: bool,
+    http_session: Optional[aiohttp.ClientSession] = None,
 ) -> Union[ImageEmbeddings, None]:
     image_embeddings_service: Optional[ImageEmbeddings] = None
     if search_images:
@@ -270,6 +280,7 @@ def setup_image_embeddings_service(
         image_embeddings_service = ImageEmbeddings(
             endpoint=vision_endpoint,
             token_provider=get_bearer_token_provider(azure_credential, "https://cognitiveservices.azure.com/.default"),
+            http_session=http_session,
         )
     return image_embeddings_service
 
@@ -1,3 +1,4 @@
+import contextlib
 import logging
 from abc import ABC
 from collections.abc import Awaitable
@@ -5,6 +6,7 @@ from typing import Callable, Optional, Union
 from urllib.parse import urljoin
 
 import aiohttp
+import httpx
 import tiktoken
 from azure.core.credentials import AzureKeyCredential
 from azure.core.credentials_async import AsyncTokenCredential
@@ -12,15 +14,23 @@ from azure.identity.aio import get_bearer_token_provider
 from openai import AsyncAzureOpenAI, AsyncOpenAI, RateLimitError
 from tenacity import (
     AsyncRetrying,
+    retry_if_exception,
     retry_if_exception_type,
     stop_after_attempt,
     wait_random_exponential,
 )
 from typing_extensions import TypedDict
 
+from core.admission import get_retry_after_seconds
+
 logger = logging.getLogger("scripts")
 
 
+def is_retryable_error(error: BaseException) -> bool:
+    # Calls shed by the backend's admission control fail right away, since retrying them would only add to the load
+    return isinstance(error, RateLimitError) and get_retry_after_seconds(error) is None
+
+
 class EmbeddingBatch:
     """
     Represents a batch of text that is going to be embedded
@@ -52,10 +62,18 @@ class OpenAIEmbeddings(ABC):
         "text-embedding-3-large": True,
     }
 
-    def __init__(self, open_ai_model_name: str, open_ai_dimensions: int, disable_batch: bool = False):
+    def __init__(
+        self,
+        open_ai_model_name: str,
+        open_ai_dimensions: int,
+        disable_batch: bool = False,
+        http_client: Optional[httpx.AsyncClient] = None,
+    ):
         self.open_ai_model_name = open_ai_model_name
         self.open_ai_dimensions = open_ai_dimensions
         self.disable_batch = disable_batch
+        # Optional shared HTTP client, so that the backend's uploads go through its admission control
+        self.http_client = http_client
 
     async def create_client(self) -> AsyncOpenAI:
         raise NotImplementedError
@@ -104,7 +122,7 @@ class OpenAIEmbeddings(ABC):
         client = await self.create_client()
         for batch in batches:
             async for attempt in AsyncRetrying(
-                retry=retry_if_exception_type(RateLimitError),
+                retry=retry_if_exception(is_retryable_error),
                 wait=wait_random_exponential(min=15, max=60),
                 stop=stop_after_attempt(15),
                 before_sleep=self.before_retry_sleep,
@@ -125,7 +143,7 @@ class OpenAIEmbeddings(ABC):
     async def create_embedding_single(self, text: str, dimensions_args: ExtraArgs) -> list[float]:
         client = await self.create_client()
         async for attempt in AsyncRetrying(
-            retry=retry_if_exception_type(RateLimitError),
+            retry=retry_if_exception(is_retryable_error),
             wait=wait_random_exponential(min=15, max=60),
             stop=stop_after_attempt(15),
             before_sleep=self.before_retry_sleep,
@@ -168,8 +186,9 @@ class AzureOpenAIEmbeddingService(OpenAIEmbeddings):
         credential: Union[AsyncTokenCredential, AzureKeyCredential],
         open_ai_custom_url: Union[str, None] = None,
         disable_batch: bool = False,
+        http_client: Optional[httpx.AsyncClient] = None,
     ):
-        super().__init__(open_ai_model_name, open_ai_dimensions, disable_batch)
+        super().__init__(open_ai_model_name, open_ai_dimensions, disable_batch, http_client)
         self.open_ai_service = open_ai_service
         if open_ai_service:
             self.open_ai_endpoint = f"https://{open_ai_service}.openai.azure.com"
@@ -200,6 +219,7 @@ class AzureOpenAIEmbeddingService(OpenAIEmbeddings):
             azure_endpoint=self.open_ai_endpoint,
             azure_deployment=self.open_ai_deployment,
             api_version=self.open_ai_api_version,
+            http_client=self.http_client,
             **auth_args,
         )
 
@@ -217,13 +237,14 @@ class OpenAIEmbeddingService(OpenAIEmbeddings):
         credential: str,
         organization: Optional[str] = None,
         disable_batch: bool = False,
+        http_client: Optional[httpx.AsyncClient] = None,
     ):
-        super().__init__(open_ai_model_name, open_ai_dimensions, disable_batch)
+        super().__init__(open_ai_model_name, open_ai_dimensions, disable_batch, http_client)
         self.credential = credential
         self.organization = organization
 
     async def create_client(self) -> AsyncOpenAI:
-        return AsyncOpenAI(api_key=self.credential, organization=self.organization)
+        return AsyncOpenAI(api_key=self.credential, organization=self.organization, http_client=self.http_client)
 
 
 class ImageEmbeddings:
@@ -232,9 +253,15 @@ class ImageEmbeddings:
     To learn more, please visit https://learn.microsoft.com/azure/ai-services/computer-vision/how-to/image-retrieval#call-the-vectorize-image-api
     """
 
-    def __init__(self, endpoint: str, token_provider: Callable[[], Awaitable[str]]):
+    def __init__(
+        self,
+        endpoint: str,
+        token_provider: Callable[[], Awaitable[str]],
+        http_session: Optional[aiohttp.ClientSession] = None,
+    ):
         self.token_provider = token_provider
         self.endpoint = endpoint
+        self.http_session = http_session
 
     async def create_embeddings(self, blob_urls: list[str]) -> list[list[float]]:
         endpoint = urljoin(self.endpoint, "computervision/retrieval:vectorizeImage")
@@ -243,7 +270,11 @@ class ImageEmbeddings:
         headers["Authorization"] = "Bearer " + await self.token_provider()
 
         embeddings: list[list[float]] = []
-        async with aiohttp.ClientSession(headers=headers) as session:
+        async with contextlib.AsyncExitStack() as stack:
+            # Without a shared session, one is only created for this call
+            session = self.http_session
+            if session is None:
+                session = await stack.enter_async_context(aiohttp.ClientSession())
             for blob_url in blob_urls:
                 async for attempt in AsyncRetrying(
                     retry=retry_if_exception_type(Exception),
@@ -253,7 +284,7 @@ class ImageEmbeddings:
                 ):
                     with attempt:
                         body = {"url": blob_url}
-                        async with session.post(url=endpoint, params=params, json=body) as resp:
+                        async with session.post(url=endpoint, params=params, headers=headers, json=body) as resp:
                             resp_json = await resp.json()
                             embeddings.append(resp_json["vector"])
 
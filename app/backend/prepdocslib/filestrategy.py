@@ -1,5 +1,5 @@
 import logging
-from typing import Optional
+from typing import Callable, Optional
 
 from azure.core.credentials import AzureKeyCredential
 
@@ -134,6 +134,7 @@ class UploadUserFileStrategy:
         embeddings: Optional[OpenAIEmbeddings] = None,
         image_embeddings: Optional[ImageEmbeddings] = None,
         search_field_name_embedding: Optional[str] = None,
+        on_content_changed: Optional[Callable[[], None]] = None,
     ):
         self.file_processors = file_processors
         self.embeddings = embeddings
@@ -147,6 +148,7 @@ class UploadUserFileStrategy:
             embeddings=self.embeddings,
             field_name_embedding=search_field_name_embedding,
             search_images=False,
+            on_content_changed=on_content_changed,
         )
         self.search_field_name_embedding = search_field_name_embedding
 
@@ -1,5 +1,7 @@
+import contextlib
 import logging
 from abc import ABC
+from typing import Optional
 
 import aiohttp
 from azure.core.credentials_async import AsyncTokenCredential
@@ -38,9 +40,12 @@ class ContentUnderstandingDescriber:
         },
     }
 
-    def __init__(self, endpoint: str, credential: AsyncTokenCredential):
+    def __init__(
+        self, endpoint: str, credential: AsyncTokenCredential, http_session: Optional[aiohttp.ClientSession] = None
+    ):
         self.endpoint = endpoint
         self.credential = credential
+        self.http_session = http_session
 
     async def poll_api(self, session, poll_url, headers):
 
@@ -85,7 +90,11 @@ class ContentUnderstandingDescriber:
 
     async def describe_image(self, image_bytes: bytes) -> str:
         logger.info("Sending image to Azure Content Understanding service...")
-        async with aiohttp.ClientSession() as session:
+        async with contextlib.AsyncExitStack() as stack:
+            # Without a shared session, one is only created for this call
+            session = self.http_session
+            if session is None:
+                session = await stack.enter_async_context(aiohttp.ClientSession())
             token = await self.credential.get_token("https://cognitiveservices.azure.com/.default")
             headers = {"Authorization": "Bearer " + token.token}
             params = {"api-version": self.CU_API_VERSION}
@@ -103,5 +112,5 @@ class ContentUnderstandingDescriber:
                     progress.add_task("Processing...", total=None, start=False)
                     results = await self.poll_api(session, poll_url, headers)
 
-                fields = results["result"]["contents"][0]["fields"]
-                return fields["Description"]["valueString"]
+        fields = results["result"]["contents"][0]["fields"]
+        return fields["Description"]["valueString"]
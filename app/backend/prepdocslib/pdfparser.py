@@ -3,8 +3,9 @@ import io
 import logging
 from collections.abc import AsyncGenerator
 from enum import Enum
-from typing import IO, Union
+from typing import IO, Optional, Union
 
+import aiohttp
 import pymupdf
 from azure.ai.documentintelligence.aio import DocumentIntelligenceClient
 from azure.ai.documentintelligence.models import (
@@ -57,12 +58,14 @@ class DocumentAnalysisParser(Parser):
         model_id="prebuilt-layout",
         use_content_understanding=True,
         content_understanding_endpoint: Union[str, None] = None,
+        http_session: Optional[aiohttp.ClientSession] = None,
     ):
         self.model_id = model_id
         self.endpoint = endpoint
         self.credential = credential
         self.use_content_understanding = use_content_understanding
         self.content_understanding_endpoint = content_understanding_endpoint
+        self.http_session = http_session
 
     async def parse(self, content: IO) -> AsyncGenerator[Page, None]:
         logger.info("Extracting text from '%s' using Azure Document Intelligence", content.name)
@@ -78,7 +81,9 @@ class DocumentAnalysisParser(Parser):
                     raise ValueError(
                         "AzureKeyCredential is not supported for Content Understanding, use keyless auth instead"
                     )
-                cu_describer = ContentUnderstandingDescriber(self.content_understanding_endpoint, self.credential)
+                cu_describer = ContentUnderstandingDescriber(
+                    self.content_understanding_endpoint, self.credential, http_session=self.http_session
+                )
                 content_bytes = content.read()
                 try:
                     poller = await document_intelligence_client.begin_analyze_document(
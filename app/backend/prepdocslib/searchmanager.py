@@ -1,7 +1,7 @@
 import asyncio
 import logging
 import os
-from typing import Optional
+from typing import Callable, Optional
 
 from azure.search.documents.indexes.models import (
     AzureOpenAIVectorizer,
@@ -35,7 +35,7 @@ from .blobmanager import BlobManager
 from .embeddings import AzureOpenAIEmbeddingService, OpenAIEmbeddings
 from .listfilestrategy import File
 from .strategy import SearchInfo
-from .textsplitter import SplitPage
+from .textsplitter import SplitPage, bpe
 
 logger = logging.getLogger("scripts")
 
@@ -66,6 +66,7 @@ class SearchManager:
         embeddings: Optional[OpenAIEmbeddings] = None,
         field_name_embedding: Optional[str] = None,
         search_images: bool = False,
+        on_content_changed: Optional[Callable[[], None]] = None,
     ):
         self.search_info = search_info
         self.search_analyzer_name = search_analyzer_name
@@ -75,6 +76,8 @@ class SearchManager:
         self.embedding_dimensions = self.embeddings.open_ai_dimensions if self.embeddings else None
         self.field_name_embedding = field_name_embedding
         self.search_images = search_images
+        # Called after documents are added to or removed from the index, so that callers can drop stale caches
+        self.on_content_changed = on_content_changed
 
     async def create_index(self):
         logger.info("Checking whether search index %s exists...", self.search_info.index_name)
@@ -207,6 +210,7 @@ class SearchManager:
                         filterable=True,
                         facetable=False,
                     ),
+                    SimpleField(name="tokenCount", type="Edm.Int32"),
                 ]
                 if self.use_acls:
                     fields.append(
@@ -294,6 +298,11 @@ class SearchManager:
                     )
                     await search_index_client.create_or_update_index(existing_index)
 
+                if not any(field.name == "tokenCount" for field in existing_index.fields):
+                    logger.info("Adding tokenCount field to index %s", self.search_info.index_name)
+                    existing_index.fields.append(SimpleField(name="tokenCount", type="Edm.Int32"))
+                    await search_index_client.create_or_update_index(existing_index)
+
                 if embedding_field and not any(
                     field.name == self.field_name_embedding for field in existing_index.fields
                 ):
@@ -435,6 +444,8 @@ class SearchManager:
                             )
                         ),
                         "sourcefile": section.content.filename(),
+                        # Lets the backend fit sources into the token budget of a prompt without counting them again
+                        "tokenCount": len(bpe.encode(section.split_page.text, disallowed_special=())),
                         **section.content.acls,
                     }
                     for section_index, section in enumerate(batch)
@@ -455,6 +466,8 @@ class SearchManager:
                         document["imageEmbedding"] = image_embeddings[section.split_page.page_num]
 
                 await search_client.upload_documents(documents)
+        if self.on_content_changed:
+            self.on_content_changed()
 
     async def remove_content(self, path: Optional[str] = None, only_oid: Optional[str] = None):
         logger.info(
@@ -489,3 +502,5 @@ class SearchManager:
                 logger.info("Removed %d sections from index", len(removed_docs))
                 # It can take a few seconds for search results to reflect changes, so wait a bit
                 await asyncio.sleep(2)
+                if self.on_content_changed:
+                    self.on_content_changed()
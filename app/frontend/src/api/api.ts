@@ -1,6 +1,15 @@
 const BACKEND_URI = "";
 
-import { ChatAppResponse, ChatAppResponseOrError, ChatAppRequest, Config, SimpleAPIResponse, HistoryListApiResponse, HistoryApiResponse } from "./models";
+import {
+    ChatAppResponse,
+    ChatAppResponseOrError,
+    ChatAppRequest,
+    Config,
+    SimpleAPIResponse,
+    HistoryListApiResponse,
+    HistoryApiResponse,
+    Thoughts
+} from "./models";
 import { useLogin, getToken, isUsingAppServicesLogin } from "../authConfig";
 
 export async function getHeaders(idToken: string | undefined): Promise<Record<string, string>> {
@@ -41,6 +50,15 @@ export async function askApi(request: ChatAppRequest, idToken: string | undefine
     return parsedResponse as ChatAppResponse;
 }
 
+export async function askStreamApi(request: ChatAppRequest, idToken: string | undefined): Promise<Response> {
+    const headers = await getHeaders(idToken);
+    return await fetch(`${BACKEND_URI}/ask/stream`, {
+        method: "POST",
+        headers: { ...headers, "Content-Type": "application/json" },
+        body: JSON.stringify(request)
+    });
+}
+
 export async function chatApi(request: ChatAppRequest, shouldStream: boolean, idToken: string | undefined): Promise<Response> {
     let url = `${BACKEND_URI}/chat`;
     if (shouldStream) {
@@ -54,6 +72,20 @@ export async function chatApi(request: ChatAppRequest, shouldStream: boolean, id
     });
 }
 
+export async function getThoughtsApi(thoughtsId: string, idToken: string | undefined): Promise<Thoughts[]> {
+    const response = await fetch(`${BACKEND_URI}/thoughts/${thoughtsId}`, {
+        method: "GET",
+        headers: await getHeaders(idToken)
+    });
+
+    if (!response.ok) {
+        throw new Error(`Getting thought process failed: ${response.statusText}`);
+    }
+
+    const dataResponse: { thoughts: Thoughts[] } = await response.json();
+    return dataResponse.thoughts;
+}
+
 export async function getSpeechApi(text: string): Promise<string | null> {
     return await fetch("/speech", {
         method: "POST",
@@ -58,7 +58,9 @@ export type Thoughts = {
 export type ResponseContext = {
     data_points: string[];
     followup_questions: string[] | null;
-    thoughts: Thoughts[];
+    thoughts?: Thoughts[];
+    // Set instead of thoughts when the backend keeps the thoughts, fetch them with getThoughtsApi
+    thoughts_id?: string;
 };
 
 export type ChatAppResponseOrError = {
@@ -78,6 +80,8 @@ export type ChatAppResponse = {
 
 export type ChatAppRequestContext = {
     overrides?: ChatAppRequestOverrides;
+    // Set when only the new message is sent: how many earlier messages the server keeps for the session
+    history_length?: number;
 };
 
 export type ChatAppRequest = {
@@ -101,6 +105,7 @@ export type Config = {
     showSpeechOutputAzure: boolean;
     showChatHistoryBrowser: boolean;
     showChatHistoryCosmos: boolean;
+    serverConversationState: boolean;
     showAgenticRetrievalOption: boolean;
 };
 
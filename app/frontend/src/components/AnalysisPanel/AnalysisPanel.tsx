@@ -3,7 +3,7 @@ import { useTranslation } from "react-i18next";
 import styles from "./AnalysisPanel.module.css";
 
 import { SupportingContent } from "../SupportingContent";
-import { ChatAppResponse } from "../../api";
+import { ChatAppResponse, getThoughtsApi, Thoughts } from "../../api";
 import { AnalysisPanelTabs } from "./AnalysisPanelTabs";
 import { ThoughtProcess } from "./ThoughtProcess";
 import { MarkdownViewer } from "../MarkdownViewer";
@@ -24,10 +24,13 @@ interface Props {
 const pivotItemDisabledStyle = { disabled: true, style: { color: "grey" } };
 
 export const AnalysisPanel = ({ answer, activeTab, activeCitation, citationHeight, className, onActiveTabChanged }: Props) => {
-    const isDisabledThoughtProcessTab: boolean = !answer.context.thoughts;
+    const isDisabledThoughtProcessTab: boolean = !answer.context.thoughts && !answer.context.thoughts_id;
     const isDisabledSupportingContentTab: boolean = !answer.context.data_points;
     const isDisabledCitationTab: boolean = !activeCitation;
     const [citation, setCitation] = useState("");
+    const [fetchedThoughts, setFetchedThoughts] = useState<{ thoughtsId: string; thoughts: Thoughts[] }>();
+    const thoughtsId = answer.context.thoughts_id;
+    const thoughts = answer.context.thoughts ?? (fetchedThoughts?.thoughtsId === thoughtsId ? fetchedThoughts?.thoughts : undefined);
 
     const client = useLogin ? useMsal().instance : undefined;
     const { t } = useTranslation();
@@ -55,6 +58,24 @@ export const AnalysisPanel = ({ answer, activeTab, activeCitation, citationHeigh
         fetchCitation();
     }, []);
 
+    // The backend may only send an id for the thought process, which is then fetched once the tab is opened
+    const fetchThoughts = async () => {
+        if (thoughts || !thoughtsId || activeTab !== AnalysisPanelTabs.ThoughtProcessTab) {
+            return;
+        }
+        const token = client ? await getToken(client) : undefined;
+        try {
+            setFetchedThoughts({ thoughtsId, thoughts: await getThoughtsApi(thoughtsId, token) });
+        } catch (error) {
+            // The backend only keeps thoughts for a while, so older answers may have none left
+            console.error(error);
+            setFetchedThoughts({ thoughtsId, thoughts: [] });
+        }
+    };
+    useEffect(() => {
+        fetchThoughts();
+    }, [activeTab, thoughtsId]);
+
     const renderFileViewer = () => {
         if (!activeCitation) {
             return null;
@@ -82,7 +103,7 @@ export const AnalysisPanel = ({ answer, activeTab, activeCitation, citationHeigh
                 headerText={t("headerTexts.thoughtProcess")}
                 headerButtonProps={isDisabledThoughtProcessTab ? pivotItemDisabledStyle : undefined}
             >
-                <ThoughtProcess thoughts={answer.context.thoughts || []} />
+                <ThoughtProcess thoughts={thoughts || []} />
             </PivotItem>
             <PivotItem
                 itemKey={AnalysisPanelTabs.SupportingContentTab}
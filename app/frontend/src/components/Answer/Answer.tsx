@@ -80,7 +80,7 @@ export const Answer = ({
                             title={t("tooltips.showThoughtProcess")}
                             ariaLabel={t("tooltips.showThoughtProcess")}
                             onClick={() => onThoughtProcessClicked()}
-                            disabled={!answer.context.thoughts?.length || isStreaming}
+                            disabled={!(answer.context.thoughts?.length || answer.context.thoughts_id) || isStreaming}
                         />
                         <IconButton
                             style={{ color: "black" }}
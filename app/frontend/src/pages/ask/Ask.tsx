@@ -2,10 +2,11 @@ import { useContext, useEffect, useRef, useState } from "react";
 import { useTranslation } from "react-i18next";
 import { Helmet } from "react-helmet-async";
 import { Panel, DefaultButton, Spinner } from "@fluentui/react";
+import readNDJSONStream from "ndjson-readablestream";
 
 import styles from "./Ask.module.css";
 
-import { askApi, configApi, ChatAppResponse, ChatAppRequest, RetrievalMode, VectorFields, GPT4VInput, SpeechConfig } from "../../api";
+import { askApi, askStreamApi, configApi, ChatAppResponse, ChatAppRequest, RetrievalMode, VectorFields, GPT4VInput, SpeechConfig } from "../../api";
 import { Answer, AnswerError } from "../../components/Answer";
 import { QuestionInput } from "../../components/QuestionInput";
 import { ExampleList } from "../../components/Example";
@@ -58,6 +59,8 @@ export function Component(): JSX.Element {
     const [isPlaying, setIsPlaying] = useState(false);
     const [showAgenticRetrievalOption, setShowAgenticRetrievalOption] = useState<boolean>(false);
     const [useAgenticRetrieval, setUseAgenticRetrieval] = useState<boolean>(false);
+    const [streamingEnabled, setStreamingEnabled] = useState<boolean>(false);
+    const [isStreaming, setIsStreaming] = useState<boolean>(false);
 
     const lastQuestionRef = useRef<string>("");
 
@@ -102,6 +105,7 @@ export function Component(): JSX.Element {
             setShowSpeechOutputBrowser(config.showSpeechOutputBrowser);
             setShowSpeechOutputAzure(config.showSpeechOutputAzure);
             setShowAgenticRetrievalOption(config.showAgenticRetrievalOption);
+            setStreamingEnabled(config.streamingEnabled);
             setUseAgenticRetrieval(config.showAgenticRetrievalOption);
             if (config.showAgenticRetrievalOption) {
                 setRetrieveCount(10);
@@ -113,6 +117,31 @@ export function Component(): JSX.Element {
         getConfig();
     }, []);
 
+    const handleAsyncRequest = async (responseBody: ReadableStream<any>) => {
+        let content = "";
+        let askResponse: ChatAppResponse = {} as ChatAppResponse;
+        try {
+            setIsStreaming(true);
+            for await (const event of readNDJSONStream(responseBody)) {
+                if (event["error"]) {
+                    throw Error(event["error"]);
+                }
+                if (event["context"]) {
+                    askResponse = { ...askResponse, context: event["context"], session_state: event["session_state"] ?? askResponse.session_state };
+                }
+                if (event["delta"] && event["delta"]["content"]) {
+                    content += event["delta"]["content"];
+                    setIsLoading(false);
+                }
+                if (content) {
+                    setAnswer({ ...askResponse, message: { content: content, role: "assistant" } });
+                }
+            }
+        } finally {
+            setIsStreaming(false);
+        }
+    };
+
     const makeApiRequest = async (question: string) => {
         lastQuestionRef.current = question;
 
@@ -162,9 +191,18 @@ export function Component(): JSX.Element {
                 // AI Chat Protocol: Client must pass on any session state received from the server
                 session_state: answer ? answer.session_state : null
             };
-            const result = await askApi(request, token);
-            setAnswer(result);
-            setSpeechUrls([null]);
+            if (streamingEnabled) {
+                const response = await askStreamApi(request, token);
+                if (!response.body || response.status > 299 || !response.ok) {
+                    throw Error(`Request failed with status ${response.status}`);
+                }
+                setSpeechUrls([null]);
+                await handleAsyncRequest(response.body);
+            } else {
+                const result = await askApi(request, token);
+                setAnswer(result);
+                setSpeechUrls([null]);
+            }
         } catch (e) {
             setError(e);
         } finally {
@@ -313,7 +351,7 @@ export function Component(): JSX.Element {
                             answer={answer}
                             index={0}
                             speechConfig={speechConfig}
-                            isStreaming={false}
+                            isStreaming={isStreaming}
                             onCitationClicked={x => onShowCitation(x)}
                             onThoughtProcessClicked={() => onToggleTab(AnalysisPanelTabs.ThoughtProcessTab)}
                             onSupportingContentClicked={() => onToggleTab(AnalysisPanelTabs.SupportingContentTab)}
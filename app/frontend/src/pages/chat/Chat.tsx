@@ -91,6 +91,7 @@ const Chat = () => {
     const [showSpeechOutputAzure, setShowSpeechOutputAzure] = useState<boolean>(false);
     const [showChatHistoryBrowser, setShowChatHistoryBrowser] = useState<boolean>(false);
     const [showChatHistoryCosmos, setShowChatHistoryCosmos] = useState<boolean>(false);
+    const [serverConversationState, setServerConversationState] = useState<boolean>(false);
     const [showAgenticRetrievalOption, setShowAgenticRetrievalOption] = useState<boolean>(false);
     const [useAgenticRetrieval, setUseAgenticRetrieval] = useState<boolean>(false);
 
@@ -134,6 +135,7 @@ const Chat = () => {
             setShowSpeechOutputAzure(config.showSpeechOutputAzure);
             setShowChatHistoryBrowser(config.showChatHistoryBrowser);
             setShowChatHistoryCosmos(config.showChatHistoryCosmos);
+            setServerConversationState(config.serverConversationState);
             setShowAgenticRetrievalOption(config.showAgenticRetrievalOption);
             setUseAgenticRetrieval(config.showAgenticRetrievalOption);
             if (config.showAgenticRetrievalOption) {
@@ -211,9 +213,14 @@ const Chat = () => {
                 { content: a[1].message.content, role: "assistant" }
             ]);
 
+            // AI Chat Protocol: Client must pass on any session state received from the server
+            const sessionState = answers.length ? answers[answers.length - 1][1].session_state : null;
+            // The server keeps the conversation under the session, so only the new message is sent
+            const sendNewMessageOnly = serverConversationState && typeof sessionState === "string" && messages.length > 0;
             const request: ChatAppRequest = {
-                messages: [...messages, { content: question, role: "user" }],
+                messages: sendNewMessageOnly ? [{ content: question, role: "user" }] : [...messages, { content: question, role: "user" }],
                 context: {
+                    ...(sendNewMessageOnly ? { history_length: messages.length } : {}),
                     overrides: {
                         prompt_template: promptTemplate.length === 0 ? undefined : promptTemplate,
                         include_category: includeCategory.length === 0 ? undefined : includeCategory,
@@ -240,11 +247,21 @@ const Chat = () => {
                         ...(seed !== null ? { seed: seed } : {})
                     }
                 },
-                // AI Chat Protocol: Client must pass on any session state received from the server
-                session_state: answers.length ? answers[answers.length - 1][1].session_state : null
+                session_state: sessionState
             };
 
-            const response = await chatApi(request, shouldStream, token);
+            let response = await chatApi(request, shouldStream, token);
+            if (response.status === 409 && sendNewMessageOnly) {
+                // The server no longer has the conversation, so it is sent whole
+                const fullRequest: ChatAppRequest = {
+                    ...request,
+                    messages: [...messages, { content: question, role: "user" }],
+                    context: { overrides: request.context?.overrides }
+                };
+                response = await chatApi(fullRequest, shouldStream, token);
+            }
+            // The server saves the turn to the chat history in Cosmos DB itself
+            const savedByServer = serverConversationState && historyProvider === HistoryProviderOptions.CosmosDB;
             if (!response.body) {
                 throw Error("No response body");
             }
@@ -254,7 +271,7 @@ const Chat = () => {
             if (shouldStream) {
                 const parsedResponse: ChatAppResponse = await handleAsyncRequest(question, answers, response.body);
                 setAnswers([...answers, [question, parsedResponse]]);
-                if (typeof parsedResponse.session_state === "string" && parsedResponse.session_state !== "") {
+                if (!savedByServer && typeof parsedResponse.session_state === "string" && parsedResponse.session_state !== "") {
                     const token = client ? await getToken(client) : undefined;
                     historyManager.addItem(parsedResponse.session_state, [...answers, [question, parsedResponse]], token);
                 }
@@ -264,7 +281,7 @@ const Chat = () => {
                     throw Error(parsedResponse.error);
                 }
                 setAnswers([...answers, [question, parsedResponse as ChatAppResponse]]);
-                if (typeof parsedResponse.session_state === "string" && parsedResponse.session_state !== "") {
+                if (!savedByServer && typeof parsedResponse.session_state === "string" && parsedResponse.session_state !== "") {
                     const token = client ? await getToken(client) : undefined;
                     historyManager.addItem(parsedResponse.session_state, [...answers, [question, parsedResponse as ChatAppResponse]], token);
                 }
@@ -0,0 +1,128 @@
+"""
+Micro-benchmark of the CPU time the backend spends on every streamed token of a chat answer:
+turning the chat completion chunk into an event and the event into an NDJSON line.
+It compares the per-chunk work of the current streaming loop with the previous one, which dumped every chunk
+with model_dump and serialized every event with json.dumps, and then times the whole streaming path
+of ChatReadRetrieveReadApproach, with and without delta coalescing. No Azure resources are needed.
+
+Run from the repository root:
+    PYTHONPATH=app/backend python scripts/benchmark_streaming.py --tokens 20000
+"""
+
+import argparse
+import asyncio
+import json
+import time
+from collections.abc import AsyncGenerator, Callable
+from typing import Optional
+
+from openai.types.chat import ChatCompletionChunk
+from openai.types.chat.chat_completion_chunk import Choice, ChoiceDelta
+
+from app import JSONEncoder, format_as_ndjson, format_event_as_ndjson
+from approaches.approach import DataPoints, ExtraInfo
+from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
+from approaches.promptmanager import PromptyManager
+from core.streamcoalescer import DeltaCoalescer
+
+
+def create_chunks(tokens: int) -> list[ChatCompletionChunk]:
+    words = ["The", " capital", " of", " France", " is", " Paris", ".", " שלום", ' "quoted"', "\n"]
+    return [
+        ChatCompletionChunk(
+            id="chatcmpl-benchmark",
+            choices=[Choice(index=0, delta=ChoiceDelta(content=words[i % len(words)], role="assistant"))],
+            created=0,
+            model="gpt-4.1-mini",
+            object="chat.completion.chunk",
+        )
+        for i in range(tokens)
+    ]
+
+
+def previous_chunk_to_line(chunk: ChatCompletionChunk) -> str:
+    event = chunk.model_dump()
+    completion = {
+        "delta": {
+            "content": event["choices"][0]["delta"].get("content"),
+            "role": event["choices"][0]["delta"]["role"],
+        }
+    }
+    return json.dumps(completion, ensure_ascii=False, cls=JSONEncoder) + "\n"
+
+
+def current_chunk_to_line(chunk: ChatCompletionChunk) -> str:
+    delta = chunk.choices[0].delta
+    return format_event_as_ndjson({"delta": {"content": delta.content, "role": delta.role}})
+
+
+def time_per_chunk(chunk_to_line: Callable[[ChatCompletionChunk], str], chunks: list[ChatCompletionChunk]) -> float:
+    started_at = time.process_time()
+    for chunk in chunks:
+        chunk_to_line(chunk)
+    return (time.process_time() - started_at) / len(chunks)
+
+
+async def time_streaming_path(
+    chunks: list[ChatCompletionChunk], coalescer: Optional[DeltaCoalescer] = None
+) -> tuple[float, int]:
+    approach = ChatReadRetrieveReadApproach(
+        search_client=None,
+        search_index_name=None,
+        agent_model=None,
+        agent_deployment=None,
+        agent_client=None,
+        auth_helper=None,
+        openai_client=None,
+        chatgpt_model="gpt-4.1-mini",
+        chatgpt_deployment="chat",
+        embedding_deployment="embeddings",
+        embedding_model="text-embedding-3-large",
+        embedding_dimensions=3072,
+        embedding_field="embedding3",
+        sourcepage_field="",
+        content_field="",
+        query_language="he-il",
+        query_speller="lexicon",
+        prompt_manager=PromptyManager(),
+    )
+
+    async def stream_chunks() -> AsyncGenerator[ChatCompletionChunk, None]:
+        for chunk in chunks:
+            yield chunk
+
+    async def chat_coroutine():
+        return stream_chunks()
+
+    async def run_until_final_call(*args, **kwargs):
+        return ExtraInfo(DataPoints(text=[]), thoughts=[]), chat_coroutine()
+
+    approach.run_until_final_call = run_until_final_call  # type: ignore[method-assign]
+    events = approach.run_with_streaming([], {}, {})
+    if coalescer:
+        events = coalescer.coalesce(events)
+    lines = 0
+    started_at = time.process_time()
+    async for _ in format_as_ndjson(events):
+        lines += 1
+    return (time.process_time() - started_at) / len(chunks), lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the CPU time spent per streamed token.")
+    parser.add_argument("--tokens", type=int, default=20000, help="Number of streamed chunks to time")
+    args = parser.parse_args()
+
+    chunks = create_chunks(args.tokens)
+    previous = time_per_chunk(previous_chunk_to_line, chunks)
+    current = time_per_chunk(current_chunk_to_line, chunks)
+    print(f"Per chunk, previous loop: {previous * 1e6:.2f} µs")
+    print(f"Per chunk, current loop:  {current * 1e6:.2f} µs ({previous / current:.1f}x faster)")
+    streaming_path, lines = asyncio.run(time_streaming_path(chunks))
+    print(f"Per chunk, whole streaming path: {streaming_path * 1e6:.2f} µs, {lines} lines")
+    streaming_path, lines = asyncio.run(time_streaming_path(chunks, DeltaCoalescer()))
+    print(f"Per chunk, whole streaming path with delta coalescing: {streaming_path * 1e6:.2f} µs, {lines} lines")
+
+
+if __name__ == "__main__":
+    main()
@@ -86,6 +86,12 @@ class ManageAcl:
             else:
                 raise Exception(f"Unknown action {self.acl_action}")
 
+        if self.acl_action in ("remove", "remove_all", "add"):
+            # The app caches access decisions for files it serves, so it doesn't see the change right away
+            logger.info(
+                "Apps with USE_PATH_AUTH_CACHE enabled apply the new acls to /content once their cached decisions expire (PATH_AUTH_CACHE_TTL_SECONDS)"
+            )
+
     async def view_acl(self, search_client: SearchClient):
         for document in await self.get_documents(search_client):
             # Assumes the acls are consistent across all sections of the document
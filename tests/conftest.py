@@ -1,5 +1,6 @@
 import json
 import os
+import time
 from typing import IO, Any
 from unittest import mock
 
@@ -690,7 +691,7 @@ async def auth_public_documents_client(
 @pytest.fixture
 def mock_validate_token_success(monkeypatch):
     async def mock_validate_access_token(self, token):
-        pass
+        return {"exp": time.time() + 3600}
 
     monkeypatch.setattr(core.authentication.AuthenticationHelper, "validate_access_token", mock_validate_access_token)
 
@@ -1,9 +1,12 @@
+import asyncio
 import json
 from collections import namedtuple
 from io import BytesIO
-from typing import Optional
+from typing import Any, Optional
 
 import openai.types
+from aiohttp import web
+from aiohttp.test_utils import TestServer
 from azure.cognitiveservices.speech import ResultReason
 from azure.core.credentials_async import AsyncTokenCredential
 from azure.search.documents.agent.models import (
@@ -46,7 +49,7 @@ class MockAzureCredentialExpired(AsyncTokenCredential):
 
 
 class MockBlobClient:
-    async def download_blob(self):
+    async def download_blob(self, *args, **kwargs):
         return MockBlob()
 
 
@@ -62,6 +65,13 @@ class MockBlob:
     async def readinto(self, buffer: BytesIO):
         buffer.write(b"test")
 
+    @property
+    def size(self):
+        return 4
+
+    async def chunks(self):
+        yield b"test"
+
 
 class MockAsyncPageIterator:
     def __init__(self, data):
@@ -302,3 +312,61 @@ def mock_speak_text_cancelled(self, text):
 
 def mock_speak_text_failed(self, text):
     return MockSynthesisResult(MockAudioFailure("mock_audio_data"))
+
+
+class MockGraphServer:
+    """
+    Local stand-in for the Microsoft Graph transitiveMemberOf endpoint, which pages through the groups of every user
+    like Graph does and can add latency to every call, so that group lookups can be tested and timed offline
+    """
+
+    def __init__(self, groups: dict[str, list[str]], latency_seconds: float = 0.0, max_page_size: int = 999):
+        self.groups = groups
+        self.latency_seconds = latency_seconds
+        self.max_page_size = max_page_size
+        self.requests: list[str] = []
+        self.server = TestServer(self.create_app())
+
+    def create_app(self) -> web.Application:
+        async def transitive_member_of(request: web.Request) -> web.Response:
+            self.requests.append(str(request.rel_url))
+            await asyncio.sleep(self.latency_seconds)
+            # The access token stands in for the signed-in user
+            token = request.headers.get("Authorization", "").removeprefix("Bearer ")
+            if token not in self.groups:
+                return web.json_response({"error": {"code": "InvalidAuthenticationToken"}}, status=401)
+            page_size = min(int(request.query.get("$top", 100)), self.max_page_size)
+            skip = int(request.query.get("$skiptoken", 0))
+            body: dict[str, Any] = {"value": [{"id": group} for group in self.groups[token][skip : skip + page_size]]}
+            if skip + page_size < len(self.groups[token]):
+                body["@odata.nextLink"] = str(
+                    request.url.update_query({"$top": page_size, "$skiptoken": skip + page_size})
+                )
+            return web.json_response(body)
+
+        app = web.Application()
+        app.router.add_get("/v1.0/me/transitiveMemberOf", transitive_member_of)
+        return app
+
+    @property
+    def endpoint(self) -> str:
+        return str(self.server.make_url("")).rstrip("/")
+
+    async def __aenter__(self) -> "MockGraphServer":
+        await self.server.start_server()
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        await self.server.close()
+
+
+class FakeClock:
+    """
+    Clock for the caches and schedulers that take one, moved forward by setting now
+    """
+
+    def __init__(self, now: float = 0.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
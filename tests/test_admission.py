@@ -0,0 +1,221 @@
+import asyncio
+import json
+
+import httpx
+import openai
+import pytest
+from azure.core.pipeline.transport import AioHttpTransport
+
+from core.admission import (
+    AdaptiveLimiter,
+    AdmissionAioHttpTransport,
+    AdmissionController,
+    AdmissionHttpxTransport,
+    AdmissionRejectedError,
+    get_retry_after_seconds,
+)
+
+from .mocks import FakeClock
+
+
+@pytest.mark.asyncio
+async def test_limiter_queues_calls_over_the_limit():
+    limiter = AdaptiveLimiter("search", max_limit=2)
+    await limiter.acquire()
+    await limiter.acquire()
+    queued = asyncio.create_task(limiter.acquire())
+    await asyncio.sleep(0)
+    assert not queued.done()
+    assert limiter.stats()["queue_depth"] == 1
+
+    limiter.release(0.1)
+    await queued
+    assert limiter.stats()["in_flight"] == 2
+    assert limiter.stats()["queued"] == 1
+    assert limiter.stats()["admitted"] == 3
+
+
+@pytest.mark.asyncio
+async def test_limiter_rejects_when_queue_is_full():
+    limiter = AdaptiveLimiter("chat", max_limit=1, max_queue=1)
+    await limiter.acquire()
+    queued = asyncio.create_task(limiter.acquire())
+    await asyncio.sleep(0)
+    with pytest.raises(AdmissionRejectedError) as exc_info:
+        await limiter.acquire()
+    assert exc_info.value.retry_after_seconds == 1
+    assert limiter.stats()["rejected"] == 1
+    queued.cancel()
+
+
+@pytest.mark.asyncio
+async def test_limiter_rejects_calls_that_would_miss_their_deadline():
+    limiter = AdaptiveLimiter("chat", max_limit=1, queue_timeout_seconds=5)
+    await limiter.acquire()
+    limiter.release(4.0)
+    await limiter.acquire()
+    queued = asyncio.create_task(limiter.acquire())
+    await asyncio.sleep(0)
+    # Two calls ahead of it, at four seconds each, is more than the five seconds it can wait
+    with pytest.raises(AdmissionRejectedError) as exc_info:
+        await limiter.acquire()
+    assert exc_info.value.retry_after_seconds == 8
+    queued.cancel()
+
+
+@pytest.mark.asyncio
+async def test_limiter_times_out_waiting_calls():
+    limiter = AdaptiveLimiter("storage", max_limit=1, queue_timeout_seconds=0.01)
+    await limiter.acquire()
+    with pytest.raises(AdmissionRejectedError):
+        await limiter.acquire()
+    assert limiter.stats()["timed_out"] == 1
+    assert limiter.stats()["queue_depth"] == 0
+
+
+@pytest.mark.asyncio
+async def test_limiter_hands_on_slots_of_cancelled_calls():
+    limiter = AdaptiveLimiter("search", max_limit=1)
+    await limiter.acquire()
+    cancelled = asyncio.create_task(limiter.acquire())
+    waiting = asyncio.create_task(limiter.acquire())
+    await asyncio.sleep(0)
+    cancelled.cancel()
+    await asyncio.sleep(0)
+
+    limiter.release(0.1)
+    await waiting
+    assert limiter.stats()["in_flight"] == 1
+    assert limiter.stats()["queue_depth"] == 0
+
+
+def test_limiter_adapts_to_throttling_and_latency():
+    clock = FakeClock()
+    limiter = AdaptiveLimiter("chat", max_limit=8, min_limit=2, latency_target_seconds=1.0, clock=clock)
+    limiter.in_flight = 4
+
+    limiter.release(0.5, throttled=True)
+    assert limiter.limit == 4
+    # The other calls that were in flight report the same overload
+    limiter.release(0.5, throttled=True)
+    assert limiter.limit == 4
+
+    clock.now = 1.0
+    limiter.release(2.0)
+    assert limiter.limit == 2
+    assert limiter.stats()["decreases"] == 2
+    assert limiter.stats()["throttled"] == 2
+    assert limiter.stats()["slow"] == 1
+
+    limiter.in_flight = 4
+    for _ in range(4):
+        limiter.release(0.5)
+    assert 3 < limiter.limit < 4
+
+
+def test_limiter_requires_valid_limits():
+    with pytest.raises(ValueError):
+        AdaptiveLimiter("chat", max_limit=2, min_limit=3)
+
+
+@pytest.mark.asyncio
+async def test_httpx_transport_sheds_openai_calls_without_retries():
+    calls = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        calls.append(request.url.path)
+        return httpx.Response(200, json={"data": [], "model": "text-embedding-3-large", "object": "list"})
+
+    limiter = AdaptiveLimiter("embeddings", max_limit=1, max_queue=0)
+    http_client = httpx.AsyncClient(
+        transport=AdmissionHttpxTransport({"/embeddings": limiter}, httpx.MockTransport(handler))
+    )
+    client = openai.AsyncOpenAI(api_key="key", base_url="https://openai.test/v1", http_client=http_client)
+
+    await client.embeddings.create(model="text-embedding-3-large", input="hi")
+    assert limiter.stats()["in_flight"] == 0
+    assert limiter.stats()["latency"]["count"] == 1
+
+    await limiter.acquire()
+    with pytest.raises(openai.RateLimitError) as exc_info:
+        await client.embeddings.create(model="text-embedding-3-large", input="hi")
+    assert get_retry_after_seconds(exc_info.value) == 1
+    assert calls == ["/v1/embeddings"]
+    assert limiter.stats()["rejected"] == 1
+
+
+@pytest.mark.asyncio
+async def test_httpx_transport_holds_the_slot_of_streamed_answers_until_they_end():
+    chunk = {
+        "id": "test-123",
+        "object": "chat.completion.chunk",
+        "created": 1,
+        "model": "gpt-4.1-mini",
+        "choices": [{"index": 0, "delta": {"content": "Paris"}, "finish_reason": None}],
+    }
+
+    async def events():
+        yield f"data: {json.dumps(chunk)}\n\n".encode()
+        yield b"data: [DONE]\n\n"
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(200, headers={"content-type": "text/event-stream"}, content=events())
+
+    limiter = AdaptiveLimiter("chat", max_limit=1)
+    http_client = httpx.AsyncClient(
+        transport=AdmissionHttpxTransport({"/chat/completions": limiter}, httpx.MockTransport(handler))
+    )
+    client = openai.AsyncOpenAI(api_key="key", base_url="https://openai.test/v1", http_client=http_client)
+
+    stream = await client.chat.completions.create(
+        model="gpt-4.1-mini", messages=[{"role": "user", "content": "hi"}], stream=True
+    )
+    # The latency (time to first token) is known once the headers arrive, but the slot is held until the stream ends
+    assert limiter.stats()["in_flight"] == 1
+    assert limiter.stats()["latency"]["count"] == 1
+    assert [chunk.choices[0].delta.content async for chunk in stream] == ["Paris"]
+    assert limiter.stats()["in_flight"] == 0
+    await stream.close()
+    assert limiter.stats()["in_flight"] == 0
+
+
+@pytest.mark.asyncio
+async def test_httpx_transport_passes_other_calls_through():
+    limiter = AdaptiveLimiter("chat", max_limit=1)
+    transport = AdmissionHttpxTransport(
+        {"/chat/completions": limiter}, httpx.MockTransport(lambda request: httpx.Response(429))
+    )
+    response = await transport.handle_async_request(httpx.Request("GET", "https://openai.test/v1/models"))
+    assert response.status_code == 429
+    assert limiter.stats()["throttled"] == 0
+
+    response = await transport.handle_async_request(httpx.Request("POST", "https://openai.test/v1/chat/completions"))
+    assert limiter.stats()["throttled"] == 1
+
+
+@pytest.mark.asyncio
+async def test_azure_transport_reports_throttling(monkeypatch):
+    class MockResponse:
+        status_code = 429
+
+    async def mock_send(self, request, **kwargs):
+        return MockResponse()
+
+    monkeypatch.setattr(AioHttpTransport, "send", mock_send)
+    limiter = AdaptiveLimiter("cosmos", max_limit=4)
+    transport = AdmissionAioHttpTransport(limiter)
+    assert (await transport.send(object())).status_code == 429
+    assert limiter.stats()["throttled"] == 1
+    assert limiter.stats()["limit"] == 2
+    assert limiter.stats()["in_flight"] == 0
+
+
+@pytest.mark.asyncio
+async def test_controller_stats():
+    controller = AdmissionController(
+        {name: AdaptiveLimiter(name) for name in ("chat", "embeddings", "search", "storage", "cosmos")}
+    )
+    controller.openai_http_client()
+    assert isinstance(controller.azure_transport("search"), AdmissionAioHttpTransport)
+    assert set(controller.stats()) == {"chat", "embeddings", "search", "storage", "cosmos"}
+    await controller.close()
@@ -0,0 +1,174 @@
+import pytest
+
+from approaches.answercache import AnswerCache, CachedAnswer
+from approaches.approach import DataPoints, ExtraInfo
+from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
+from approaches.promptmanager import PromptyManager
+from core.cache import TTLCache
+
+from .mocks import MOCK_EMBEDDING_DIMENSIONS, MOCK_EMBEDDING_MODEL_NAME, FakeClock
+
+
+def test_ttlcache_expires_entries():
+    clock = FakeClock()
+    cache: TTLCache[str, int] = TTLCache(max_entries=10, ttl_seconds=5, clock=clock)
+    cache.set("a", 1)
+    assert cache.get("a") == 1
+    clock.now = 5
+    assert cache.get("a") is None
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+    assert cache.stats()["expirations"] == 1
+
+
+def test_ttlcache_evicts_least_recently_used():
+    cache: TTLCache[str, int] = TTLCache(max_entries=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert "a" in cache
+    assert "b" not in cache
+    assert "c" in cache
+    assert cache.stats()["evictions"] == 1
+
+
+def test_normalize_question():
+    assert AnswerCache.normalize_question("  What is  the PLAN?! ") == "what is the plan"
+    assert AnswerCache.normalize_question("מה התוכנית?") == "מה התוכנית"
+    # Vowel points are dropped, rather than splitting the words
+    assert AnswerCache.normalize_question("שָׁלוֹם עוֹלָם") == "שלום עולם"
+
+
+@pytest.mark.asyncio
+async def test_answer_cache_exact_lookup():
+    cache = AnswerCache()
+    key = cache.build_key("chat", [{"role": "user", "content": "What is the plan?"}], {"top": 3}, None)
+    cache.store(key, CachedAnswer("The plan", "assistant", context=None))
+
+    same_key = cache.build_key("chat", [{"role": "user", "content": "what is the plan"}], {"top": 3}, None)
+    answer = await cache.lookup(same_key)
+    assert answer.content == "The plan"
+
+
+@pytest.mark.asyncio
+async def test_answer_cache_scope():
+    cache = AnswerCache()
+    messages = [{"role": "user", "content": "What is the plan?"}]
+    cache.store(
+        cache.build_key("chat", messages, {}, "oids/any(g:search.in(g, 'OID_X'))"), CachedAnswer("A", "assistant", None)
+    )
+
+    assert await cache.lookup(cache.build_key("chat", messages, {}, "oids/any(g:search.in(g, 'OID_Y'))")) is None
+    assert await cache.lookup(cache.build_key("ask", messages, {}, "oids/any(g:search.in(g, 'OID_X'))")) is None
+    assert (
+        await cache.lookup(cache.build_key("chat", messages, {"top": 5}, "oids/any(g:search.in(g, 'OID_X'))")) is None
+    )
+    history = [{"role": "user", "content": "hi"}, {"role": "assistant", "content": "hello"}] + messages
+    assert await cache.lookup(cache.build_key("chat", history, {}, "oids/any(g:search.in(g, 'OID_X'))")) is None
+
+
+@pytest.mark.asyncio
+async def test_answer_cache_similarity_lookup():
+    cache = AnswerCache(similarity_threshold=0.95)
+    embeddings = {"what is the plan": [1.0, 0.0], "what s the plan": [0.99, 0.05], "who is the manager": [0.0, 1.0]}
+
+    async def embed(question):
+        return embeddings[question]
+
+    key = cache.build_key("chat", [{"role": "user", "content": "What is the plan?"}], {}, None)
+    assert await cache.lookup(key, embed) is None
+    cache.store(key, CachedAnswer("The plan", "assistant", None))
+
+    similar_key = cache.build_key("chat", [{"role": "user", "content": "What's the plan?"}], {}, None)
+    assert (await cache.lookup(similar_key, embed)).content == "The plan"
+    different_key = cache.build_key("chat", [{"role": "user", "content": "Who is the manager?"}], {}, None)
+    assert await cache.lookup(different_key, embed) is None
+    assert cache.stats()["similar_hits"] == 1
+
+
+@pytest.mark.asyncio
+async def test_answer_cache_invalidate():
+    cache = AnswerCache()
+    key = cache.build_key("chat", [{"role": "user", "content": "What is the plan?"}], {}, None)
+    cache.store(key, CachedAnswer("The plan", "assistant", None))
+    cache.invalidate()
+    assert await cache.lookup(key) is None
+    assert cache.stats()["invalidations"] == 1
+
+
+@pytest.mark.asyncio
+async def test_answer_cache_skips_answers_started_before_invalidation():
+    cache = AnswerCache()
+    key = cache.build_key("chat", [{"role": "user", "content": "What is the plan?"}], {}, None, cache.generation)
+    # The content changes while the answer is being generated
+    cache.invalidate()
+    cache.store(key, CachedAnswer("The old plan", "assistant", None))
+    assert await cache.lookup(key) is None
+
+    key = cache.build_key("chat", [{"role": "user", "content": "What is the plan?"}], {}, None, cache.generation)
+    cache.store(key, CachedAnswer("The new plan", "assistant", None))
+    assert (await cache.lookup(key)).content == "The new plan"
+
+
+def test_answer_cache_skips_multimodal_questions():
+    cache = AnswerCache()
+    messages = [{"role": "user", "content": [{"type": "text", "text": "What is the plan?"}]}]
+    assert cache.build_key("chat", messages, {}, None) is None
+
+
+@pytest.fixture
+def cached_chat_approach(monkeypatch):
+    chat_approach = ChatReadRetrieveReadApproach(
+        search_client=None,
+        search_index_name=None,
+        agent_model=None,
+        agent_deployment=None,
+        agent_client=None,
+        auth_helper=None,
+        openai_client=None,
+        chatgpt_model="gpt-4.1-mini",
+        chatgpt_deployment="chat",
+        embedding_deployment="embeddings",
+        embedding_model=MOCK_EMBEDDING_MODEL_NAME,
+        embedding_dimensions=MOCK_EMBEDDING_DIMENSIONS,
+        embedding_field="embedding3",
+        sourcepage_field="",
+        content_field="",
+        query_language="en-us",
+        query_speller="lexicon",
+        prompt_manager=PromptyManager(),
+        answer_cache=AnswerCache(),
+    )
+    monkeypatch.setattr(chat_approach, "build_filter", lambda overrides, auth_claims: None)
+    messages = [{"role": "user", "content": "What is the plan?"}]
+    key = chat_approach.get_answer_cache_key(messages, {}, {})
+    chat_approach.cache_answer(
+        key,
+        CachedAnswer("The plan", "assistant", ExtraInfo(DataPoints(text=["a.pdf: plan"])), ["Why?"]),
+    )
+    return chat_approach
+
+
+@pytest.mark.asyncio
+async def test_chat_approach_returns_cached_answer(cached_chat_approach):
+    response = await cached_chat_approach.run_without_streaming(
+        [{"role": "user", "content": "what is the plan"}], {}, {}, session_state="abc"
+    )
+    assert response["message"] == {"content": "The plan", "role": "assistant"}
+    assert response["context"].data_points.text == ["a.pdf: plan"]
+    assert response["context"].followup_questions == ["Why?"]
+    assert response["session_state"] == "abc"
+
+
+@pytest.mark.asyncio
+async def test_chat_approach_replays_cached_answer_as_stream(cached_chat_approach):
+    events = [
+        event
+        async for event in cached_chat_approach.run_with_streaming(
+            [{"role": "user", "content": "what is the plan"}], {}, {}, session_state="abc"
+        )
+    ]
+    assert events[0]["session_state"] == "abc"
+    assert events[1]["delta"] == {"content": "The plan", "role": "assistant"}
+    assert events[2]["context"]["followup_questions"] == ["Why?"]
@@ -1,3 +1,4 @@
+import asyncio
 import json
 import os
 from unittest import mock
@@ -8,6 +9,14 @@ from httpx import Request, Response
 from openai import BadRequestError
 
 import app
+from approaches.contextpacker import ContextPacker
+from approaches.fairshare import FairShareScheduler
+from approaches.historywindow import HISTORY_SUMMARY_PREFIX, HistoryManager
+from approaches.requestcoalescer import RequestCoalescer
+from approaches.thoughtstore import ThoughtStore
+from chat_history.conversationstore import ConversationStore
+from core.admission import AdmissionController, AdmissionRejectedError
+from core.streamcoalescer import DeltaCoalescer
 
 
 def fake_response(http_code):
@@ -169,6 +178,36 @@ async def test_ask_rtr_text(client, snapshot):
     snapshot.assert_match(json.dumps(result, indent=4), "result.json")
 
 
+@pytest.mark.asyncio
+async def test_ask_stream_request_must_be_json(client):
+    response = await client.post("/ask/stream")
+    assert response.status_code == 415
+    result = await response.get_json()
+    assert result["error"] == "request must be json"
+
+
+@pytest.mark.asyncio
+async def test_ask_stream_text(client):
+    response = await client.post(
+        "/ask/stream",
+        json={
+            "messages": [{"content": "What is the capital of France?", "role": "user"}],
+            "context": {
+                "overrides": {"retrieval_mode": "text"},
+            },
+        },
+    )
+    assert response.status_code == 200
+    assert response.mimetype == "application/json-lines"
+    events = [json.loads(line) for line in (await response.get_data(as_text=True)).splitlines()]
+    assert events[0]["context"]["data_points"]["text"]
+    assert "".join(event["delta"].get("content") or "" for event in events) == (
+        "The capital of France is Paris. [Benefit_Options-2.pdf]."
+    )
+    # The last event carries the token usage of the answer
+    assert events[-1]["context"]["thoughts"][-1]["props"]["token_usage"]["total_tokens"] == 919
+
+
 @pytest.mark.asyncio
 async def test_ask_rtr_text_agent(agent_client, snapshot):
     response = await agent_client.post(
@@ -362,6 +401,54 @@ async def test_chat_stream_handle_exception(client, monkeypatch, snapshot, caplo
     snapshot.assert_match(json.dumps(result, indent=4), "result.json")
 
 
+@pytest.mark.asyncio
+async def test_chat_sheds_load_with_retry_after(client, monkeypatch):
+    monkeypatch.setattr(
+        "approaches.chatreadretrieveread.ChatReadRetrieveReadApproach.run",
+        mock.Mock(side_effect=AdmissionRejectedError("chat", 3)),
+    )
+
+    response = await client.post(
+        "/chat",
+        json={"messages": [{"content": "What is the capital of France?", "role": "user"}]},
+    )
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "3"
+    assert "try again in 3 seconds" in (await response.get_json())["error"]
+
+
+@pytest.mark.asyncio
+async def test_chat_stream_sheds_load_with_retry_after(client, monkeypatch):
+    client.app.config[app.CONFIG_ADMISSION_CONTROLLER] = AdmissionController({})
+    monkeypatch.setattr(
+        "approaches.chatreadretrieveread.ChatReadRetrieveReadApproach.run_until_final_call",
+        mock.AsyncMock(side_effect=AdmissionRejectedError("search", 2)),
+    )
+
+    response = await client.post(
+        "/chat/stream",
+        json={"messages": [{"content": "What is the capital of France?", "role": "user"}]},
+    )
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "2"
+
+
+@pytest.mark.asyncio
+async def test_chat_stream_keeps_other_errors_in_stream_with_admission_control(client, monkeypatch):
+    client.app.config[app.CONFIG_ADMISSION_CONTROLLER] = AdmissionController({})
+    monkeypatch.setattr(
+        "approaches.chatreadretrieveread.ChatReadRetrieveReadApproach.run_until_final_call",
+        mock.AsyncMock(side_effect=ZeroDivisionError("something bad happened")),
+    )
+
+    response = await client.post(
+        "/chat/stream",
+        json={"messages": [{"content": "What is the capital of France?", "role": "user"}]},
+    )
+    assert response.status_code == 200
+    assert "error" in json.loads(await response.get_data(as_text=True))
+
+
 @pytest.mark.asyncio
 async def test_chat_handle_exception_contentsafety(client, monkeypatch, snapshot, caplog):
     monkeypatch.setattr(
@@ -856,6 +943,286 @@ async def test_chat_stream_text(client, snapshot):
     snapshot.assert_match(result, "result.jsonlines")
 
 
+@pytest.mark.asyncio
+async def test_chat_stream_progress(client):
+    client.app.config[app.CONFIG_CHAT_APPROACH].stream_progress = True
+    response = await client.post(
+        "/chat/stream",
+        json={
+            "messages": [{"content": "What is the capital of France?", "role": "user"}],
+            "context": {
+                "overrides": {"retrieval_mode": "text"},
+            },
+        },
+    )
+    assert response.status_code == 200
+    events = [json.loads(line) for line in (await response.get_data(as_text=True)).splitlines()]
+    stages = [event["progress"]["stage"] for event in events if "progress" in event]
+    assert stages == ["search_query", "search_results", "data_points", "answer"]
+    assert [thought["title"] for thought in events[0]["context"]["thoughts"]] == ["Prompt to generate search query"]
+    assert events[1]["context"]["thoughts"][-1]["title"] == "Search results"
+    assert events[2]["context"]["data_points"]["text"]
+    assert events[3]["context"]["thoughts"][-1]["title"] == "Prompt to generate answer"
+    assert all(event["session_state"] is None for event in events[:4])
+    assert "".join(event["delta"].get("content") or "" for event in events) == (
+        "The capital of France is Paris. [Benefit_Options-2.pdf]."
+    )
+
+
+@pytest.mark.asyncio
+async def test_chat_compact_response(client):
+    client.app.config[app.CONFIG_THOUGHT_STORE] = ThoughtStore()
+    response = await client.post(
+        "/chat",
+        json={
+            "messages": [{"content": "What is the capital of France?", "role": "user"}],
+            "context": {
+                "overrides": {"retrieval_mode": "text"},
+            },
+        },
+    )
+    assert response.status_code == 200
+    result = await response.get_json()
+    assert "thoughts" not in result["context"]
+    assert result["context"]["data_points"]["text"]
+
+    response = await client.get(f"/thoughts/{result['context']['thoughts_id']}")
+    assert response.status_code == 200
+    thoughts = (await response.get_json())["thoughts"]
+    assert thoughts[1]["props"]["use_text_search"] is True
+
+    response = await client.get("/thoughts/unknown")
+    assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_chat_stream_compact_response(client):
+    client.app.config[app.CONFIG_THOUGHT_STORE] = ThoughtStore()
+    response = await client.post(
+        "/chat/stream",
+        json={
+            "messages": [{"content": "What is the capital of France?", "role": "user"}],
+            "context": {
+                "overrides": {"retrieval_mode": "text"},
+            },
+        },
+    )
+    assert response.status_code == 200
+    events = [json.loads(line) for line in (await response.get_data(as_text=True)).splitlines()]
+    # The context is only sent once, the token usage is added to the stored thoughts
+    context_events = [event for event in events if "context" in event]
+    assert len(context_events) == 1
+    assert "thoughts" not in context_events[0]["context"]
+    assert "".join(event["delta"].get("content") or "" for event in events) == (
+        "The capital of France is Paris. [Benefit_Options-2.pdf]."
+    )
+
+    response = await client.get(f"/thoughts/{context_events[0]['context']['thoughts_id']}")
+    assert response.status_code == 200
+    thoughts = (await response.get_json())["thoughts"]
+    assert thoughts[-1]["props"]["token_usage"]["total_tokens"] > 0
+
+
+@pytest.mark.asyncio
+async def test_chat_stream_coalesced_deltas(client):
+    client.app.config[app.CONFIG_STREAM_COALESCER] = DeltaCoalescer(window_seconds=10, max_chars=100)
+    response = await client.post(
+        "/chat/stream",
+        json={
+            "messages": [{"content": "What is the capital of France?", "role": "user"}],
+            "context": {
+                "overrides": {"retrieval_mode": "text"},
+            },
+        },
+    )
+    assert response.status_code == 200
+    events = [json.loads(line) for line in (await response.get_data(as_text=True)).splitlines()]
+    assert "".join(event["delta"].get("content") or "" for event in events) == (
+        "The capital of France is Paris. [Benefit_Options-2.pdf]."
+    )
+    assert "context" in events[0]
+    assert "context" in events[-1]
+    assert client.app.config[app.CONFIG_STREAM_COALESCER].stats()["deltas"] == 2
+
+
+@pytest.mark.asyncio
+async def test_chat_coalesced_requests(client):
+    client.app.config[app.CONFIG_REQUEST_COALESCER] = RequestCoalescer()
+    request_json = {
+        "messages": [{"content": "What is the capital of France?", "role": "user"}],
+        "context": {
+            "overrides": {"retrieval_mode": "text"},
+        },
+    }
+    responses = await asyncio.gather(
+        client.post("/chat", json=request_json | {"session_state": "session1"}),
+        client.post("/chat", json=request_json | {"session_state": "session2"}),
+    )
+    results = [await response.get_json() for response in responses]
+    assert [result["session_state"] for result in results] == ["session1", "session2"]
+    assert results[0]["message"] == results[1]["message"]
+    stats = client.app.config[app.CONFIG_REQUEST_COALESCER].stats()
+    assert stats["runs"] + stats["coalesced"] == 2
+
+
+@pytest.mark.asyncio
+async def test_chat_fair_share_scheduler(client):
+    chat_scheduler = FairShareScheduler()
+    client.app.config[app.CONFIG_CHAT_APPROACH].chat_scheduler = chat_scheduler
+    request_json = {
+        "messages": [{"content": "What is the capital of France?", "role": "user"}],
+        "context": {
+            "overrides": {"retrieval_mode": "text"},
+        },
+    }
+    response = await client.post("/chat", json=request_json)
+    assert response.status_code == 200
+    response = await client.post("/chat/stream", json=request_json)
+    assert response.status_code == 200
+    await response.get_data()
+
+    assert chat_scheduler.stats()["in_flight"] == 0
+    assert (await client.get("/usage")).status_code == 404
+    client.app.config[app.CONFIG_FAIR_SHARE_SCHEDULER] = chat_scheduler
+    response = await client.get("/usage")
+    assert response.status_code == 200
+    # The query rewrite and the answer of both requests, all charged to the anonymous user
+    usage = (await response.get_json())["usage"]
+    assert usage["requests"] == 4
+    assert usage["total_tokens"] > 0
+
+
+@pytest.mark.asyncio
+async def test_chat_context_packing(client):
+    # Far less than the prompt takes, so only a bit of the top source gets in
+    client.app.config[app.CONFIG_CHAT_APPROACH].context_packer = ContextPacker(
+        max_prompt_tokens=200, min_source_tokens=5
+    )
+    response = await client.post(
+        "/chat",
+        json={
+            "messages": [{"content": "What is the capital of France?", "role": "user"}],
+            "context": {
+                "overrides": {"retrieval_mode": "text"},
+            },
+        },
+    )
+    assert response.status_code == 200
+    result = await response.get_json()
+    thoughts = {thought["title"]: thought for thought in result["context"]["thoughts"]}
+    packing_thought = thoughts["Pack sources into token budget"]
+    assert packing_thought["props"]["source_token_budget"] == 7
+    assert packing_thought["description"][0]["action"] == "truncated"
+    assert len(result["context"]["data_points"]["text"]) == 1
+    assert result["context"]["thoughts"][-1]["title"] == "Prompt to generate answer"
+
+
+@pytest.mark.asyncio
+async def test_chat_history_window(client):
+    # Room for the last turn only, so the earlier ones are summarized
+    client.app.config[app.CONFIG_CHAT_APPROACH].history_manager = HistoryManager(
+        rewrite_max_tokens=150, answer_max_tokens=150, max_turns=1, summary_max_tokens=50
+    )
+    history = []
+    for question in ["What does the plan cover?", "Does it include hearing?", "And vision?"]:
+        history += [
+            {"content": question, "role": "user"},
+            {"content": "The plan covers it. [Benefit_Options-2.pdf]", "role": "assistant"},
+        ]
+    request = {
+        "messages": history + [{"content": "What is the capital of France?", "role": "user"}],
+        "context": {"overrides": {"retrieval_mode": "text"}},
+        "session_state": "session1",
+    }
+    response = await client.post("/chat", json=request)
+    assert response.status_code == 200
+    result = await response.get_json()
+    history_thought = result["context"]["thoughts"][0]
+    assert history_thought["title"] == "Window conversation history"
+    assert history_thought["props"]["summarized_messages"] == 4
+    assert history_thought["props"]["summary_reused"] is False
+    assert history_thought["props"]["answer_messages"] == 3
+    answer_prompt = result["context"]["thoughts"][-1]["description"]
+    assert answer_prompt[1]["content"].startswith(HISTORY_SUMMARY_PREFIX)
+    assert answer_prompt[2]["content"] == "And vision?"
+
+    # The summary is computed once for the conversation
+    response = await client.post("/chat", json=request)
+    result = await response.get_json()
+    assert result["context"]["thoughts"][0]["props"]["summary_reused"] is True
+
+
+@pytest.mark.asyncio
+async def test_chat_conversation_state(client):
+    conversation_store = ConversationStore()
+    client.app.config[app.CONFIG_CONVERSATION_STORE] = conversation_store
+    context = {"overrides": {"retrieval_mode": "text"}}
+    response = await client.post(
+        "/chat",
+        json={"messages": [{"content": "What is the capital of France?", "role": "user"}], "context": context},
+    )
+    assert response.status_code == 200
+    result = await response.get_json()
+    # A session is started even with chat history disabled, to keep the conversation under
+    session_state = result["session_state"]
+    assert isinstance(session_state, str)
+
+    # The client only sends the new message
+    response = await client.post(
+        "/chat",
+        json={
+            "messages": [{"content": "And of Germany?", "role": "user"}],
+            "context": context | {"history_length": 2},
+            "session_state": session_state,
+        },
+    )
+    assert response.status_code == 200
+    result = await response.get_json()
+    answer_prompt = result["context"]["thoughts"][-1]["description"]
+    assert answer_prompt[1] == {"role": "user", "content": "What is the capital of France?"}
+    assert answer_prompt[2]["role"] == "assistant"
+    assert answer_prompt[-1]["content"].startswith("And of Germany?")
+    messages = await conversation_store.get_messages(None, session_state)
+    assert len(messages) == 4
+    assert messages[3]["content"] == result["message"]["content"]
+
+
+@pytest.mark.asyncio
+async def test_chat_stream_conversation_state(client):
+    conversation_store = ConversationStore()
+    client.app.config[app.CONFIG_CONVERSATION_STORE] = conversation_store
+    response = await client.post(
+        "/chat/stream",
+        json={
+            "messages": [{"content": "What is the capital of France?", "role": "user"}],
+            "context": {"overrides": {"retrieval_mode": "text"}},
+        },
+    )
+    assert response.status_code == 200
+    events = [json.loads(line) for line in (await response.get_data(as_text=True)).splitlines()]
+    session_state = events[0]["session_state"]
+    answer = "".join(event["delta"]["content"] for event in events if event.get("delta", {}).get("content"))
+    # Saved once the answer was streamed whole
+    messages = await conversation_store.get_messages(None, session_state)
+    assert messages[-1] == {"role": "assistant", "content": answer}
+    assert conversation_store.stats()["turns_saved"] == 1
+
+
+@pytest.mark.asyncio
+async def test_chat_conversation_state_not_found(client):
+    client.app.config[app.CONFIG_CONVERSATION_STORE] = ConversationStore()
+    response = await client.post(
+        "/chat/stream",
+        json={
+            "messages": [{"content": "And of Germany?", "role": "user"}],
+            "context": {"overrides": {"retrieval_mode": "text"}, "history_length": 2},
+            "session_state": "unknown-session",
+        },
+    )
+    # The client sends the whole conversation instead
+    assert response.status_code == 409
+
+
 @pytest.mark.asyncio
 async def test_chat_text_reasoning(reasoning_client, snapshot):
     response = await reasoning_client.post(
@@ -1101,3 +1468,19 @@ async def test_format_as_ndjson():
 
     result = [line async for line in app.format_as_ndjson(gen())]
     assert result == ['{"a": "I ❤️ 🐍"}\n', '{"b": "Newlines inside \\n strings are fine"}\n']
+
+
+@pytest.mark.parametrize(
+    "event",
+    [
+        {"delta": {"content": "Paris", "role": "assistant"}},
+        {"delta": {"content": 'Quotes " and \\ backslashes\n', "role": "assistant"}},
+        {"delta": {"content": "שלום 🐍", "role": None}},
+        {"delta": {"content": None, "role": "assistant"}},
+        {"delta": {"content": "", "role": "tool"}},
+        {"delta": {"role": "assistant", "content": "Paris"}},
+        {"delta": {"content": "Paris", "role": "assistant"}, "session_state": None},
+    ],
+)
+def test_format_event_as_ndjson_matches_json_dumps(event):
+    assert app.format_event_as_ndjson(event) == json.dumps(event, ensure_ascii=False) + "\n"
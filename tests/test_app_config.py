@@ -307,3 +307,135 @@ async def test_app_config_for_reasoning_override_effort(monkeypatch, minimal_env
         assert result["streamingEnabled"] is True
         assert result["showReasoningEffortOption"] is True
         assert result["defaultReasoningEffort"] == "low"
+
+
+@pytest.mark.asyncio
+async def test_app_answer_cache(monkeypatch, minimal_env):
+    monkeypatch.setenv("ENABLE_METRICS_ENDPOINT", "true")
+    monkeypatch.setenv("USE_ANSWER_CACHE", "true")
+    monkeypatch.setenv("ANSWER_CACHE_MAX_ENTRIES", "10")
+    monkeypatch.setenv("ANSWER_CACHE_SIMILARITY_THRESHOLD", "0.97")
+
+    quart_app = app.create_app()
+    async with quart_app.test_app() as test_app:
+        answer_cache = quart_app.config[app.CONFIG_ANSWER_CACHE]
+        assert quart_app.config[app.CONFIG_CHAT_APPROACH].answer_cache is answer_cache
+        assert quart_app.config[app.CONFIG_ASK_APPROACH].answer_cache is answer_cache
+        client = test_app.test_client()
+        response = await client.get("/metrics")
+        assert response.status_code == 200
+        result = await response.get_json()
+        assert result["answer_cache"]["max_entries"] == 10
+        assert result["answer_cache"]["similarity_threshold"] == 0.97
+
+
+@pytest.mark.asyncio
+async def test_app_admission_control(monkeypatch, minimal_env):
+    monkeypatch.setenv("ENABLE_METRICS_ENDPOINT", "true")
+    monkeypatch.setenv("USE_ADMISSION_CONTROL", "true")
+    monkeypatch.setenv("ADMISSION_CHAT_MAX_CONCURRENCY", "8")
+    monkeypatch.setenv("ADMISSION_SEARCH_LATENCY_TARGET_MS", "1500")
+
+    quart_app = app.create_app()
+    async with quart_app.test_app() as test_app:
+        admission_controller = quart_app.config[app.CONFIG_ADMISSION_CONTROLLER]
+        assert quart_app.config[app.CONFIG_OPENAI_CLIENT]._client is admission_controller.http_clients[0]
+        assert admission_controller.limiters["search"].latency_target_seconds == 1.5
+        client = test_app.test_client()
+        response = await client.get("/metrics")
+        assert response.status_code == 200
+        result = await response.get_json()
+        assert result["admission"]["chat"]["max_limit"] == 8
+        assert result["admission"]["storage"]["max_limit"] == 64
+
+
+@pytest.mark.asyncio
+async def test_app_fair_share_scheduler(monkeypatch, minimal_env):
+    monkeypatch.setenv("ENABLE_METRICS_ENDPOINT", "true")
+    monkeypatch.setenv("USE_FAIR_SHARE_SCHEDULER", "true")
+    monkeypatch.setenv("FAIR_SHARE_MAX_CONCURRENCY", "4")
+    monkeypatch.setenv("FAIR_SHARE_WEIGHTS", "oid-1=3, oid-2=2")
+
+    quart_app = app.create_app()
+    async with quart_app.test_app() as test_app:
+        chat_scheduler = quart_app.config[app.CONFIG_FAIR_SHARE_SCHEDULER]
+        assert chat_scheduler.weights == {"oid-1": 3, "oid-2": 2}
+        assert quart_app.config[app.CONFIG_CHAT_APPROACH].chat_scheduler is chat_scheduler
+        assert quart_app.config[app.CONFIG_ASK_APPROACH].chat_scheduler is chat_scheduler
+        client = test_app.test_client()
+        response = await client.get("/metrics")
+        assert response.status_code == 200
+        result = await response.get_json()
+        assert result["fair_share"]["max_concurrency"] == 4
+
+
+@pytest.mark.asyncio
+async def test_app_context_packing(monkeypatch, minimal_env):
+    monkeypatch.setenv("ENABLE_METRICS_ENDPOINT", "true")
+    monkeypatch.setenv("USE_CONTEXT_PACKING", "true")
+    monkeypatch.setenv("CONTEXT_PACKING_MAX_PROMPT_TOKENS", "4000")
+
+    quart_app = app.create_app()
+    async with quart_app.test_app() as test_app:
+        context_packer = quart_app.config[app.CONFIG_CONTEXT_PACKER]
+        assert context_packer.max_prompt_tokens == 4000
+        assert context_packer.min_source_tokens == 100
+        assert quart_app.config[app.CONFIG_CHAT_APPROACH].context_packer is context_packer
+        assert quart_app.config[app.CONFIG_ASK_APPROACH].context_packer is context_packer
+        client = test_app.test_client()
+        response = await client.get("/metrics")
+        assert response.status_code == 200
+        result = await response.get_json()
+        assert result["context_packing"]["prompts"] == 0
+
+
+@pytest.mark.asyncio
+async def test_app_history_window(monkeypatch, minimal_env):
+    monkeypatch.setenv("ENABLE_METRICS_ENDPOINT", "true")
+    monkeypatch.setenv("USE_HISTORY_WINDOW", "true")
+    monkeypatch.setenv("HISTORY_ANSWER_MAX_TOKENS", "2000")
+
+    quart_app = app.create_app()
+    async with quart_app.test_app() as test_app:
+        history_manager = quart_app.config[app.CONFIG_HISTORY_MANAGER]
+        assert history_manager.answer_max_tokens == 2000
+        assert history_manager.rewrite_max_tokens == 1000
+        assert history_manager.max_turns == 6
+        assert quart_app.config[app.CONFIG_CHAT_APPROACH].history_manager is history_manager
+        client = test_app.test_client()
+        response = await client.get("/metrics")
+        assert response.status_code == 200
+        result = await response.get_json()
+        assert result["history_window"]["windows"] == 0
+
+
+@pytest.mark.asyncio
+async def test_app_conversation_state(monkeypatch, minimal_env):
+    monkeypatch.setenv("ENABLE_METRICS_ENDPOINT", "true")
+    monkeypatch.setenv("USE_CHAT_CONVERSATION_STATE", "true")
+    monkeypatch.setenv("CHAT_CONVERSATION_STATE_MAX_ENTRIES", "50")
+
+    quart_app = app.create_app()
+    async with quart_app.test_app() as test_app:
+        conversation_store = quart_app.config[app.CONFIG_CONVERSATION_STORE]
+        assert conversation_store.conversations.max_entries == 50
+        # Kept in memory only, without Cosmos DB chat history
+        assert conversation_store.container is None
+        client = test_app.test_client()
+        response = await client.get("/config")
+        result = await response.get_json()
+        assert result["serverConversationState"] is True
+        response = await client.get("/metrics")
+        result = await response.get_json()
+        assert result["conversation_state"]["turns_saved"] == 0
+
+
+@pytest.mark.asyncio
+async def test_app_metrics_disabled(monkeypatch, minimal_env):
+    monkeypatch.setenv("USE_ANSWER_CACHE", "true")
+
+    quart_app = app.create_app()
+    async with quart_app.test_app() as test_app:
+        client = test_app.test_client()
+        response = await client.get("/metrics")
+        assert response.status_code == 404
@@ -1,18 +1,22 @@
+import asyncio
 import base64
 import json
-import re
+import threading
+import time
 from datetime import datetime, timedelta, timezone
 
 import aiohttp
 import jwt
+import msal
 import pytest
 from azure.core.credentials import AzureKeyCredential
 from azure.search.documents.aio import SearchClient
 from azure.search.documents.indexes.models import SearchField, SearchIndex
-from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.asymmetric import rsa
 
 from core.authentication import AuthenticationHelper, AuthError
+from core.jwkscache import JwksCache
+from core.pathauthcache import PathAuthCache
 
 from .mocks import MockAsyncPageIterator, MockResponse
 
@@ -111,6 +115,60 @@ async def test_get_auth_claims_overage_unauthorized(
     assert len(auth_claims.keys()) == 0
 
 
+@pytest.mark.asyncio
+async def test_get_auth_claims_cached(monkeypatch, mock_confidential_client_success, mock_validate_token_success):
+    helper = create_authentication_helper()
+    exchanges = []
+    acquire_token_on_behalf_of = helper.confidential_client.acquire_token_on_behalf_of
+
+    def mock_acquire_token_on_behalf_of(*args, **kwargs):
+        exchanges.append(threading.current_thread().name)
+        time.sleep(0.05)
+        return acquire_token_on_behalf_of(*args, **kwargs)
+
+    monkeypatch.setattr(helper.confidential_client, "acquire_token_on_behalf_of", mock_acquire_token_on_behalf_of)
+
+    # Concurrent requests with the same token share one exchange, which runs off the event loop
+    results = await asyncio.gather(
+        *(helper.get_auth_claims_if_enabled(headers={"Authorization": "Bearer Token"}) for _ in range(3))
+    )
+    assert all(auth_claims == {"oid": "OID_X", "groups": ["GROUP_Y", "GROUP_Z"]} for auth_claims in results)
+    await helper.get_auth_claims_if_enabled(headers={"Authorization": "Bearer Token"})
+    assert len(exchanges) == 1
+    assert exchanges[0].startswith("obo")
+
+    await helper.get_auth_claims_if_enabled(headers={"Authorization": "Bearer OtherToken"})
+    assert len(exchanges) == 2
+    stats = helper.stats()
+    assert stats["auth_claims"]["coalesced"] == 2
+    assert stats["obo_latency"]["count"] == 2
+    assert stats["obo_latency"]["p50_ms"] >= 50
+    await helper.close()
+
+
+@pytest.mark.asyncio
+async def test_get_auth_claims_failed_exchange_not_cached(monkeypatch, mock_validate_token_success):
+    responses = [
+        {"error": "unauthorized"},
+        {"access_token": "MockToken", "id_token_claims": {"oid": "OID_X", "groups": []}},
+    ]
+
+    def mock_acquire_token_on_behalf_of(self, *args, **kwargs):
+        return responses.pop(0)
+
+    monkeypatch.setattr(
+        msal.ConfidentialClientApplication, "acquire_token_on_behalf_of", mock_acquire_token_on_behalf_of
+    )
+    monkeypatch.setattr(msal.ConfidentialClientApplication, "__init__", lambda self, *args, **kwargs: None)
+
+    helper = create_authentication_helper()
+    assert await helper.get_auth_claims_if_enabled(headers={"Authorization": "Bearer Token"}) == {}
+    assert await helper.get_auth_claims_if_enabled(headers={"Authorization": "Bearer Token"}) == {
+        "oid": "OID_X",
+        "groups": [],
+    }
+
+
 @pytest.mark.asyncio
 async def test_list_groups_success(mock_list_groups_success, mock_validate_token_success):
     groups = await AuthenticationHelper.list_groups(graph_resource_access_token={"access_token": "MockToken"})
@@ -518,93 +576,32 @@ async def test_check_path_auth_allowed_public_without_access_control(
     assert called_search is False
 
 
-@pytest.mark.asyncio
-async def test_create_pem_format(mock_confidential_client_success, mock_validate_token_success):
-    helper = create_authentication_helper()
-    mock_token, public_key, payload = create_mock_jwt(oid="OID_X")
-    _, other_public_key, _ = create_mock_jwt(oid="OID_Y")
-    mock_jwks = {
-        "keys": [
-            # Include a key with a different KID to ensure the correct key is selected
-            {
-                "kty": "RSA",
-                "kid": "other_mock_kid",
-                "use": "sig",
-                "n": base64.urlsafe_b64encode(
-                    other_public_key.public_numbers().n.to_bytes(
-                        (other_public_key.public_numbers().n.bit_length() + 7) // 8, byteorder="big"
-                    )
-                )
-                .decode("utf-8")
-                .rstrip("="),
-                "e": base64.urlsafe_b64encode(
-                    other_public_key.public_numbers().e.to_bytes(
-                        (other_public_key.public_numbers().e.bit_length() + 7) // 8, byteorder="big"
-                    )
-                )
-                .decode("utf-8")
-                .rstrip("="),
-            },
-            {
-                "kty": "RSA",
-                "kid": "mock_kid",
-                "use": "sig",
-                "n": base64.urlsafe_b64encode(
-                    public_key.public_numbers().n.to_bytes(
-                        (public_key.public_numbers().n.bit_length() + 7) // 8, byteorder="big"
-                    )
-                )
-                .decode("utf-8")
-                .rstrip("="),
-                "e": base64.urlsafe_b64encode(
-                    public_key.public_numbers().e.to_bytes(
-                        (public_key.public_numbers().e.bit_length() + 7) // 8, byteorder="big"
-                    )
-                )
-                .decode("utf-8")
-                .rstrip("="),
-            },
-        ]
-    }
-
-    pem_key = await helper.create_pem_format(mock_jwks, mock_token)
-
-    # Assert that the result is bytes
-    assert isinstance(pem_key, bytes), "create_pem_format should return bytes"
-
-    # Convert bytes to string for regex matching
-    pem_str = pem_key.decode("utf-8")
-
-    # Assert that the key starts and ends with the correct markers
-    assert pem_str.startswith("-----BEGIN PUBLIC KEY-----"), "PEM key should start with the correct marker"
-    assert pem_str.endswith("-----END PUBLIC KEY-----\n"), "PEM key should end with the correct marker"
-
-    # Assert that the format matches the structure of a PEM key
-    pem_regex = r"^-----BEGIN PUBLIC KEY-----\n([A-Za-z0-9+/\n]+={0,2})\n-----END PUBLIC KEY-----\n$"
-    assert re.match(pem_regex, pem_str), "PEM key format is incorrect"
-
-    # Verify that the key can be used to decode the token
-    try:
-        decoded = jwt.decode(
-            mock_token, key=pem_key, algorithms=["RS256"], audience=payload["aud"], issuer=payload["iss"]
+def create_mock_jwk(public_key, kid="mock_kid"):
+    def encode_number(number: int) -> str:
+        return (
+            base64.urlsafe_b64encode(number.to_bytes((number.bit_length() + 7) // 8, byteorder="big"))
+            .decode()
+            .rstrip("=")
         )
-        assert decoded["oid"] == payload["oid"], "Decoded token should contain correct OID"
-    except Exception as e:
-        pytest.fail(f"jwt.decode raised an unexpected exception: {str(e)}")
 
-    # Try to load the key using cryptography library to ensure it's a valid PEM format
-    try:
-        loaded_public_key = serialization.load_pem_public_key(pem_key)
-        assert isinstance(loaded_public_key, rsa.RSAPublicKey), "Loaded key should be an RSA public key"
-    except Exception as e:
-        pytest.fail(f"Failed to load PEM key: {str(e)}")
+    public_numbers = public_key.public_numbers()
+    return {
+        "kty": "RSA",
+        "use": "sig",
+        "kid": kid,
+        "n": encode_number(public_numbers.n),
+        "e": encode_number(public_numbers.e),
+    }
 
 
 @pytest.mark.asyncio
 async def test_validate_access_token(monkeypatch, mock_confidential_client_success):
     mock_token, public_key, payload = create_mock_jwt(oid="OID_X")
+    jwks_requests = 0
 
     def mock_get(*args, **kwargs):
+        nonlocal jwks_requests
+        jwks_requests += 1
         return MockResponse(
             status=200,
             text=json.dumps(
@@ -630,6 +627,7 @@ async def test_validate_access_token(monkeypatch, mock_confidential_client_succe
                             "x5c": ["MIIC/jCC"],
                             "issuer": "https://login.microsoftonline.com/TENANT_ID/v2.0",
                         },
+                        create_mock_jwk(public_key),
                     ]
                 }
             ),
@@ -637,15 +635,162 @@ async def test_validate_access_token(monkeypatch, mock_confidential_client_succe
 
     monkeypatch.setattr(aiohttp.ClientSession, "get", mock_get)
 
+    helper = create_authentication_helper()
+    await helper.validate_access_token(mock_token)
+    assert jwks_requests == 1
+
+    # Validated tokens and signing keys are kept in memory
+    decode_calls = 0
+    original_decode = jwt.decode
+
     def mock_decode(*args, **kwargs):
-        return payload
+        nonlocal decode_calls
+        decode_calls += 1
+        return original_decode(*args, **kwargs)
 
     monkeypatch.setattr(jwt, "decode", mock_decode)
+    await helper.validate_access_token(mock_token)
+    assert decode_calls == 0
 
-    async def mock_create_pem_format(*args, **kwargs):
-        return public_key
+    other_token, _, _ = create_mock_jwt(oid="OID_Y", kid="other_kid")
+    with pytest.raises(AuthError, match="Unable to find appropriate key"):
+        await helper.validate_access_token(other_token)
+    assert jwks_requests == 1
+    assert helper.stats()["validated_tokens"]["entries"] == 1
 
-    monkeypatch.setattr(AuthenticationHelper, "create_pem_format", mock_create_pem_format)
+
+@pytest.mark.asyncio
+async def test_validate_access_token_refreshes_keys_for_unknown_kid(monkeypatch, mock_confidential_client_success):
+    first_token, first_public_key, _ = create_mock_jwt(oid="OID_X", kid="first_kid")
+    second_token, second_public_key, _ = create_mock_jwt(oid="OID_X", kid="second_kid")
+    jwks = [{"keys": [create_mock_jwk(first_public_key, "first_kid")]}]
+
+    def mock_get(*args, **kwargs):
+        return MockResponse(status=200, text=json.dumps(jwks[-1]))
+
+    monkeypatch.setattr(aiohttp.ClientSession, "get", mock_get)
 
     helper = create_authentication_helper()
-    await helper.validate_access_token(mock_token)
+    await helper.validate_access_token(first_token)
+
+    # After a key rollover, the key set is downloaded again, but not more than once a minute
+    jwks.append({"keys": [create_mock_jwk(second_public_key, "second_kid")]})
+    with pytest.raises(AuthError):
+        await helper.validate_access_token(second_token)
+    helper.jwks_cache.last_refresh -= 60
+    await helper.validate_access_token(second_token)
+    assert helper.jwks_cache.stats()["unknown_kid_refreshes"] == 1
+    assert helper.jwks_cache.stats()["refreshes"] == 2
+
+
+@pytest.mark.asyncio
+async def test_validate_access_token_rejects_invalid_tokens(monkeypatch, mock_confidential_client_success):
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+    def mock_get(*args, **kwargs):
+        return MockResponse(status=200, text=json.dumps({"keys": [create_mock_jwk(private_key.public_key())]}))
+
+    monkeypatch.setattr(aiohttp.ClientSession, "get", mock_get)
+    helper = create_authentication_helper()
+
+    # Signed with a different key that has the same key id
+    mock_token, _, payload = create_mock_jwt(oid="OID_X")
+    with pytest.raises(AuthError, match="Unable to parse authorization token"):
+        await helper.validate_access_token(mock_token)
+
+    for claims, message in [
+        ({"exp": int((datetime.now(timezone.utc) - timedelta(minutes=1)).timestamp())}, "Token is expired"),
+        ({"aud": "OTHER_APP"}, "Audience OTHER_APP not in"),
+        ({"iss": "https://login.microsoftonline.com/OTHER_TENANT/v2.0"}, "Issuer .* not in"),
+    ]:
+        token = jwt.encode(payload | claims, private_key, algorithm="RS256", headers={"kid": "mock_kid"})
+        with pytest.raises(AuthError, match=message):
+            await helper.validate_access_token(token)
+    assert len(helper.validated_tokens) == 0
+
+
+@pytest.mark.asyncio
+async def test_check_path_auth_cached(monkeypatch, mock_confidential_client_success, mock_validate_token_success):
+    auth_helper = create_authentication_helper(require_access_control=True)
+    auth_helper.path_auth_cache = PathAuthCache()
+    calls = []
+
+    async def mock_search(self, *args, **kwargs):
+        calls.append(kwargs)
+        return MockAsyncPageIterator(data=[{"id": "1"}] if "OID_X" in kwargs["filter"] else [])
+
+    monkeypatch.setattr(SearchClient, "search", mock_search)
+
+    async def check_path_auth(path, auth_claims):
+        return await auth_helper.check_path_auth(
+            path=path, auth_claims=auth_claims, search_client=create_search_client()
+        )
+
+    claims = {"oid": "OID_X", "groups": ["GROUP_Y", "GROUP_Z"]}
+    assert await check_path_auth("Benefit_Options.pdf#page=1", claims) is True
+    assert await check_path_auth("Benefit_Options.pdf#page=2", claims) is True
+    assert await check_path_auth("Benefit_Options.pdf", {"oid": "OID_X", "groups": ["GROUP_Z", "GROUP_Y"]}) is True
+    assert len(calls) == 1
+    assert calls[0]["select"] == ["id"]
+
+    # Decisions are cached per user and group membership, and denials are cached as well
+    assert await check_path_auth("Benefit_Options.pdf", {"oid": "OID_X", "groups": ["GROUP_Y"]}) is True
+    assert await check_path_auth("Benefit_Options.pdf", {"oid": "OID_W", "groups": []}) is False
+    assert await check_path_auth("Benefit_Options.pdf", {"oid": "OID_W", "groups": []}) is False
+    assert len(calls) == 3
+
+    auth_helper.path_auth_cache.invalidate()
+    assert await check_path_auth("Benefit_Options.pdf", claims) is True
+    assert len(calls) == 4
+    assert auth_helper.path_auth_cache.stats()["invalidations"] == 1
+
+
+@pytest.mark.asyncio
+async def test_path_auth_cache_coalesces_concurrent_checks():
+    cache = PathAuthCache()
+    release = asyncio.Event()
+    calls = 0
+
+    async def check():
+        nonlocal calls
+        calls += 1
+        await release.wait()
+        return True
+
+    claims = {"oid": "OID_X", "groups": []}
+    checks = [asyncio.create_task(cache.get_or_check(claims, "a.pdf", check)) for _ in range(3)]
+    await asyncio.sleep(0)
+    # A decision made while the index changes is returned, but not cached
+    cache.invalidate()
+    release.set()
+    assert await asyncio.gather(*checks) == [True, True, True]
+    assert calls == 1
+    assert cache.stats()["coalesced"] == 2
+
+    release.clear()
+    release.set()
+    assert await cache.get_or_check(claims, "a.pdf", check) is True
+    assert calls == 2
+
+
+@pytest.mark.asyncio
+async def test_jwks_cache_background_refresh(monkeypatch):
+    jwks_cache = JwksCache("https://login.microsoftonline.com/TENANT_ID/discovery/v2.0/keys", 0.05, 0.01)
+    jwks = {"keys": [create_mock_jwk(create_mock_jwt()[1])]}
+    fetches = 0
+
+    async def mock_fetch_jwks(self):
+        nonlocal fetches
+        fetches += 1
+        if fetches == 1:
+            raise Exception("Service Unavailable")
+        return jwks
+
+    monkeypatch.setattr(JwksCache, "fetch_jwks", mock_fetch_jwks)
+    jwks_cache.start()
+    await asyncio.sleep(0.15)
+    await jwks_cache.close()
+    stats = jwks_cache.stats()
+    assert stats["keys"] == 1
+    assert stats["refresh_failures"] == 1
+    assert stats["refreshes"] >= 2
@@ -0,0 +1,97 @@
+import asyncio
+import base64
+from datetime import datetime, timedelta, timezone
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+from azure.storage.blob import UserDelegationKey
+from azure.storage.blob.aio import BlobServiceClient
+
+from core.blobsas import UserDelegationSasProvider
+
+from .mocks import MockAzureCredential
+
+
+class MockBlobServiceClient(BlobServiceClient):
+    def __init__(self):
+        super().__init__("https://test.blob.core.windows.net", credential=MockAzureCredential())
+        self.key_requests: list[tuple[datetime, datetime]] = []
+
+    async def get_user_delegation_key(self, key_start_time, key_expiry_time, **kwargs):
+        self.key_requests.append((key_start_time, key_expiry_time))
+        key = UserDelegationKey()
+        key.signed_oid = "OID_X"
+        key.signed_tid = "TID_X"
+        key.signed_start = key_start_time.strftime("%Y-%m-%dT%H:%M:%SZ")
+        key.signed_expiry = key_expiry_time.strftime("%Y-%m-%dT%H:%M:%SZ")
+        key.signed_service = "b"
+        key.signed_version = "2021-08-06"
+        key.value = base64.b64encode(f"key{len(self.key_requests)}".encode()).decode()
+        return key
+
+
+@pytest.mark.asyncio
+async def test_generate_read_url():
+    service_client = MockBlobServiceClient()
+    provider = UserDelegationSasProvider(service_client, sas_ttl_seconds=300)
+    blob_client = service_client.get_blob_client("content", "Benefit_Options.pdf")
+
+    url = await provider.generate_read_url(blob_client, content_type="application/pdf")
+    parsed_url = urlparse(url)
+    assert f"{parsed_url.scheme}://{parsed_url.netloc}{parsed_url.path}" == blob_client.url
+    query = parse_qs(parsed_url.query)
+    assert query["sp"] == ["r"]
+    assert query["sr"] == ["b"]
+    assert query["skoid"] == ["OID_X"]
+    assert query["rsct"] == ["application/pdf"]
+    expiry = datetime.strptime(query["se"][0], "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc)
+    assert expiry - datetime.now(timezone.utc) <= timedelta(seconds=300)
+
+    # The user delegation key is reused for further URLs
+    await provider.generate_read_url(blob_client)
+    assert len(service_client.key_requests) == 1
+    assert provider.stats()["urls_signed"] == 2
+
+
+@pytest.mark.asyncio
+async def test_key_close_to_expiry_is_replaced():
+    service_client = MockBlobServiceClient()
+    provider = UserDelegationSasProvider(service_client, sas_ttl_seconds=300)
+    blob_client = service_client.get_blob_client("content", "Benefit_Options.pdf")
+    await provider.generate_read_url(blob_client)
+
+    # URLs must not outlive the key they are signed with
+    provider.key_expiry = datetime.now(timezone.utc) + timedelta(seconds=200)
+    await provider.generate_read_url(blob_client)
+    assert len(service_client.key_requests) == 2
+    assert provider.key_expiry > datetime.now(timezone.utc) + timedelta(hours=23)
+
+
+@pytest.mark.asyncio
+async def test_background_refresh(monkeypatch):
+    service_client = MockBlobServiceClient()
+    provider = UserDelegationSasProvider(
+        service_client, sas_ttl_seconds=1, key_ttl_seconds=4, key_refresh_margin_seconds=3
+    )
+    provider.start()
+    await asyncio.sleep(1.5)
+    await provider.close()
+    assert len(service_client.key_requests) == 2
+    assert provider.stats()["key_refreshes"] == 2
+
+    failing_client = MockBlobServiceClient()
+
+    async def get_user_delegation_key(*args, **kwargs):
+        raise Exception("Forbidden")
+
+    monkeypatch.setattr(failing_client, "get_user_delegation_key", get_user_delegation_key)
+    provider = UserDelegationSasProvider(failing_client, retry_delay_seconds=60)
+    provider.start()
+    await asyncio.sleep(0.1)
+    await provider.close()
+    assert provider.stats()["key_refresh_failures"] == 1
+
+
+def test_invalid_ttls():
+    with pytest.raises(ValueError):
+        UserDelegationSasProvider(MockBlobServiceClient(), sas_ttl_seconds=7200)
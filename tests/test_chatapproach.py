@@ -6,6 +6,7 @@ from azure.search.documents.agent.aio import KnowledgeAgentRetrievalClient
 from azure.search.documents.aio import SearchClient
 from openai.types.chat import ChatCompletion
 
+from approaches.approach import Document
 from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
 from approaches.promptmanager import PromptyManager
 
@@ -300,3 +301,106 @@ async def test_agent_retrieval_results(monkeypatch):
     assert results[0].content == "There is a whistleblower policy."
     assert results[0].sourcepage == "Benefit_Options-2.pdf"
     assert results[0].search_agent_query == "whistleblower query"
+
+
+def test_is_similar_query():
+    assert ChatReadRetrieveReadApproach.is_similar_query("health plan deductible", "Health plan deductible?")
+    assert ChatReadRetrieveReadApproach.is_similar_query("deductible health plan", "health plan deductible")
+    assert not ChatReadRetrieveReadApproach.is_similar_query("Northwind Health Plus deductible", "what about it?")
+
+
+def test_fuse_results():
+    first = [Document(id="a"), Document(id="b"), Document(id="c")]
+    second = [Document(id="c"), Document(id="d")]
+    fused = ChatReadRetrieveReadApproach.fuse_results([first, second], top=3)
+    assert [document.id for document in fused] == ["c", "a", "b"]
+
+
+def rewrite_completion(query_text: str) -> ChatCompletion:
+    return ChatCompletion.model_validate(
+        {
+            "id": "test",
+            "object": "chat.completion",
+            "created": 0,
+            "model": "gpt-4.1-mini",
+            "choices": [
+                {
+                    "index": 0,
+                    "finish_reason": "stop",
+                    "message": {"role": "assistant", "content": query_text},
+                }
+            ],
+        }
+    )
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "query_text, expected_searches, expected_mode",
+    [
+        ("What is the deductible?", ["What is the deductible?"], "reused"),
+        ("Northwind Health deductible", ["What is the deductible?", "Northwind Health deductible"], "fused"),
+    ],
+)
+async def test_speculative_search(monkeypatch, chat_approach, query_text, expected_searches, expected_mode):
+    chat_approach.speculative_search = True
+    searches = []
+
+    async def mock_create_chat_completion(*args, **kwargs):
+        return rewrite_completion(query_text)
+
+    async def mock_search(top, query_text, *args):
+        searches.append(query_text)
+        return [Document(id=query_text, content=query_text)]
+
+    monkeypatch.setattr(chat_approach, "create_chat_completion", mock_create_chat_completion)
+    monkeypatch.setattr(chat_approach, "search", mock_search)
+    monkeypatch.setattr(chat_approach, "build_filter", lambda overrides, auth_claims: None)
+
+    extra_info = await chat_approach.run_search_approach(
+        [{"role": "user", "content": "What is the deductible?"}], {"retrieval_mode": "text"}, {}
+    )
+    assert sorted(searches) == sorted(expected_searches)
+    assert extra_info.thoughts[1].props["speculative_search"] == expected_mode
+    assert len(extra_info.data_points.text) == len(expected_searches)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "messages, expected_skipped",
+    [
+        ([{"role": "user", "content": "What is the deductible?"}], True),
+        (
+            [
+                {"role": "user", "content": "What is the deductible?"},
+                {"role": "assistant", "content": "It is $500."},
+                {"role": "user", "content": "And for Plus?"},
+            ],
+            False,
+        ),
+    ],
+)
+async def test_query_rewrite_fast_path(monkeypatch, chat_approach, messages, expected_skipped):
+    chat_approach.query_rewrite_max_skipped_history = 0
+    searches = []
+
+    async def mock_create_chat_completion(*args, **kwargs):
+        return rewrite_completion("Northwind Plus deductible")
+
+    async def mock_search(top, query_text, *args):
+        searches.append(query_text)
+        return [Document(id=query_text, content=query_text)]
+
+    monkeypatch.setattr(chat_approach, "create_chat_completion", mock_create_chat_completion)
+    monkeypatch.setattr(chat_approach, "search", mock_search)
+    monkeypatch.setattr(chat_approach, "build_filter", lambda overrides, auth_claims: None)
+
+    extra_info = await chat_approach.run_search_approach(messages, {"retrieval_mode": "text"}, {})
+    if expected_skipped:
+        assert searches == ["deductible"]
+        assert extra_info.thoughts[0].title == "Skipped search query generation"
+        assert chat_approach.query_rewrite_stats() == {"generated": 0, "skipped": 1, "skip_rate": 1.0}
+    else:
+        assert searches == ["Northwind Plus deductible"]
+        assert extra_info.thoughts[0].title == "Prompt to generate search query"
+        assert chat_approach.query_rewrite_stats() == {"generated": 1, "skipped": 0, "skip_rate": 0.0}
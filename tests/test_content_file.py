@@ -1,6 +1,7 @@
 import os
 
 import aiohttp
+import azure.storage.blob
 import azure.storage.blob.aio
 import azure.storage.filedatalake.aio
 import pytest
@@ -101,7 +102,7 @@ async def test_content_file(monkeypatch, mock_env, mock_acs_search):
 async def test_content_file_useruploaded_found(monkeypatch, auth_client, mock_blob_container_client):
 
     class MockBlobClient:
-        async def download_blob(self):
+        async def download_blob(self, *args, **kwargs):
             raise ResourceNotFoundError(MockAiohttpClientResponse404("userdoc.pdf", b""))
 
     monkeypatch.setattr(
@@ -110,7 +111,7 @@ async def test_content_file_useruploaded_found(monkeypatch, auth_client, mock_bl
 
     downloaded_files = []
 
-    async def mock_download_file(self):
+    async def mock_download_file(self, *args, **kwargs):
         downloaded_files.append(self.path_name)
         return MockBlob()
 
@@ -125,17 +126,209 @@ async def test_content_file_useruploaded_found(monkeypatch, auth_client, mock_bl
 async def test_content_file_useruploaded_notfound(monkeypatch, auth_client, mock_blob_container_client):
 
     class MockBlobClient:
-        async def download_blob(self):
+        async def download_blob(self, *args, **kwargs):
             raise ResourceNotFoundError(MockAiohttpClientResponse404("userdoc.pdf", b""))
 
     monkeypatch.setattr(
         azure.storage.blob.aio.ContainerClient, "get_blob_client", lambda *args, **kwargs: MockBlobClient()
     )
 
-    async def mock_download_file(self):
+    async def mock_download_file(self, *args, **kwargs):
         raise ResourceNotFoundError(MockAiohttpClientResponse404("userdoc.pdf", b""))
 
     monkeypatch.setattr(azure.storage.filedatalake.aio.DataLakeFileClient, "download_file", mock_download_file)
 
     response = await auth_client.get("/content/userdoc.pdf", headers={"Authorization": "Bearer test"})
     assert response.status_code == 404
+
+
+class MockAiohttpClientResponseWithStatus(aiohttp.ClientResponse):
+    def __init__(self, url, body_bytes, headers, status):
+        self._body = body_bytes
+        self._headers = headers
+        self._cache = {}
+        self.status = status
+        self.reason = "Partial Content" if status == 206 else "Not Modified"
+        self._url = url
+
+
+class MockRangeTransport(AsyncHttpTransport):
+    """Serves a single file like Blob Storage does, honoring ranges and If-None-Match"""
+
+    def __init__(self, content: bytes, etag: str):
+        self.content = content
+        self.etag = etag
+        self.requests: list[HttpRequest] = []
+
+    async def send(self, request: HttpRequest, **kwargs) -> AioHttpTransportResponse:
+        self.requests.append(request)
+        headers = {"ETag": self.etag, "Last-Modified": "Wed, 01 Jan 2025 00:00:00 GMT"}
+        if request.headers.get("If-None-Match") == self.etag:
+            headers["x-ms-error-code"] = "ConditionNotMet"
+            return AioHttpTransportResponse(
+                request, MockAiohttpClientResponseWithStatus(request.url, b"", headers, 304)
+            )
+        start, end = (int(value) for value in request.headers["x-ms-range"].split("=")[1].split("-"))
+        end = min(end, len(self.content) - 1)
+        headers |= {
+            "Content-Type": "application/pdf",
+            "Content-Range": f"bytes {start}-{end}/{len(self.content)}",
+            "Content-Length": str(end - start + 1),
+        }
+        return AioHttpTransportResponse(
+            request, MockAiohttpClientResponseWithStatus(request.url, self.content[start : end + 1], headers, 206)
+        )
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+
+def mock_range_container_client(transport: MockRangeTransport):
+    blob_client = BlobServiceClient(
+        f"https://{os.environ['AZURE_STORAGE_ACCOUNT']}.blob.core.windows.net",
+        credential=MockAzureCredential(),
+        transport=transport,
+        retry_total=0,
+    )
+    return blob_client.get_container_client(os.environ["AZURE_STORAGE_CONTAINER"])
+
+
+@pytest.mark.asyncio
+async def test_content_file_range_and_conditional(monkeypatch, mock_env, mock_acs_search):
+    content = b"0123456789"
+    etag = '"0x8DB5A1B2C3D4E5F"'
+    transport = MockRangeTransport(content, etag)
+    requests = transport.requests
+    blob_container_client = mock_range_container_client(transport)
+
+    quart_app = app.create_app()
+    async with quart_app.test_app() as test_app:
+        quart_app.config.update({"blob_container_client": blob_container_client})
+        client = test_app.test_client()
+
+        response = await client.get("/content/role_library.pdf")
+        assert response.status_code == 200
+        assert await response.get_data() == content
+        assert response.headers["ETag"] == etag
+        assert response.headers["Accept-Ranges"] == "bytes"
+        assert response.headers["Last-Modified"] == "Wed, 01 Jan 2025 00:00:00 GMT"
+        assert response.headers["Content-Length"] == "10"
+
+        response = await client.get("/content/role_library.pdf", headers={"Range": "bytes=2-5"})
+        assert response.status_code == 206
+        assert await response.get_data() == b"2345"
+        assert response.headers["Content-Range"] == "bytes 2-5/10"
+        assert requests[-1].headers["x-ms-range"] == "bytes=2-5"
+
+        response = await client.get("/content/role_library.pdf", headers={"Range": "bytes=7-"})
+        assert response.status_code == 206
+        assert await response.get_data() == b"789"
+        assert response.headers["Content-Range"] == "bytes 7-9/10"
+
+        response = await client.get("/content/role_library.pdf", headers={"Range": "bytes=2-5", "If-Range": etag})
+        assert response.status_code == 206
+        assert await response.get_data() == b"2345"
+
+        # A stale If-Range validator means the whole file is sent instead of the range
+        response = await client.get(
+            "/content/role_library.pdf", headers={"Range": "bytes=2-5", "If-Range": '"0x8DB000000000000"'}
+        )
+        assert response.status_code == 200
+        assert await response.get_data() == content
+
+        requests.clear()
+        response = await client.get("/content/role_library.pdf", headers={"If-None-Match": etag})
+        assert response.status_code == 304
+        assert response.headers["ETag"] == etag
+        assert await response.get_data() == b""
+        assert len(requests) == 1
+
+
+@pytest.mark.asyncio
+async def test_content_file_cache(monkeypatch, mock_env, mock_acs_search, tmp_path):
+    monkeypatch.setenv("ENABLE_METRICS_ENDPOINT", "true")
+    monkeypatch.setenv("USE_CONTENT_FILE_CACHE", "true")
+    monkeypatch.setenv("CONTENT_FILE_CACHE_DIR", str(tmp_path))
+    transport = MockRangeTransport(b"0123456789", '"0x8DB5A1B2C3D4E5F"')
+
+    quart_app = app.create_app()
+    async with quart_app.test_app() as test_app:
+        quart_app.config.update({"blob_container_client": mock_range_container_client(transport)})
+        client = test_app.test_client()
+
+        response = await client.get("/content/role_library.pdf")
+        assert await response.get_data() == b"0123456789"
+
+        # The cached copy is served once storage confirms that it is still current
+        transport.requests.clear()
+        response = await client.get("/content/role_library.pdf")
+        assert response.status_code == 200
+        assert await response.get_data() == b"0123456789"
+        assert response.headers["ETag"] == '"0x8DB5A1B2C3D4E5F"'
+        assert transport.requests[0].headers["If-None-Match"] == '"0x8DB5A1B2C3D4E5F"'
+
+        response = await client.get("/content/role_library.pdf", headers={"Range": "bytes=2-5"})
+        assert response.status_code == 206
+        assert await response.get_data() == b"2345"
+        assert response.headers["Content-Range"] == "bytes 2-5/10"
+
+        response = await client.get("/content/role_library.pdf", headers={"If-None-Match": '"0x8DB5A1B2C3D4E5F"'})
+        assert response.status_code == 304
+
+        # A changed file is downloaded again and replaces the cached copy
+        transport.content, transport.etag = b"abcdefghij", '"0x8DB000000000001"'
+        response = await client.get("/content/role_library.pdf")
+        assert await response.get_data() == b"abcdefghij"
+        response = await client.get("/content/role_library.pdf")
+        assert await response.get_data() == b"abcdefghij"
+
+        response = await client.get("/metrics")
+        stats = (await response.get_json())["content_file_cache"]
+        assert stats["hits"] == 4
+        assert stats["misses"] == 2
+        assert stats["bytes_saved"] == 24
+        assert stats["files"] == 1
+        assert len(list(tmp_path.iterdir())) == 1
+
+
+@pytest.mark.asyncio
+async def test_content_file_sas_redirect(monkeypatch, mock_env, mock_acs_search):
+    monkeypatch.setenv("ENABLE_METRICS_ENDPOINT", "true")
+    monkeypatch.setenv("USE_CONTENT_SAS_REDIRECT", "true")
+
+    async def mock_get_user_delegation_key(self, key_start_time, key_expiry_time, **kwargs):
+        key = azure.storage.blob.UserDelegationKey()
+        key.signed_oid = "OID_X"
+        key.signed_tid = "TID_X"
+        key.signed_start = key_start_time.strftime("%Y-%m-%dT%H:%M:%SZ")
+        key.signed_expiry = key_expiry_time.strftime("%Y-%m-%dT%H:%M:%SZ")
+        key.signed_service = "b"
+        key.signed_version = "2021-08-06"
+        key.value = "a2V5"
+        return key
+
+    monkeypatch.setattr(BlobServiceClient, "get_user_delegation_key", mock_get_user_delegation_key)
+
+    quart_app = app.create_app()
+    async with quart_app.test_app() as test_app:
+        client = test_app.test_client()
+        response = await client.get("/content/role_library.pdf#page=2")
+        assert response.status_code == 302
+        location = response.headers["Location"]
+        assert location.startswith(
+            f"https://{os.environ['AZURE_STORAGE_ACCOUNT']}.blob.core.windows.net/{os.environ['AZURE_STORAGE_CONTAINER']}/role_library.pdf?"
+        )
+        assert "sp=r" in location
+        assert "rsct=application/pdf" in location
+
+        response = await client.get("/metrics")
+        assert (await response.get_json())["content_sas"]["urls_signed"] == 1
@@ -0,0 +1,90 @@
+import pytest
+
+from core.contentcache import ContentFileCache
+
+
+async def stream(*chunks: bytes):
+    for chunk in chunks:
+        yield chunk
+
+
+async def store(cache: ContentFileCache, key: str, *chunks: bytes, size=None):
+    stored_chunks = cache.store_while_streaming(
+        key,
+        stream(*chunks),
+        etag='"0x1"',
+        last_modified=None,
+        content_type="application/pdf",
+        size=sum(len(chunk) for chunk in chunks) if size is None else size,
+    )
+    return [chunk async for chunk in stored_chunks]
+
+
+@pytest.mark.asyncio
+async def test_store_while_streaming(tmp_path):
+    cache = ContentFileCache(tmp_path, max_bytes=100)
+    assert await store(cache, "blob/a.pdf", b"abc", b"def") == [b"abc", b"def"]
+
+    cached_file = cache.get("blob/a.pdf")
+    assert cached_file.file_path.read_bytes() == b"abcdef"
+    assert cached_file.etag == '"0x1"'
+    assert cache.stats()["bytes"] == 6
+
+
+@pytest.mark.asyncio
+async def test_incomplete_download_is_not_cached(tmp_path):
+    cache = ContentFileCache(tmp_path, max_bytes=100)
+    assert await store(cache, "blob/a.pdf", b"abc", size=10) == [b"abc"]
+    assert cache.get("blob/a.pdf") is None
+    assert list(tmp_path.iterdir()) == []
+
+
+@pytest.mark.asyncio
+async def test_large_file_is_not_cached(tmp_path):
+    cache = ContentFileCache(tmp_path, max_bytes=100, max_file_bytes=5)
+    assert await store(cache, "blob/a.pdf", b"abcdef") == [b"abcdef"]
+    assert cache.get("blob/a.pdf") is None
+
+
+@pytest.mark.asyncio
+async def test_evicts_least_recently_used_files(tmp_path):
+    cache = ContentFileCache(tmp_path, max_bytes=10, max_files=2)
+    await store(cache, "blob/a.pdf", b"aaaa")
+    await store(cache, "blob/b.pdf", b"bbbb")
+    cache.get("blob/a.pdf")
+    await store(cache, "blob/c.pdf", b"cccc")
+    assert cache.get("blob/b.pdf") is None
+    assert cache.get("blob/a.pdf") is not None
+    assert cache.get("blob/c.pdf") is not None
+
+    # The size limit applies as well as the file count limit
+    await store(cache, "blob/d.pdf", b"dddddddd")
+    assert cache.get("blob/a.pdf") is None
+    assert cache.get("blob/c.pdf") is None
+    assert cache.stats()["evictions"] == 3
+    assert len(list(tmp_path.iterdir())) == 1
+
+
+@pytest.mark.asyncio
+async def test_replaced_file_and_leftovers_are_removed(tmp_path):
+    cache = ContentFileCache(tmp_path, max_bytes=100)
+    await store(cache, "blob/a.pdf", b"old")
+    await store(cache, "blob/a.pdf", b"new")
+    assert cache.get("blob/a.pdf").file_path.read_bytes() == b"new"
+    assert cache.stats()["bytes"] == 3
+    assert len(list(tmp_path.iterdir())) == 1
+
+    (tmp_path / "unrelated.txt").write_text("keep")
+    ContentFileCache(tmp_path, max_bytes=100)
+    assert [path.name for path in tmp_path.iterdir()] == ["unrelated.txt"]
+
+
+def test_stats(tmp_path):
+    cache = ContentFileCache(tmp_path, max_bytes=100)
+    cache.record_hit(10)
+    cache.record_hit(5)
+    cache.record_miss()
+    stats = cache.stats()
+    assert stats["hits"] == 2
+    assert stats["hit_rate"] == 2 / 3
+    assert stats["bytes_saved"] == 15
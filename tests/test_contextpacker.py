@@ -0,0 +1,95 @@
+import pytest
+
+from approaches.approach import Document
+from approaches.contextpacker import SOURCE_OVERHEAD_TOKENS, ContextPacker
+from approaches.retrievethenread import RetrieveThenReadApproach
+
+
+def make_source(name: str, tokens: int) -> str:
+    # " word" is one token in cl100k_base
+    return f"{name}:" + " word" * tokens
+
+
+def test_pack_keeps_sources_that_fit():
+    packer = ContextPacker(max_prompt_tokens=1000, min_source_tokens=10)
+    sources = [make_source("a.pdf#page=1", 50), make_source("b.pdf#page=2", 50)]
+    packed, decisions = packer.pack(sources, [None, None], 500)
+    assert packed == sources
+    assert [decision["action"] for decision in decisions] == ["kept", "kept"]
+    assert decisions[0]["source"] == "a.pdf#page=1"
+
+
+def test_pack_truncates_then_drops_lowest_ranked_sources():
+    packer = ContextPacker(max_prompt_tokens=1000, min_source_tokens=10)
+    sources = [make_source("a.pdf", 100), make_source("b.pdf", 100), make_source("c.pdf", 1)]
+    packed, decisions = packer.pack(sources, [None, None, None], 150)
+
+    assert [decision["action"] for decision in decisions] == ["kept", "truncated", "dropped"]
+    assert packed[0] == sources[0]
+    assert sources[1].startswith(packed[1])
+    assert packer.count_tokens(packed[1]) <= 150 - decisions[0]["kept_tokens"] - SOURCE_OVERHEAD_TOKENS
+    # The last source would fit, but it is ranked below one that didn't
+    assert len(packed) == 2
+    assert sum(decision["kept_tokens"] for decision in decisions) == 150
+    assert packer.stats()["truncated"] == 1
+    assert packer.stats()["dropped"] == 1
+
+
+def test_pack_drops_sources_when_too_little_of_them_fits():
+    packer = ContextPacker(max_prompt_tokens=1000, min_source_tokens=50)
+    packed, decisions = packer.pack([make_source("a.pdf", 40), make_source("b.pdf", 100)], [None, None], 80)
+    assert len(packed) == 1
+    assert decisions[1]["action"] == "dropped"
+    assert decisions[1]["kept_tokens"] == 0
+
+
+def test_pack_uses_stored_token_counts():
+    packer = ContextPacker(max_prompt_tokens=1000, min_source_tokens=10)
+    # The stored count says the source is much longer than its text
+    packed, decisions = packer.pack([make_source("a.pdf", 5)], [500], 100)
+    assert decisions[0]["action"] == "truncated"
+    assert decisions[0]["tokens"] == 500 + SOURCE_OVERHEAD_TOKENS
+
+
+def test_truncate_does_not_split_characters():
+    packer = ContextPacker()
+    truncated = packer.truncate("שלום עולם " * 20, 5)
+    assert "�" not in truncated
+    assert ("שלום עולם " * 20).startswith(truncated)
+
+
+def test_source_token_budget():
+    packer = ContextPacker(max_prompt_tokens=200, min_source_tokens=20)
+    messages = [{"role": "system", "content": "word"}, {"role": "user", "content": " word" * 50}]
+    assert packer.get_source_token_budget(messages) == 200 - packer.count_message_tokens(messages)
+    # The top source still gets some room when the rest of the prompt is over the budget
+    messages[1]["content"] = " word" * 500
+    assert packer.get_source_token_budget(messages) == 20 + SOURCE_OVERHEAD_TOKENS
+
+
+def test_pack_sources_records_decisions_in_thought():
+    approach = RetrieveThenReadApproach.__new__(RetrieveThenReadApproach)
+    approach.context_packer = ContextPacker(max_prompt_tokens=1000, min_source_tokens=10)
+    results = [
+        Document(sourcepage="a.pdf#page=1", content=" word" * 100, token_count=100),
+        Document(sourcepage="b.pdf#page=1", content=" word" * 100),
+    ]
+    text_sources = approach.get_sources_content(results, use_semantic_captions=False, use_image_citation=False)
+    packed, thought = approach.pack_sources(results, text_sources, False, 150)
+
+    assert thought.title == "Pack sources into token budget"
+    assert [decision["action"] for decision in thought.description] == ["kept", "truncated"]
+    # The stored count of the content, and the citation in front of it
+    citation_tokens = approach.context_packer.count_tokens("a.pdf#page=1: ")
+    assert thought.description[0]["tokens"] == 100 + citation_tokens + SOURCE_OVERHEAD_TOKENS
+    assert thought.props["source_token_budget"] == 150
+    assert thought.props["source_tokens"] == 150
+    assert len(packed) == 2
+
+    approach.context_packer = None
+    assert approach.pack_sources(results, text_sources, False, 150) == (text_sources, None)
+
+
+def test_packer_requires_valid_budget():
+    with pytest.raises(ValueError):
+        ContextPacker(max_prompt_tokens=100, min_source_tokens=100)
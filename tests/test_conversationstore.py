@@ -0,0 +1,128 @@
+import pytest
+
+from chat_history.conversationstore import ConversationStore
+
+from .mocks import MockAsyncPageIterator
+
+
+class MockResultsIterator:
+    def __init__(self, items):
+        self.pages = [items]
+
+    def by_page(self):
+        return self
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self.pages:
+            raise StopAsyncIteration
+        return MockAsyncPageIterator(self.pages.pop(0))
+
+
+class MockContainer:
+    def __init__(self, items=None):
+        self.items = items or []
+        self.batches = []
+        self.queries = 0
+
+    def query_items(self, query, parameters, partition_key):
+        self.queries += 1
+        return MockResultsIterator(list(self.items))
+
+    async def execute_item_batch(self, batch_operations, partition_key):
+        self.batches.append((batch_operations, partition_key))
+
+
+def message_pair_item(index, question, answer):
+    return {
+        "id": f"123-{index}",
+        "session_id": "123",
+        "type": "message_pair",
+        "question": question,
+        "response": {"message": {"content": answer, "role": "assistant"}, "session_state": "123"},
+    }
+
+
+@pytest.mark.asyncio
+async def test_turns_are_kept_in_memory():
+    store = ConversationStore()
+    assert await store.get_messages("OID_X", "123") is None
+
+    messages = [{"role": "user", "content": "What does a Product Manager do?"}]
+    await store.save_turn("OID_X", "123", messages, {"message": {"content": "They lead.", "role": "assistant"}})
+    assert await store.get_messages("OID_X", "123") == messages + [{"role": "assistant", "content": "They lead."}]
+    # Another user doesn't get the conversation, even with its session id
+    assert await store.get_messages("OID_Y", "123") is None
+    assert store.stats()["turns_saved"] == 1
+    assert store.stats()["turns_persisted"] == 0
+
+    store.forget("OID_X", "123")
+    assert await store.get_messages("OID_X", "123") is None
+
+
+@pytest.mark.asyncio
+async def test_turns_are_persisted_one_message_pair_at_a_time():
+    container = MockContainer()
+    store = ConversationStore(container=container, version="cosmosdb-v2")
+    messages = [
+        {"role": "user", "content": "What does a Product Manager do?"},
+        {"role": "assistant", "content": "They lead."},
+        {"role": "user", "content": "Who do they report to?"},
+    ]
+    response = {"message": {"content": "The CEO.", "role": "assistant"}, "session_state": "123"}
+    await store.save_turn("OID_X", "123", messages, response)
+
+    batch_operations, partition_key = container.batches[0]
+    assert partition_key == ["OID_X", "123"]
+    assert len(batch_operations) == 2
+    session = batch_operations[0][1][0]
+    assert session["id"] == "123"
+    assert session["title"] == "What does a Product Manager do?"
+    assert session["version"] == "cosmosdb-v2"
+    message_pair = batch_operations[1][1][0]
+    assert message_pair["id"] == "123-1"
+    assert message_pair["question"] == "Who do they report to?"
+    assert message_pair["response"] == response
+    assert store.stats()["turns_persisted"] == 1
+
+
+@pytest.mark.asyncio
+async def test_turns_are_not_persisted_without_user():
+    container = MockContainer()
+    store = ConversationStore(container=container, version="cosmosdb-v2")
+    await store.save_turn(None, "123", [{"role": "user", "content": "Hi"}], {"message": {"content": "Hello"}})
+    assert container.batches == []
+    assert await store.get_messages(None, "123") is not None
+    assert container.queries == 0
+
+
+@pytest.mark.asyncio
+async def test_conversations_are_loaded_from_cosmos():
+    container = MockContainer(
+        [
+            message_pair_item(1, "Who do they report to?", "The CEO."),
+            message_pair_item(0, "What does a Product Manager do?", "They lead."),
+        ]
+    )
+    store = ConversationStore(container=container, version="cosmosdb-v2")
+    messages = await store.get_messages("OID_X", "123")
+    assert messages == [
+        {"role": "user", "content": "What does a Product Manager do?"},
+        {"role": "assistant", "content": "They lead."},
+        {"role": "user", "content": "Who do they report to?"},
+        {"role": "assistant", "content": "The CEO."},
+    ]
+    # Kept in memory from then on
+    assert await store.get_messages("OID_X", "123") == messages
+    assert container.queries == 1
+    assert store.stats()["loaded"] == 1
+
+
+@pytest.mark.asyncio
+async def test_unknown_conversations_are_not_cached():
+    container = MockContainer()
+    store = ConversationStore(container=container, version="cosmosdb-v2")
+    assert await store.get_messages("OID_X", "123") is None
+    assert len(store.conversations) == 0
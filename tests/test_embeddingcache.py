@@ -0,0 +1,132 @@
+import asyncio
+
+import pytest
+from openai.types.create_embedding_response import CreateEmbeddingResponse, Usage
+from openai.types.embedding import Embedding
+
+from approaches.embeddingcache import QueryEmbeddingCache
+from approaches.promptmanager import PromptyManager
+from approaches.retrievethenread import RetrieveThenReadApproach
+from core.cache import SingleFlight
+
+from .mocks import MOCK_EMBEDDING_DIMENSIONS, MOCK_EMBEDDING_MODEL_NAME
+
+
+@pytest.mark.asyncio
+async def test_single_flight_coalesces_concurrent_calls():
+    single_flight: SingleFlight[str, int] = SingleFlight()
+    calls = []
+    release = asyncio.Event()
+
+    async def create():
+        calls.append(True)
+        await release.wait()
+        return 42
+
+    waiters = [asyncio.create_task(single_flight.do("key", create)) for _ in range(3)]
+    await asyncio.sleep(0)
+    release.set()
+    assert await asyncio.gather(*waiters) == [42, 42, 42]
+    assert len(calls) == 1
+    assert single_flight.stats() == {"in_flight": 0, "calls": 1, "coalesced": 2}
+
+
+@pytest.mark.asyncio
+async def test_single_flight_shares_exceptions():
+    single_flight: SingleFlight[str, int] = SingleFlight()
+    release = asyncio.Event()
+
+    async def create():
+        await release.wait()
+        raise ValueError("boom")
+
+    waiters = [asyncio.create_task(single_flight.do("key", create)) for _ in range(2)]
+    await asyncio.sleep(0)
+    release.set()
+    results = await asyncio.gather(*waiters, return_exceptions=True)
+    assert all(isinstance(result, ValueError) for result in results)
+    assert len(single_flight) == 0
+
+
+@pytest.mark.asyncio
+async def test_single_flight_survives_cancelled_caller():
+    single_flight: SingleFlight[str, int] = SingleFlight()
+    release = asyncio.Event()
+
+    async def create():
+        await release.wait()
+        return 1
+
+    first = asyncio.create_task(single_flight.do("key", create))
+    second = asyncio.create_task(single_flight.do("key", create))
+    await asyncio.sleep(0)
+    first.cancel()
+    release.set()
+    assert await second == 1
+    with pytest.raises(asyncio.CancelledError):
+        await first
+
+
+@pytest.mark.asyncio
+async def test_query_embedding_cache():
+    cache = QueryEmbeddingCache(max_entries=10)
+    calls = []
+
+    async def create():
+        calls.append(True)
+        return [0.1, 0.2]
+
+    assert await cache.get_or_create(("model", 2, "question"), create) == [0.1, 0.2]
+    assert await cache.get_or_create(("model", 2, "question"), create) == [0.1, 0.2]
+    assert await cache.get_or_create(("model", 3, "question"), create) == [0.1, 0.2]
+    assert len(calls) == 2
+    assert cache.stats()["hits"] == 1
+
+
+@pytest.mark.asyncio
+async def test_compute_text_embedding_uses_cache(monkeypatch):
+    calls = []
+
+    class MockEmbeddingsClient:
+        async def create(self, *args, **kwargs) -> CreateEmbeddingResponse:
+            calls.append(kwargs)
+            return CreateEmbeddingResponse(
+                object="list",
+                data=[Embedding(embedding=[0.5, 0.5], index=0, object="embedding")],
+                model=kwargs["model"],
+                usage=Usage(prompt_tokens=8, total_tokens=8),
+            )
+
+    class MockClient:
+        embeddings = MockEmbeddingsClient()
+
+    approach = RetrieveThenReadApproach(
+        search_client=None,
+        search_index_name=None,
+        agent_model=None,
+        agent_deployment=None,
+        agent_client=None,
+        auth_helper=None,
+        openai_client=MockClient(),
+        chatgpt_model="gpt-4.1-mini",
+        chatgpt_deployment="chat",
+        embedding_deployment="embeddings",
+        embedding_model=MOCK_EMBEDDING_MODEL_NAME,
+        embedding_dimensions=MOCK_EMBEDDING_DIMENSIONS,
+        embedding_field="embedding3",
+        sourcepage_field="",
+        content_field="",
+        query_language="en-us",
+        query_speller="lexicon",
+        prompt_manager=PromptyManager(),
+        embedding_cache=QueryEmbeddingCache(),
+    )
+
+    results = await asyncio.gather(*[approach.compute_text_embedding("question") for _ in range(3)])
+    await approach.compute_text_embedding("question")
+    assert [result.vector for result in results] == [[0.5, 0.5]] * 3
+    assert len(calls) == 1
+    assert calls[0]["model"] == "embeddings"
+
+    await approach.compute_text_embedding("another question")
+    assert len(calls) == 2
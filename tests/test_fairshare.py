@@ -0,0 +1,155 @@
+import asyncio
+
+import pytest
+
+from approaches.approach import TokenUsageProps
+from approaches.fairshare import FairShareScheduler
+
+from .mocks import FakeClock
+
+# 400 characters, estimated at 100 tokens until the scheduler learns the actual ratio
+MESSAGES = [{"role": "user", "content": "x" * 400}]
+
+
+def usage(prompt_tokens, completion_tokens):
+    return TokenUsageProps(
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens,
+        reasoning_tokens=None,
+        total_tokens=prompt_tokens + completion_tokens,
+    )
+
+
+async def queue_calls(scheduler, oids, started, tickets=None):
+    async def call(oid):
+        ticket = await scheduler.acquire(oid, MESSAGES, 100)
+        started.append(oid)
+        if tickets is not None:
+            tickets.append(ticket)
+        return ticket
+
+    tasks = [asyncio.create_task(call(oid)) for oid in oids]
+    await asyncio.sleep(0)
+    return tasks
+
+
+@pytest.mark.asyncio
+async def test_calls_start_right_away_below_max_concurrency():
+    scheduler = FairShareScheduler(max_concurrency=2, clock=FakeClock())
+    ticket = await scheduler.acquire("user1", MESSAGES, 100)
+    assert ticket.estimated_tokens == 200
+    await scheduler.acquire(None, MESSAGES, 100)
+    assert scheduler.stats()["in_flight"] == 2
+    assert ticket.share.balance == 40000 - 200
+
+
+@pytest.mark.asyncio
+async def test_waiting_calls_start_in_weighted_round_robin_order():
+    scheduler = FairShareScheduler(max_concurrency=1, weights={"heavy": 2}, clock=FakeClock())
+    first = await scheduler.acquire("other", MESSAGES, 100)
+    started = []
+    tickets = [first]
+    await queue_calls(scheduler, ["heavy"] * 4 + ["light"] * 2, started, tickets)
+    assert scheduler.stats()["waiting"] == 6
+
+    for _ in range(6):
+        scheduler.release(tickets[-1], None)
+        await asyncio.sleep(0)
+        assert scheduler.stats()["in_flight"] == 1
+    assert started == ["heavy", "heavy", "light", "heavy", "heavy", "light"]
+    assert scheduler.stats()["active_users"] == 0
+
+
+@pytest.mark.asyncio
+async def test_users_within_their_budget_go_first():
+    clock = FakeClock()
+    scheduler = FairShareScheduler(max_concurrency=1, tokens_per_minute=600, clock=clock)
+    first = await scheduler.acquire("heavy", MESSAGES, 100)
+    # The heavy user used far more than estimated, and is now deep in debt
+    scheduler.release(first, usage(100, 1000))
+    blocking = await scheduler.acquire("other", MESSAGES, 100)
+    started = []
+    tasks = await queue_calls(scheduler, ["heavy", "light"], started)
+
+    scheduler.release(blocking, None)
+    await asyncio.sleep(0)
+    assert started == ["light"]
+    # Nobody else is waiting, so the heavy user still gets the deployment rather than leaving it idle
+    scheduler.release(await tasks[1], None)
+    await asyncio.sleep(0)
+    assert started == ["light", "heavy"]
+    assert scheduler.stats()["dispatched_over_budget"] == 1
+
+
+@pytest.mark.asyncio
+async def test_release_settles_the_actual_usage():
+    clock = FakeClock()
+    scheduler = FairShareScheduler(tokens_per_minute=600, clock=clock)
+    ticket = await scheduler.acquire("user1", MESSAGES, 100)
+    assert ticket.share.balance == 400
+    scheduler.release(ticket, usage(200, 50))
+    assert ticket.share.balance == 350
+    # Prompts turned out to take more tokens per character than assumed
+    assert scheduler.tokens_per_char == pytest.approx(0.275)
+
+    clock.now = 60.0
+    ticket = await scheduler.acquire("user1", MESSAGES, 100)
+    # The bucket refilled up to its burst size before the call was charged
+    assert ticket.share.balance == 600 - ticket.estimated_tokens
+    assert ticket.estimated_tokens == 210
+
+
+@pytest.mark.asyncio
+async def test_cancelled_calls_leave_the_queue():
+    scheduler = FairShareScheduler(max_concurrency=1, clock=FakeClock())
+    first = await scheduler.acquire("user1", MESSAGES, 100)
+    started = []
+    cancelled, waiting = await queue_calls(scheduler, ["user2", "user3"], started)
+    cancelled.cancel()
+    await asyncio.sleep(0)
+    assert scheduler.stats()["waiting"] == 1
+
+    scheduler.release(first, None)
+    await waiting
+    assert started == ["user3"]
+    assert scheduler.stats()["in_flight"] == 1
+
+
+@pytest.mark.asyncio
+async def test_release_right_after_a_cancel_skips_the_cancelled_call():
+    scheduler = FairShareScheduler(max_concurrency=1, clock=FakeClock())
+    first = await scheduler.acquire("user1", MESSAGES, 100)
+    started = []
+    (cancelled,) = await queue_calls(scheduler, ["user2"], started)
+    cancelled.cancel()
+    # Released before the cancelled call's task gets to leave the queue
+    scheduler.release(first, None)
+    assert scheduler.stats()["in_flight"] == 0
+    with pytest.raises(asyncio.CancelledError):
+        await cancelled
+    assert scheduler.stats()["waiting"] == 0
+
+    await scheduler.acquire("user3", MESSAGES, 100)
+    assert scheduler.stats()["in_flight"] == 1
+
+
+@pytest.mark.asyncio
+async def test_stats_only_report_totals():
+    scheduler = FairShareScheduler(clock=FakeClock())
+    for oid, completion_tokens in [("user1", 10), ("user2", 500), ("user3", 50)]:
+        scheduler.release(await scheduler.acquire(oid, MESSAGES, 100), usage(100, completion_tokens))
+    stats = scheduler.stats()
+    assert stats["users"] == 3
+    assert stats["requests"] == 3
+    assert stats["total_tokens"] == 860
+    assert "user2" not in str(stats)
+
+    user_stats = scheduler.user_stats("user2")
+    assert user_stats["total_tokens"] == 600
+    assert user_stats["requests"] == 1
+    assert scheduler.user_stats("user4") is None
+
+
+def test_scheduler_requires_valid_limits():
+    with pytest.raises(ValueError):
+        FairShareScheduler(max_concurrency=0)
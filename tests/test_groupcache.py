@@ -0,0 +1,105 @@
+import asyncio
+import time
+
+import pytest
+
+from core.authentication import AuthenticationHelper
+from core.groupcache import GroupMembershipCache
+
+from .mocks import FakeClock, MockGraphServer
+from .test_authenticationhelper import create_authentication_helper
+
+MANY_GROUPS = [f"GROUP_{i}" for i in range(300)]
+
+
+@pytest.mark.asyncio
+async def test_list_groups_pages_through_graph():
+    async with MockGraphServer({"MockToken": MANY_GROUPS}, max_page_size=100) as graph:
+        groups = await AuthenticationHelper.list_groups({"access_token": "MockToken"}, graph.endpoint)
+        assert groups == MANY_GROUPS
+        assert len(graph.requests) == 3
+
+    # Graph returns up to 999 groups per page, which covers most users with a single call
+    async with MockGraphServer({"MockToken": MANY_GROUPS}) as graph:
+        assert await AuthenticationHelper.list_groups({"access_token": "MockToken"}, graph.endpoint) == MANY_GROUPS
+        assert len(graph.requests) == 1
+
+
+@pytest.mark.asyncio
+async def test_stale_groups_are_refreshed_in_background():
+    clock = FakeClock()
+    cache = GroupMembershipCache(ttl_seconds=300, max_stale_seconds=3600, clock=clock)
+    groups = {"MockToken": ["GROUP_Y"]}
+
+    async with MockGraphServer(groups, latency_seconds=0.05) as graph:
+
+        async def get_groups():
+            return await cache.get_or_fetch(
+                "OID_X", lambda: AuthenticationHelper.list_groups({"access_token": "MockToken"}, graph.endpoint)
+            )
+
+        assert await get_groups() == ["GROUP_Y"]
+        clock.now += 100
+        assert await get_groups() == ["GROUP_Y"]
+        assert len(graph.requests) == 1
+
+        # Stale groups are returned right away, while newer ones are fetched for later requests
+        groups["MockToken"] = ["GROUP_Y", "GROUP_Z"]
+        clock.now += 300
+        start_time = time.monotonic()
+        assert await get_groups() == ["GROUP_Y"]
+        assert await get_groups() == ["GROUP_Y"]
+        assert time.monotonic() - start_time < 0.05
+        await asyncio.sleep(0.1)
+        assert await get_groups() == ["GROUP_Y", "GROUP_Z"]
+        assert len(graph.requests) == 2
+
+        # Groups that are too old are fetched again before they are used
+        groups["MockToken"] = ["GROUP_Z"]
+        clock.now += 3600
+        assert await get_groups() == ["GROUP_Z"]
+        assert len(graph.requests) == 3
+
+        stats = cache.stats()
+        assert stats["stale_hits"] == 2
+        assert stats["background_refreshes"] == 1
+        await cache.close()
+
+
+@pytest.mark.asyncio
+async def test_failed_background_refresh_keeps_stale_groups():
+    clock = FakeClock()
+    cache = GroupMembershipCache(ttl_seconds=300, clock=clock)
+
+    async def fetch_groups():
+        return ["GROUP_Y"]
+
+    async def fail():
+        raise Exception("Graph is unavailable")
+
+    assert await cache.get_or_fetch("OID_X", fetch_groups) == ["GROUP_Y"]
+    clock.now += 400
+    assert await cache.get_or_fetch("OID_X", fail) == ["GROUP_Y"]
+    await asyncio.sleep(0.01)
+    assert await cache.get_or_fetch("OID_X", fail) == ["GROUP_Y"]
+    await asyncio.sleep(0.01)
+    assert cache.stats()["background_refresh_failures"] == 2
+
+
+@pytest.mark.asyncio
+async def test_get_auth_claims_overage_uses_group_cache(
+    monkeypatch, mock_confidential_client_overage, mock_validate_token_success
+):
+    async with MockGraphServer({"MockToken": MANY_GROUPS}, latency_seconds=0.01) as graph:
+        helper = create_authentication_helper()
+        helper.graph_endpoint = graph.endpoint
+        helper.group_cache = GroupMembershipCache()
+
+        # Every new access token needs a new token exchange, but the groups of the user are only read once
+        results = await asyncio.gather(
+            *(helper.get_auth_claims_if_enabled(headers={"Authorization": f"Bearer Token{i}"}) for i in range(5))
+        )
+        assert all(auth_claims == {"oid": "OID_X", "groups": MANY_GROUPS} for auth_claims in results)
+        assert len(graph.requests) == 1
+        assert helper.group_cache.stats()["coalesced"] == 4
+        await helper.close()
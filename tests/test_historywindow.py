@@ -0,0 +1,120 @@
+import asyncio
+
+import pytest
+
+from approaches.historywindow import HISTORY_SUMMARY_PREFIX, HistoryManager
+
+
+def make_history(turns: int, words: int = 20) -> list:
+    history = []
+    for turn in range(turns):
+        # " word" is one token in cl100k_base
+        history.append({"role": "user", "content": f"question {turn}:" + " word" * words})
+        history.append({"role": "assistant", "content": f"answer {turn}:" + " word" * words})
+    return history
+
+
+class FakeSummarizer:
+    def __init__(self):
+        self.calls = []
+
+    async def __call__(self, summary, messages):
+        self.calls.append((summary, messages))
+        return f"summary of {len(messages)} messages"
+
+
+@pytest.mark.asyncio
+async def test_short_history_is_kept_whole():
+    manager = HistoryManager(rewrite_max_tokens=500, answer_max_tokens=1000)
+    history = make_history(2)
+    summarize = FakeSummarizer()
+    window = await manager.get_window(history, "key", summarize)
+    assert window.answer_messages == history
+    assert window.rewrite_messages == history
+    assert window.summary is None
+    assert summarize.calls == []
+    assert manager.stats()["trimmed"] == 0
+
+
+@pytest.mark.asyncio
+async def test_long_history_is_summarized():
+    manager = HistoryManager(rewrite_max_tokens=200, answer_max_tokens=400, max_turns=6, summary_max_tokens=100)
+    history = make_history(10)
+    summarize = FakeSummarizer()
+    window = await manager.get_window(history, "key", summarize)
+
+    # Each message takes about 28 tokens, so 10 of them fit next to the summary
+    assert window.summarized_messages == 10
+    assert window.answer_messages[0] == {"role": "system", "content": HISTORY_SUMMARY_PREFIX + "summary of 10 messages"}
+    assert window.answer_messages[1:] == history[10:]
+    assert window.answer_messages[1]["role"] == "user"
+    # The query rewrite prompt gets fewer of the latest turns, with the same summary
+    assert window.rewrite_messages[0] == window.answer_messages[0]
+    assert window.rewrite_messages[1:] == history[18:]
+    assert summarize.calls == [(None, history[:10])]
+
+
+@pytest.mark.asyncio
+async def test_max_turns_limits_window():
+    manager = HistoryManager(rewrite_max_tokens=1000, answer_max_tokens=2000, max_turns=2)
+    window = await manager.get_window(make_history(4), "key", FakeSummarizer())
+    assert window.summarized_messages == 4
+    assert len(window.answer_messages) == 5
+
+
+@pytest.mark.asyncio
+async def test_summary_is_reused_then_rolled():
+    manager = HistoryManager(rewrite_max_tokens=1000, answer_max_tokens=2000, max_turns=2)
+    summarize = FakeSummarizer()
+    history = make_history(4)
+    await manager.get_window(history, "key", summarize)
+    window = await manager.get_window(history, "key", summarize)
+    assert window.summary_reused is True
+    assert len(summarize.calls) == 1
+
+    # The next turn only summarizes the turn that dropped out of the window
+    history += make_history(5)[8:]
+    window = await manager.get_window(history, "key", summarize)
+    assert window.summarized_messages == 6
+    assert summarize.calls[1] == ("summary of 4 messages", history[4:6])
+    stats = manager.stats()
+    assert stats["summaries_reused"] == 1
+    assert stats["summaries_rolled"] == 1
+    assert stats["summaries_computed"] == 2
+
+
+@pytest.mark.asyncio
+async def test_edited_history_is_summarized_again():
+    manager = HistoryManager(rewrite_max_tokens=1000, answer_max_tokens=2000, max_turns=2)
+    summarize = FakeSummarizer()
+    history = make_history(4)
+    await manager.get_window(history, "key", summarize)
+    edited = [{"role": "user", "content": "another question"}] + history[1:]
+    window = await manager.get_window(edited, "key", summarize)
+    assert window.summary_reused is False
+    assert summarize.calls[1] == (None, edited[:4])
+
+
+@pytest.mark.asyncio
+async def test_concurrent_summaries_are_coalesced():
+    manager = HistoryManager(rewrite_max_tokens=1000, answer_max_tokens=2000, max_turns=2)
+    summarize = FakeSummarizer()
+    history = make_history(4)
+    windows = await asyncio.gather(*(manager.get_window(history, "key", summarize) for _ in range(3)))
+    assert len(summarize.calls) == 1
+    assert all(window.summary == "summary of 4 messages" for window in windows)
+    assert manager.stats()["summaries_coalesced"] == 2
+
+
+def test_build_key():
+    manager = HistoryManager()
+    history = make_history(2)
+    assert manager.build_key("oid1", "session1", history) == "oid1:session1"
+    # Without a session, conversations that started differently don't share a summary
+    assert manager.build_key(None, None, history) == manager.build_key(None, None, history[:1])
+    assert manager.build_key(None, None, history) != manager.build_key(None, None, history[1:])
+
+
+def test_manager_requires_valid_budgets():
+    with pytest.raises(ValueError):
+        HistoryManager(rewrite_max_tokens=300, summary_max_tokens=300)
@@ -0,0 +1,57 @@
+import asyncio
+
+import pytest
+
+from core.authentication import AuthenticationHelper
+from core.httpsession import HttpSessionPool
+
+from .mocks import MockGraphServer
+
+GRAPH_TOKEN = {"access_token": "MockToken"}
+
+
+@pytest.mark.asyncio
+async def test_list_groups_reuses_connections():
+    async with MockGraphServer({"MockToken": ["group1", "group2", "group3"]}, max_page_size=1) as graph:
+        pool = HttpSessionPool()
+        try:
+            for _ in range(2):
+                groups = await AuthenticationHelper.list_groups(
+                    GRAPH_TOKEN, graph_endpoint=graph.endpoint, session=pool.session
+                )
+                assert groups == ["group1", "group2", "group3"]
+        finally:
+            await pool.close()
+
+    stats = pool.stats()
+    assert len(graph.requests) == 6
+    assert stats["requests"] == 6
+    assert stats["connections_created"] == 1
+    assert stats["connections_reused"] == 5
+    assert stats["pool_wait"]["count"] == 0
+
+
+@pytest.mark.asyncio
+async def test_requests_wait_for_a_free_connection():
+    async with MockGraphServer({"MockToken": ["group1"]}, latency_seconds=0.05) as graph:
+        pool = HttpSessionPool(limit_per_host=1)
+        try:
+            await asyncio.gather(
+                *(
+                    AuthenticationHelper.list_groups(GRAPH_TOKEN, graph_endpoint=graph.endpoint, session=pool.session)
+                    for _ in range(3)
+                )
+            )
+        finally:
+            await pool.close()
+
+    stats = pool.stats()
+    assert stats["connections_created"] == 1
+    assert stats["pool_wait"]["count"] == 2
+    assert stats["pool_wait"]["max_ms"] >= 50
+
+
+@pytest.mark.asyncio
+async def test_list_groups_without_shared_session():
+    async with MockGraphServer({"MockToken": ["group1"]}) as graph:
+        assert await AuthenticationHelper.list_groups(GRAPH_TOKEN, graph_endpoint=graph.endpoint) == ["group1"]
@@ -0,0 +1,16 @@
+from core.metrics import LatencyRecorder
+
+
+def test_latency_recorder():
+    recorder = LatencyRecorder(max_samples=4)
+    assert recorder.stats() == {"count": 0, "mean_ms": 0.0, "p50_ms": 0.0, "p95_ms": 0.0, "max_ms": 0.0}
+
+    for seconds in [0.5, 0.1, 0.2, 0.3, 0.4]:
+        recorder.record(seconds)
+    stats = recorder.stats()
+    assert stats["count"] == 5
+    assert stats["mean_ms"] == 300.0
+    assert stats["max_ms"] == 500.0
+    # Percentiles only cover the most recent samples
+    assert stats["p50_ms"] == 200.0
+    assert stats["p95_ms"] == 400.0
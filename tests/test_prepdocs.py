@@ -7,6 +7,8 @@ import tenacity
 from httpx import Request, Response
 from openai.types.create_embedding_response import Usage
 
+from core.admission import ADMISSION_REJECTED_CODE
+
 from .mocks import (
     MOCK_EMBEDDING_DIMENSIONS,
     MOCK_EMBEDDING_MODEL_NAME,
@@ -178,6 +180,44 @@ async def test_compute_embedding_ratelimiterror_single(monkeypatch, caplog):
         assert caplog.text.count("Rate limited on the OpenAI embeddings API") == 14
 
 
+class AdmissionRejectedMockEmbeddingsClient:
+    def __init__(self):
+        self.calls = 0
+
+    async def create(self, *args, **kwargs) -> openai.types.CreateEmbeddingResponse:
+        self.calls += 1
+        raise openai.RateLimitError(
+            message="Too many calls to openai",
+            response=Response(
+                429, headers={"retry-after": "5"}, request=Request(method="post", url="https://foo.bar/")
+            ),
+            body={"code": ADMISSION_REJECTED_CODE, "message": "Too many calls to openai"},
+        )
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("disable_batch", [False, True])
+async def test_compute_embedding_admission_rejected_is_not_retried(monkeypatch, disable_batch):
+    embeddings_client = AdmissionRejectedMockEmbeddingsClient()
+
+    async def create_admission_rejected_client(*args, **kwargs):
+        return MockClient(embeddings_client=embeddings_client)
+
+    embeddings = AzureOpenAIEmbeddingService(
+        open_ai_service="x",
+        open_ai_deployment="x",
+        open_ai_model_name=MOCK_EMBEDDING_MODEL_NAME,
+        open_ai_dimensions=MOCK_EMBEDDING_DIMENSIONS,
+        open_ai_api_version="test-api-version",
+        credential=MockAzureCredential(),
+        disable_batch=disable_batch,
+    )
+    monkeypatch.setattr(embeddings, "create_client", create_admission_rejected_client)
+    with pytest.raises(openai.RateLimitError):
+        await embeddings.create_embeddings(texts=["foo"])
+    assert embeddings_client.calls == 1
+
+
 class AuthenticationErrorMockEmbeddingsClient:
     async def create(self, *args, **kwargs) -> openai.types.CreateEmbeddingResponse:
         raise openai.AuthenticationError(message="Bad things happened.", response=fake_response(403), body=None)
@@ -77,6 +77,7 @@ async def test_file_strategy_adls2(monkeypatch, mock_env, mock_data_lake_service
             "oids": ["A-USER-ID"],
             "sourcepage": "a.txt",
             "sourcefile": "a.txt",
+            "tokenCount": 2,
             "storageUrl": "https://test.blob.core.windows.net/a.txt",
         },
         {
@@ -87,6 +88,7 @@ async def test_file_strategy_adls2(monkeypatch, mock_env, mock_data_lake_service
             "oids": ["B-USER-ID"],
             "sourcepage": "b.txt",
             "sourcefile": "b.txt",
+            "tokenCount": 2,
             "storageUrl": "https://test.blob.core.windows.net/b.txt",
         },
         {
@@ -97,6 +99,7 @@ async def test_file_strategy_adls2(monkeypatch, mock_env, mock_data_lake_service
             "oids": ["C-USER-ID"],
             "sourcepage": "c.txt",
             "sourcefile": "c.txt",
+            "tokenCount": 2,
             "storageUrl": "https://test.blob.core.windows.net/c.txt",
         },
     ]
@@ -0,0 +1,137 @@
+import asyncio
+
+import pytest
+
+from approaches.requestcoalescer import RequestCoalescer
+
+QUESTION = [{"role": "user", "content": "What is the capital of France?"}]
+
+
+class FakeApproach:
+    def __init__(self, error: Exception = None):
+        self.runs = 0
+        self.stream_closed = asyncio.Event()
+        self.release = asyncio.Event()
+        self.error = error
+
+    def build_filter(self, overrides, auth_claims):
+        return f"oids/any(g:search.in(g, '{auth_claims['oid']}'))" if overrides.get("use_oid_security_filter") else None
+
+    async def run(self, messages, session_state=None, context={}):
+        self.runs += 1
+        await self.release.wait()
+        return {"message": {"content": "Paris", "role": "assistant"}, "session_state": session_state}
+
+    async def run_stream(self, messages, session_state=None, context={}):
+        self.runs += 1
+        return self.stream(session_state)
+
+    async def stream(self, session_state):
+        try:
+            yield {"delta": {"role": "assistant"}, "context": {"data_points": []}, "session_state": session_state}
+            yield {"delta": {"content": "Par", "role": "assistant"}}
+            await self.release.wait()
+            if self.error:
+                raise self.error
+            yield {"delta": {"content": "is", "role": "assistant"}}
+        finally:
+            self.stream_closed.set()
+
+
+async def read_all(events):
+    return [event async for event in events]
+
+
+@pytest.mark.asyncio
+async def test_concurrent_identical_requests_share_one_run():
+    coalescer = RequestCoalescer()
+    approach = FakeApproach()
+    context = {"overrides": {"top": 3}, "auth_claims": {"oid": "user1"}}
+    first = asyncio.create_task(coalescer.run(approach, QUESTION, context, "session1"))
+    second = asyncio.create_task(
+        coalescer.run(approach, QUESTION, {"overrides": {"top": 3}, "auth_claims": {"oid": "user2"}}, "session2")
+    )
+    await asyncio.sleep(0)
+    approach.release.set()
+
+    assert (await first)["session_state"] == "session1"
+    assert (await second)["session_state"] == "session2"
+    assert (await first)["message"] == (await second)["message"]
+    assert approach.runs == 1
+    assert coalescer.stats()["saved_runs"] == 1
+
+
+@pytest.mark.asyncio
+async def test_personalized_requests_are_not_coalesced():
+    coalescer = RequestCoalescer()
+    approach = FakeApproach()
+    approach.release.set()
+    overrides = {"use_oid_security_filter": True}
+    await asyncio.gather(
+        coalescer.run(approach, QUESTION, {"overrides": overrides, "auth_claims": {"oid": "user1"}}),
+        coalescer.run(approach, QUESTION, {"overrides": overrides, "auth_claims": {"oid": "user2"}}),
+    )
+    assert approach.runs == 2
+
+    history = [{"role": "user", "content": "Hi"}, {"role": "assistant", "content": "Hello"}] + QUESTION
+    await asyncio.gather(coalescer.run(approach, history, {}), coalescer.run(approach, history, {}))
+    assert approach.runs == 4
+    assert coalescer.stats()["skipped"] == 2
+    assert coalescer.stats()["saved_runs"] == 0
+
+
+@pytest.mark.asyncio
+async def test_streams_fan_out_to_late_requests():
+    coalescer = RequestCoalescer()
+    approach = FakeApproach()
+    first = await coalescer.run_stream(approach, QUESTION, {}, "session1")
+    assert (await first.__anext__())["session_state"] == "session1"
+    assert (await first.__anext__())["delta"]["content"] == "Par"
+
+    # The second request attaches while the answer is being generated and still gets all of it
+    second = await coalescer.run_stream(approach, QUESTION, {}, "session2")
+    second_events = asyncio.create_task(read_all(second))
+    approach.release.set()
+    first_events = await read_all(first)
+
+    assert first_events == [{"delta": {"content": "is", "role": "assistant"}}]
+    assert [event["delta"].get("content") for event in await second_events] == [None, "Par", "is"]
+    assert (await second_events)[0]["session_state"] == "session2"
+    assert approach.runs == 1
+    assert coalescer.stats()["streams_coalesced"] == 1
+    assert coalescer.stats()["streams_in_flight"] == 0
+
+
+@pytest.mark.asyncio
+async def test_stream_keeps_running_until_last_request_leaves():
+    coalescer = RequestCoalescer()
+    approach = FakeApproach()
+    first = await coalescer.run_stream(approach, QUESTION, {}, "session1")
+    second = await coalescer.run_stream(approach, QUESTION, {}, "session2")
+    await first.__anext__()
+    await second.__anext__()
+
+    await first.aclose()
+    await asyncio.sleep(0)
+    assert not approach.stream_closed.is_set()
+
+    await second.aclose()
+    await asyncio.wait_for(approach.stream_closed.wait(), timeout=1)
+
+    # A new request after everyone left starts a new answer
+    third = await coalescer.run_stream(approach, QUESTION, {}, "session3")
+    approach.release.set()
+    assert len(await read_all(third)) == 3
+    assert approach.runs == 2
+
+
+@pytest.mark.asyncio
+async def test_stream_errors_reach_every_request():
+    coalescer = RequestCoalescer()
+    approach = FakeApproach(error=ValueError("The model went away"))
+    first = await coalescer.run_stream(approach, QUESTION, {}, "session1")
+    second = await coalescer.run_stream(approach, QUESTION, {}, "session2")
+    approach.release.set()
+    for events in (first, second):
+        with pytest.raises(ValueError):
+            await read_all(events)
@@ -0,0 +1,123 @@
+import pytest
+from azure.core.credentials import AzureKeyCredential
+from azure.search.documents.aio import SearchClient
+from azure.search.documents.models import VectorizedQuery
+
+from approaches.approach import Document
+from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
+from approaches.promptmanager import PromptyManager
+from approaches.searchcache import SearchResultCache
+
+from .mocks import (
+    MOCK_EMBEDDING_DIMENSIONS,
+    MOCK_EMBEDDING_MODEL_NAME,
+    MockAsyncSearchResultsIterator,
+)
+
+
+def build_key(cache, **kwargs):
+    args = {
+        "search_text": "test query",
+        "filter": None,
+        "vectors": [VectorizedQuery(vector=[0.1, 0.2], k_nearest_neighbors=50, fields="embedding")],
+        "top": 3,
+        "use_semantic_ranker": True,
+        "use_semantic_captions": False,
+        "use_query_rewriting": False,
+        "query_language": "he-il",
+    }
+    return cache.build_key(**(args | kwargs))
+
+
+def test_build_key_covers_query_parameters():
+    cache = SearchResultCache()
+    key = build_key(cache)
+    assert build_key(cache) == key
+    assert build_key(cache, search_text="other query") != key
+    assert build_key(cache, filter="category ne 'x'") != key
+    assert build_key(cache, top=5) != key
+    assert build_key(cache, use_semantic_captions=True) != key
+    assert build_key(cache, use_query_rewriting=True) != key
+    assert (
+        build_key(cache, vectors=[VectorizedQuery(vector=[0.1, 0.3], k_nearest_neighbors=50, fields="embedding")])
+        != key
+    )
+
+
+def test_bump_generation_drops_old_results():
+    cache = SearchResultCache()
+    key = build_key(cache)
+    cache.store(key, [Document(id="1", content="content")])
+    assert cache.get(key)[0].id == "1"
+
+    cache.bump_generation()
+    assert cache.get(build_key(cache)) is None
+    assert cache.stats()["generation"] == 1
+
+
+def test_stats_reports_memory_footprint():
+    cache = SearchResultCache()
+    cache.store(build_key(cache), [Document(id="1", content="a" * 1000), Document(id="2", content="b" * 1000)])
+    stats = cache.stats()
+    assert stats["entries"] == 1
+    assert stats["estimated_bytes"] > 2000
+
+
+@pytest.mark.asyncio
+async def test_search_uses_cache(monkeypatch):
+    calls = []
+
+    async def mock_search(*args, **kwargs):
+        calls.append(kwargs)
+        return MockAsyncSearchResultsIterator(kwargs.get("search_text"), kwargs.get("vector_queries"))
+
+    monkeypatch.setattr(SearchClient, "search", mock_search)
+
+    chat_approach = ChatReadRetrieveReadApproach(
+        search_client=SearchClient(endpoint="", index_name="", credential=AzureKeyCredential("")),
+        search_index_name=None,
+        agent_model=None,
+        agent_deployment=None,
+        agent_client=None,
+        auth_helper=None,
+        openai_client=None,
+        chatgpt_model="gpt-4.1-mini",
+        chatgpt_deployment="chat",
+        embedding_deployment="embeddings",
+        embedding_model=MOCK_EMBEDDING_MODEL_NAME,
+        embedding_dimensions=MOCK_EMBEDDING_DIMENSIONS,
+        embedding_field="embedding3",
+        sourcepage_field="",
+        content_field="",
+        query_language="en-us",
+        query_speller="lexicon",
+        prompt_manager=PromptyManager(),
+        search_cache=SearchResultCache(),
+    )
+
+    async def search(minimum_search_score=0):
+        return await chat_approach.search(
+            top=10,
+            query_text="test query",
+            filter=None,
+            vectors=[],
+            use_text_search=True,
+            use_vector_search=True,
+            use_semantic_ranker=True,
+            use_semantic_captions=True,
+            minimum_search_score=minimum_search_score,
+            minimum_reranker_score=0,
+        )
+
+    first_results = await search()
+    second_results = await search()
+    assert len(calls) == 1
+    assert [document.id for document in second_results] == [document.id for document in first_results]
+
+    # Score thresholds are applied to cached results rather than being part of the key
+    assert await search(minimum_search_score=100) == []
+    assert len(calls) == 1
+
+    chat_approach.search_cache.bump_generation()
+    await search()
+    assert len(calls) == 2
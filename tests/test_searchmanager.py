@@ -53,7 +53,7 @@ async def test_create_index_doesnt_exist_yet(monkeypatch, search_info):
     await manager.create_index()
     assert len(indexes) == 1, "It should have created one index"
     assert indexes[0].name == "test"
-    assert len(indexes[0].fields) == 6
+    assert len(indexes[0].fields) == 7
 
 
 @pytest.mark.asyncio
@@ -78,7 +78,7 @@ async def test_create_index_using_int_vectorization(monkeypatch, search_info):
     await manager.create_index()
     assert len(indexes) == 1, "It should have created one index"
     assert indexes[0].name == "test"
-    assert len(indexes[0].fields) == 7
+    assert len(indexes[0].fields) == 8
 
 
 @pytest.mark.asyncio
@@ -100,7 +100,8 @@ async def test_create_index_does_exist(monkeypatch, search_info):
                     name="storageUrl",
                     type=SearchFieldDataType.String,
                     filterable=True,
-                )
+                ),
+                SimpleField(name="tokenCount", type=SearchFieldDataType.Int32),
             ],
         )
 
@@ -146,9 +147,8 @@ async def test_create_index_add_field(monkeypatch, search_info):
     manager = SearchManager(search_info)
     await manager.create_index()
     assert len(created_indexes) == 0, "It should not have created a new index"
-    assert len(updated_indexes) == 1, "It should have updated the existing index"
-    assert len(updated_indexes[0].fields) == 1
-    assert updated_indexes[0].fields[0].name == "storageUrl"
+    assert len(updated_indexes) == 2, "It should have updated the existing index once per missing field"
+    assert [field.name for field in updated_indexes[-1].fields] == ["storageUrl", "tokenCount"]
 
 
 @pytest.mark.asyncio
@@ -173,7 +173,7 @@ async def test_create_index_acls(monkeypatch, search_info):
     await manager.create_index()
     assert len(indexes) == 1, "It should have created one index"
     assert indexes[0].name == "test"
-    assert len(indexes[0].fields) == 8
+    assert len(indexes[0].fields) == 9
 
 
 @pytest.mark.asyncio
@@ -185,6 +185,7 @@ async def test_update_content(monkeypatch, search_info):
         assert documents[0]["category"] == "test"
         assert documents[0]["sourcepage"] == "foo.pdf#page=1"
         assert documents[0]["sourcefile"] == "foo.pdf"
+        assert documents[0]["tokenCount"] == 2
 
     monkeypatch.setattr(SearchClient, "upload_documents", mock_upload_documents)
 
@@ -208,6 +209,24 @@ async def test_update_content(monkeypatch, search_info):
     )
 
 
+@pytest.mark.asyncio
+async def test_update_content_notifies_content_changed(monkeypatch, search_info):
+    async def mock_upload_documents(self, documents):
+        pass
+
+    monkeypatch.setattr(SearchClient, "upload_documents", mock_upload_documents)
+
+    changes = []
+    manager = SearchManager(search_info, on_content_changed=lambda: changes.append(True))
+
+    test_io = io.BytesIO(b"test content")
+    test_io.name = "test/foo.pdf"
+    file = File(test_io)
+
+    await manager.update_content([Section(split_page=SplitPage(page_num=0, text="test content"), content=file)])
+    assert changes == [True]
+
+
 @pytest.mark.asyncio
 async def test_update_content_many(monkeypatch, search_info):
     ids = []
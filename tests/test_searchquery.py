@@ -0,0 +1,42 @@
+import pytest
+
+from approaches.searchquery import (
+    build_search_query,
+    hebrew_word_forms,
+    strip_hebrew_prefix,
+)
+
+
+@pytest.mark.parametrize(
+    "question, expected_query",
+    [
+        ("What is the deductible for the Northwind Health Plus plan?", "deductible northwind health plus plan"),
+        ("מה ההבדל בין התוכנית והמסלול הבסיסי?", "ההבדל התוכנית מסלול הבסיסי"),
+        ("וכמה ימי חופשה מגיעים לי?", "ימי חופשה מגיעים"),
+        ("מָה הַתּוֹכְנִית?", "התוכנית"),
+        # Roots that start with ו are searched as they are, and without the ו in case it meant "and"
+        ("מה החליטה ועדת הכספים?", "החליטה ועדת עדת הכספים"),
+        ("Plan plan PLAN", "plan"),
+        ("What is it?", ""),
+    ],
+)
+def test_build_search_query(question, expected_query):
+    assert build_search_query(question) == expected_query
+
+
+def test_strip_hebrew_prefix():
+    assert strip_hebrew_prefix("והמסלול") == "מסלול"
+    # "And" on its own is never stripped, since many roots start with ו
+    assert strip_hebrew_prefix("ועדת") == "ועדת"
+    # Too short to carry a prefix
+    assert strip_hebrew_prefix("ועד") == "ועד"
+    # Only conjunction prefixes are stripped
+    assert strip_hebrew_prefix("משכורת") == "משכורת"
+    assert strip_hebrew_prefix("vacation") == "vacation"
+
+
+def test_hebrew_word_forms():
+    assert hebrew_word_forms("והמסלול") == ["מסלול"]
+    assert hebrew_word_forms("ועדת") == ["ועדת", "עדת"]
+    assert hebrew_word_forms("ועד") == ["ועד"]
+    assert hebrew_word_forms("משכורת") == ["משכורת"]
@@ -0,0 +1,136 @@
+import threading
+
+import pytest
+from azure.cognitiveservices.speech import SpeechConfig
+
+import core.speechsynthesis
+from core.speechsynthesis import (
+    SpeechAudioCache,
+    SpeechSynthesisError,
+    SpeechSynthesisService,
+)
+
+from .mocks import MockAudio, MockAudioCancelled, MockSynthesisResult
+
+
+class MockEventSignal:
+    def __init__(self):
+        self.callbacks = []
+
+    def connect(self, callback):
+        self.callbacks.append(callback)
+
+
+class MockSynthesisEvent:
+    def __init__(self, audio_data):
+        self.result = MockAudio(audio_data)
+
+
+class MockStreamingSynthesizer:
+    """
+    Reports the audio in pieces from another thread, like the Speech SDK does while a synthesis is running
+    """
+
+    pieces = [b"ab", b"cd", b"ef"]
+    calls = 0
+
+    def __init__(self, speech_config, audio_config):
+        self.synthesizing = MockEventSignal()
+
+    def speak_text_async(self, text):
+        MockStreamingSynthesizer.calls += 1
+
+        def report_pieces():
+            for piece in self.pieces:
+                for callback in self.synthesizing.callbacks:
+                    callback(MockSynthesisEvent(piece))
+
+        thread = threading.Thread(target=report_pieces)
+        thread.start()
+        thread.join()
+        return MockSynthesisResult(MockAudio(b"".join(self.pieces)))
+
+
+@pytest.fixture
+def speech_config():
+    speech_config = SpeechConfig(auth_token="aad#test-id#token", region="eastus")
+    speech_config.speech_synthesis_voice_name = "en-US-AndrewMultilingualNeural"
+    return speech_config
+
+
+@pytest.fixture
+def mock_streaming_synthesizer(monkeypatch):
+    MockStreamingSynthesizer.calls = 0
+    monkeypatch.setattr(core.speechsynthesis, "SpeechSynthesizer", MockStreamingSynthesizer)
+
+
+def test_audio_cache_key_covers_voice_and_text():
+    key = SpeechAudioCache.build_key("voice1", "text")
+    assert SpeechAudioCache.build_key("voice1", "text") == key
+    assert SpeechAudioCache.build_key("voice2", "text") != key
+    assert SpeechAudioCache.build_key("voice1", "other text") != key
+
+
+def test_audio_cache_evicts_least_recently_used_audio():
+    cache = SpeechAudioCache(max_bytes=10, max_audio_bytes=6)
+    cache.set("a", b"aaaa")
+    cache.set("b", b"bbbb")
+    cache.get("a")
+    cache.set("c", b"cccc")
+    assert cache.get("b") is None
+    assert cache.get("a") == b"aaaa"
+    assert cache.get("c") == b"cccc"
+
+    # Audio larger than the per-entry limit is never cached
+    cache.set("d", b"ddddddd")
+    assert cache.get("d") is None
+    stats = cache.stats()
+    assert stats["bytes"] == 8
+    assert stats["evictions"] == 1
+
+
+@pytest.mark.asyncio
+async def test_synthesize_streams_audio_pieces(speech_config, mock_streaming_synthesizer):
+    service = SpeechSynthesisService(max_workers=1)
+    try:
+        assert [chunk async for chunk in service.synthesize(speech_config, "text")] == [b"ab", b"cd", b"ef"]
+    finally:
+        service.close()
+    stats = service.stats()
+    assert stats["syntheses"] == 1
+    assert stats["failures"] == 0
+
+
+@pytest.mark.asyncio
+async def test_synthesize_uses_audio_cache(speech_config, mock_streaming_synthesizer):
+    service = SpeechSynthesisService(max_workers=1, audio_cache=SpeechAudioCache(max_bytes=100))
+    try:
+        assert [chunk async for chunk in service.synthesize(speech_config, "text")] == [b"ab", b"cd", b"ef"]
+        assert [chunk async for chunk in service.synthesize(speech_config, "text")] == [b"abcdef"]
+        assert MockStreamingSynthesizer.calls == 1
+
+        speech_config.speech_synthesis_voice_name = "en-US-AvaMultilingualNeural"
+        assert [chunk async for chunk in service.synthesize(speech_config, "text")] == [b"ab", b"cd", b"ef"]
+        assert MockStreamingSynthesizer.calls == 2
+    finally:
+        service.close()
+    assert service.stats()["audio_cache"]["hits"] == 1
+
+
+@pytest.mark.asyncio
+async def test_synthesize_failure_is_not_cached(speech_config, monkeypatch):
+    monkeypatch.setattr(
+        core.speechsynthesis.SpeechSynthesizer,
+        "speak_text_async",
+        lambda self, text: MockSynthesisResult(MockAudioCancelled(b"")),
+    )
+    cache = SpeechAudioCache(max_bytes=100)
+    service = SpeechSynthesisService(max_workers=1, audio_cache=cache)
+    try:
+        with pytest.raises(SpeechSynthesisError, match="Speech synthesis canceled"):
+            async for _ in service.synthesize(speech_config, "text"):
+                pass
+    finally:
+        service.close()
+    assert cache.stats()["entries"] == 0
+    assert service.stats()["failures"] == 1
@@ -0,0 +1,103 @@
+import asyncio
+import time
+
+import pytest
+
+from core.streamcoalescer import DeltaCoalescer
+
+
+def delta(content, role="assistant"):
+    return {"delta": {"content": content, "role": role}}
+
+
+async def stream(*events, delay_seconds=0.0):
+    for event in events:
+        if isinstance(event, float):
+            await asyncio.sleep(event)
+            continue
+        yield event
+        await asyncio.sleep(delay_seconds)
+
+
+@pytest.mark.asyncio
+async def test_coalesce_merges_deltas_and_flushes_context_right_away():
+    coalescer = DeltaCoalescer(window_seconds=10, max_chars=6)
+    context_event = {"delta": {"role": "assistant"}, "context": {"data_points": []}, "session_state": None}
+    events = [
+        event
+        async for event in coalescer.coalesce(
+            stream(context_event, delta(""), delta("The"), delta(" cap"), delta("ital"), delta(" of"), context_event)
+        )
+    ]
+    assert events == [
+        context_event,
+        # The first content is sent right away, together with the empty delta before it
+        delta("The"),
+        delta(" capital"),
+        delta(" of"),
+        context_event,
+    ]
+    assert coalescer.stats()["deltas"] == 5
+    assert coalescer.stats()["frames"] == 3
+
+
+@pytest.mark.asyncio
+async def test_coalesce_keeps_roles_apart():
+    coalescer = DeltaCoalescer(window_seconds=10, max_chars=100)
+    events = [event async for event in coalescer.coalesce(stream(delta("a"), delta("b"), delta("c", None), delta("d")))]
+    assert events == [delta("a"), delta("b"), delta("c", None), delta("d")]
+
+
+@pytest.mark.asyncio
+async def test_coalesce_flushes_after_window_while_model_is_silent():
+    coalescer = DeltaCoalescer(window_seconds=0.02, max_chars=100)
+    started_at = time.monotonic()
+    arrivals = []
+    async for event in coalescer.coalesce(stream(delta("a"), delta("b"), delta("c"), 0.5, delta("d"))):
+        arrivals.append((event["delta"]["content"], time.monotonic() - started_at))
+
+    assert [content for content, _ in arrivals] == ["a", "bc", "d"]
+    # The merged content didn't wait for the model to send more
+    assert arrivals[1][1] < 0.3
+    assert arrivals[2][1] >= 0.5
+
+
+@pytest.mark.asyncio
+async def test_coalesce_stops_waiting_when_client_goes_away():
+    source_closed = asyncio.Event()
+
+    async def slow_stream():
+        try:
+            yield delta("a")
+            yield delta("b")
+            await asyncio.sleep(10)
+            yield delta("c")
+        finally:
+            source_closed.set()
+
+    coalescer = DeltaCoalescer(window_seconds=0.01, max_chars=100)
+    events = coalescer.coalesce(slow_stream())
+    assert await events.__anext__() == delta("a")
+    assert await events.__anext__() == delta("b")
+    await events.aclose()
+    await asyncio.wait_for(source_closed.wait(), timeout=1)
+
+
+@pytest.mark.asyncio
+async def test_coalesce_raises_stream_errors_after_pending_content():
+    async def failing_stream():
+        yield delta("a")
+        yield delta("b")
+        raise ValueError("The model went away")
+
+    coalescer = DeltaCoalescer(window_seconds=10, max_chars=100)
+    events = []
+    with pytest.raises(ValueError):
+        async for event in coalescer.coalesce(failing_stream()):
+            events.append(event)
+    assert events == [delta("a"), delta("b")]
+
+
+def test_coalescer_requires_positive_limits():
+    with pytest.raises(ValueError):
+        DeltaCoalescer(window_seconds=0)
@@ -0,0 +1,103 @@
+import pytest
+
+from approaches.approach import DataPoints, ExtraInfo, ThoughtStep
+from approaches.thoughtstore import ThoughtStore
+
+
+async def answer_events(extra_info: ExtraInfo):
+    yield {"delta": {"role": "assistant"}, "context": extra_info, "session_state": "session"}
+    yield {"delta": {"content": "Paris", "role": "assistant"}}
+    # The context again once the token usage is known
+    extra_info.thoughts[-1].props["token_usage"] = {"total_tokens": 10}
+    yield {"delta": {"role": "assistant"}, "context": extra_info, "session_state": "session"}
+    yield {
+        "delta": {"role": "assistant"},
+        "context": {"context": extra_info, "followup_questions": ["What about Spain?"]},
+    }
+
+
+def create_extra_info() -> ExtraInfo:
+    return ExtraInfo(
+        DataPoints(text=["Benefit_Options-2.pdf: Paris"]),
+        thoughts=[ThoughtStep("Prompt to generate answer", ["a long prompt"], {"model": "gpt-4.1-mini"})],
+    )
+
+
+@pytest.mark.asyncio
+async def test_thoughts_are_only_returned_to_their_owner():
+    store = ThoughtStore()
+    thoughts_id = await store.store([ThoughtStep("Search results", [])], "user1")
+    assert (await store.get(thoughts_id, "user1"))[0].title == "Search results"
+    assert await store.get(thoughts_id, "user2") is None
+    assert await store.get(thoughts_id, None) is None
+    assert await store.get("unknown", "user1") is None
+
+
+@pytest.mark.asyncio
+async def test_thoughts_are_shared_through_the_directory(tmp_path):
+    # Two stores on the same directory, like two workers of one instance
+    store = ThoughtStore(directory=tmp_path)
+    other_store = ThoughtStore(directory=tmp_path)
+    thoughts_id = await store.store(create_extra_info().thoughts, "user1")
+
+    thoughts = await other_store.get(thoughts_id, "user1")
+    assert thoughts == [
+        {"title": "Prompt to generate answer", "description": ["a long prompt"], "props": {"model": "gpt-4.1-mini"}}
+    ]
+    assert other_store.stats()["file_hits"] == 1
+    assert await other_store.get(thoughts_id, "user2") is None
+    assert await other_store.get("../" + thoughts_id, "user1") is None
+
+
+@pytest.mark.asyncio
+async def test_expired_thoughts_are_not_read_from_the_directory(tmp_path):
+    store = ThoughtStore(ttl_seconds=0, directory=tmp_path)
+    thoughts_id = await store.store(create_extra_info().thoughts, "user1")
+    assert await ThoughtStore(directory=tmp_path).get(thoughts_id, "user1") is None
+
+
+@pytest.mark.asyncio
+async def test_compact_response():
+    store = ThoughtStore()
+    extra_info = create_extra_info()
+    extra_info.followup_questions = ["What about Spain?"]
+    response = {"message": {"content": "Paris", "role": "assistant"}, "context": extra_info, "session_state": None}
+
+    compact_response = await store.compact_response(response, "user1")
+    assert compact_response["message"] == response["message"]
+    assert compact_response["context"]["data_points"] is extra_info.data_points
+    assert compact_response["context"]["followup_questions"] == ["What about Spain?"]
+    assert await store.get(compact_response["context"]["thoughts_id"], "user1") == extra_info.thoughts
+
+    # Responses without a context, like errors, are passed on as they are
+    assert await store.compact_response({"error": "error"}, "user1") == {"error": "error"}
+
+
+@pytest.mark.asyncio
+async def test_compact_events_only_send_changes():
+    store = ThoughtStore()
+    events = [event async for event in store.compact_events(answer_events(create_extra_info()), "user1")]
+
+    assert len(events) == 3
+    thoughts_id = events[0]["context"]["thoughts_id"]
+    assert events[0]["context"]["data_points"].text == ["Benefit_Options-2.pdf: Paris"]
+    assert events[0]["session_state"] == "session"
+    assert events[1] == {"delta": {"content": "Paris", "role": "assistant"}}
+    assert events[2]["context"] == {"followup_questions": ["What about Spain?"]}
+
+    thoughts = await store.get(thoughts_id, "user1")
+    assert thoughts[-1].props["token_usage"] == {"total_tokens": 10}
+    assert store.stats()["skipped_events"] == 1
+
+
+@pytest.mark.asyncio
+async def test_compact_events_keep_progress_events():
+    async def progress_events():
+        extra_info = create_extra_info()
+        yield {"delta": {"role": "assistant"}, "context": extra_info, "progress": {"stage": "data_points"}}
+        yield {"delta": {"role": "assistant"}, "context": extra_info, "progress": {"stage": "answer"}}
+
+    store = ThoughtStore()
+    events = [event async for event in store.compact_events(progress_events(), None)]
+    assert [event["progress"]["stage"] for event in events] == ["data_points", "answer"]
+    assert events[0]["context"]["thoughts_id"] == events[1]["context"]["thoughts_id"]